@@ -1,13 +1,15 @@
 import sys
 import os
 import csv
+import json
 
 import numpy
 
 import logging
 logger = logging.getLogger(__name__)
 
-# NOTE: This file depends on numpy.add.at(), which requires numpy v1.8.0
+DEFAULT_CSV_FORMAT = { 'delimiter' : '\t', 'lineterminator' : '\n' }
+DEFAULT_CHUNK_ROWS = 1000000
 
 def downsample_pointcloud( pointcloud_csv_filepath, 
                        output_filepath, 
@@ -74,14 +76,18 @@ def density_volume_from_pointcloud( pointcloud_csv_filepath,
                                     scale_xyz=None, 
                                     offset_xyz=None,
                                     volume_shape_xyz=None,
-                                    method='by_count' ): 
+                                    method='by_count',
+                                    use_cache=True,
+                                    chunk_rows=DEFAULT_CHUNK_ROWS ): 
     """
     Read the given pointcloud file and generate a downsampled intensity volume 
     according to how many points fall within each downsampled pixel.
     
     Optionally, also weight the intensity of each downsampled pixel according to the size of each point.
-    
-    NOTE: This function depends on numpy.add.at(), which requires numpy v1.8.0
+
+    The pointcloud is streamed in chunks of rows, so it never has to fit into memory.
+    If the offset or volume shape is not provided, an extra pass determines the bounding box
+    (with use_cache, that pass also creates the cache, so the csv file is only parsed once).
     
     pointcloud_csv_filepath: The input pointcloud file.  Must include
     scale_xyz: (optional) The downsampling factor, specified as a tuple in XYZ order, e.g. (10,10,1).
@@ -94,178 +100,313 @@ def density_volume_from_pointcloud( pointcloud_csv_filepath,
                - 'binary': Produce a binary image.  No scaling for downsampled voxels containing more than one detection.
                - 'by_count': Each downsampled voxel represents the count of points contained within it.
                - 'by_size': Weight the intensity of each downsampled voxel according to the size of each point (via the size_px column).    
+    use_cache, chunk_rows: See iter_pointcloud_chunks(), below.
     """
-    # Load csv data
-    pointcloud_data = array_from_csv( pointcloud_csv_filepath, 
-                                      DEFAULT_CSV_FORMAT, 
-                                      numpy.uint32 )
-
-    POINTCLOUD_COLUMNS = ["x_px", "y_px", "z_px",
-                          "size_px", 
-                          "min_x_px", "min_y_px", "min_z_px", 
-                          "max_x_px", "max_y_px", "max_z_px"]
+    assert method in ('binary', 'by_count', 'by_size'), "Unknown method: {}".format( method )
+
+    def iter_chunks():
+        return iter_pointcloud_chunks( pointcloud_csv_filepath,
+                                       DEFAULT_CSV_FORMAT,
+                                       numpy.uint32,
+                                       use_cache,
+                                       chunk_rows )
+
+    # Determine offset and volume shape if not provided.
+    if not offset_xyz or not volume_shape_xyz:
+        min_xyz, max_xyz = pointcloud_bounds( iter_chunks() )
+        if not offset_xyz:
+            offset_xyz = tuple(min_xyz)
+        if not volume_shape_xyz:
+            volume_shape_xyz = tuple( 1 + numpy.array(max_xyz) - offset_xyz )
 
-    expected_columns = set(POINTCLOUD_COLUMNS)
-    data_columns = set(pointcloud_data.dtype.fields.keys())
-    assert expected_columns.issubset( data_columns ), \
-        "Your pointcloud data file does not contain all expected columns.\n"\
-        "Expected columns: {},\n"\
-        "Your file's columns: {}"\
-        .format( POINTCLOUD_COLUMNS, pointcloud_data.dtype.fields.keys() )
-
-    # Determine offset if not provided.
-    if not offset_xyz:
-        offset_xyz = ( pointcloud_data['x_px'].min(),
-                       pointcloud_data['y_px'].min(),
-                       pointcloud_data['z_px'].min() )
-
-    # Apply offset
     logger.debug("Subtracting offset: {}".format( offset_xyz ))
-    for axis, axis_offset in zip('xyz', offset_xyz):
-        fields = [ '{}_px'.format(axis),
-                   'min_{}_px'.format(axis), 
-                   'max_{}_px'.format(axis) ]
-        for field in fields:
-            pointcloud_data[field] -= axis_offset
-
-    # Determine volume shape if not provided.
-    if not volume_shape_xyz:
-        volume_shape_xyz = ( pointcloud_data['x_px'].max(),
-                             pointcloud_data['y_px'].max(),
-                             pointcloud_data['z_px'].max() )
-        volume_shape_xyz = 1 + numpy.array(volume_shape_xyz)
-        volume_shape_xyz = tuple(volume_shape_xyz)
-
     logger.debug("Assuming original volume shape: {}".format(volume_shape_xyz))
 
     # Apply scale
     if not scale_xyz:
         logger.debug("No scale provided. Rendering at full scale.")
+        scale_xyz = (1,1,1)
         scaled_volume_shape_xyz = volume_shape_xyz
     else:
         logger.debug("Dividing by scale: {}".format( scale_xyz ))
+        scale_xyz = numpy.array(scale_xyz) * numpy.ones( (3,), dtype=numpy.array(scale_xyz).dtype )
         scaled_volume_shape_xyz = (numpy.array(volume_shape_xyz) + scale_xyz-1) / scale_xyz
-        
-        # Scale coordinates, too.
-        for axis, axis_scale in zip('xyz', scale_xyz):
-            fields = [ '{}_px'.format(axis),
-                       'min_{}_px'.format(axis), 
-                       'max_{}_px'.format(axis) ]
-            for field in fields:
-                pointcloud_data[field] /= axis_scale
-
-    # All coords
-    coordinates_zyx = ( pointcloud_data['z_px'],
-                        pointcloud_data['y_px'],
-                        pointcloud_data['x_px'] )
+    scaled_volume_shape_zyx = tuple( int(x) for x in numpy.ceil( scaled_volume_shape_xyz[::-1] ) )
 
+    # Initialize volume
     if method == 'binary':
-        scaled_volume_shape_zyx = tuple(scaled_volume_shape_xyz[::-1])
         logger.debug("Initializing binary volume of zyx shape: {}".format( scaled_volume_shape_zyx ))
         density_volume_zyx = numpy.zeros( scaled_volume_shape_zyx, dtype=numpy.uint8 )
-        density_volume_zyx[coordinates_zyx] = 1
     else:
-        # Prepare weights
-        if method == 'by_size':
-            weights = pointcloud_data['size_px']
-        elif method == 'by_count':
-            weights = 1
-        else:
-            assert False, "Unknown method: {}".format( method )
-    
-        # Initialize volume
-        scaled_volume_shape_zyx = tuple(scaled_volume_shape_xyz[::-1])
         logger.debug("Initializing volume of zyx shape: {}".format( scaled_volume_shape_zyx ))
         density_volume_zyx = numpy.zeros( scaled_volume_shape_zyx, dtype=numpy.float32 )
+    density_flat = density_volume_zyx.reshape(-1)
+
+    logger.debug("Accumulating densities...")
+    num_points = 0
+    num_outside = 0
+    for chunk in iter_chunks():
+        check_pointcloud_columns( chunk )
+        coordinates_zyx = []
+        inside = numpy.ones( (len(chunk['x_px']),), dtype=bool )
+        for axis, axis_offset, axis_scale, axis_size in reversed( zip( 'xyz', offset_xyz, scale_xyz, scaled_volume_shape_zyx[::-1] ) ):
+            coords = ( chunk['{}_px'.format(axis)].astype(numpy.int64) - axis_offset ) / axis_scale
+            coords = numpy.floor( coords ).astype(numpy.int64)
+            inside &= (coords >= 0) & (coords < axis_size)
+            coordinates_zyx.append( coords )
+        num_points += len(inside)
+        if not inside.all():
+            num_outside += len(inside) - numpy.count_nonzero(inside)
+            coordinates_zyx = [ coords[inside] for coords in coordinates_zyx ]
+
+        # Accumulate on flat indexes.  Rows with identical coordinates must all be counted,
+        #  so we sum the weights per distinct index before adding them to the volume.
+        flat_indexes = numpy.ravel_multi_index( coordinates_zyx, scaled_volume_shape_zyx )
+        if method == 'binary':
+            density_flat[flat_indexes] = 1
+            continue
+        unique_indexes, inverse = numpy.unique( flat_indexes, return_inverse=True )
+        if method == 'by_size':
+            weights = numpy.bincount( inverse, weights=chunk['size_px'][inside] )
+        else:
+            weights = numpy.bincount( inverse )
+        density_flat[unique_indexes] += weights
 
-        # We can't just use the following:
-        # density_volume_zyx[coordinates_zyx] = weights
-        # Because that wouldn't correctly handle multiple rows with identical coordinates
-        # (the multiple rows wouldn't both be counted).
-        # Instead, we must use an "unbuffered" (accumulated) operation:
-        logger.debug("Accumulating densities...")
-        numpy.add.at( density_volume_zyx, coordinates_zyx, weights )
-
+    if num_outside > 0:
+        logger.warn("{} of {} points were outside the volume and have been ignored."
+                    .format( num_outside, num_points ))
     return density_volume_zyx
 
 
-DEFAULT_CSV_FORMAT = { 'delimiter' : '\t', 'lineterminator' : '\n' }
-def array_from_csv( pointcloud_csv_filepath, 
-                    csv_format=DEFAULT_CSV_FORMAT, 
-                    column_dtypes=None, 
-                    weight_by_size=False,
-                    use_cache=True):
+POINTCLOUD_COLUMNS = ["x_px", "y_px", "z_px",
+                      "size_px", 
+                      "min_x_px", "min_y_px", "min_z_px", 
+                      "max_x_px", "max_y_px", "max_z_px"]
+
+def check_pointcloud_columns( chunk ):
+    expected_columns = set(POINTCLOUD_COLUMNS)
+    data_columns = set(chunk.keys())
+    assert expected_columns.issubset( data_columns ), \
+        "Your pointcloud data file does not contain all expected columns.\n"\
+        "Expected columns: {},\n"\
+        "Your file's columns: {}"\
+        .format( POINTCLOUD_COLUMNS, chunk.keys() )
+
+def pointcloud_bounds( chunks ):
     """
-    Read the given csv file and return a corresponding 
-    numpy structured array of all its values.  
-    The CSV file must include a header row.
-    
+    Return the (min_xyz, max_xyz) of the point coordinates in the given chunks.
+    """
+    min_xyz = None
+    max_xyz = None
+    for chunk in chunks:
+        check_pointcloud_columns( chunk )
+        if len(chunk['x_px']) == 0:
+            continue
+        chunk_min = numpy.array( [ chunk['{}_px'.format(axis)].min() for axis in 'xyz' ], dtype=numpy.int64 )
+        chunk_max = numpy.array( [ chunk['{}_px'.format(axis)].max() for axis in 'xyz' ], dtype=numpy.int64 )
+        if min_xyz is None:
+            min_xyz, max_xyz = chunk_min, chunk_max
+        else:
+            min_xyz = numpy.minimum( min_xyz, chunk_min )
+            max_xyz = numpy.maximum( max_xyz, chunk_max )
+    assert min_xyz is not None, "The pointcloud is empty."
+    return min_xyz, max_xyz
+
+
+def iter_pointcloud_chunks( pointcloud_csv_filepath,
+                            csv_format=DEFAULT_CSV_FORMAT,
+                            column_dtypes=None,
+                            use_cache=True,
+                            chunk_rows=DEFAULT_CHUNK_ROWS ):
+    """
+    Read the given csv file in chunks of (at most) chunk_rows rows.
+    Yields each chunk as a dict of {column_name : 1D array}.
+    The CSV file must include a header row, and all values must be numbers.
+    Values that don't fit into an integer column (e.g. negative or fractional values) raise a ValueError.
+
     pointcloud_csv_filepath: The input file
-    csv_format: A dict of formatting parameters for the csv module
+    csv_format: A dict of formatting parameters for the csv module (only the delimiter is used for the data rows)
     column_dtypes: Either: 
                    - a dtype object to use for all columns, or 
-                   - a dict of {column_name : dtype} to use for each column
-    weight_by_size: If True, weight the intensity of each downsampled pixel 
-                    according to the size_px of the objects that it represents.
-    use_cache: If True, attempt to use a cached copy of the imported csv data, already in .npy format.
-               Provide a string instead of a bool to specify the location of the cache file.
-               If the cache file can't be found, it will be created after csv import is complete.
+                   - a dict of {column_name : dtype} to use for each column (default: float32)
+    use_cache: If True, attempt to use a columnar cache of the imported csv data (see ColumnarCache).
+               Provide a string instead of a bool to specify the location of the cache directory.
+               If the cache can't be found, it will be created while the csv file is read.
     """
-    cache_path = pointcloud_csv_filepath + ".cache.npy"
+    cache = None
     if use_cache:
+        cache_path = pointcloud_csv_filepath + ".cache"
         if isinstance(use_cache, (str, unicode)):
             cache_path = use_cache
-        if os.path.exists(cache_path):
-            if os.path.getmtime(cache_path) > os.path.getmtime(pointcloud_csv_filepath):
-                logger.info("Loading data from cache file: {}".format( cache_path ))
-                return numpy.load(cache_path)
-    
-    # Quick first pass to get the number of points
-    # (-1 for header)
-    num_points = countlines(pointcloud_csv_filepath) - 1
+        cache = ColumnarCache( cache_path )
+        columns = cache.load( os.path.getmtime(pointcloud_csv_filepath) )
+        if columns is not None:
+            logger.info("Loading data from cache: {}".format( cache_path ))
+            num_rows = len(columns.values()[0]) if columns else 0
+            for start in range(0, num_rows, chunk_rows):
+                yield dict( (name, column[start:start+chunk_rows]) for name, column in columns.items() )
+            return
 
     logger.debug("Loading data from csv file: {}".format( pointcloud_csv_filepath ))
+    completed = False
     with open(pointcloud_csv_filepath, 'r') as f_in:
-        csv_reader = csv.reader(f_in, **csv_format)
-        column_names = csv_reader.next()
-
-        # If user provided only a single dtype, it is the default type.
-        if isinstance(column_dtypes, dict):
-            default_column_dtype = numpy.float32
-        else:
-            if column_dtypes is not None:
-                default_column_dtype = column_dtypes
-            column_dtypes = {}
-
-        if not column_dtypes:
-            column_dtypes = {}
-        for column_name in column_names:
-            if column_name not in column_dtypes:
-                column_dtypes[column_name] = default_column_dtype
-
-        dtype_list = [column_dtypes[column_name] for column_name in column_names]
-        row_dtype = zip( column_names, dtype_list )
-        csv_array_data = numpy.ndarray( shape=(num_points,), dtype=row_dtype )
-    
-        for row_index, row_data in enumerate(csv_reader):
-            csv_array_data[row_index] = tuple(int(x) for x in row_data)
+        column_names = csv.reader( [f_in.readline()], **csv_format ).next()
+        dtypes = _column_dtypes( column_names, column_dtypes )
+        if cache:
+            logger.info("Saving data to cache: {}".format( cache.path ))
+            cache.begin( zip(column_names, dtypes) )
+        try:
+            delimiter = csv_format.get('delimiter', ',')
+            # Read about chunk_rows lines at once (estimated from the size of the first lines)
+            chunk_bytes = chunk_rows * 8 * max(1, len(column_names))
+            while True:
+                lines = f_in.readlines( chunk_bytes )
+                if not lines:
+                    break
+                chunk = _parse_csv_lines( lines, column_names, dtypes, delimiter )
+                if cache:
+                    cache.append( chunk )
+                num_rows = len(chunk[column_names[0]])
+                for start in range(0, num_rows, chunk_rows):
+                    yield dict( (name, column[start:start+chunk_rows]) for name, column in chunk.items() )
+            completed = True
+        finally:
+            # If the caller stopped early, the cache is incomplete.
+            if cache:
+                if completed:
+                    cache.commit()
+                else:
+                    cache.abort()
+
+def _column_dtypes( column_names, column_dtypes ):
+    # If user provided only a single dtype, it is the default type.
+    if isinstance(column_dtypes, dict):
+        default_column_dtype = numpy.float32
+    else:
+        default_column_dtype = column_dtypes or numpy.float32
+        column_dtypes = {}
+    return [ numpy.dtype( column_dtypes.get(name, default_column_dtype) ) for name in column_names ]
 
-    if use_cache:
-        logger.info("Saving data to cache file: {}".format( cache_path ))
-        numpy.save(cache_path, csv_array_data)
-    
-    return csv_array_data
+def _parse_csv_lines( lines, column_names, dtypes, delimiter ):
+    """
+    Parse the given lines of numbers into a dict of {column_name : array}.
+    """
+    lines = [line for line in lines if line.strip()]
+    text = ''.join(lines)
+    if delimiter.strip():
+        text = text.replace(delimiter, ' ')
+    values = numpy.fromstring( text, dtype=numpy.float64, sep=' ' )
+    if len(values) != len(lines) * len(column_names):
+        raise ValueError("Could not parse the csv data: Expected {} numbers in each row."
+                         .format( len(column_names) ))
+    values = values.reshape( (len(lines), len(column_names)) )
+    columns = {}
+    for i, (name, dtype) in enumerate( zip(column_names, dtypes) ):
+        column = values[:, i]
+        if dtype.kind in 'iu':
+            # Don't silently truncate or wrap values that don't fit into an integer column.
+            info = numpy.iinfo( dtype )
+            if not ( ( column == numpy.floor(column) ) & ( column >= info.min ) & ( column <= info.max ) ).all():
+                raise ValueError("Could not parse the csv data: Column {} must contain {} values."
+                                 .format( name, dtype.name ))
+        columns[name] = column.astype(dtype)
+    return columns
+
+
+class ColumnarCache(object):
+    """
+    A directory with one raw binary file per column and a small json header,
+    which is written last, so incomplete caches are never loaded.
+    The columns are loaded as read-only memory maps.
+    """
+    HEADER_FILENAME = "columns.json"
+
+    def __init__(self, path):
+        self.path = path
+        self._files = None
+
+    def _column_path(self, index):
+        return os.path.join( self.path, "column-{}.bin".format(index) )
+
+    def load(self, source_mtime):
+        """
+        Return a dict of {column_name : memmap}, or None if there is no
+        complete cache that is newer than the source file.
+        """
+        header_path = os.path.join( self.path, self.HEADER_FILENAME )
+        if not os.path.exists( header_path ) or os.path.getmtime( header_path ) <= source_mtime:
+            return None
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        columns = {}
+        for index, (name, dtype) in enumerate( header['columns'] ):
+            if header['num_rows'] == 0:
+                columns[str(name)] = numpy.zeros( (0,), dtype=dtype )
+            else:
+                columns[str(name)] = numpy.memmap( self._column_path(index), dtype=dtype, mode='r',
+                                                   shape=(header['num_rows'],) )
+        return columns
+
+    def begin(self, columns):
+        """
+        Start a new cache with the given (column_name, dtype) columns.
+        """
+        if not os.path.exists( self.path ):
+            os.makedirs( self.path )
+        header_path = os.path.join( self.path, self.HEADER_FILENAME )
+        if os.path.exists( header_path ):
+            os.remove( header_path )
+        self._columns = [ (name, numpy.dtype(dtype)) for name, dtype in columns ]
+        self._files = [ open(self._column_path(index), 'wb') for index in range(len(columns)) ]
+        self._num_rows = 0
+
+    def append(self, chunk):
+        for f, (name, dtype) in zip( self._files, self._columns ):
+            numpy.asarray( chunk[name], dtype=dtype ).tofile(f)
+        self._num_rows += len( chunk[self._columns[0][0]] )
+
+    def commit(self):
+        self._close()
+        header = { 'num_rows' : self._num_rows,
+                   'columns' : [ (name, dtype.str) for name, dtype in self._columns ] }
+        with open( os.path.join( self.path, self.HEADER_FILENAME ), 'w' ) as f:
+            json.dump( header, f )
+
+    def abort(self):
+        self._close()
+        for index in range(len(self._columns)):
+            os.remove( self._column_path(index) )
+
+    def _close(self):
+        for f in self._files:
+            f.close()
+        self._files = None
 
 
-def countlines(file_path):
+def array_from_csv( pointcloud_csv_filepath, 
+                    csv_format=DEFAULT_CSV_FORMAT, 
+                    column_dtypes=None, 
+                    use_cache=True ):
     """
-    Return the number of lines in the given file.
+    Read the given csv file and return a corresponding 
+    numpy structured array of all its values.  
+    The whole file must fit into memory; use iter_pointcloud_chunks() to stream it instead.
+
+    Parameters: See iter_pointcloud_chunks()
     """
-    line_count = 0
-    with open(file_path, 'r') as f:
-        for _ in f:
-            line_count += 1
-    return line_count
+    chunks = list( iter_pointcloud_chunks( pointcloud_csv_filepath, csv_format, column_dtypes, use_cache ) )
+    with open(pointcloud_csv_filepath, 'r') as f_in:
+        column_names = csv.reader( [f_in.readline()], **csv_format ).next()
+    dtypes = _column_dtypes( column_names, column_dtypes )
+    num_points = sum( len(chunk[column_names[0]]) for chunk in chunks )
+    csv_array_data = numpy.ndarray( shape=(num_points,), dtype=zip( column_names, dtypes ) )
+    start = 0
+    for chunk in chunks:
+        stop = start + len(chunk[column_names[0]])
+        for name in column_names:
+            csv_array_data[name][start:stop] = chunk[name]
+        start = stop
+    return csv_array_data
 
 
 def export_hdf5( density_volume_zyx, output_filepath, dset_name ):
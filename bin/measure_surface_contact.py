@@ -1,3 +1,5 @@
+import itertools
+
 import numpy
 import vigra
 
@@ -34,19 +36,13 @@ def measure_surface_contact_B( label_volume, object_label_1, object_label_2, con
     
     Does not yield the same results as method 1, above.
     """
-    assert object_label_1 <= 255
-    assert object_label_2 <= 255
-    object_label_1 = numpy.uint8(object_label_1)
-    object_label_2 = numpy.uint8(object_label_2)
-    
     # Reduce to 3D if necessary: remove singleton axes.
     label_volume = label_volume.squeeze()
     assert label_volume.ndim == 3
     
-    label_volume = numpy.asarray(label_volume, numpy.uint8)
-    
     # Remove everything but object 1
-    vol_1 = numpy.where( label_volume == object_label_1, numpy.uint8(object_label_1), numpy.uint8(0) )
+    # (as a binary uint8 volume, so labels of any size are supported)
+    vol_1 = numpy.asarray( label_volume == object_label_1, numpy.uint8 )
 
     # Generate a "shell" of pixels around object 1 via a dilation
     dilated = vigra.filters.multiBinaryDilation(vol_1, contact_distance)
@@ -61,6 +57,176 @@ def measure_surface_contact_B( label_volume, object_label_1, object_label_2, con
     contact_area = contact_volume.sum()
     return contact_area
 
+# Both of the above need a full-volume operation per pair of objects.
+# The following measures the contacts of all pairs of objects in a single sweep over neighboring voxels.
+
+# Offsets to the neighbors of a voxel
+NEIGHBOR_OFFSETS = {
+    # 6-neighborhood: voxels sharing a face
+    'face' : [ o for o in itertools.product( (-1,0,1), repeat=3 ) if numpy.abs(o).sum() == 1 ],
+    # 18-neighborhood: voxels sharing a face or an edge (i.e. at a distance of 1 or sqrt(2))
+    'edge' : [ o for o in itertools.product( (-1,0,1), repeat=3 ) if numpy.abs(o).sum() in (1,2) ] }
+
+CONTACT_TABLE_DTYPE = [ ('label_a', numpy.uint64), 
+                        ('label_b', numpy.uint64),
+                        ('adjacency', numpy.uint64),
+                        ('voxels_a', numpy.uint64),
+                        ('voxels_b', numpy.uint64) ]
+
+def measure_all_contacts( label_volume, connectivity='face', block_depth=64, background_label=0 ):
+    """
+    Find all pairs of touching objects and measure their contact, in a single pass over the volume.
+
+    The volume is processed in blocks of block_depth slices along the first (non-singleton) axis
+    (plus one slice of halo on each side), so label_volume may also be an h5py dataset that doesn't fit into memory.
+    Singleton axes (e.g. t and c of a tzyxc volume) are ignored.
+
+    connectivity: 'face' or 'edge' (see NEIGHBOR_OFFSETS).
+    background_label: Contacts with this label are ignored (None: include all labels).
+
+    Returns an edge table (a structured array, see CONTACT_TABLE_DTYPE) with one row for each pair of
+    touching objects label_a < label_b, sorted by (label_a, label_b):
+    - adjacency: The number of neighboring voxel pairs (one voxel in each object).
+                 With connectivity='face', this is the contact area in voxel faces.
+    - voxels_a: The number of voxels of label_a with a neighbor in label_b.
+    - voxels_b: The number of voxels of label_b with a neighbor in label_a.
+                With connectivity='edge', this equals measure_surface_contact_A( vol, label_a, label_b, 1 ).
+    """
+    # Reduce to 3D if necessary: remove singleton axes.
+    # (By index, since h5py datasets can't be squeezed.)
+    spatial_axes = [ axis for axis, size in enumerate( label_volume.shape ) if size != 1 ]
+    assert len(spatial_axes) == 3, "Expected a 3D volume, got shape {}".format( label_volume.shape )
+    depth = label_volume.shape[ spatial_axes[0] ]
+    offsets = NEIGHBOR_OFFSETS[connectivity]
+
+    block_results = []
+    for z_start in range( 0, depth, block_depth ):
+        z_stop = min( z_start + block_depth, depth )
+        block_results.append( _measure_block_contacts( label_volume, spatial_axes, z_start, z_stop, offsets, background_label ) )
+
+    # Sum up the directed counts (own label, neighbor label) of all blocks
+    own, neighbor, adjacency, voxels = map( numpy.concatenate, zip( *block_results ) )
+    own, neighbor, (adjacency, voxels) = _sum_by_pair( own, neighbor, (adjacency, voxels) )
+
+    # Each directed pair (a,b) has a reverse pair (b,a), since the neighborhoods are symmetric.
+    forward = own < neighbor
+    backward = ~forward
+    table = numpy.zeros( ( numpy.count_nonzero(forward), ), dtype=CONTACT_TABLE_DTYPE )
+    table['label_a'] = own[forward]
+    table['label_b'] = neighbor[forward]
+    table['adjacency'] = adjacency[forward]
+    table['voxels_a'] = voxels[forward]
+    # _sum_by_pair() sorted by (own, neighbor), so sort the reverse pairs by (neighbor, own) to match.
+    order = numpy.lexsort( ( own[backward], neighbor[backward] ) )
+    assert ( neighbor[backward][order] == table['label_a'] ).all()
+    table['voxels_b'] = voxels[backward][order]
+    return table
+
+def _read_slab( label_volume, spatial_axes, start, stop ):
+    """
+    Read the slices [start, stop) along the first spatial axis as a 3D array (without the singleton axes).
+    """
+    index = [ 0 ] * len( label_volume.shape )
+    for axis in spatial_axes:
+        index[axis] = slice(None)
+    index[ spatial_axes[0] ] = slice( start, stop )
+    return numpy.asarray( label_volume[ tuple(index) ] )
+
+def _measure_block_contacts( label_volume, spatial_axes, z_start, z_stop, offsets, background_label ):
+    """
+    Return the (own label, neighbor label, adjacency, voxels) counts of the voxels in slices [z_start, z_stop).
+    """
+    read_start = max( z_start - 1, 0 )
+    read_stop = min( z_stop + 1, label_volume.shape[ spatial_axes[0] ] )
+    block = _read_slab( label_volume, spatial_axes, read_start, read_stop )
+
+    # Work with dense label ids, so that pairs (and voxel/label pairs) can be encoded as single int64 keys.
+    labels, ids = numpy.unique( block, return_inverse=True )
+    ids = ids.reshape( block.shape ).astype( numpy.int64 )
+    num_labels = len(labels)
+    background_id = -1
+    if background_label is not None and background_label in labels:
+        background_id = numpy.searchsorted( labels, background_label )
+
+    pair_keys = []
+    voxel_keys = []
+    for offset in offsets:
+        # The voxels we own whose neighbor at the given offset is within the block
+        source_start = [ max( z_start - read_start, -offset[0] ) ] + [ max( 0, -d ) for d in offset[1:] ]
+        source_stop = [ min( z_stop - read_start, block.shape[0] - offset[0] ) ] + \
+                      [ size - max( 0, d ) for size, d in zip( block.shape[1:], offset[1:] ) ]
+        source = tuple( slice(start, stop) for start, stop in zip( source_start, source_stop ) )
+        target = tuple( slice(start + d, stop + d) for start, stop, d in zip( source_start, source_stop, offset ) )
+
+        own = ids[source]
+        neighbor = ids[target]
+        contact = (own != neighbor) & (own != background_id) & (neighbor != background_id)
+        coords = numpy.nonzero( contact )
+        if len(coords[0]) == 0:
+            continue
+        coords = tuple( c + start for c, start in zip( coords, source_start ) )
+        neighbor = neighbor[contact]
+        pair_keys.append( own[contact] * num_labels + neighbor )
+        voxel_keys.append( numpy.ravel_multi_index( coords, block.shape ) * num_labels + neighbor )
+
+    if not pair_keys:
+        empty = numpy.zeros( (0,), dtype=numpy.uint64 )
+        return empty, empty, empty, empty
+
+    pair_keys, adjacency = _unique_counts( numpy.concatenate( pair_keys ) )
+
+    # Count each voxel only once per neighboring label
+    voxel_keys = numpy.unique( numpy.concatenate( voxel_keys ) )
+    own = ids.reshape(-1)[ voxel_keys // num_labels ]
+    voxel_pair_keys, voxels = _unique_counts( own * num_labels + voxel_keys % num_labels )
+    assert ( voxel_pair_keys == pair_keys ).all()
+
+    own = labels[ pair_keys // num_labels ].astype( numpy.uint64 )
+    neighbor = labels[ pair_keys % num_labels ].astype( numpy.uint64 )
+    return own, neighbor, adjacency.astype( numpy.uint64 ), voxels.astype( numpy.uint64 )
+
+def _unique_counts( keys ):
+    """
+    Return the sorted distinct keys and how often each of them occurs.
+    (Same as numpy.unique( keys, return_counts=True ), which requires numpy >= 1.9.)
+    """
+    keys = numpy.sort( keys )
+    if len(keys) == 0:
+        return keys, numpy.zeros( (0,), dtype=numpy.int64 )
+    starts = numpy.flatnonzero( numpy.concatenate( ( [True], keys[1:] != keys[:-1] ) ) )
+    counts = numpy.diff( numpy.append( starts, len(keys) ) )
+    return keys[starts], counts
+
+def _sum_by_pair( labels_1, labels_2, values ):
+    """
+    Group by distinct (labels_1, labels_2) pairs, sorted by labels_1, then labels_2.
+    Returns the distinct pairs and the sums of each array in values.
+    """
+    labels, ids = numpy.unique( numpy.concatenate( (labels_1, labels_2) ), return_inverse=True )
+    ids = ids.astype( numpy.int64 )
+    keys = ids[:len(labels_1)] * len(labels) + ids[len(labels_1):]
+    keys, inverse = numpy.unique( keys, return_inverse=True )
+    sums = tuple( numpy.bincount( inverse, weights=v, minlength=len(keys) ).astype( numpy.uint64 ) for v in values )
+    return labels[ keys // max(len(labels), 1) ], labels[ keys % max(len(labels), 1) ], sums
+
+def validate_contact_table( label_volume, table, num_pairs=10 ):
+    """
+    Compare (up to) num_pairs random rows of a contact table from measure_all_contacts( connectivity='edge' )
+    with measure_surface_contact_A().  Returns the list of mismatching (label_a, label_b, expected, measured).
+    """
+    mismatches = []
+    rows = numpy.random.permutation( len(table) )[:num_pairs]
+    for row in table[rows]:
+        for label_1, label_2, measured in [ ( row['label_a'], row['label_b'], row['voxels_b'] ),
+                                            ( row['label_b'], row['label_a'], row['voxels_a'] ) ]:
+            expected = measure_surface_contact_A( label_volume, label_1, label_2, contact_distance=1 )
+            if expected != measured:
+                mismatches.append( ( label_1, label_2, expected, measured ) )
+    return mismatches
+
+def write_contact_table( table, csv_path ):
+    numpy.savetxt( csv_path, table, fmt='%d', delimiter=',', header=','.join( table.dtype.names ), comments='' )
+
 if __name__ == "__main__":
     import h5py
     import argparse
@@ -68,20 +234,42 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('h5_volume_path', help='A path to the hdf5 volume, with internal dataset name, e.g. /tmp/myfile.h5/myvolume')
-    parser.add_argument('object_label_1', help='The label value of the first object for comparison')
-    parser.add_argument('object_label_2', help='The label value of the second object for comparison')
+    parser.add_argument('object_label_1', nargs='?', help='The label value of the first object for comparison')
+    parser.add_argument('object_label_2', nargs='?', help='The label value of the second object for comparison')
+    parser.add_argument('--all-contacts-csv', help='Instead of a single pair, measure the contacts of all pairs of objects '
+                                                   'and write them to the given csv file.')
+    parser.add_argument('--connectivity', choices=['face', 'edge'], default='face', help='Neighborhood for --all-contacts-csv')
+    parser.add_argument('--block-depth', type=int, default=64, help='Number of slices to process at once for --all-contacts-csv')
+    parser.add_argument('--validate', type=int, default=0, help='Check this many pairs of the contact table against '
+                                                                'measure_surface_contact_A() (requires --connectivity=edge)')
     
     parsed_args = parser.parse_args()
     h5_path_comp = PathComponents(parsed_args.h5_volume_path)
-    object_label_1 = int(parsed_args.object_label_1)
-    object_label_2 = int(parsed_args.object_label_2)
+
+    if parsed_args.all_contacts_csv:
+        with h5py.File(h5_path_comp.externalPath, 'r') as f:
+            dataset = f[h5_path_comp.internalPath]
+            table = measure_all_contacts(dataset, parsed_args.connectivity, parsed_args.block_depth)
+            write_contact_table(table, parsed_args.all_contacts_csv)
+            print "Found {} contacts.".format( len(table) )
+            if parsed_args.validate:
+                assert parsed_args.connectivity == 'edge', "Validation requires --connectivity=edge"
+                mismatches = validate_contact_table(dataset[:], table, parsed_args.validate)
+                for mismatch in mismatches:
+                    print "Mismatch for labels {}, {}: expected {}, measured {}".format( *mismatch )
+                print "Validated {} pairs, {} mismatches.".format( min(len(table), parsed_args.validate), len(mismatches) )
+    else:
+        assert parsed_args.object_label_1 is not None and parsed_args.object_label_2 is not None, \
+            "Please provide two object labels (or use --all-contacts-csv)"
+        object_label_1 = int(parsed_args.object_label_1)
+        object_label_2 = int(parsed_args.object_label_2)
     
-    with h5py.File(h5_path_comp.externalPath, 'r') as f:
-        volume = f[h5_path_comp.internalPath][:]
+        with h5py.File(h5_path_comp.externalPath, 'r') as f:
+            volume = f[h5_path_comp.internalPath][:]
 
-    contact_area = measure_surface_contact_A(volume, object_label_1, object_label_2, contact_distance=1)
+        contact_area = measure_surface_contact_A(volume, object_label_1, object_label_2, contact_distance=1)
 
-    # Alternative implementation:
-    #contact_area = measure_surface_contact_B(volume, object_label_1, object_label_2, contact_distance=1)
+        # Alternative implementation:
+        #contact_area = measure_surface_contact_B(volume, object_label_1, object_label_2, contact_distance=1)
 
-    print contact_area
+        print contact_area
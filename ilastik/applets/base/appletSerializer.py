@@ -29,12 +29,16 @@ from ilastik.utility.maybe import maybe
 import os
 import re
 import tempfile
+import collections
 import h5py
 import numpy
 import warnings
 import cPickle as pickle
 
+from functools import partial
+
 from lazyflow.roi import TinyVector, roiToSlice, sliceToRoi
+from lazyflow.request import Request
 from lazyflow.utility import timeLogged
 from lazyflow.slot import OutputSlot
 
@@ -340,23 +344,98 @@ class SerialListSlot(SerialSlot):
         self.dirty = False
 
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    Saving is incremental: dirty notifications from each lane of the slot are
+    recorded, and if the project file already contains this slot's group, only
+    the blocks that intersect a dirty region (or that were added or removed since
+    the last save) are rewritten.  All other blocks are left in place.
+
+    Blocks are requested in parallel (on the lazyflow request pool), but all
+    reads and writes of the hdf5 file happen in the thread that calls
+    serialize() or deserialize().
+
+    """
+    #: Maximum number of block requests that are in flight (or waiting to be written) at once.
+    MAX_PENDING_BLOCKS = 32
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
-                 default=None, depends=None, selfdepends=True, shrink_to_bb=False):
+                 default=None, depends=None, selfdepends=True, shrink_to_bb=False,
+                 compression=None, compression_opts=None, chunks=None):
         """
         :param blockslot: provides non-zero blocks.
         :param shrink_to_bb: If true, reduce each block of data from the slot to  
                              its nonzero bounding box before feeding saving it.
+        :param compression: The h5py compression filter for the block datasets ('gzip', 'lzf' or 'none').
+                            If None, the 'block_compression' setting from the ilastik config file is used.
+        :param compression_opts: The compression level (gzip only).
+                                 If None, the 'block_compression_level' setting from the ilastik config file is used.
+        :param chunks: The chunk shape of the block datasets, or True to let h5py choose it.
+                       If None, each compressed block is stored as a single chunk.
 
         """
         assert isinstance(slot, OutputSlot), "slot is of wrong type: '{}' is not an OutputSlot".format( slot.name )
+
+        # Dirty regions since the last save, as (start, stop) tuples for each lane index.
+        self._dirtyBlockRois = collections.defaultdict(list)
+        # Until we have saved or loaded, we can't know which blocks in the file are up-to-date.
+        self._rewriteAll = True
+
         super(SerialBlockSlot, self).__init__(
             slot, inslot, name, subname, default, depends, selfdepends
         )
         self.blockslot = blockslot
-        self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
 
+        if compression is None:
+            compression = ilastik_config.get("project_file", "block_compression")
+        if compression == 'none':
+            compression = None
+        assert compression in (None, 'gzip', 'lzf'), "Unknown block compression: {}".format( compression )
+        if compression == 'gzip' and compression_opts is None:
+            compression_opts = ilastik_config.getint("project_file", "block_compression_level")
+        self._compression = compression
+        self._compression_opts = compression_opts
+        self._chunks = chunks
+
+    def _bind(self, slot=None):
+        super(SerialBlockSlot, self)._bind(slot)
+        slot = maybe(slot, self.slot)
+        assert slot.level == 1
+
+        # Record the dirty region of each lane, including lanes that already exist.
+        def bindLane(slot, index, size):
+            slot[index].notifyDirty(self._setBlocksDirty)
+        for subslot in slot:
+            subslot.notifyDirty(self._setBlocksDirty)
+        slot.notifyInserted(bindLane)
+
+        # Inserting or removing lanes changes the lane indexes.
+        def rewriteAll(*args):
+            if not self.ignoreDirty:
+                self._rewriteAll = True
+        slot.notifyInserted(rewriteAll)
+        slot.notifyRemoved(rewriteAll)
+
+    def _setBlocksDirty(self, subslot, roi, **kwargs):
+        if self.ignoreDirty:
+            return
+        self.dirty = True
+        for index, s in enumerate(self.slot):
+            if s is subslot:
+                self._dirtyBlockRois[index].append( (tuple(roi.start), tuple(roi.stop)) )
+
+    def _resetDirtyBlocks(self):
+        self._dirtyBlockRois.clear()
+        self._rewriteAll = False
+
+    @staticmethod
+    def _intersectsAny(start, stop, rois):
+        for roiStart, roiStop in rois:
+            if (numpy.less(start, roiStop) & numpy.less(roiStart, stop)).all():
+                return True
+        return False
+
     def shouldSerialize(self, group):
         # Should this be a docstring?
         #
@@ -393,22 +472,48 @@ class SerialBlockSlot(SerialSlot):
             else:
                 logger.debug("Found \"" + subname + "\" from \"" + repr(mygroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
 
+            # Blocks are not necessarily named in order (see _serializeLane), so we can only compare the counts.
             subgroup = mygroup[subname]
-
             nonZeroBlocks = self.blockslot[index].value
-            for blockIndex in xrange(len(nonZeroBlocks)):
-                blockName = 'block{:04d}'.format(blockIndex)
-
-                if blockName not in subgroup:
-                    logger.debug("Missing \"" + blockName + "\" from \"" + repr(subgroup) + "\". Should serialize.")
-                    return True
-                else:
-                    logger.debug("Found \"" + blockName + "\" from \"" + repr(subgroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
+            if len(subgroup) < len(nonZeroBlocks):
+                logger.debug("Missing blocks from \"" + repr(subgroup) + "\". Should serialize.")
+                return True
 
         logger.debug("Everything belonging to BlockSlot \"" + self.name + "\" appears to be in order. Should not serialize.")
 
         return False
 
+    def serialize(self, group):
+        """Like SerialSlot.serialize(), but only rewrites the blocks
+        that changed since the last save, if possible.
+
+        """
+        if not self.shouldSerialize(group):
+            return
+        if self._rewriteAll or self.name not in group or not self.slot.ready():
+            deleteIfPresent(group, self.name)
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
+        else:
+            self._serializeIncrementally(group[self.name])
+        self._resetDirtyBlocks()
+        self.dirty = False
+
+    @timeLogged(logger, logging.DEBUG)
+    def _serializeIncrementally(self, mygroup):
+        logger.debug("Updating BlockSlot: {}".format( self.name ))
+        num = len(self.blockslot)
+        for index in range(num):
+            subname = self.subname.format(index)
+            if subname in mygroup:
+                self._serializeLane(mygroup[subname], index, self._dirtyBlockRois[index])
+            else:
+                self._serializeLane(mygroup.create_group(subname), index, None)
+
+        # Remove the groups of lanes that no longer exist.
+        for index in range(num, len(mygroup)):
+            deleteIfPresent(mygroup, self.subname.format(index))
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
@@ -417,30 +522,85 @@ class SerialBlockSlot(SerialSlot):
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                if not isinstance(slicing[0], slice):
-                    slicing = roiToSlice(*slicing)
-
-                block = self.slot[index][slicing].wait()
-                blockName = 'block{:04d}'.format(blockIndex)
-
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                subgroup.create_dataset(blockName, data=block)
-                subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+            self._serializeLane(subgroup, index, None)
+
+    def _serializeLane(self, subgroup, index, dirtyRois):
+        """Bring the blocks stored in subgroup up-to-date with lane 'index' of the slot.
+
+        :param dirtyRois: regions that changed since the subgroup was written.
+            If None, the subgroup is assumed to be empty.
+
+        """
+        # Map each non-zero block to its (unshrunk) slicing string.
+        blockSlicings = collections.OrderedDict()
+        for slicing in self.blockslot[index].value:
+            if not isinstance(slicing[0], slice):
+                slicing = roiToSlice(*slicing)
+            blockSlicings[slicingToString(slicing)] = slicing
+
+        if dirtyRois is not None:
+            # Drop stored blocks that are now empty or that were edited.
+            # (Blocks written by older versions don't record their source block, so they are always dropped.)
+            for blockName, blockDataset in subgroup.items():
+                sourceSlicing = blockDataset.attrs.get('sourceBlockSlice', None)
+                if sourceSlicing is not None and sourceSlicing in blockSlicings:
+                    slicing = blockSlicings[sourceSlicing]
+                    start, stop = sliceToRoi( slicing, (0,)*len(slicing) )
+                    if not self._intersectsAny(start, stop, dirtyRois):
+                        del blockSlicings[sourceSlicing]
+                        continue
+                del subgroup[blockName]
+
+        # Write the new and changed blocks under names that aren't in use yet.
+        blockNames = []
+        blockIndex = 0
+        for slicing in blockSlicings.values():
+            while 'block{:04d}'.format(blockIndex) in subgroup:
+                blockIndex += 1
+            blockNames.append( 'block{:04d}'.format(blockIndex) )
+            blockIndex += 1
+        self._writeBlocks(subgroup, index, zip(blockNames, blockSlicings.values()))
+
+    def _writeBlocks(self, subgroup, index, namedSlicings):
+        """Request the given blocks in parallel and write each one to the
+        subgroup (in order) as soon as it is ready.
+
+        """
+        pending = collections.deque()
+        for blockName, slicing in namedSlicings:
+            req = self.slot[index][slicing]
+            req.submit()
+            pending.append( (blockName, slicing, req) )
+            if len(pending) >= self.MAX_PENDING_BLOCKS:
+                self._writeBlock(subgroup, *pending.popleft())
+        while pending:
+            self._writeBlock(subgroup, *pending.popleft())
+
+    def _writeBlock(self, subgroup, blockName, slicing, req):
+        block = req.wait()
+        sourceSlicing = slicing
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+                block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+                block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+                
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+
+        chunks = self._chunks
+        if chunks is None and self._compression is not None:
+            chunks = block.shape
+        subgroup.create_dataset(blockName, data=block, chunks=chunks,
+                                compression=self._compression, compression_opts=self._compression_opts)
+        subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+        subgroup[blockName].attrs['sourceBlockSlice'] = slicingToString(sourceSlicing)
 
     @timeLogged(logger, logging.DEBUG)
     def _deserialize(self, mygroup, slot):
@@ -454,11 +614,26 @@ class SerialBlockSlot(SerialSlot):
         index_capture = re.compile(r'[^0-9]*(\d*).*')
         def extract_index(s):
             return int(index_capture.match(s).groups()[0])
+        # Blocks are read from the file in this thread, 
+        #  but they are copied into the slot in parallel.
+        pending = collections.deque()
         for index, t in enumerate(sorted(mygroup.items(), key=lambda (k,v): extract_index(k))):
             groupName, labelGroup = t
             for blockData in labelGroup.values():
                 slicing = stringToSlicing(blockData.attrs['blockSlice'])
-                self.inslot[index][slicing] = blockData[...]
+                req = Request( partial(self.inslot[index].__setitem__, slicing, blockData[...]) )
+                req.submit()
+                pending.append( req )
+                if len(pending) >= self.MAX_PENDING_BLOCKS:
+                    pending.popleft().wait()
+        while pending:
+            pending.popleft().wait()
+
+    def deserialize(self, group):
+        super(SerialBlockSlot, self).deserialize(group)
+        if self.name in group:
+            # The file now matches our state.
+            self._resetDirtyBlocks()
 
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
@@ -468,13 +643,33 @@ class SerialHdf5BlockSlot(SerialBlockSlot):
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
-            cleanBlockRois = self.blockslot[index].value
-            for roi in cleanBlockRois:
-                # The protocol for hdf5 slots is that they create appropriately 
-                #  named datasets within the subgroup that we provide via writeInto()
-                req = self.slot[index]( *roi )
-                req.writeInto( subgroup )
-                req.wait()
+            self._serializeLane(subgroup, index, None)
+
+    def _serializeLane(self, subgroup, index, dirtyRois):
+        # Blocks are stored under the string representation of their roi.
+        cleanBlockRois = collections.OrderedDict()
+        for roi in self.blockslot[index].value:
+            cleanBlockRois[self._roiKey(roi)] = roi
+
+        if dirtyRois is not None:
+            # Drop stored blocks that are no longer clean or that were recomputed.
+            for blockRoiString in subgroup.keys():
+                key = self._roiKey( eval(blockRoiString) )
+                if key in cleanBlockRois and not self._intersectsAny(key[0], key[1], dirtyRois):
+                    del cleanBlockRois[key]
+                else:
+                    del subgroup[blockRoiString]
+
+        for roi in cleanBlockRois.values():
+            # The protocol for hdf5 slots is that they create appropriately 
+            #  named datasets within the subgroup that we provide via writeInto()
+            req = self.slot[index]( *roi )
+            req.writeInto( subgroup )
+            req.wait()
+
+    @staticmethod
+    def _roiKey(roi):
+        return ( tuple(map(int, roi[0])), tuple(map(int, roi[1])) )
 
     def _deserialize(self, mygroup, slot):
         num = len(mygroup)
@@ -39,7 +39,8 @@ class BlockwiseObjectClassificationApplet(StandardApplet):
 
     @property
     def broadcastingSlots(self):
-        return ['Classifier', 'LabelsCount', 'SelectedFeatures', 'BlockShape3dDict', 'HaloPadding3dDict']
+        return ['Classifier', 'LabelsCount', 'SelectedFeatures', 'BlockShape3dDict', 'HaloPadding3dDict',
+                'PipelineRamBudgetMb', 'SpillDirectory']
     
     @property
     def singleLaneGuiClass(self):
@@ -19,16 +19,22 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 # Built-in
+import os
 import logging
+import tempfile
+import threading
+import collections
+import multiprocessing
 
 # Third-party
 import numpy
+import h5py
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.request import RequestLock, RequestPool
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice, TinyVector
-from lazyflow.operators import OpSubRegion, OpMultiArrayStacker, OpArrayCache
+from lazyflow.operators import OpSubRegion, OpArrayCache
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 
@@ -37,6 +43,8 @@ from ilastik.utility import bind
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel, OpMultiRelabelSegmentation
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.config import cfg as ilastik_config
+from opHaloSlabCache import OpHaloSlabCache
 
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
@@ -138,11 +146,7 @@ class OpSingleBlockObjectPrediction( Operator ):
         self._opProbabilityChannelsToImage.ObjectMaps.connect( self._opPredict.ProbabilityChannels )
         self._opProbabilityChannelsToImage.Features.connect( self._opExtract.RegionFeatures )
         
-        self._opProbabilityChannelStacker = OpMultiArrayStacker( parent=self )
-        self._opProbabilityChannelStacker.Images.connect( self._opProbabilityChannelsToImage.Output )
-        self._opProbabilityChannelStacker.AxisFlag.setValue('c')
-        
-        self.ProbabilityChannelImage.connect( self._opProbabilityChannelStacker.Output )
+        self.ProbabilityChannelImage.connect( self._opProbabilityChannelsToImage.StackedOutput )
 
     def setupOutputs(self):
         tagged_input_shape = self.RawImage.meta.getTaggedShape()
@@ -221,9 +225,68 @@ class OpSingleBlockObjectPrediction( Operator ):
         return halo_roi
 
 
+class SpilledBlockPredictions(object):
+    """
+    A temporary hdf5 file that keeps the prediction images of blocks whose 
+    pipelines were evicted, so they can be served again without rebuilding the pipeline.
+
+    Each clear() (and close()) starts a new generation.  A prediction that was computed
+    before the last clear() (i.e. before the data became dirty) is not stored.
+    """
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp( suffix='.h5', prefix='spilled-block-predictions-', dir=directory )
+        os.close(fd)
+        self._file = h5py.File( self.path, 'w' )
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def _name(self, block_start):
+        return "_".join( str(x) for x in block_start )
+
+    def __contains__(self, block_start):
+        with self._lock:
+            return self._name(block_start) in self._file
+
+    def store(self, block_start, data, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            name = self._name(block_start)
+            if name in self._file:
+                del self._file[name]
+            self._file.create_dataset( name, data=data, chunks=True, compression='gzip', compression_opts=1 )
+
+    def read(self, block_start, block_relative_roi, destination):
+        """
+        Read the stored prediction of a block into destination.
+        Returns False if the block is not stored (anymore).
+        """
+        with self._lock:
+            name = self._name(block_start)
+            if name not in self._file:
+                return False
+            destination[:] = self._file[name][roiToSlice(*block_relative_roi)]
+        return True
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            for name in self._file.keys():
+                del self._file[name]
+
+    def close(self):
+        with self._lock:
+            self.generation += 1
+            self._file.close()
+        os.remove(self.path)
+
 class OpBlockwiseObjectClassification( Operator ):
     """
     Handles prediction ONLY.  Training must be provided externally and loaded via the serializer.
+
+    Memory: the block pipelines and the two halo slab caches (raw and binary) together stay within
+    PipelineRamBudgetMb, except for the blocks that are being computed (at most MAX_BLOCKS_IN_FLIGHT)
+    and the most recently used block.
     """
     RawImage = InputSlot()
     BinaryImage = InputSlot()
@@ -233,14 +296,46 @@ class OpBlockwiseObjectClassification( Operator ):
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
 
+    # If non-zero, the (estimated) memory of the block pipelines and both halo slab caches is kept within this budget:
+    #  the slab caches get at most SLAB_CACHE_BUDGET_FRACTION of it, and the least recently used block pipelines
+    #  are deleted when they exceed the rest.  (Blocks that are currently being computed and the most recently
+    #  used block are never deleted.)
+    #  Defaults to ram_budget_mb in the [blockwise_object_classification] config section.
+    PipelineRamBudgetMb = InputSlot( optional=True )
+    # If set, the prediction images of deleted block pipelines are kept in a temporary file in this directory.
+    #  Defaults to spill_directory in the [blockwise_object_classification] config section.
+    SpillDirectory = InputSlot( optional=True )
+    # The size of the cache for the halo regions that are shared by neighbouring blocks (for raw and binary data each).
+    #  With a RAM budget, each cache is shrunk to at most half of SLAB_CACHE_BUDGET_FRACTION of the budget.
+    HaloSlabCacheMb = InputSlot( value=256 )
+
     PredictionImage = OutputSlot()
     ProbabilityChannelImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
     
+    # The number of blocks that are processed in parallel
+    MAX_BLOCKS_IN_FLIGHT = max( 1, multiprocessing.cpu_count() )
+
+    # The share of the RAM budget that both halo slab caches may use together
+    SLAB_CACHE_BUDGET_FRACTION = 0.25
+    
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict() # indexed by blockstart, least recently used first
+        self._pipelineBytes = {} # estimated memory of each pipeline, indexed by blockstart
+        self._pinnedPipelines = collections.defaultdict(int) # the number of requests that use each pipeline
+        self._predictedBlocks = set() # blocks whose PredictionImage was requested
+        self._evictedBlocks = set() # blocks whose pipeline was deleted to save memory
+        self._spilledPredictions = None
         self._lock = RequestLock()
+
+        # The block pipelines read their inputs through these caches,
+        #  so neighbouring blocks don't read their shared halo regions twice.
+        self._opRawSlabCache = OpHaloSlabCache( parent=self )
+        self._opRawSlabCache.Input.connect( self.RawImage )
+
+        self._opBinarySlabCache = OpHaloSlabCache( parent=self )
+        self._opBinarySlabCache.Input.connect( self.BinaryImage )
         
     def setupOutputs(self):
         # Check for preconditions.
@@ -257,6 +352,11 @@ class OpBlockwiseObjectClassification( Operator ):
         self._block_shape_dict = self.BlockShape3dDict.value
         self._halo_padding_dict = self.HaloPadding3dDict.value
 
+        for opSlabCache in (self._opRawSlabCache, self._opBinarySlabCache):
+            opSlabCache.BlockShape.setValue( tuple( self._getFullShape( self._block_shape_dict ) ) )
+            opSlabCache.HaloPadding.setValue( tuple( self._getFullShape( self._halo_padding_dict ) ) )
+            opSlabCache.MaxCacheMb.setValue( self._getSlabCacheMb() )
+
         self.PredictionImage.meta.assignFrom( self.RawImage.meta )
         self.PredictionImage.meta.dtype = numpy.uint8 # Ultimately determined by meta.mapping_dtype from OpRelabelSegmentation
         prediction_tagged_shape = self.RawImage.meta.getTaggedShape()
@@ -300,37 +400,79 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = getIntersectingBlocks( block_shape, roi_one_channel )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
-
-        # Retrieve result from each block, and write into the appropriate region of the destination
-        pool = RequestPool()
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
-            block_roi = opBlockPipeline.block_roi
-            block_intersection = getIntersection( block_roi, roi_one_channel )
-            block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
-            destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
-
-            block_slot = opBlockPipeline.PredictionImage            
-            if slot == self.ProbabilityChannelImage:
-                block_slot = opBlockPipeline.ProbabilityChannelImage
-                # Add channels back to roi
-                # request all channels
-                block_relative_intersection[...,-1] = (0, opBlockPipeline.ProbabilityChannelImage.meta.shape[-1])
-                # But only write the ones that were specified in the original roi
-                destination_relative_intersection[...,-1] = ( roi.start[-1], roi.stop[-1] )
-
-            # Request the data
-            destination_slice = roiToSlice( *destination_relative_intersection )
-            req = block_slot( *block_relative_intersection )
-            req.writeInto( destination[destination_slice] )
-            pool.add( req )
-        pool.wait()
-
+        # Blocks that were evicted after their prediction image was spilled to disk are read from there.
+        #  (If a block was removed from the spill file in the meantime, its pipeline is rebuilt below.)
+        spilledPredictions = self._spilledPredictions
+        if slot == self.PredictionImage and spilledPredictions is not None:
+            with self._lock:
+                evicted_block_starts = filter( lambda block_start: block_start not in self._blockPipelines, block_starts )
+            spilled_block_starts = set()
+            for block_start in evicted_block_starts:
+                block_roi = self.get_block_roi( block_start )
+                block_intersection = getIntersection( block_roi, roi_one_channel )
+                block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
+                destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
+                if spilledPredictions.read( block_start, block_relative_intersection,
+                                            destination[ roiToSlice( *destination_relative_intersection ) ] ):
+                    spilled_block_starts.add( block_start )
+            block_starts = filter( lambda block_start: block_start not in spilled_block_starts, block_starts )
+
+        # Process the blocks in raster order, a few at a time, 
+        #  so the halo regions that neighbouring blocks share are still cached when the next block needs them.
+        block_starts = sorted( block_starts )
+        for wave_start in range( 0, len(block_starts), self.MAX_BLOCKS_IN_FLIGHT ):
+            wave = block_starts[ wave_start : wave_start + self.MAX_BLOCKS_IN_FLIGHT ]
+            self._executeBlockWave( slot, roi, roi_one_channel, wave, destination )
+
+        if len(block_starts) > 1:
+            naive, actual = self.get_read_amplification()
+            logger.debug( "Read amplification: {:.2f} (without sharing halos: {:.2f})".format( actual, naive ) )
         return destination
 
+    def _executeBlockWave(self, slot, roi, roi_one_channel, block_starts, destination):
+        # Ensure that block pipelines exist (create first if necessary) 
+        #  and keep them from being evicted until we're done.
+        pipelines = self._acquirePipelines( block_starts )
+        try:
+            # Retrieve result from each block, and write into the appropriate region of the destination
+            pool = RequestPool()
+            for block_start in block_starts:
+                opBlockPipeline = pipelines[block_start]
+                block_roi = opBlockPipeline.block_roi
+                block_intersection = getIntersection( block_roi, roi_one_channel )
+                block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
+                destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
+    
+                block_slot = opBlockPipeline.PredictionImage            
+                if slot == self.ProbabilityChannelImage:
+                    block_slot = opBlockPipeline.ProbabilityChannelImage
+                    # Add channels back to roi
+                    # request all channels
+                    block_relative_intersection[...,-1] = (0, opBlockPipeline.ProbabilityChannelImage.meta.shape[-1])
+                    # But only write the ones that were specified in the original roi
+                    destination_relative_intersection[...,-1] = ( roi.start[-1], roi.stop[-1] )
+                else:
+                    self._predictedBlocks.add( block_start )
+    
+                # Request the data
+                destination_slice = roiToSlice( *destination_relative_intersection )
+                req = block_slot( *block_relative_intersection )
+                req.writeInto( destination[destination_slice] )
+                pool.add( req )
+            pool.wait()
+        finally:
+            self._releasePipelines( block_starts )
+
+    def get_read_amplification(self):
+        """
+        Return how often each voxel of the raw data has been read on average (for the regions that were processed so far),
+        as a tuple: (without sharing the halos between blocks, actual)
+        Useful for tuning the block and halo shapes.
+        """
+        stats = self._opRawSlabCache.readStatistics()
+        touched = max( stats['touched'], 1 )
+        return ( float(stats['requested']) / touched, float(stats['read']) / touched )
+
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
         Provide data for the BlockwiseRegionFeatures slot.
@@ -339,7 +481,7 @@ class OpBlockwiseObjectClassification( Operator ):
                    (1,20,30,40,5) should be requested via roi [(1,2,3,4,5),(2,3,4,5,6)]
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
-              Therefore, it is considered an error to request features that are not already computed.
+              If the block's pipeline was evicted in the meantime, it is recreated (and the features recomputed).
         """
         axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
@@ -349,56 +491,179 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = map( tuple, block_starts )
         
         # TODO: Parallelize this?
-        for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
-
-            # Discard spatial axes to get (t,c) index for region slot roi
-            tagged_block_start = zip( axiskeys, block_start )
-            tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
-            block_start_tc = map( lambda (k,v): v, tagged_block_start_tc )
-            block_roi_tc = ( block_start_tc, block_start_tc + numpy.array([1,1]) )
-            block_roi_t = (block_roi_tc[0][:-1], block_roi_tc[1][:-1])
-
-            destination_start = numpy.array(block_start) / block_shape - roi.start
-            destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
-
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_t )
-            destination_without_channel = destination[ roiToSlice( destination_start, destination_stop ) ]
-            destination_with_channel = destination_without_channel[ ...,block_roi_tc[0][-1] : block_roi_tc[1][-1] ]
-            req.writeInto( destination_with_channel )
-            req.wait()
+        pipelines = self._acquirePipelines( block_starts )
+        try:
+            for block_start in block_starts:
+                # Discard spatial axes to get (t,c) index for region slot roi
+                tagged_block_start = zip( axiskeys, block_start )
+                tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
+                block_start_tc = map( lambda (k,v): v, tagged_block_start_tc )
+                block_roi_tc = ( block_start_tc, block_start_tc + numpy.array([1,1]) )
+                block_roi_t = (block_roi_tc[0][:-1], block_roi_tc[1][:-1])
+    
+                destination_start = numpy.array(block_start) / block_shape - roi.start
+                destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
+    
+                opBlockPipeline = pipelines[block_start]
+                req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_t )
+                destination_without_channel = destination[ roiToSlice( destination_start, destination_stop ) ]
+                destination_with_channel = destination_without_channel[ ...,block_roi_tc[0][-1] : block_roi_tc[1][-1] ]
+                req.writeInto( destination_with_channel )
+                req.wait()
+        finally:
+            self._releasePipelines( block_starts )
         
         return destination
 
+    def _acquirePipelines(self, block_starts):
+        """
+        Return the pipelines for the given blocks (creating them if necessary).
+        They are not evicted until _releasePipelines() is called.
+        """
+        with self._lock:
+            pipelines = {}
+            for block_start in block_starts:
+                self._pinnedPipelines[block_start] += 1
+                pipelines[block_start] = self._ensurePipelineExists(block_start)
+            evicted = self._evictPipelines()
+        self._finishEvictions( evicted )
+        return pipelines
+
+    def _releasePipelines(self, block_starts):
+        with self._lock:
+            for block_start in block_starts:
+                self._pinnedPipelines[block_start] -= 1
+                if self._pinnedPipelines[block_start] == 0:
+                    del self._pinnedPipelines[block_start]
+            evicted = self._evictPipelines()
+        self._finishEvictions( evicted )
+
     def _ensurePipelineExists(self, block_start):
+        # Must be called with self._lock held.
         if block_start in self._blockPipelines:
-            return
-        with self._lock:
-            if block_start in self._blockPipelines:
-                return
+            # Mark as most recently used
+            opBlockPipeline = self._blockPipelines.pop(block_start)
+            self._blockPipelines[block_start] = opBlockPipeline
+            return opBlockPipeline
 
-            logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+        logger.debug( "Creating pipeline for block: {}".format( block_start ) )
 
-            block_shape = self._getFullShape( self._block_shape_dict )
-            halo_padding = self._getFullShape( self._halo_padding_dict )
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( self._halo_padding_dict )
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
-            block_roi = (block_start, block_stop)
+        input_shape = self.RawImage.meta.shape
+        block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
+        block_roi = (block_start, block_stop)
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
-            opBlockPipeline.RawImage.connect( self.RawImage )
-            opBlockPipeline.BinaryImage.connect( self.BinaryImage )
-            opBlockPipeline.Classifier.connect( self.Classifier )
-            opBlockPipeline.LabelsCount.connect( self.LabelsCount )
-            opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
+        opBlockPipeline.RawImage.connect( self._opRawSlabCache.Output )
+        opBlockPipeline.BinaryImage.connect( self._opBinarySlabCache.Output )
+        opBlockPipeline.Classifier.connect( self.Classifier )
+        opBlockPipeline.LabelsCount.connect( self.LabelsCount )
+        opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
 
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
-            
-            self._blockPipelines[block_start] = opBlockPipeline
+        # Forward dirtyness
+        opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
+        
+        self._blockPipelines[block_start] = opBlockPipeline
+        self._pipelineBytes[block_start] = self._estimatePipelineBytes( block_roi, halo_padding )
+        self._evictedBlocks.discard( block_start )
+        return opBlockPipeline
+
+    def _estimatePipelineBytes(self, block_roi, halo_padding):
+        """
+        Roughly estimate the memory held by the caches of a block pipeline:
+        the raw and binary data, the label image (uint32) and the cached prediction image (uint8) of the halo region.
+        """
+        halo_start, halo_stop = OpSingleBlockObjectPrediction.computeHaloRoi( self.RawImage.meta.getTaggedShape(), halo_padding, block_roi )
+        channel_index = self.RawImage.meta.axistags.channelIndex
+        halo_shape = numpy.subtract( halo_stop, halo_start )
+        halo_voxels = numpy.prod( halo_shape ) / halo_shape[channel_index]
+
+        raw_bytes = numpy.dtype(self.RawImage.meta.dtype).itemsize * self.RawImage.meta.shape[channel_index]
+        binary_bytes = numpy.dtype(self.BinaryImage.meta.dtype).itemsize
+        return halo_voxels * (raw_bytes + binary_bytes + 4 + 1)
+
+    def _getRamBudgetMb(self):
+        if self.PipelineRamBudgetMb.ready():
+            return self.PipelineRamBudgetMb.value
+        return ilastik_config.getfloat('blockwise_object_classification', 'ram_budget_mb')
+
+    def _getSlabCacheMb(self):
+        """
+        The size of each of the two halo slab caches.
+        They are counted against the RAM budget, so together they may use at most SLAB_CACHE_BUDGET_FRACTION of it.
+        """
+        slab_cache_mb = self.HaloSlabCacheMb.value
+        budget_mb = self._getRamBudgetMb()
+        if budget_mb > 0:
+            slab_cache_mb = min( slab_cache_mb, budget_mb * self.SLAB_CACHE_BUDGET_FRACTION / 2 )
+        return slab_cache_mb
+
+    def _getSpillDirectory(self):
+        if self.SpillDirectory.ready():
+            return self.SpillDirectory.value
+        return ilastik_config.get('blockwise_object_classification', 'spill_directory')
+
+    def _evictPipelines(self):
+        """
+        Remove least recently used (and currently unused) pipelines until they fit into the part
+        of the RAM budget that is not reserved for the halo slab caches.
+        The most recently used pipeline is always kept, even if it alone exceeds the budget
+        (e.g. a single block covering the whole image), so it isn't rebuilt for every request.
+        Must be called with self._lock held.  The removed pipelines must be passed to
+        _finishEvictions() after the lock was released.
+        """
+        evicted = []
+        budget_mb = self._getRamBudgetMb()
+        if budget_mb <= 0:
+            return evicted
+        budget = ( budget_mb - 2 * self._getSlabCacheMb() ) * 1024**2
+        total = sum( self._pipelineBytes.values() )
+        for block_start in list(self._blockPipelines.keys())[:-1]:
+            if total <= budget:
+                break
+            if block_start in self._pinnedPipelines:
+                continue
+            total -= self._pipelineBytes[block_start]
+            evicted.append( self._evictPipeline( block_start ) )
+        return evicted
+
+    def _evictPipeline(self, block_start):
+        # Must be called with self._lock held.
+        logger.debug( "Evicting pipeline for block: {}".format( block_start ) )
+        opBlockPipeline = self._blockPipelines.pop( block_start )
+        del self._pipelineBytes[block_start]
+
+        spill = None
+        spill_directory = self._getSpillDirectory()
+        if spill_directory and block_start in self._predictedBlocks:
+            if self._spilledPredictions is None:
+                self._spilledPredictions = SpilledBlockPredictions( spill_directory )
+            spill = (self._spilledPredictions, self._spilledPredictions.generation)
+
+        self._predictedBlocks.discard( block_start )
+        self._evictedBlocks.add( block_start )
+        return (block_start, opBlockPipeline, spill)
+
+    def _finishEvictions(self, evicted):
+        """
+        Spill the predictions of the evicted pipelines (if requested) and delete the pipelines.
+        This is done without holding self._lock, so the other blocks don't wait for the disk.
+        """
+        for block_start, opBlockPipeline, spill in evicted:
+            try:
+                if spill is not None:
+                    # Not stored if the data became dirty in the meantime (see SpilledBlockPredictions)
+                    spilledPredictions, generation = spill
+                    spilledPredictions.store( block_start, opBlockPipeline.PredictionImage[:].wait(), generation )
+            except Exception:
+                # The block will simply be recomputed when it is requested again.
+                logger.warn( "Could not spill the prediction of block {}".format( block_start ), exc_info=True )
+            finally:
+                opBlockPipeline.PredictionImage.unregisterDirty( bind(self._handleDirtyBlock, block_start ) )
+                opBlockPipeline.cleanUp()
 
     def get_blockshape(self):
         return self._getFullShape(self.BlockShape3dDict.value)
@@ -438,9 +703,14 @@ class OpBlockwiseObjectClassification( Operator ):
     
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
-        oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
         with self._lock:
+            oldBlockPipelines = self._blockPipelines
+            self._blockPipelines = collections.OrderedDict()
+            self._pipelineBytes = {}
+            self._predictedBlocks = set()
+            self._evictedBlocks = set()
+            if self._spilledPredictions is not None:
+                self._spilledPredictions.clear()
             for opBlockPipeline in oldBlockPipelines.values():
                 opBlockPipeline.cleanUp()
     
@@ -449,6 +719,25 @@ class OpBlockwiseObjectClassification( Operator ):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty( slice(None) )
+        elif slot == self.PipelineRamBudgetMb or slot == self.SpillDirectory or slot == self.HaloSlabCacheMb:
+            pass
+        else:
+            # Existing pipelines forward their own dirty notifications, 
+            #  but evicted blocks have nobody to do that for them.
+            with self._lock:
+                evictedBlocks = self._evictedBlocks
+                self._evictedBlocks = set()
+                if self._spilledPredictions is not None:
+                    self._spilledPredictions.clear()
+            for block_start in evictedBlocks:
+                self.PredictionImage.setDirty( *self.get_block_roi( block_start ) )
+
+    def cleanUp(self):
+        self._deleteAllPipelines()
+        if self._spilledPredictions is not None:
+            self._spilledPredictions.close()
+            self._spilledPredictions = None
+        super( OpBlockwiseObjectClassification, self ).cleanUp()
     
     
     def _handleDirtyBlock(self, block_start, slot, roi):
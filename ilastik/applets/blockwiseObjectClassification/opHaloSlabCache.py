@@ -0,0 +1,238 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+# Built-in
+import logging
+import fractions
+import threading
+import collections
+from functools import partial
+
+# Third-party
+import numpy
+
+# lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+
+logger = logging.getLogger(__name__)
+
+class OpHaloSlabCache( Operator ):
+    """
+    Sits between an input image and the block pipelines of OpBlockwiseObjectClassification,
+    which each read their block plus a halo.
+
+    The image is divided into slabs that are aligned with both the block and the halo boundaries.
+    Slabs that lie within the halo of more than one block are read once and kept in a small LRU cache,
+    so neighbouring blocks share the overlap instead of reading it again.
+    All other slabs are passed through without caching.
+
+    The read statistics (see readStatistics()) tell how often each voxel was read from the input.
+    """
+    Input = InputSlot()
+    BlockShape = InputSlot() # Full block shape (same axes as Input)
+    HaloPadding = InputSlot() # Full halo padding (same axes as Input)
+    MaxCacheMb = InputSlot( value=256 )
+
+    Output = OutputSlot()
+
+    # Slabs should not be thinner than this (unless the halo is)
+    MIN_SLAB_WIDTH = 8
+
+    def __init__(self, *args, **kwargs):
+        super( OpHaloSlabCache, self ).__init__( *args, **kwargs )
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict() # slab start -> data, least recently used first
+        self._cacheBytes = 0
+        self._pending = {} # slab start -> Request that is reading the slab
+        self._generation = 0 # Incremented whenever the cache is invalidated
+        self._resetReadStatistics()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+
+        shape = self.Input.meta.shape
+        channel_index = self.Input.meta.axistags.channelIndex
+        self._blockShape = numpy.array( self.BlockShape.value )
+        self._haloPadding = numpy.array( self.HaloPadding.value )
+        self._blockShape[channel_index] = shape[channel_index]
+        self._haloPadding[channel_index] = 0
+
+        self._slabShape = numpy.array( map( self._slabWidth, self._blockShape, self._haloPadding ) )
+        self._slabShape = numpy.minimum( self._slabShape, shape )
+        self._slabShape[channel_index] = shape[channel_index]
+        self._numBlocks = ( numpy.array(shape) + self._blockShape - 1 ) / self._blockShape
+        self._clear()
+        self.resetReadStatistics()
+
+    def _slabWidth(self, block_width, halo_width):
+        if halo_width == 0:
+            return block_width
+        width = fractions.gcd( block_width, halo_width )
+        if width < min( self.MIN_SLAB_WIDTH, halo_width ):
+            # Block and halo boundaries are (almost) never aligned.
+            # Slabs of the halo width still share most of the overlap.
+            width = halo_width
+        return width
+
+    def execute(self, slot, subindex, roi, destination):
+        assert slot == self.Output
+        roi = numpy.array( (roi.start, roi.stop) )
+        self._countVoxels( '_requestedVoxels', roi )
+
+        slab_starts = map( tuple, getIntersectingBlocks( self._slabShape, roi ) )
+        shared = set( filter( self._isShared, slab_starts ) )
+        if not shared:
+            # Nothing to share: read everything at once.
+            self._countVoxels( '_readVoxels', roi )
+            self._touch( slab_starts )
+            self.Input( *roi ).writeInto( destination ).wait()
+            return destination
+
+        pool = RequestPool()
+        for slab_start in slab_starts:
+            slab_roi = getBlockBounds( self.Input.meta.shape, self._slabShape, slab_start )
+            intersection = getIntersection( slab_roi, roi )
+            destination_view = destination[ roiToSlice( *numpy.subtract( intersection, roi[0] ) ) ]
+            if slab_start in shared:
+                pool.add( Request( partial( self._copyFromSlab, slab_start, slab_roi, intersection, destination_view ) ) )
+            else:
+                self._countVoxels( '_readVoxels', intersection )
+                pool.add( self.Input( *intersection ).writeInto( destination_view ) )
+        self._touch( slab_starts )
+        pool.wait()
+        return destination
+
+    def _isShared(self, slab_start):
+        """
+        True if the slab intersects the halo regions of more than one block.
+        """
+        slab_stop = numpy.minimum( numpy.add( slab_start, self._slabShape ), self.Input.meta.shape )
+        b, h = self._blockShape, self._haloPadding
+        first_block = numpy.maximum( ( numpy.array(slab_start) - h ) // b, 0 )
+        last_block = numpy.minimum( ( slab_stop + h + b - 1 ) // b - 1, self._numBlocks - 1 )
+        return numpy.prod( last_block - first_block + 1 ) > 1
+
+    def _copyFromSlab(self, slab_start, slab_roi, intersection, destination_view):
+        data = self._getSlab( slab_start, slab_roi )
+        destination_view[:] = data[ roiToSlice( *numpy.subtract( intersection, slab_roi[0] ) ) ]
+
+    def _getSlab(self, slab_start, slab_roi):
+        with self._lock:
+            if slab_start in self._cache:
+                data = self._cache.pop( slab_start )
+                self._cache[slab_start] = data
+                return data
+            owner = slab_start not in self._pending
+            if owner:
+                self._pending[slab_start] = Request( partial( self._readSlab, slab_roi ) )
+            req = self._pending[slab_start]
+            generation = self._generation
+
+        try:
+            data = req.wait()
+        except:
+            if owner:
+                with self._lock:
+                    del self._pending[slab_start]
+            raise
+        if owner:
+            with self._lock:
+                del self._pending[slab_start]
+                if generation == self._generation:
+                    self._cache[slab_start] = data
+                    self._cacheBytes += data.nbytes
+                    self._evict()
+        return data
+
+    def _readSlab(self, slab_roi):
+        self._countVoxels( '_readVoxels', slab_roi )
+        return self.Input( *slab_roi ).wait()
+
+    def _evict(self):
+        # Must be called with self._lock held.
+        max_bytes = self.MaxCacheMb.value * 1024**2
+        while self._cacheBytes > max_bytes and self._cache:
+            _, data = self._cache.popitem( last=False )
+            self._cacheBytes -= data.nbytes
+
+    def _clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._cacheBytes = 0
+            self._generation += 1
+
+    def _spatialVoxels(self, roi):
+        shape = numpy.subtract( roi[1], roi[0] )
+        shape[ self.Input.meta.axistags.channelIndex ] = 1
+        return int( numpy.prod( shape ) )
+
+    def _countVoxels(self, counter, roi):
+        voxels = self._spatialVoxels( roi )
+        with self._lock:
+            setattr( self, counter, getattr( self, counter ) + voxels )
+
+    def _touch(self, slab_starts):
+        with self._lock:
+            for slab_start in slab_starts:
+                if slab_start not in self._touchedSlabs:
+                    slab_roi = getBlockBounds( self.Input.meta.shape, self._slabShape, slab_start )
+                    self._touchedSlabs.add( slab_start )
+                    self._touchedVoxels += self._spatialVoxels( slab_roi )
+
+    def readStatistics(self):
+        """
+        Return a dict with the number of voxels (channels not counted) since the last resetReadStatistics():
+        - 'requested': requested from our output (i.e. what the blocks would have read without this cache)
+        - 'read': actually read from the input
+        - 'touched': in the regions that were requested (i.e. what a perfect cache would have read)
+        """
+        with self._lock:
+            return { 'requested' : self._requestedVoxels,
+                     'read' : self._readVoxels,
+                     'touched' : self._touchedVoxels }
+
+    def resetReadStatistics(self):
+        with self._lock:
+            self._resetReadStatistics()
+
+    def _resetReadStatistics(self):
+        self._requestedVoxels = 0
+        self._readVoxels = 0
+        self._touchedVoxels = 0
+        self._touchedSlabs = set()
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            dirty_roi = numpy.array( (roi.start, roi.stop) )
+            with self._lock:
+                self._generation += 1
+                for slab_start in self._cache.keys():
+                    slab_roi = getBlockBounds( self.Input.meta.shape, self._slabShape, slab_start )
+                    if getIntersection( slab_roi, dirty_roi, assertIntersect=False ) is not None:
+                        self._cacheBytes -= self._cache.pop( slab_start ).nbytes
+            self.Output.setDirty( roi.start, roi.stop )
+        elif slot == self.MaxCacheMb:
+            with self._lock:
+                self._evict()
+        else:
+            # Block or halo shape changed: the slab layout will be recomputed in setupOutputs()
+            self._clear()
@@ -0,0 +1,228 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import json
+import threading
+import logging
+
+import numpy
+
+from lazyflow.utility import PathComponents
+from lazyflow.utility.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+COMPLETION_MARKER_SUFFIX = '.export-complete'
+
+class StreamingBatchExport(object):
+    """
+    Runs the export of several lanes of an OpDataExport (e.g. the batch results
+    of a headless run), several files at a time.
+
+    - At most max_concurrent_files exports run at once, and a file is only
+      started if its estimated memory use fits into what's left of ram_budget_mb
+      (a file is always started if nothing else is running).
+    - While the exports run, the raw data file of the next waiting lane is read
+      ahead (in small chunks, into the OS file cache), so its input is available
+      as soon as it starts.
+    - After a successful export, a small marker file is written next to the
+      exported file.  With resume=True, lanes with an up-to-date marker are skipped,
+      so an interrupted batch can be continued.
+    - The progress (every PROGRESS_LOG_STEP percent) and the throughput of each file are logged.
+    """
+    PREFETCH_CHUNK_BYTES = 16 * 1024**2
+    PROGRESS_LOG_STEP = 10
+
+    def __init__(self, lane_views, max_concurrent_files=1, ram_budget_mb=0, resume=False, prefetch=True):
+        """
+        lane_views: the lane views of the OpDataExport to run
+        ram_budget_mb: 0 means no limit (apart from max_concurrent_files)
+        """
+        assert max_concurrent_files > 0
+        self.lane_views = list(lane_views)
+        self.max_concurrent_files = max_concurrent_files
+        self.ram_budget_bytes = ram_budget_mb * 1024**2
+        self.resume = resume
+        self.prefetch = prefetch
+
+        self._condition = threading.Condition()
+        self._reserved_bytes = 0
+        self._running = 0
+        self._failures = []
+
+    def run(self):
+        """
+        Export all lanes.  Raises if any of the exports failed.
+        Returns the indexes of the lanes that were exported (not skipped).
+        """
+        pending = []
+        for lane_index, lane_view in enumerate(self.lane_views):
+            if self.resume and is_export_complete(lane_view):
+                logger.info( "Skipping result {}: {} is already complete.".format( lane_index, lane_view.ExportPath.value ) )
+            else:
+                pending.append( lane_index )
+
+        threads = []
+        for position, lane_index in enumerate(pending):
+            cost = self._estimate_bytes(self.lane_views[lane_index])
+            with self._condition:
+                while not self._can_start(cost):
+                    self._condition.wait()
+                self._running += 1
+                self._reserved_bytes += cost
+
+            th = threading.Thread( target=self._export, args=(lane_index, cost),
+                                   name="StreamingBatchExport-{}".format(lane_index) )
+            th.daemon = True
+            th.start()
+            threads.append(th)
+
+            # Read ahead the input of the file that will be started next, while this one is running.
+            if self.prefetch and position+1 < len(pending):
+                self._prefetch( self.lane_views[ pending[position+1] ] )
+
+        for th in threads:
+            th.join()
+
+        if self._failures:
+            for lane_index, exc in self._failures:
+                logger.error( "Export of result {} failed: {}".format( lane_index, exc ) )
+            raise RuntimeError( "{} of {} batch exports failed.".format( len(self._failures), len(pending) ) )
+        return pending
+
+    def _can_start(self, cost):
+        if self._running == 0:
+            return True
+        if self._running >= self.max_concurrent_files:
+            return False
+        return self.ram_budget_bytes <= 0 or self._reserved_bytes + cost <= self.ram_budget_bytes
+
+    def _estimate_bytes(self, lane_view):
+        """
+        Estimate the memory that exporting this lane needs at once.
+        The export streams its result in blocks, so this is an upper bound
+        that is capped by the budget.
+        """
+        meta = lane_view.ImageToExport.meta
+        nbytes = numpy.prod(meta.shape) * numpy.dtype(meta.dtype).itemsize
+        if self.ram_budget_bytes > 0:
+            nbytes = min(nbytes, self.ram_budget_bytes)
+        return nbytes
+
+    def _export(self, lane_index, cost):
+        lane_view = self.lane_views[lane_index]
+        try:
+            export_path = lane_view.ExportPath.value
+            logger.info( "Exporting result {}/{} to {}".format( lane_index, len(self.lane_views), export_path ) )
+            remove_completion_marker(lane_view)
+
+            # Several files may be exported at once, so only every few percent are logged.
+            last_logged = [-1]
+            def log_progress( progress ):
+                step = int(progress) // self.PROGRESS_LOG_STEP
+                if step > last_logged[0]:
+                    last_logged[0] = step
+                    logger.info( "Result {}/{} Progress: {}%".format( lane_index, len(self.lane_views), int(progress) ) )
+            lane_view.progressSignal.subscribe( log_progress )
+
+            with Timer() as timer:
+                lane_view.run_export()
+            write_completion_marker(lane_view)
+
+            meta = lane_view.ImageToExport.meta
+            tagged_shape = meta.getTaggedShape()
+            voxels = numpy.prod( [v for k,v in tagged_shape.items() if k != 'c'] )
+            megabytes = numpy.prod(meta.shape) * numpy.dtype(meta.dtype).itemsize / float(1024**2)
+            seconds = max( timer.seconds(), 1e-6 )
+            logger.info( "Exported result {} in {:.1f} seconds ({:.1f} MB/s, {:.0f} voxels/s)"
+                         .format( lane_index, seconds, megabytes / seconds, voxels / seconds ) )
+        except Exception as ex:
+            logger.exception( "Export of result {} failed".format( lane_index ) )
+            self._failures.append( (lane_index, ex) )
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._reserved_bytes -= cost
+                self._condition.notify_all()
+
+    def _prefetch(self, lane_view):
+        """
+        Read the raw data file of the given lane in the background,
+        so it is in the OS file cache when its export starts.
+        Only a single small chunk is held in memory at a time.
+        """
+        try:
+            path = PathComponents( lane_view.RawDatasetInfo.value.filePath ).externalPath
+        except Exception:
+            return
+        if not os.path.isfile(path):
+            # E.g. stacks (globstrings) and remote data.
+            return
+        if self.ram_budget_bytes > 0 and os.path.getsize(path) > self.ram_budget_bytes:
+            # Would not fit into the file cache next to the running exports anyway.
+            return
+
+        def read_file():
+            try:
+                with open(path, 'rb') as f:
+                    while f.read(self.PREFETCH_CHUNK_BYTES):
+                        pass
+            except IOError as ex:
+                logger.debug( "Could not prefetch {}: {}".format( path, ex ) )
+        th = threading.Thread( target=read_file, name="StreamingBatchExport-prefetch" )
+        th.daemon = True
+        th.start()
+
+def _completion_marker_path(lane_view):
+    return PathComponents( lane_view.ExportPath.value ).externalPath + COMPLETION_MARKER_SUFFIX
+
+def _export_description(lane_view):
+    meta = lane_view.ImageToExport.meta
+    return { 'export_path' : lane_view.ExportPath.value,
+             'shape' : [ int(x) for x in meta.shape ],
+             'dtype' : numpy.dtype(meta.dtype).name }
+
+def is_export_complete(lane_view):
+    """
+    True if the lane was completely exported earlier with the same path, shape and dtype.
+    """
+    marker_path = _completion_marker_path(lane_view)
+    exported_path = PathComponents( lane_view.ExportPath.value ).externalPath
+    if not os.path.exists(marker_path):
+        return False
+    if os.path.exists(exported_path) and os.path.getmtime(exported_path) > os.path.getmtime(marker_path):
+        # The file was changed after the export was complete.
+        return False
+    try:
+        with open(marker_path, 'r') as f:
+            description = json.load(f)
+    except ValueError:
+        return False
+    return description == _export_description(lane_view)
+
+def write_completion_marker(lane_view):
+    with open(_completion_marker_path(lane_view), 'w') as f:
+        json.dump(_export_description(lane_view), f)
+
+def remove_completion_marker(lane_view):
+    marker_path = _completion_marker_path(lane_view)
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
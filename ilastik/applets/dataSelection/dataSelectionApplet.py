@@ -230,56 +230,33 @@ class DataSelectionApplet( Applet ):
         """
         If any of the files in filePaths appear to be globstrings for a stack,
         convert the given stack to hdf5 format.
+        Stacks that were converted before are updated: only new or modified slices are read again.
         
         Return the filePaths list with globstrings replaced by the paths to the new hdf5 volumes.
         """
-        import hashlib
-        import pickle
-        import h5py
-        from lazyflow.graph import Graph
-        from lazyflow.operators.ioOperators import OpStackToH5Writer
+        from stackToH5Converter import StackToH5Converter
         
         filePaths = list(filePaths)
         for i, path in enumerate(filePaths):
             if '*' in path:
                 globstring = path
+                stackPath = StackToH5Converter.cache_path( globstring, stackVolumeCacheDir )
+
+                logger.info( "Converting stack {} to hdf5".format(path) )
+                logger.info( "Volume path: {}".format(stackPath) )
     
-                # Embrace paranoia:
-                # We want to make sure we never re-use a stale cache file for a new dataset,
-                #  even if the dataset is located in the same location as a previous one and has the same globstring!
-                # Create a sha-1 of the file name and modification date.
-                sha = hashlib.sha1()
-                files = [k.replace('\\', '/') for k in glob.glob( path )]
-                for f in files:
-                    sha.update(f)
-                    sha.update(pickle.dumps(os.stat(f).st_mtime))
-                stackFile = sha.hexdigest() + '.h5'
-                stackPath = os.path.join( stackVolumeCacheDir, stackFile ).replace('\\', '/')
-                
-                # Overwrite original path
-                filePaths[i] = stackPath + "/volume/data"
-    
-                # Generate the hdf5 if it doesn't already exist
-                if os.path.exists(stackPath):
+                if not os.path.exists( stackVolumeCacheDir ):
+                    os.makedirs( stackVolumeCacheDir )
+
+                totalProgress = [-100]
+                def handleProgress( progress ):
+                    if progress / 10 != totalProgress[0] / 10:
+                        totalProgress[0] = progress
+                        logger.info( "Converting stack: {}%".format( progress ) )
+                converter = StackToH5Converter( globstring, stackPath )
+                filePaths[i] = converter.run( progress=handleProgress )
+                if converter.converted_slices == 0:
                     logger.info( "Using previously generated hdf5 volume for stack {}".format(path) )
-                    logger.info( "Volume path: {}".format(filePaths[i]) )
-                else:
-                    logger.info( "Generating hdf5 volume for stack {}".format(path) )
-                    logger.info( "Volume path: {}".format(filePaths[i]) )
-    
-                    if not os.path.exists( stackVolumeCacheDir ):
-                        os.makedirs( stackVolumeCacheDir )
-                    
-                    with h5py.File(stackPath) as f:
-                        # Configure the conversion operator
-                        opWriter = OpStackToH5Writer( graph=Graph() )
-                        opWriter.hdf5Group.setValue(f)
-                        opWriter.hdf5Path.setValue("volume/data")
-                        opWriter.GlobString.setValue(globstring)
-                        
-                        # Initiate the write
-                        success = opWriter.WriteImage.value
-                        assert success, "Something went wrong when generating an hdf5 file from an image sequence."
             
         return filePaths
 
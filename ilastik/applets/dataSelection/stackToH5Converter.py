@@ -0,0 +1,158 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import hashlib
+from functools import partial
+import logging
+
+import numpy
+import h5py
+import vigra
+
+from lazyflow.request import Request, RequestPool
+from lazyflow.operators.ioOperators import OpStackLoader
+
+logger = logging.getLogger(__name__)
+
+class StackToH5Converter(object):
+    """
+    Converts an image stack (given by a globstring) into a chunked, compressed
+    hdf5 volume with zyxc axes.
+
+    A hash of each slice file (name, size and modification time) is stored
+    along with the volume, so converting the same stack again only reads the
+    slices that were added or changed since the last conversion.
+
+    Slices are read in parallel, one slab of SLAB_SIZE slices at a time, and
+    each slab is written (and flushed) as soon as it is complete, so an
+    interrupted conversion continues with the first unfinished slab.
+    The volume can only be used once run() has returned: without SWMR support,
+    hdf5 does not allow reading the file while it is open for writing.
+    """
+    DATASET_PATH = "volume/data"
+    HASHES_PATH = "volume/slice_hashes"
+    SLAB_SIZE = 64
+    CHUNK_SHAPE = (16, 128, 128) # zyx; the chunks always include all channels
+    COMPRESSION = 'gzip'
+    COMPRESSION_LEVEL = 1
+
+    def __init__(self, globstring, h5_path):
+        self.globstring = globstring
+        self.h5_path = h5_path
+        self.converted_slices = 0 # The number of slices read during the last run()
+
+    @classmethod
+    def cache_path(cls, globstring, cache_dir):
+        """
+        The location of the volume for the given stack in a cache directory.
+        It only depends on the globstring, so stacks that grow are updated in place.
+        """
+        sha = hashlib.sha1()
+        sha.update( os.path.abspath(globstring).replace('\\', '/') )
+        return os.path.join( cache_dir, "stack-" + sha.hexdigest() + '.h5' ).replace('\\', '/')
+
+    @classmethod
+    def slice_hash(cls, filename):
+        stat = os.stat(filename)
+        sha = hashlib.sha1()
+        sha.update( filename.replace('\\', '/') )
+        sha.update( str(stat.st_size) )
+        sha.update( repr(stat.st_mtime) )
+        return sha.hexdigest()
+
+    def run(self, progress=None):
+        """
+        Create or update the hdf5 volume.
+        progress: optional callback, called with the percentage of slices done after each slab
+        """
+        filenames = OpStackLoader.expandGlobStrings( self.globstring )
+        if not filenames:
+            raise RuntimeError( "No files found for stack: {}".format( self.globstring ) )
+        hashes = [ self.slice_hash(f) for f in filenames ]
+        first_slice = self._read_slice( filenames[0] )
+        slice_shape, dtype = first_slice.shape, first_slice.dtype
+
+        self.converted_slices = 0
+        with h5py.File( self.h5_path, 'a' ) as f:
+            dataset, stored_hashes = self._prepare_datasets( f, len(filenames), slice_shape, dtype )
+            todo = [ z for z in range( len(filenames) )
+                     if z >= len(stored_hashes) or stored_hashes[z] != hashes[z] ]
+            logger.info( "Stack {}: converting {} of {} slices".format( self.globstring, len(todo), len(filenames) ) )
+
+            # Process the slices slab by slab
+            for slab_index in range( 0, len(filenames), self.SLAB_SIZE ):
+                slab_z = [ z for z in todo if slab_index <= z < slab_index + self.SLAB_SIZE ]
+                if slab_z:
+                    slices = {}
+                    def read( z ):
+                        slices[z] = self._read_slice( filenames[z] )
+
+                    pool = RequestPool()
+                    for z in slab_z:
+                        pool.add( Request( partial( read, z ) ) )
+                    pool.wait()
+
+                    for z in slab_z:
+                        data = slices.pop(z)
+                        if data.shape != slice_shape or data.dtype != dtype:
+                            raise RuntimeError( "Slice {} has shape {} and type {}, but expected {} and {}"
+                                                .format( filenames[z], data.shape, data.dtype, slice_shape, dtype ) )
+                        dataset[z] = data
+                        f[self.HASHES_PATH][z] = hashes[z]
+                    f.flush()
+                    self.converted_slices += len(slab_z)
+                slab_stop = min( slab_index + self.SLAB_SIZE, len(filenames) )
+                if progress is not None:
+                    progress( 100 * slab_stop / len(filenames) )
+        return self.h5_path + "/" + self.DATASET_PATH
+
+    def _read_slice(self, filename):
+        image = vigra.impex.readImage( filename, dtype='NATIVE' )
+        return numpy.asarray( image.withAxes( 'y', 'x', 'c' ) )
+
+    def _prepare_datasets(self, f, num_slices, slice_shape, dtype):
+        """
+        Return the (resized) volume dataset and the stored slice hashes.
+        If the existing volume doesn't match the slices, it is recreated.
+        """
+        shape = (num_slices,) + slice_shape
+        if self.DATASET_PATH in f and self.HASHES_PATH in f:
+            dataset = f[self.DATASET_PATH]
+            if dataset.shape[1:] == slice_shape and dataset.dtype == dtype and dataset.maxshape[0] is None:
+                stored_hashes = list( f[self.HASHES_PATH][:] )
+                # Hashes beyond the end of the stack belong to deleted slices.
+                stored_hashes = stored_hashes[:num_slices]
+                dataset.resize( shape )
+                f[self.HASHES_PATH].resize( (num_slices,) )
+                return dataset, stored_hashes
+            logger.info( "Stack {} has changed its slice shape or type.  Converting all slices.".format( self.globstring ) )
+
+        for path in (self.DATASET_PATH, self.HASHES_PATH):
+            if path in f:
+                del f[path]
+
+        chunks = tuple( min(c, s) for c, s in zip( self.CHUNK_SHAPE, shape ) ) + (slice_shape[-1],)
+        dataset = f.create_dataset( self.DATASET_PATH, shape=shape, maxshape=(None,) + slice_shape, dtype=dtype,
+                                    chunks=chunks, compression=self.COMPRESSION, compression_opts=self.COMPRESSION_LEVEL )
+        dataset.attrs['axistags'] = vigra.defaultAxistags('zyxc').toJSON()
+        # Empty hashes mark the slices that have not been converted yet.
+        f.create_dataset( self.HASHES_PATH, shape=(num_slices,), maxshape=(None,), dtype='S40' )
+        return dataset, []
@@ -0,0 +1,126 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import threading
+import collections
+import logging
+
+import numpy
+import h5py
+
+logger = logging.getLogger(__name__)
+
+class FeatureFilePool(object):
+    """
+    Reads the "data" dataset of a list of precomputed feature files
+    (one feature channel per file), keeping at most maxOpenFiles of them open.
+    The least recently used files are closed when the limit is reached.
+
+    Datasets that are stored contiguously and uncompressed are read through
+    a memory map of the file, without going through the hdf5 library.
+    """
+    DATASET_NAME = "data"
+
+    def __init__(self, filenames, maxOpenFiles=16):
+        assert maxOpenFiles > 0
+        self.filenames = list(filenames)
+        self.maxOpenFiles = maxOpenFiles
+        self._lock = threading.Lock()
+        # file index -> (h5py.File or None, dataset or memmap), least recently used first
+        self._readers = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @property
+    def numOpenFiles(self):
+        return len(self._readers)
+
+    def shape(self, index):
+        with self._lock:
+            return self._getReader(index).shape
+
+    def dtype(self, index):
+        with self._lock:
+            return self._getReader(index).dtype
+
+    def read(self, index, key, out=None):
+        """
+        Read dataset[key] of the given file, into out if provided.
+        """
+        with self._lock:
+            reader = self._getReader(index)
+            if not isinstance(reader, numpy.memmap):
+                # Read hdf5 datasets with the lock held, so their file can't be closed meanwhile.
+                return self._copy(reader[key], out)
+        # A memory map stays valid even if it is dropped from the pool while reading.
+        return self._copy(reader[key], out)
+
+    def readChannels(self, indices, key, out):
+        """
+        Read dataset[key] of all the given files into the last axis of out.
+        """
+        assert out.shape[-1] == len(indices)
+        for j, index in enumerate(indices):
+            self.read(index, key, out[..., j])
+        return out
+
+    def close(self):
+        with self._lock:
+            while self._readers:
+                self._closeOldest()
+
+    def _copy(self, data, out):
+        if out is None:
+            return numpy.array(data)
+        out[...] = data
+        return out
+
+    def _getReader(self, index):
+        # Must be called with the lock held.
+        try:
+            reader = self._readers.pop(index)
+        except KeyError:
+            while len(self._readers) >= self.maxOpenFiles:
+                self._closeOldest()
+            reader = self._openReader(index)
+        self._readers[index] = reader
+        return reader[1]
+
+    def _openReader(self, index):
+        filename = self.filenames[index]
+        f = h5py.File(filename, 'r')
+        dataset = f[self.DATASET_NAME]
+        offset = None
+        if dataset.chunks is None and dataset.compression is None and dataset.dtype.kind in 'biuf':
+            # Only contiguous, allocated datasets have an offset
+            offset = dataset.id.get_offset()
+        if offset is None:
+            return (f, dataset)
+
+        shape, dtype = dataset.shape, dataset.dtype
+        f.close()
+        logger.debug( "Memory-mapping feature file {}".format( filename ) )
+        return (None, numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape))
+
+    def _closeOldest(self):
+        _, (f, _) = self._readers.popitem(last=False)
+        if f is not None:
+            f.close()
@@ -24,7 +24,6 @@ import logging
 
 #SciPy
 import numpy
-import h5py
 
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -36,6 +35,9 @@ from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as
 from lazyflow.operators import OpReorderAxes, OperatorWrapper
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.config import cfg as ilastik_config
+from opPersistentFeatureCache import OpPersistentFeatureCache
+from featureFilePool import FeatureFilePool
 
 logger = logging.getLogger(__name__)
 
@@ -69,9 +71,13 @@ class OpFeatureSelectionNoCache(Operator):
     # For ease of development and testing, the underlying feature computation implementation 
     #  can be switched via a constructor argument.  These are the possible choices.
     FilterImplementations = ['Original', 'Refactored', 'Interpolated']
+
+    # In FeatureListFilename mode, at most this many feature files are kept open at once.
+    MAX_OPEN_FEATURE_FILES = 32
     
     def __init__(self, filter_implementation, *args, **kwargs):
         super(OpFeatureSelectionNoCache, self).__init__(*args, **kwargs)
+        self._filter_implementation = filter_implementation
 
         # Create the operator that actually generates the features
         if filter_implementation == 'Original':
@@ -98,12 +104,25 @@ class OpFeatureSelectionNoCache(Operator):
                                                broadcastingSlotNames=["AxisOrder"])
         self.opReorderLayers.Input.connect(self.opPixelFeatures.Features)
 
+        # Optionally keep the computed features on disk, so later sessions 
+        #  and headless runs on the same data can reuse them.
+        #  (Disabled unless a directory is given in the [feature_cache] config section.)
+        self.opPersistentCache = OpPersistentFeatureCache(parent=self)
+        self.opPersistentCache.Input.connect(self.opReorderOut.Output)
+        self.opPersistentCache.KeyImage.connect(self.InputImage)
+        self.opPersistentCache.CacheDirectory.setValue( ilastik_config.get('feature_cache', 'directory') )
+        self.opPersistentCache.MaxCacheSizeBytes.setValue( ilastik_config.getint('feature_cache', 'max_size_mb') * 1024**2 )
+        self.opPersistentCache.BlockSize.setValue( ilastik_config.getint('feature_cache', 'block_size') )
+
         # We don't connect SelectionMatrix here because we want to 
         #  check it for errors (See setupOutputs)
         # self.opPixelFeatures.SelectionMatrix.connect( self.SelectionMatrix )
 
         self.WINDOW_SIZE = self.opPixelFeatures.WINDOW_SIZE
 
+        # Readers for the precomputed features in FeatureListFilename mode
+        self._featureFiles = None
+
     def setupOutputs(self):
         # drop non-channel singleton axes
         allAxes = 'txyzc'
@@ -128,13 +147,15 @@ class OpFeatureSelectionNoCache(Operator):
             
             axistags = self.InputImage.meta.axistags
             
+            if self._featureFiles is not None:
+                self._featureFiles.close()
+            self._featureFiles = FeatureFilePool(self._files, self.MAX_OPEN_FEATURE_FILES)
+
             self.FeatureLayers.resize(len(self._files))
             for i in range(len(self._files)):
-                f = h5py.File(self._files[i], 'r')
-                shape = f["data"].shape
+                shape = self._featureFiles.shape(i)
                 assert len(shape) == 3
-                dtype = f["data"].dtype.type
-                f.close()
+                dtype = self._featureFiles.dtype(i).type
                 self.FeatureLayers[i].meta.shape    = shape+(1,)
                 self.FeatureLayers[i].meta.dtype    = dtype
                 self.FeatureLayers[i].meta.axistags = axistags 
@@ -157,8 +178,15 @@ class OpFeatureSelectionNoCache(Operator):
                       "The invalid scales are: {}".format( invalid_scales )                      
                 raise DatasetConstraintError( "Feature Selection", msg )
             
+            # The persistent cache must not reuse blocks that were computed with different settings
+            cacheParameters = ( self._filter_implementation,
+                                list(self.Scales.value),
+                                list(self.FeatureIds.value),
+                                numpy.asarray(selections).tolist() )
+            self.opPersistentCache.KeyParameters.setValue( repr(cacheParameters) )
+
             # Connect our external outputs to our internal operators
-            self.OutputImage.connect( self.opReorderOut.Output )
+            self.OutputImage.connect( self.opPersistentCache.Output )
             self.FeatureLayers.connect( self.opReorderLayers.Output )
 
     def propagateDirty(self, slot, subindex, roi):
@@ -175,26 +203,22 @@ class OpFeatureSelectionNoCache(Operator):
             
         if slot == self.FeatureLayers:
             index = subindex[0]
-            f = h5py.File(self._files[index], 'r')
-            result[...,0] = f["data"][key[0:3]]
+            self._featureFiles.read(index, key[0:3], result[...,0])
             return result
         elif slot == self.OutputImage:
             assert result.ndim == 4
-            assert result.shape[-1] == len(self._files), "result.shape = %r" % result.shape 
-            assert rroi.start == 0, "rroi = %r" % (rroi,)
-            assert rroi.stop  == len(self._files), "rroi = %r" % (rroi,)
+            assert result.shape[-1] == key[3].stop - key[3].start, "result.shape = %r" % result.shape 
             
-            j = 0
-            for i in range(key[3].start, key[3].stop):
-                f = h5py.File(self._files[i], 'r')
-                r = f["data"][key[0:3]]
-                assert r.dtype == numpy.float32
-                assert r.ndim == 3
-                f.close()
-                result[:,:,:,j] = r 
-                j += 1
+            # Read all requested channels in one pass over the (already open) files
+            self._featureFiles.readChannels(range(key[3].start, key[3].stop), key[0:3], result)
             return result  
 
+    def cleanUp(self):
+        if self._featureFiles is not None:
+            self._featureFiles.close()
+            self._featureFiles = None
+        super(OpFeatureSelectionNoCache, self).cleanUp()
+
 class OpFeatureSelection( OpFeatureSelectionNoCache ):
     """
     This is the top-level operator of the feature selection applet when used in a GUI.
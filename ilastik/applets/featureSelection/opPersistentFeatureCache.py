@@ -0,0 +1,300 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+#Python
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+from functools import partial
+import logging
+
+#SciPy
+import numpy
+
+#lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds, getIntersection
+from lazyflow.request import Request, RequestPool, RequestLock
+
+logger = logging.getLogger(__name__)
+
+class PersistentBlockStore(object):
+    """
+    A directory of memory-mappable .npy block files with a total size limit.
+    When the limit is exceeded, the least recently used blocks are deleted.
+    The access order survives across sessions via the files' modification times.
+
+    Use PersistentBlockStore.get() to obtain the (shared) store of a directory.
+    """
+    _stores = {}
+    _storesLock = threading.Lock()
+
+    @classmethod
+    def get(cls, directory, maxBytes):
+        directory = os.path.abspath( os.path.expanduser(directory) )
+        with cls._storesLock:
+            try:
+                store = cls._stores[directory]
+            except KeyError:
+                store = cls._stores[directory] = PersistentBlockStore( directory )
+            store.maxBytes = maxBytes
+            return store
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.maxBytes = None
+        self._lock = threading.Lock()
+        self._totalBytes = 0
+        # path -> size, least recently used first
+        self._index = collections.OrderedDict()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith('.npy'):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    files.append( (stat.st_mtime, path, stat.st_size) )
+        for _, path, size in sorted(files):
+            self._index[path] = size
+            self._totalBytes += size
+
+    @property
+    def totalBytes(self):
+        return self._totalBytes
+
+    def blockPath(self, key, blockStart):
+        name = "block-" + "_".join( str(x) for x in blockStart ) + ".npy"
+        return os.path.join( self.directory, key, name )
+
+    def load(self, path, shape, dtype):
+        """
+        Return a read-only memory map of the block, or None if the block is not (validly) stored.
+        """
+        with self._lock:
+            if path not in self._index:
+                return None
+            self._index[path] = self._index.pop(path)
+        try:
+            data = numpy.load(path, mmap_mode='r')
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self._forget(path)
+            return None
+        if data.shape != tuple(shape) or data.dtype != dtype:
+            logger.warn( "Discarding persistent cache block with unexpected shape or type: {}".format( path ) )
+            self._remove(path)
+            return None
+        return data
+
+    def store(self, path, data):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another thread may have created it in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+
+        # Write to a temporary file first, so readers never see a partially written block.
+        fd, tmpPath = tempfile.mkstemp( suffix='.tmp', dir=dirname )
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, numpy.ascontiguousarray(data))
+        try:
+            os.rename(tmpPath, path)
+        except OSError:
+            # On Windows, rename() does not replace existing files
+            self._unlink(path)
+            os.rename(tmpPath, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self._totalBytes += size - self._index.pop(path, 0)
+            self._index[path] = size
+            evicted = []
+            while self.maxBytes is not None and self._totalBytes > self.maxBytes and len(self._index) > 1:
+                oldPath, oldSize = self._index.popitem(last=False)
+                self._totalBytes -= oldSize
+                evicted.append(oldPath)
+        for oldPath in evicted:
+            self._unlink(oldPath)
+        if evicted:
+            logger.debug( "Evicted {} blocks from the persistent feature cache".format( len(evicted) ) )
+
+    def _forget(self, path):
+        with self._lock:
+            self._totalBytes -= self._index.pop(path, 0)
+
+    def _remove(self, path):
+        self._forget(path)
+        self._unlink(path)
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class OpPersistentFeatureCache(Operator):
+    """
+    Caches blocks of the Input in a directory on disk, so they can be reused
+    by later sessions and headless runs on the same data.
+
+    The blocks are stored under a key that is computed from the content of the
+    KeyImage (the data the Input is computed from), the KeyParameters (anything
+    else the Input depends on, e.g. the feature selection) and the block shape.
+    If no CacheDirectory is given, the Input is simply passed through.
+    """
+    Input = InputSlot()
+    KeyImage = InputSlot()
+    KeyParameters = InputSlot(value='')
+    CacheDirectory = InputSlot(value='')
+    MaxCacheSizeBytes = InputSlot(value=10*1024**3)
+    BlockSize = InputSlot(value=64) # Spatial block size. Blocks always include all channels.
+
+    Output = OutputSlot()
+
+    # Spatial block size used to hash the KeyImage
+    KEY_HASH_BLOCK_SIZE = 128
+
+    def __init__(self, *args, **kwargs):
+        super( OpPersistentFeatureCache, self ).__init__( *args, **kwargs )
+        self._cacheKey = None
+        self._keyLock = RequestLock()
+        # The (expensive) hash of the KeyImage content is kept separately from the key,
+        #  since most changes (e.g. of the feature selection) leave the KeyImage untouched.
+        self._keyImageDigest = None
+        self._keyImageMeta = None
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+        keyImageMeta = ( tuple(self.KeyImage.meta.shape), numpy.dtype(self.KeyImage.meta.dtype) )
+        with self._keyLock:
+            if keyImageMeta != self._keyImageMeta:
+                self._keyImageDigest = None
+                self._keyImageMeta = keyImageMeta
+            self._cacheKey = None
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot is self.Input:
+            self.Output.setDirty( roi.start, roi.stop )
+        elif slot is self.KeyImage:
+            # The Input is computed from the KeyImage, so it will be marked dirty, too.
+            with self._keyLock:
+                self._keyImageDigest = None
+                self._cacheKey = None
+        # Changes to the other slots trigger setupOutputs(), which resets the key
+        #  (but keeps the KeyImage digest, unless the shape or dtype of the KeyImage changed).
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot is self.Output
+        if not self.CacheDirectory.value:
+            self.Input(roi.start, roi.stop).writeInto(result).wait()
+            return result
+
+        store = PersistentBlockStore.get( self.CacheDirectory.value, self.MaxCacheSizeBytes.value )
+        key = self._getCacheKey()
+        blockShape = self._getBlockShape()
+
+        pool = RequestPool()
+        for blockStart in getIntersectingBlocks( blockShape, (roi.start, roi.stop) ):
+            pool.add( Request( partial( self._copyBlock, store, key, blockShape, blockStart, roi, result ) ) )
+        pool.wait()
+        return result
+
+    def _getBlockShape(self):
+        blockSize = self.BlockSize.value
+        tagged = self.Input.meta.getTaggedShape()
+        blockShape = []
+        for axis, size in tagged.items():
+            if axis == 'c':
+                blockShape.append( size )
+            elif axis == 't':
+                blockShape.append( 1 )
+            else:
+                blockShape.append( min( size, blockSize ) )
+        return tuple(blockShape)
+
+    def _copyBlock(self, store, key, blockShape, blockStart, roi, result):
+        blockStart, blockStop = getBlockBounds( self.Input.meta.shape, blockShape, blockStart )
+        blockStart = numpy.array( blockStart )
+        blockStop = numpy.array( blockStop )
+        path = store.blockPath( key, blockStart )
+
+        data = store.load( path, blockStop - blockStart, numpy.dtype(self.Input.meta.dtype) )
+        if data is None:
+            data = self.Input( blockStart, blockStop ).wait()
+            store.store( path, data )
+
+        intersection = getIntersection( (blockStart, blockStop), (numpy.array(roi.start), numpy.array(roi.stop)) )
+        intersection = numpy.array( intersection )
+        result[ roiToSlice( *(intersection - roi.start) ) ] = data[ roiToSlice( *(intersection - blockStart) ) ]
+
+    def _getCacheKey(self):
+        with self._keyLock:
+            if self._cacheKey is None:
+                if self._keyImageDigest is None:
+                    self._keyImageDigest = self._hashKeyImage()
+                sha = hashlib.sha1()
+                sha.update( self._keyImageDigest )
+                sha.update( str(self.KeyParameters.value) )
+                sha.update( str(self._getBlockShape()) )
+                sha.update( str(numpy.dtype(self.Input.meta.dtype)) )
+                self._cacheKey = sha.hexdigest()
+                logger.debug( "Persistent feature cache key: {}".format( self._cacheKey ) )
+            return self._cacheKey
+
+    def _hashKeyImage(self):
+        """
+        Hash the content of the KeyImage.  It is hashed in parallel, one fixed-size
+        block at a time, so the result does not depend on the available RAM or threads.
+        """
+        shape = self.KeyImage.meta.shape
+        blockShape = []
+        for axis, size in self.KeyImage.meta.getTaggedShape().items():
+            if axis == 'c':
+                blockShape.append( size )
+            elif axis == 't':
+                blockShape.append( 1 )
+            else:
+                blockShape.append( min( size, self.KEY_HASH_BLOCK_SIZE ) )
+
+        blockDigests = {}
+        def hashBlock( blockStart ):
+            blockStart, blockStop = getBlockBounds( shape, blockShape, blockStart )
+            data = self.KeyImage( blockStart, blockStop ).wait()
+            blockDigests[ tuple(blockStart) ] = hashlib.sha1( numpy.ascontiguousarray(data).data ).digest()
+
+        pool = RequestPool()
+        for blockStart in getIntersectingBlocks( blockShape, ( (0,)*len(shape), shape ) ):
+            pool.add( Request( partial( hashBlock, blockStart ) ) )
+        pool.wait()
+
+        sha = hashlib.sha1()
+        sha.update( str(tuple(shape)) )
+        sha.update( str(numpy.dtype(self.KeyImage.meta.dtype)) )
+        for blockStart in sorted(blockDigests.keys()):
+            sha.update( blockDigests[blockStart] )
+        return sha.hexdigest()
@@ -19,12 +19,12 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import numpy
-import numpy.lib.recfunctions as rfn
 import vigra
 import time
+import math
 import warnings
-import itertools
-from collections import defaultdict
+import threading
+from collections import defaultdict, namedtuple, OrderedDict
 from functools import partial
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
@@ -38,15 +38,88 @@ from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, Paral
 from ilastik.utility import OperatorSubView, MultiLaneOperatorABC, OpMultiLaneWrapper
 from ilastik.utility.mode import mode
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
-from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
+from ilastik.applets.objectExtraction.featureTable import FeatureTable
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.config import cfg as ilastik_config
 
 import logging
 logger = logging.getLogger(__name__)
 
 MISSING_VALUE = 0
 
+def _overlappingBoxPairs(mins_a, maxs_a, mins_b, maxs_b, max_cells_per_box=64):
+    """
+    Find all pairs of boxes (one from a, one from b) whose interiors overlap,
+    i.e. mins_a < maxs_b and mins_b < maxs_a along all axes.
+    Returns the indexes of the pairs as two arrays (sorted by a, then b).
+
+    The boxes are sorted into a uniform grid, so only boxes that share a grid cell are compared.
+    Boxes that span many cells are compared with all boxes of the other set instead.
+    """
+    mins_a, maxs_a = numpy.asarray(mins_a, dtype=numpy.float64), numpy.asarray(maxs_a, dtype=numpy.float64)
+    mins_b, maxs_b = numpy.asarray(mins_b, dtype=numpy.float64), numpy.asarray(maxs_b, dtype=numpy.float64)
+    na, nb = len(mins_a), len(mins_b)
+    if na == 0 or nb == 0:
+        return numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp)
+
+    def overlap(ia, ib):
+        keep = numpy.logical_and(mins_a[ia] < maxs_b[ib], mins_b[ib] < maxs_a[ia]).all(axis=1)
+        return ia[keep], ib[keep]
+
+    # Grid cells have the median box size
+    extents = numpy.concatenate((maxs_a - mins_a, maxs_b - mins_b))
+    cell_size = numpy.maximum(numpy.median(extents, axis=0), 1.0)
+    origin = numpy.minimum(mins_a.min(axis=0), mins_b.min(axis=0))
+    def cell_ranges(mins, maxs):
+        lo = numpy.floor((mins - origin) / cell_size).astype(numpy.int64)
+        hi = numpy.floor((maxs - origin) / cell_size).astype(numpy.int64)
+        return lo, hi - lo + 1
+    lo_a, ext_a = cell_ranges(mins_a, maxs_a)
+    lo_b, ext_b = cell_ranges(mins_b, maxs_b)
+    big_a = numpy.prod(ext_a, axis=1) > max_cells_per_box
+    big_b = numpy.prod(ext_b, axis=1) > max_cells_per_box
+    grid_shape = numpy.maximum((lo_a + ext_a).max(axis=0), (lo_b + ext_b).max(axis=0))
+
+    def cells(indexes, lo, ext):
+        # Expand each box into the (flat) indexes of all cells it touches
+        ncells = numpy.prod(ext[indexes], axis=1)
+        box = numpy.repeat(indexes, ncells)
+        local = numpy.arange(ncells.sum()) - numpy.repeat(numpy.cumsum(ncells) - ncells, ncells)
+        flat = numpy.zeros(len(box), dtype=numpy.int64)
+        for axis in range(lo.shape[1]):
+            coord = lo[box, axis] + local % ext[box, axis]
+            local //= ext[box, axis]
+            flat = flat * grid_shape[axis] + coord
+        return box, flat
+
+    pairs = []
+    small_a = numpy.nonzero(~big_a)[0]
+    small_b = numpy.nonzero(~big_b)[0]
+    if len(small_a) and len(small_b):
+        box_a, cell_a = cells(small_a, lo_a, ext_a)
+        box_b, cell_b = cells(small_b, lo_b, ext_b)
+        order = numpy.argsort(cell_b, kind='mergesort')
+        box_b, cell_b = box_b[order], cell_b[order]
+        first = numpy.searchsorted(cell_b, cell_a, 'left')
+        count = numpy.searchsorted(cell_b, cell_a, 'right') - first
+        ia = numpy.repeat(box_a, count)
+        ib = box_b[numpy.repeat(first - numpy.cumsum(count) + count, count) + numpy.arange(count.sum())]
+        pairs.append(overlap(ia, ib))
+
+    # Big boxes are compared with everything (big a with all b, big b with the remaining a)
+    all_b = numpy.arange(nb)
+    for i in numpy.nonzero(big_a)[0]:
+        pairs.append(overlap(numpy.repeat(i, nb), all_b))
+    for j in numpy.nonzero(big_b)[0]:
+        pairs.append(overlap(small_a, numpy.repeat(j, len(small_a))))
+
+    ia = numpy.concatenate([p[0] for p in pairs]) if pairs else numpy.zeros((0,), dtype=numpy.intp)
+    ib = numpy.concatenate([p[1] for p in pairs]) if pairs else numpy.zeros((0,), dtype=numpy.intp)
+    # Boxes that share several cells were found several times
+    pair_ids = numpy.unique(ia.astype(numpy.int64) * nb + ib)
+    return pair_ids // nb, pair_ids % nb
+
 class OpObjectClassification(Operator, MultiLaneOperatorABC):
     """The top-level operator for object classification.
 
@@ -90,6 +163,7 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
     
     FreezePredictions = InputSlot(stype='bool', value=False)
     EnableLabelTransfer = InputSlot(stype='bool', value=False)
+    WarmStart = InputSlot(stype='bool', optional=True) # See OpObjectTrain.WarmStart
 
     # for reading from disk
     InputProbabilities = InputSlot(level=1, stype=Opaque, rtype=List, optional=True)
@@ -149,6 +223,7 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
         self.opTrain.Labels.connect(self.LabelInputs)
         self.opTrain.FixClassifier.setValue(False)
         self.opTrain.SelectedFeatures.connect(self.SelectedFeatures)
+        self.opTrain.WarmStart.connect(self.WarmStart)
 
         self.classifier_cache.Input.connect(self.opTrain.Classifier)
 
@@ -468,89 +543,56 @@ class OpObjectClassification(Operator, MultiLaneOperatorABC):
         maxs_old = old_bboxes["Coord<Maximum>"]
         mins_new = new_bboxes["Coord<Minimum>"]
         maxs_new = new_bboxes["Coord<Maximum>"]
-        nobj_old = mins_old.shape[0]
         nobj_new = mins_new.shape[0]
         if axistags is None:
             axistags = "xyz"
-        
-        data2D = False
+
+        # Bounding box columns in xyz order
         if mins_old.shape[1]==2:
-            data2D = True
-        class bbox():
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index('x')]
-                self.ymin = minmaxs[0][axistags.index('y')]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index('z')]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index('x')]
-                self.ymax = minmaxs[1][axistags.index('y')]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index('z')]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5*(self.xmax - self.xmin)
-                self.cent_x = self.xmin+self.rad_x
-                self.rad_y = 0.5*(self.ymax-self.ymin)
-                self.cent_y = self.ymin+self.rad_y
-                self.rad_z = 0.5*(self.zmax-self.zmin)
-                self.cent_z = self.zmin+self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
-                over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
-                over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
-                if not data2D:
-                    if over_x>0 and over_y>0 and over_z>0:
-                        return over_x*over_y*over_z
-                else:
-                    if over_x>0 and over_y>0:
-                        return over_x*over_y
-                return 0
+            columns = [axistags.index('x'), axistags.index('y')]
+        else:
+            columns = [axistags.index('x'), axistags.index('y'), axistags.index('z')]
 
         nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
-
+        mins_old = numpy.asarray(mins_old)[nonzeros][:, columns]
+        maxs_old = numpy.asarray(maxs_old)[nonzeros][:, columns]
         #remove background
         #FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
+        mins_new = numpy.asarray(mins_new)[1:, columns]
+        maxs_new = numpy.asarray(maxs_new)[1:, columns]
+
+        def centers(mins, maxs):
+            cents = mins + 0.5*(maxs - mins)
+            if cents.shape[1] == 2:
+                cents = numpy.concatenate((cents, numpy.zeros((cents.shape[0], 1))), axis=1)
+            return cents
+
+        # Sparse overlaps: only the pairs of boxes that actually overlap
+        iold, inew = _overlappingBoxPairs(mins_old, maxs_old, mins_new, maxs_new)
+        rad_old = 0.5*(maxs_old - mins_old)
+        rad_new = 0.5*(maxs_new - mins_new)
+        over = rad_old[iold] + rad_new[inew] - numpy.abs(centers(mins_old, maxs_old)[iold] - centers(mins_new, maxs_new)[inew])[:, :len(columns)]
+        overlaps = numpy.prod(over, axis=1)
+
+        # Each old object goes to the new object with maximum overlap (the first one, for ties)
+        order = numpy.lexsort((inew, -overlaps, iold))
+        iold, inew = iold[order], inew[order]
+        first = numpy.ones(len(iold), dtype=bool)
+        first[1:] = iold[1:] != iold[:-1]
+        assigned_old, assigned_new = iold[first], inew[first]
+        noverlaps = numpy.bincount(iold, minlength=len(nonzeros))
 
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = map(bbox.overlap, double_for_loop)
+        old_labels_lost = dict()
+        old_labels_lost["full"]=map(tuple, centers(mins_old, maxs_old)[noverlaps == 0])
+        #these objects overlap with more than one new object
+        old_labels_lost["partial"]=map(tuple, centers(mins_old, maxs_old)[noverlaps > 1])
 
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
-        old_labels_lost = dict()
-        old_labels_lost["full"]=[]
-        old_labels_lost["partial"]=[]
         new_labels_lost = dict()
-        new_labels_lost["conflict"]=[]
-        for iobj in range(overlaps.shape[0]):
-            #take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum==0:
-                old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum-overlaps[iobj,newindex]>0:
-                #this object overlaps with more than one new object
-                old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1 #doesn't matter what number>0
-
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj]>0)[0]
-            if labels.shape[0]==1:
-                new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
-            elif labels.shape[0]>1:
-                new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
+        nassigned = numpy.bincount(assigned_new, minlength=len(mins_new))
+        unique = nassigned[assigned_new] == 1
+        new_labels[assigned_new[unique]+1] = old_labels[nonzeros[assigned_old[unique]]] #+1 because of the background
+        new_labels_lost["conflict"]=map(tuple, centers(mins_new, maxs_new)[nassigned > 1])
 
         new_labels = new_labels
         new_labels[0]=0 #FIXME: hardcoded background value again
@@ -730,57 +772,47 @@ def _concatenate(arrays, axis):
     return numpy.concatenate(arrays, axis=axis)
 
 
-def make_feature_array(feats, selected, labels=None):
-    featlist = []
-    labellist = []
-
-    row_names = []
-    col_names = []
-
-    for t in sorted(feats.keys()):
-        featsMatrix_tmp = []
-        index = None
-        if labels is not None:
-            labellist_tmp = []
-            lab = labels[t].squeeze()
-            index = numpy.nonzero(lab)
-            labellist_tmp.append(lab[index])
-
-        timestep_col_names = []
-        for plugin in sorted(feats[t].keys()):
-            if plugin == default_features_key or plugin not in selected:
-                continue
-            for featname in sorted(feats[t][plugin].keys()):
-                if featname not in selected[plugin]:
-                    continue
-                value = feats[t][plugin][featname]
-                ft = numpy.asarray(value.squeeze())
-                if index is not None:
-                    ft = ft[index]
-                featsMatrix_tmp.append(ft)
-                timestep_col_names.extend([(plugin, featname)] * value.shape[1])
-        if not col_names:
-            col_names = timestep_col_names
-        elif col_names != timestep_col_names:
-            raise Exception('different time slices did not have same features.')
-            
-        #FIXME: we can do it all with just arrays
-        featsMatrix_tmp_combined = _concatenate(featsMatrix_tmp, axis=1)
-        featlist.append(featsMatrix_tmp_combined)
-        if index is not None:
-            row_names.extend(list((t, obj) for obj in index[0]))
-        if labels is not None:
-            labellist_tmp_combined = _concatenate(labellist_tmp, axis=1)
-            labellist.append(labellist_tmp_combined)
+def make_feature_table(feats, selected, objects=None, extraColumns=()):
+    """
+    Create a FeatureTable of the selected features (never including the default features).
+    objects: optional dict of t -> ids of the objects to include
+    """
+    selected = dict( (plugin, names) for plugin, names in selected.iteritems()
+                     if plugin != default_features_key )
+    return FeatureTable.fromFeatures(feats, selected, objects, extraColumns)
+
 
-    featMatrix = _concatenate(featlist, axis=0)
+def make_feature_array(feats, selected, labels=None):
+    objects = None
+    if labels is not None:
+        objects = {}
+        labellist = []
+        row_names = []
+        for t in sorted(feats.keys()):
+            lab = numpy.atleast_1d(labels[t].squeeze())
+            index = numpy.nonzero(lab)[0]
+            objects[t] = index
+            labellist.append(lab[index])
+            row_names.extend(list((t, obj) for obj in index))
+
+    table = make_feature_table(feats, selected, objects)
+    featMatrix = table.features
+    col_names = table.featureNames
 
     if labels is not None:
         labelsMatrix = _concatenate(labellist, axis=0)
+        _atleast_nd(labelsMatrix, 2)
         assert labelsMatrix.shape[0] == featMatrix.shape[0]
         return featMatrix, row_names, col_names, labelsMatrix
-    return featMatrix, row_names, col_names
+    return featMatrix, [], col_names
+
 
+def get_num_objects(extracted_features):
+    n = 0
+    for group, feature_dict in extracted_features.items():
+        for feature_name, feature_matrix in feature_dict.items():
+            n = max(n, len(feature_matrix))
+    return n
 
 def replace_missing(a):
     rows, cols = numpy.where(numpy.isnan(a) + numpy.isinf(a))
@@ -791,8 +823,22 @@ def replace_missing(a):
     return rows, cols
 
 
+# The feature rows of the labeled objects of one time step, sorted by object id
+_TrainingRows = namedtuple('_TrainingRows', ['objects', 'features', 'bad_mask'])
+
 class OpObjectTrain(Operator):
-    """Trains a random forest on all labeled objects."""
+    """Trains a random forest on all labeled objects.
+
+    The feature rows of labeled objects are kept in a store indexed by
+    (lane, time, object), so after a label change only the features of
+    newly labeled objects are fetched.  The store is invalidated when
+    the features become dirty.
+
+    With WarmStart, the trees are divided into several forests and only
+    some of them are retrained (on all labels) when labels were added,
+    replacing the oldest forests.  If labels were changed or removed, or
+    the features changed, all forests are retrained.
+    """
 
     name = "TrainRandomForestObjects"
     description = "Train a random forest on multiple images"
@@ -804,15 +850,34 @@ class OpObjectTrain(Operator):
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     FixClassifier = InputSlot(stype="bool")
     ForestCount = InputSlot(stype="int", value=1)
+    WarmStart = InputSlot(stype="bool", optional=True) # default: see the [object_classification] config section
 
     Classifier = OutputSlot()
     BadObjects = OutputSlot(stype=Opaque)
 
+    # With WarmStart, the trees are divided into at least this many forests
+    WARM_START_MIN_FORESTS = 4
+
     def __init__(self, *args, **kwargs):
         super(OpObjectTrain, self).__init__(*args, **kwargs)
         self._tree_count = 100
         self.FixClassifier.setValue(False)        
 
+        self._lock = RequestLock()
+        self._rowStore = {} # (lane, t) -> _TrainingRows
+        self._colNames = None
+        self._numLanes = 0
+
+        # For warm starts: the last classifier and the labels it was trained with
+        self._lastClassifier = None
+        self._lastTraining = None
+        self._trainedLabels = {} # (lane, t) -> (objects, labels)
+        self._featuresChanged = False
+
+        # Durations (in seconds) of the steps of the last training:
+        # 'fetch', 'assemble' and 'train'
+        self.timings = {}
+
     def setupOutputs(self):
         if self.FixClassifier.value == False:
             self.Classifier.meta.dtype = object
@@ -823,106 +888,245 @@ class OpObjectTrain(Operator):
         self.BadObjects.meta.dtype = object
         self.BadObjects.meta.axistags = None
 
+        if len(self.Labels) != self._numLanes:
+            # Lanes were added or removed: the lane indexes of the store are no longer valid.
+            self._invalidateTrainingRows()
+            self._numLanes = len(self.Labels)
+
     def execute(self, slot, subindex, roi, result):
-        featList = []
-        all_col_names = []
-        labelsList = []
         # get the number of ALL labels
         numLabels=0
         if self.LabelsCount.ready():
             numLabels = self.LabelsCount[:].wait()
             numLabels = int(numLabels[0])
 
-        # will be available at slot self.Warnings
-        all_bad_objects = defaultdict(lambda: defaultdict(list))
-        all_bad_feats = set()
-
         selected = self.SelectedFeatures([]).wait()
         if len(selected)==0:
             # no features - no predictions
+            self._lastClassifier = None
             self.Classifier.setValue(None)
             return
 
-        lock = RequestLock()
+        tFetch = time.time()
+        lane_rows = [[] for _ in range(len(self.Labels))]
         def fetch_features(lane_index):
             # TODO: we should be able to use self.Labels[i].value,
             # but the current implementation of Slot.value() does not
             # do the right thing.
             labels_image = self.Labels[lane_index]([]).wait()
-            labels_image_filtered = {}
-            nztimes = []
-            for timestep, labels_time in labels_image.iteritems():
-                nz = numpy.nonzero(labels_time)
-                if len(nz[0])==0:
-                    continue
-                else:
-                    nztimes.append(timestep)
-                    labels_image_filtered[timestep] = labels_time
-
-            if len(nztimes)==0:
-                return
-            # compute the features if there are nonzero labels in this image
-            # and only for the time steps, which have labels
-            feats = self.Features[lane_index](nztimes).wait()
-
-            featstmp, row_names, col_names, labelstmp = make_feature_array(feats, selected, labels_image_filtered)
-            if labelstmp.size == 0 or featstmp.size == 0:
-                return
-
-            rows, cols = replace_missing(featstmp)
-
-            # Critical section: Adding to shared lists.
-            with lock:
-                featList.append(featstmp)
-                all_col_names.append(tuple(col_names))
-                labelsList.append(labelstmp)
-    
-                for idx in rows:
-                    t, obj = row_names[idx]
-                    all_bad_objects[lane_index][t].append(obj)
-    
-                for c in cols:
-                    all_bad_feats.add(col_names[c])
+            lane_rows[lane_index] = self._updateTrainingRows(lane_index, labels_image, selected)
 
         pool = RequestPool()
         for i in range(len(self.Labels)):
             # this loop is by image, not time! 
             pool.add( Request( partial(fetch_features, i) ) )
         pool.wait()
+        self.timings['fetch'] = time.time() - tFetch
+
+        tAssemble = time.time()
+        featList = []
+        labelsList = []
+        trainedLabels = {}
+        # will be available at slot self.Warnings
+        all_bad_objects = defaultdict(lambda: defaultdict(list))
+        all_bad_feats = set()
+        for lane_index, rows in enumerate(lane_rows):
+            for t, objects, features, bad_mask, labels in rows:
+                featList.append(features)
+                labelsList.append(labels[:, numpy.newaxis])
+                trainedLabels[(lane_index, t)] = (objects, labels)
+                bad_rows = bad_mask.any(axis=1)
+                if bad_rows.any():
+                    all_bad_objects[lane_index][t].extend(objects[bad_rows])
+                for c in numpy.nonzero(bad_mask.any(axis=0))[0]:
+                    all_bad_feats.add(self._colNames[c])
 
         if len(labelsList)==0:
             #no labels, return here
+            self._lastClassifier = None
             self.Classifier.setValue(None)
             return
-        
-        
-        self._warnBadObjects(all_bad_objects, all_bad_feats)
 
-        if not len(set(all_col_names)) == 1:
-            raise Exception('different time slices did not have same features.')
+        self._warnBadObjects(all_bad_objects, all_bad_feats)
 
         featMatrix = _concatenate(featList, axis=0)
         labelsMatrix = _concatenate(labelsList, axis=0)
+        self.timings['assemble'] = time.time() - tAssemble
 
         logger.info("training on matrix of shape {}".format(featMatrix.shape))
 
         if featMatrix.size == 0 or labelsMatrix.size == 0:
             result[:] = None
             return
+
+        tTrain = time.time()
         allLabels=map(long, range(1,numLabels+1))
-        classifier_factory = ParallelVigraRfLazyflowClassifierFactory( self._tree_count, self.ForestCount.value, labels=allLabels )
-        classifier = classifier_factory.create_and_train( featMatrix.astype(numpy.float32), numpy.asarray(labelsMatrix, dtype=numpy.uint32) )
+        training = (tuple(allLabels), tuple(self._colNames), self._tree_count, self.ForestCount.value)
+        added, changed = self._compareLabels(self._trainedLabels, trainedLabels)
+        warm_start = ( self._useWarmStart() and
+                       self._lastClassifier is not None and
+                       self._lastTraining == training and
+                       not self._featuresChanged and
+                       changed == 0 )
+
+        if warm_start and added == 0:
+            logger.info("labels did not change, keeping the classifier")
+            classifier = self._lastClassifier
+        else:
+            classifier = self._train( featMatrix.astype(numpy.float32),
+                                      numpy.asarray(labelsMatrix, dtype=numpy.uint32),
+                                      allLabels,
+                                      added if warm_start else None )
+        self.timings['train'] = time.time() - tTrain
+
+        self._lastClassifier = classifier
+        self._lastTraining = training
+        self._trainedLabels = trainedLabels
+        self._featuresChanged = False
+
         avg_oob = numpy.mean(classifier.oobs)
         logger.info("training finished, average out-of-bag error: {}".format(avg_oob))
+        logger.info("training times: fetch features {:.3f}s, assemble matrix {:.3f}s, train {:.3f}s"
+                    .format(self.timings['fetch'], self.timings['assemble'], self.timings['train']))
         result[0] = classifier
         return result
 
+    def _updateTrainingRows(self, lane_index, labels_image, selected):
+        """
+        Return the training rows of all labeled objects of the given lane,
+        as a list of (t, objects, features, bad_mask, labels) tuples.
+        Only the features of objects that are not in the store yet are fetched.
+        """
+        labeled = {}
+        missing = {}
+        for t, labels_time in labels_image.iteritems():
+            labels_time = numpy.atleast_1d(numpy.asarray(labels_time).squeeze())
+            objects = numpy.nonzero(labels_time)[0]
+            if len(objects)==0:
+                continue
+            labeled[t] = (objects, labels_time[objects])
+            with self._lock:
+                stored = self._rowStore.get((lane_index, t))
+            known = stored.objects if stored is not None else numpy.zeros((0,), dtype=objects.dtype)
+            missing_objects = numpy.setdiff1d(objects, known)
+            if len(missing_objects) > 0:
+                missing[t] = missing_objects
+
+        if len(missing) > 0:
+            # compute the features only for the time steps with newly labeled objects
+            feats = self.Features[lane_index](sorted(missing.keys())).wait()
+            for t, missing_objects in missing.iteritems():
+                table = make_feature_table({t: feats[t]}, selected, objects={t: missing_objects})
+                features = table.features
+                col_names = table.featureNames
+                bad_mask = numpy.isnan(features) + numpy.isinf(features)
+                features[bad_mask] = MISSING_VALUE
+
+                with self._lock:
+                    if self._colNames is None:
+                        self._colNames = list(col_names)
+                    elif self._colNames != list(col_names):
+                        raise Exception('different time slices did not have same features.')
+
+                    stored = self._rowStore.get((lane_index, t))
+                    if stored is not None:
+                        objects = numpy.concatenate((stored.objects, missing_objects))
+                        features = numpy.concatenate((stored.features, features))
+                        bad_mask = numpy.concatenate((stored.bad_mask, bad_mask))
+                    else:
+                        objects = missing_objects
+                    order = numpy.argsort(objects)
+                    self._rowStore[(lane_index, t)] = _TrainingRows(objects[order], features[order], bad_mask[order])
+
+        rows = []
+        for t in sorted(labeled.keys()):
+            objects, labels = labeled[t]
+            with self._lock:
+                stored = self._rowStore[(lane_index, t)]
+            index = numpy.searchsorted(stored.objects, objects)
+            rows.append((t, objects, stored.features[index], stored.bad_mask[index], labels))
+        return rows
+
+    @staticmethod
+    def _compareLabels(old, new):
+        """
+        Compare two sets of training labels, given as dicts of (lane, t) -> (objects, labels).
+        Return the number of added labels and the number of changed or removed labels.
+        """
+        added = 0
+        changed = 0
+        empty = (numpy.zeros((0,), dtype=int), numpy.zeros((0,)))
+        for key in set(old.keys()) | set(new.keys()):
+            old_objects, old_labels = old.get(key, empty)
+            new_objects, new_labels = new.get(key, empty)
+            common = numpy.intersect1d(old_objects, new_objects)
+            old_common = old_labels[numpy.searchsorted(old_objects, common)]
+            new_common = new_labels[numpy.searchsorted(new_objects, common)]
+            changed += numpy.count_nonzero(old_common != new_common) + len(old_objects) - len(common)
+            added += len(new_objects) - len(common)
+        return added, changed
+
+    def _train(self, featMatrix, labelsMatrix, allLabels, added=None):
+        """
+        Train a classifier.  If the number of added labels is given,
+        only a corresponding part of the forests of the last classifier is retrained.
+        """
+        nforests = self._getForestCount()
+        if added is not None:
+            nretrain = int(math.ceil(nforests * float(added) / labelsMatrix.shape[0]))
+            nretrain = min(max(nretrain, 1), nforests)
+            try:
+                previous = self._lastClassifier
+                classifier_factory = ParallelVigraRfLazyflowClassifierFactory( self._tree_count * nretrain / nforests, nretrain, labels=allLabels )
+                retrained = classifier_factory.create_and_train( featMatrix, labelsMatrix )
+                # Replace the oldest forests
+                forests = list(previous._forests[nretrain:]) + list(retrained._forests)
+                oobs = list(previous._oobs[nretrain:]) + list(retrained._oobs)
+                classifier = ParallelVigraRfLazyflowClassifier( forests, oobs, previous._known_labels )
+                logger.info("warm start: retrained {} of {} forests".format(nretrain, nforests))
+                return classifier
+            except (AttributeError, TypeError):
+                logger.debug("This classifier can't be partially retrained.  Retraining all forests.", exc_info=True)
+
+        classifier_factory = ParallelVigraRfLazyflowClassifierFactory( self._tree_count, nforests, labels=allLabels )
+        return classifier_factory.create_and_train( featMatrix, labelsMatrix )
+
+    def _invalidateTrainingRows(self, lane_index=None, times=None):
+        with self._lock:
+            if lane_index is None:
+                self._rowStore = {}
+                self._colNames = None
+            else:
+                for key in self._rowStore.keys():
+                    if key[0] == lane_index and (not times or key[1] in times):
+                        del self._rowStore[key]
+            self._featuresChanged = True
+
     def propagateDirty(self, slot, subindex, roi):
+        if slot is self.Features:
+            self._invalidateTrainingRows(subindex[0], getattr(roi, '_l', None))
+        elif slot is self.SelectedFeatures:
+            self._invalidateTrainingRows()
+
         if slot is not self.FixClassifier and \
            self.inputs["FixClassifier"].value == False:
-            slcs = (slice(0, self.ForestCount.value, None),)
+            slcs = (slice(0, self._getForestCount(), None),)
             self.outputs["Classifier"].setDirty(slcs)
 
+    def _useWarmStart(self):
+        if self.WarmStart.ready():
+            return self.WarmStart.value
+        return ilastik_config.getboolean('object_classification', 'warm_start')
+
+    def _getForestCount(self):
+        """
+        The number of forests of the classifier (with WarmStart, at least WARM_START_MIN_FORESTS).
+        """
+        nforests = self.ForestCount.value
+        if self._useWarmStart():
+            nforests = max(nforests, self.WARM_START_MIN_FORESTS)
+        return nforests
+
     def _warnBadObjects(self, bad_objects, bad_feats):
         if len(bad_feats) > 0 or\
                 any([len(bad_objects[i]) > 0 for i in bad_objects.keys()]):
@@ -934,15 +1138,20 @@ class OpObjectPredict(Operator):
     """Predicts object labels in a single image.
 
     Performs prediction on all objects in a time slice at once, and
-    caches the result.
+    caches the result.  Each time slice is predicted in its own
+    request, so requests for different time slices run in parallel,
+    while concurrent requests for the same time slice share a single
+    prediction.
+
+    Besides time steps, the outputs (except CachedProbabilities) accept
+    (t, objects) pairs in their roi, e.g. to predict only the objects
+    that are visible in a roi of a large image.  The result for t then
+    contains the values of the given objects, in the given order.  These
+    objects are predicted (and cached) without predicting the rest of
+    the time slice.  Outputs that accept such requests have
+    meta.object_requests set.
 
     """
-    # WARNING: right now we predict and cache a whole time slice. We
-    # expect this to be fast because there are relatively few objects
-    # compared to the number of pixels in pixel classification. If
-    # this should be too slow, we should instead cache at the object
-    # level, and only predict for objects visible in the roi.
-
     name = "OpObjectPredict"
 
     Features = InputSlot(rtype=List, stype=Opaque)
@@ -959,21 +1168,38 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        # Protects the dicts below.  Never held while predicting.
+        self.lock = RequestLock()
+        self.prob_cache = dict()
+        self.bad_objects = dict()
+        # Objects of partially predicted time slices: t -> (probs, bad_objects, predicted)
+        self._object_cache = dict()
+        # One lock per time slice that is being predicted, held while predicting it
+        self._timestep_locks = dict()
+        # Incremented whenever the cache is invalidated,
+        # so predictions that were started before are not cached.
+        self._cache_generation = 0
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
         self.Predictions.meta.axistags = None
         self.Predictions.meta.mapping_dtype = numpy.uint8
+        self.Predictions.meta.object_requests = True
 
         self.Probabilities.meta.shape = self.Features.meta.shape
         self.Probabilities.meta.dtype = object
         self.Probabilities.meta.mapping_dtype = numpy.float32
         self.Probabilities.meta.axistags = None
+        self.Probabilities.meta.object_requests = True
 
         self.BadObjects.meta.shape = self.Features.meta.shape
         self.BadObjects.meta.dtype = object
         self.BadObjects.meta.mapping_dtype = numpy.uint8
         self.BadObjects.meta.axistags = None
+        self.BadObjects.meta.object_requests = True
 
         if self.LabelsCount.ready():
             nlabels = self.LabelsCount[:].wait()
@@ -984,10 +1210,10 @@ class OpObjectPredict(Operator):
                 oslot.meta.dtype = object
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
+                oslot.meta.object_requests = True
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
+        with self.lock:
+            self._invalidateCache()
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -996,165 +1222,275 @@ class OpObjectPredict(Operator):
                         self.ProbabilityChannels,
                         self.BadObjects]
 
-        times = roi._l
-        if len(times) == 0:
+        # t -> the requested objects of time step t, or None for all of them
+        requested = OrderedDict()
+        for item in roi._l:
+            if isinstance(item, tuple):
+                t, objects = item
+                requested[t] = numpy.atleast_1d( numpy.asarray(objects, dtype=numpy.intp) )
+            else:
+                requested[item] = None
+        if len(requested) == 0:
             # we assume that 0-length requests are requesting everything
-            times = range(self.Predictions.meta.shape[0])
+            requested = OrderedDict((t, None) for t in range(self.Predictions.meta.shape[0]))
+        times = requested.keys()
 
         if slot is self.CachedProbabilities:
-            return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            with self.lock:
+                return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
 
         classifier = self.Classifier.value
         if classifier is None:
             # this happens if there was no data to train with
             return dict((t, numpy.array([])) for t in times)
 
-        feats = {}
-        prob_predictions = {}
-
         selected = self.SelectedFeatures([]).wait()
 
-        def get_num_objects(extracted_features):
-            n = 0
-            for group, feature_dict in extracted_features.items():
-                for feature_name, feature_matrix in feature_dict.items():
-                    n = max(n, len(feature_matrix))
-            return n
+        # prob_predictions is a dict-of-arrays, indexed as follows:
+        # prob_predictions[t][object_index, class_index]
+        prob_predictions = {}
+        bad_objects = {}
+        def predict_timestep(t):
+            if requested[t] is None:
+                prob_predictions[t], bad_objects[t] = self._getTimestepProbabilities(t, classifier, selected)
+            else:
+                prob_predictions[t], bad_objects[t] = self._getObjectProbabilities(t, requested[t], classifier, selected)
 
-        # FIXME: self.prob_cache is shared, so we need to block.
-        # However, this makes prediction single-threaded.
-        with self.lock:
-            for t in times:
-                if t in self.prob_cache:
-                    continue
+        # predict the time slices in parallel
+        pool = RequestPool()
+        for t in times:
+            pool.add( Request( partial(predict_timestep, t) ) )
+        pool.wait()
+        pool.clean()
 
-                # Initialize with a single value for the 'background object '
-                prob_predictions[t] = numpy.zeros( (1, len(self.ProbabilityChannels)), dtype=numpy.float32 )
-                tmpfeats = self.Features([t]).wait()
-                num_objects = get_num_objects(tmpfeats[t])
+        if slot == self.Probabilities:
+            return prob_predictions
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
+            for t in times:
+                labels[t] = 1 + numpy.argmax(prob_predictions[t], axis=1)
+                # Background gets the zero label
+                if requested[t] is None:
+                    labels[t][0] = 0
+                else:
+                    labels[t][requested[t] == 0] = 0
+            
+            return labels
 
-                # Apparently self.Features always returns a background object, 
-                #  so we expect at least 1 object in the list, even if there's nothing to predict.
-                assert num_objects > 0
-                if num_objects == 1:
-                    continue
-                    
-                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
-                rows, cols = replace_missing(ftmatrix)
-                self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-                self.bad_objects[t][rows] = 1
-                feats[t] = ftmatrix
-
-            # Are there any objects to predict?
-            if len(feats) > 0:
-                def predict_forest(_t):
-                    # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
-                    #        and we have to average the PROBABILITIES from all forests.
-                    #       Averaging the label predictions from each forest is NOT equivalent.
-                    #       For details please see wikipedia:
-                    #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
-                    #       (^-^)
-                    prob_predictions[_t] = classifier.predict_probabilities(feats[_t].astype(numpy.float32))
-    
-                # predict the data with all the forests in parallel
-                pool = RequestPool()
-                for t in times:
-                    if t in self.prob_cache:
-                        continue
-                    logger.debug("Predicting object probabilities for time step: {}".format( t ))
-                    req = Request( partial(predict_forest, t) )
-                    pool.add(req)
-    
-                pool.wait()
-                pool.clean()
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: prob_predictions[t][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((prob_predictions[t].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
 
-            for t in times:
-                if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-arrays, indexed as follows:
-                    # prob_predictions[t][object_index, class_index]
-                    self.prob_cache[t] = prob_predictions[t]
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
+        elif slot == self.BadObjects:
+            return bad_objects
 
-            elif slot == self.ProbabilityChannels:
-                try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
+        else:
+            assert False, "Unknown input slot"
 
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
+    def _getTimestepProbabilities(self, t, classifier, selected):
+        """
+        Return the probabilities and the 'bad objects' of all objects in time slice t,
+        from the cache or predicting them first if necessary.
+        """
+        with self.lock:
+            if t in self.prob_cache:
+                return self._getCachedTimestep(t)
+            timestep_lock = self._timestep_locks.setdefault(t, RequestLock())
 
+        # Concurrent requests for the same time slice wait here for the first one
+        with timestep_lock:
+            with self.lock:
+                if t in self.prob_cache:
+                    return self._getCachedTimestep(t)
+                generation = self._cache_generation
+
+            logger.debug("Predicting object probabilities for time step: {}".format( t ))
+            probs, bad_objects = self._predictTimestep(t, classifier, selected)
+
+            with self.lock:
+                if generation == self._cache_generation:
+                    self.prob_cache[t] = probs
+                    self.bad_objects[t] = bad_objects
+                    self._object_cache.pop(t, None)
+                # Later requests find the cached prediction (or predict again if it's stale)
+                if self._timestep_locks.get(t) is timestep_lock:
+                    del self._timestep_locks[t]
+            return probs, bad_objects
+
+    def _getObjectProbabilities(self, t, objects, classifier, selected):
+        """
+        Return the probabilities and the 'bad objects' of the given objects of time slice t.
+        Only the objects that haven't been predicted yet are predicted, and their predictions
+        are cached until all objects of the time slice are known.
+        """
+        with self.lock:
+            if t in self.prob_cache:
+                probs, bad_objects = self._getCachedTimestep(t)
+                return probs[objects], bad_objects[objects]
+            generation = self._cache_generation
+            entry = self._object_cache.get(t)
+            if entry is not None:
+                # (Fancy indexing copies, so these don't change when the cache is updated.)
+                probs, bad_objects, predicted = [a[objects] for a in entry]
             else:
-                assert False, "Unknown input slot"
+                probs = bad_objects = None
+                # Background probability is always zero
+                predicted = (objects == 0)
+
+        if predicted.all():
+            if probs is None:
+                probs = numpy.zeros( (len(objects), len(self.ProbabilityChannels)), dtype=numpy.float32 )
+                bad_objects = numpy.zeros((len(objects),))
+            return probs, bad_objects
+
+        missing = numpy.unique(objects[~predicted])
+        logger.debug("Predicting {} object(s) of time step: {}".format( len(missing), t ))
+        tmpfeats = self.Features([t]).wait()
+        missing_probs, missing_bad_objects = self._predictObjects(tmpfeats, t, missing, classifier, selected)
+
+        if probs is None:
+            probs = numpy.zeros( (len(objects), missing_probs.shape[1]), dtype=missing_probs.dtype )
+            bad_objects = numpy.zeros((len(objects),))
+        index = numpy.searchsorted(missing, objects[~predicted])
+        probs[~predicted] = missing_probs[index]
+        bad_objects[~predicted] = missing_bad_objects[index]
 
-    def propagateDirty(self, slot, subindex, roi):
+        with self.lock:
+            if generation == self._cache_generation and t not in self.prob_cache:
+                self._cacheObjects(t, get_num_objects(tmpfeats[t]), missing, missing_probs, missing_bad_objects)
+        return probs, bad_objects
+
+    def _cacheObjects(self, t, num_objects, objects, probs, bad_objects):
+        # Must be called with self.lock held.
+        entry = self._object_cache.get(t)
+        if entry is None:
+            entry = ( numpy.zeros( (num_objects, probs.shape[1]), dtype=probs.dtype ),
+                      numpy.zeros((num_objects,)),
+                      numpy.zeros((num_objects,), dtype=bool) )
+            entry[2][0] = True # Background probability is always zero
+            self._object_cache[t] = entry
+        all_probs, all_bad_objects, predicted = entry
+        all_probs[objects] = probs
+        all_bad_objects[objects] = bad_objects
+        predicted[objects] = True
+        if predicted.all():
+            # Now it's as good as a prediction of the whole time slice
+            self.prob_cache[t] = all_probs
+            self.bad_objects[t] = all_bad_objects
+            del self._object_cache[t]
+
+    def _getCachedTimestep(self, t):
+        # Must be called with self.lock held.
+        probs = self.prob_cache[t]
+        # The bad objects of probabilities that were loaded from the project file are unknown
+        bad_objects = self.bad_objects.get(t)
+        if bad_objects is None:
+            bad_objects = numpy.zeros((probs.shape[0],))
+        return probs, bad_objects
+
+    def _predictTimestep(self, t, classifier, selected):
+        """
+        Predict all objects of time slice t.
+        Returns the probabilities and the 'bad objects' (1 for objects with missing feature values, 0 otherwise).
+        """
+        tmpfeats = self.Features([t]).wait()
+        num_objects = get_num_objects(tmpfeats[t])
+
+        # Apparently self.Features always returns a background object, 
+        #  so we expect at least 1 object in the list, even if there's nothing to predict.
+        assert num_objects > 0
+        if num_objects == 1:
+            # Just a single value for the 'background object'
+            return numpy.zeros( (1, len(self.ProbabilityChannels)), dtype=numpy.float32 ), numpy.zeros((1,))
+
+        ftmatrix = make_feature_table(tmpfeats, selected).features
+        rows, cols = replace_missing(ftmatrix)
+        bad_objects = numpy.zeros((ftmatrix.shape[0],))
+        bad_objects[rows] = 1
+
+        # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
+        #        and we have to average the PROBABILITIES from all forests.
+        #       Averaging the label predictions from each forest is NOT equivalent.
+        #       For details please see wikipedia:
+        #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
+        #       (^-^)
+        probs = classifier.predict_probabilities(ftmatrix)
+        probs[0] = 0 # Background probability is always zero
+        return probs, bad_objects
+
+    def _predictObjects(self, feats, t, objects, classifier, selected):
+        """
+        Predict the given (foreground) objects of time slice t.
+        Returns their probabilities and 'bad objects', like _predictTimestep().
+        """
+        ftmatrix = make_feature_table(feats, selected, objects={t: objects}).features
+        rows, cols = replace_missing(ftmatrix)
+        bad_objects = numpy.zeros((ftmatrix.shape[0],))
+        bad_objects[rows] = 1
+        return classifier.predict_probabilities(ftmatrix), bad_objects
+
+    def _invalidateCache(self):
+        # Must be called with self.lock held.
         self.prob_cache = {}
-        if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
+        self.bad_objects = {}
+        self._object_cache = {}
+        # Predictions that are still running keep their lock, but nobody else will wait for them.
+        self._timestep_locks = {}
+        self._cache_generation += 1
+
+    def propagateDirty(self, slot, subindex, roi):
+        with self.lock:
+            self._invalidateCache()
+            if slot is self.InputProbabilities:
+                self.prob_cache = self.InputProbabilities([]).wait()
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.ProbabilityChannels.setDirty(())
+        self.BadObjects.setDirty(())
 
-    def createExportTable(self, roi):
+    def createFeatureTable(self, roi):
+        """
+        Return a FeatureTable of all features, the predictions and the
+        probabilities of each class for the time steps in roi (or None if
+        the inputs are not ready).  The prediction and probability columns
+        are only filled if the prediction has been run.
+        """
         if not self.Predictions.ready() or not self.Features.ready():
             return None
-        
+
         features = self.Features(roi).wait()
-        feature_table = OpObjectExtraction.createExportTable(features)
+        nclasses = len(self.ProbabilityChannels)
+        extraColumns = [('Prediction', 1, numpy.uint8)]
+        extraColumns += [('Probability of class %d'%ich, 1, numpy.float32) for ich in range(nclasses)]
+        table = FeatureTable.fromFeatures(features, extraColumns=extraColumns)
+
         predictions = self.Predictions(roi).wait()
-        probs = self.Probabilities(roi).wait()
-        nobjs = []
-        for t, preds in predictions.iteritems():
-            nobjs.append(preds.shape[0])
-        nobjs_total = sum(nobjs)
-        if nobjs_total==0:
+        if sum(preds.shape[0] for preds in predictions.itervalues()) == 0:
             logger.info("Prediction not run yet, won't be exported")
-            return feature_table
-        else:
-            assert nobjs_total==feature_table.shape[0]
-            
-            def fill_column(slot_value, column, name, channel=None):
-                start = 0
-                finish = start
-                for t, values in slot_value.iteritems():
-                    #FIXME: remove the first object, it's always background
-                    finish = start + nobjs[t]
-                    if channel is None:
-                        column[name][start:finish] = values[:]
-                    else:
-                        column[name][start:finish] = values[:, channel]
-                    start = finish
-                    
-            pred_column = numpy.zeros(nobjs_total, {'names': ['Prediction'], 'formats': [numpy.dtype(numpy.uint8)]})
-            fill_column(predictions, pred_column, "Prediction")
-            joint_table = rfn.merge_arrays((feature_table, pred_column), flatten = True, usemask = False)
-            nchannels = probs[0].shape[-1]
-            columns = [feature_table, pred_column]
-            for ich in range(nchannels):
-                prob_column = numpy.zeros(nobjs_total, {'names': ['Probability of class %d'%ich], \
-                                                      'formats': [numpy.dtype(numpy.float32)]})
-                fill_column(probs, prob_column, 'Probability of class %d'%ich, ich)
-                columns.append(prob_column)
-                
-            joint_table = rfn.merge_arrays(columns, flatten = True, usemask = False)
-            return joint_table
+            return table
+
+        probs = self.Probabilities(roi).wait()
+        #FIXME: remove the first object, it's always background
+        for t in features.keys():
+            rows = table.rows(t)
+            assert predictions[t].shape[0] == rows.stop - rows.start
+            table.column('Prediction')[rows, 0] = predictions[t]
+            for ich in range(nclasses):
+                table.column('Probability of class %d'%ich)[rows, 0] = probs[t][:, ich]
+        return table
+
+    def createExportTable(self, roi):
+        table = self.createFeatureTable(roi)
+        if table is None:
+            return None
+        return table.toRecordArray()
 
 
 
@@ -1174,9 +1510,81 @@ class OpRelabelSegmentation(Operator):
     loggingName = __name__ + ".OpRelabelSegmentation"
     logger = logging.getLogger(loggingName)
 
+    def __init__(self, *args, **kwargs):
+        super(OpRelabelSegmentation, self).__init__(*args, **kwargs)
+        # Protects the cache below.  Never held while waiting for requests.
+        self._lock = threading.Lock()
+        self._lookupTables = {} # Indexed by time
+        self._generation = 0 # Incremented whenever the cache is invalidated
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Image.meta)
         self.Output.meta.dtype = self.ObjectMap.meta.mapping_dtype
+        self._invalidateLookupTables()
+
+    @staticmethod
+    def makeLookupTable(tmap, dtype):
+        """
+        Convert an object map (as returned by the ObjectMap slot for a single time step) 
+        into a lookup table of the given dtype.
+        The table has an extra 0 entry at the end: labels without an entry in the 
+        map are clipped to it, so they are mapped to 0 without checking the maximum label.
+        """
+        # FIXME: necessary because predictions are returned
+        # enclosed in a list.
+        if isinstance(tmap, list):
+            tmap = tmap[0]
+        tmap = numpy.asarray(tmap).squeeze()
+        if tmap.ndim==0:
+            # no objects, nothing to paint
+            return numpy.zeros((1,), dtype=dtype)
+        lut = numpy.zeros((len(tmap)+1,), dtype=dtype)
+        lut[:-1] = tmap
+        return lut
+
+    @staticmethod
+    def makeObjectLookupTable(objects, values, dtype):
+        """
+        Like makeLookupTable(), but only for the given (sorted) objects,
+        from the values returned by the ObjectMap slot for a (t, objects) request.
+        """
+        if len(objects) == 0:
+            return numpy.zeros((1,), dtype=dtype)
+        lut = numpy.zeros((objects[-1]+2,), dtype=dtype)
+        values = numpy.asarray(values).reshape(-1)
+        if len(values) == len(objects):
+            lut[objects] = values
+        return lut
+
+    def getLookupTable(self, t, labels=None):
+        """
+        Return the (cached) lookup table for time step t (see makeLookupTable()).
+        If it isn't cached and the ObjectMap accepts (t, objects) requests (meta.object_requests),
+        the table is only made for the objects in the given labels (image), and not cached.
+        This way, only the objects that are visible in a roi need to be predicted.
+        """
+        with self._lock:
+            lut = self._lookupTables.get(t)
+            generation = self._generation
+        if lut is None and labels is not None and self.ObjectMap.meta.object_requests:
+            objects = numpy.unique(labels)
+            values = self.ObjectMap([(t, objects)]).wait()[t]
+            return self.makeObjectLookupTable(objects, values, self.Output.meta.dtype)
+        if lut is None:
+            lut = self.makeLookupTable(self.ObjectMap([t]).wait()[t], self.Output.meta.dtype)
+            with self._lock:
+                if generation == self._generation:
+                    self._lookupTables[t] = lut
+        return lut
+
+    def _invalidateLookupTables(self, times=None):
+        with self._lock:
+            self._generation += 1
+            if times is None:
+                self._lookupTables = {}
+            else:
+                for t in times:
+                    self._lookupTables.pop(t, None)
 
     def execute(self, slot, subindex, roi, result):
         tStart = time.time()
@@ -1184,41 +1592,22 @@ class OpRelabelSegmentation(Operator):
         tIMG = time.time()
         img = self.Image(roi.start, roi.stop).wait()
         tIMG = 1000.0*(time.time()-tIMG)
-        
+
+        tMAP = 0.0
+        tWORK = 0.0
         for t in range(roi.start[0], roi.stop[0]):
-            
-            tMAP = time.time()
-            map_ = self.ObjectMap([t]).wait()
-            tmap = map_[t]
-            # FIXME: necessary because predictions are returned
-            # enclosed in a list.
-            if isinstance(tmap, list):
-                tmap = tmap[0]
-            tmap = tmap.squeeze()
-            if tmap.ndim==0:
-                # no objects, nothing to paint
-                result[t-roi.start[0]][:] = 0
-                return result
-            
-            tMAP = 1000.0*(time.time()-tMAP)
-            #FIXME: This should be cached (and reset when the input becomes dirty)")
-            tMAX = time.time()
-            idx = img.max()
-            
-            if len(tmap) <= idx:
-                newTmap = numpy.zeros((idx + 1,)) # And maybe this should be cached, too?
-                newTmap[:len(tmap)] = tmap[:]
-                tmap = newTmap
-            tMAX = 1000.0*(time.time()-tMAX)
-            
+            tMAP -= time.time()
+            lut = self.getLookupTable(t, img[t-roi.start[0]]).astype(result.dtype, copy=False)
+            tMAP += time.time()
+
             #do the work thing
-            tWORK = time.time()
-            result[t-roi.start[0]] = tmap[img[t-roi.start[0]]]
-            tWORK = 1000.0*(time.time()-tWORK)
-            
+            tWORK -= time.time()
+            numpy.take(lut, img[t-roi.start[0]], out=result[t-roi.start[0]], mode='clip')
+            tWORK += time.time()
+
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tStart = 1000.0*(time.time()-tStart)
-            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f, max: %f)" % (tStart, tIMG, tMAP, tWORK, tMAX))
+            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f)" % (tStart, tIMG, 1000.0*tMAP, 1000.0*tWORK))
         
         return result
 
@@ -1231,14 +1620,17 @@ class OpRelabelSegmentation(Operator):
             # setDirty with a (time, object) pair, while elsewhere we
             # call setDirty with ().
             if len(roi._l) == 0:
+                self._invalidateLookupTables()
                 self.Output.setDirty(slice(None))
             elif isinstance(roi._l[0], int):
+                self._invalidateLookupTables(roi._l)
                 for t in roi._l:
                     self.Output.setDirty(slice(t))
             else:
                 assert len(roi._l[0]) == 2
                 # for each dirty object, only set its bounding box dirty
                 ts = list(set(t for t, _ in roi._l))
+                self._invalidateLookupTables(ts)
                 feats = self.Features(ts).wait()
                 for t, obj in roi._l:
                     min_coords = feats[t][default_features_key]['Coord<Minimum>'][obj].astype(numpy.uint32)
@@ -1254,12 +1646,16 @@ class OpMultiRelabelSegmentation(Operator):
     For instance, map prediction probabilities for different classes
     onto objects.
 
+    The StackedOutput provides all mapped images as channels of a single
+    image, computed with a single lookup per pixel.
+
     """
     name = "OpToImageMulti"
     Image = InputSlot()
     ObjectMaps = InputSlot(stype=Opaque, rtype=List, level=1)
     Features = InputSlot(rtype=List, stype=Opaque) #this is needed to limit dirty propagation to the object bbox
     Output = OutputSlot(level=1)
+    StackedOutput = OutputSlot()
 
     def __init__(self, *args, **kwargs):
         super(OpMultiRelabelSegmentation, self).__init__(*args, **kwargs)
@@ -1267,20 +1663,57 @@ class OpMultiRelabelSegmentation(Operator):
 
     def setupOutputs(self):
         nmaps = len(self.ObjectMaps)
-        for islot in self.ObjectMaps:
+        for islot in self.ObjectMaps[len(self._innerOperators):]:
             op = OpRelabelSegmentation(parent=self)
             op.Image.connect(self.Image)
             op.ObjectMap.connect(islot)
             op.Features.connect(self.Features)
+            op.Output.notifyDirty(partial(self._handleInnerDirty, len(self._innerOperators)))
             self._innerOperators.append(op)
+        for op in self._innerOperators[nmaps:]:
+            op.cleanUp()
+        del self._innerOperators[nmaps:]
         self.Output.resize(nmaps)
         for i, oslot in enumerate(self.Output):
             oslot.connect(self._innerOperators[i].Output)
-            
+
+        if nmaps == 0:
+            self.StackedOutput.meta.NOTREADY = True
+            return
+        assert self.Image.meta.getAxisKeys()[-1] == 'c' and self.Image.meta.shape[-1] == 1
+        self.StackedOutput.meta.assignFrom(self.Image.meta)
+        self.StackedOutput.meta.dtype = self._innerOperators[0].Output.meta.dtype
+        self.StackedOutput.meta.shape = self.Image.meta.shape[:-1] + (nmaps,)
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.StackedOutput
+        image_start = tuple(roi.start[:-1]) + (0,)
+        image_stop = tuple(roi.stop[:-1]) + (1,)
+        img = self.Image(image_start, image_stop).wait()
+        channels = range(roi.start[-1], roi.stop[-1])
+
+        for t in range(roi.start[0], roi.stop[0]):
+            # One table with a column per channel (padded with 0 if the maps differ in length)
+            labels = img[t-roi.start[0]]
+            if any(self.ObjectMaps[c].meta.object_requests for c in channels):
+                # Find the visible objects only once (rather than in each inner operator)
+                labels = numpy.unique(labels)
+            luts = [self._innerOperators[c].getLookupTable(t, labels) for c in channels]
+            table = numpy.zeros((max(map(len, luts)), len(channels)), dtype=result.dtype)
+            for i, lut in enumerate(luts):
+                table[:len(lut)-1, i] = lut[:-1]
+            numpy.take(table, img[t-roi.start[0], ..., 0], axis=0, out=result[t-roi.start[0]], mode='clip')
+        return result
 
     def propagateDirty(self, slot, subindex, roi):
+        # Dirty notifications are handled by the inner operators.
         pass
 
+    def _handleInnerDirty(self, channel, slot, roi):
+        start = tuple(roi.start[:-1]) + (channel,)
+        stop = tuple(roi.stop[:-1]) + (channel+1,)
+        self.StackedOutput.setDirty(start, stop)
+
 class OpMaxLabel(Operator):
     """Finds the maximum label value in the input labels.
 
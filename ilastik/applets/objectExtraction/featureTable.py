@@ -0,0 +1,231 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+
+import numpy
+
+class FeatureTable(object):
+    """
+    A table of object features, stored in a single preallocated, contiguous float32 matrix
+    with one row per object and one matrix column per feature channel.
+    Rows are ordered by time, then by object id.
+
+    Each column (a feature, or an extra column such as the predictions) spans a range of
+    matrix columns, which can be accessed as a view with column().
+    Features are named (plugin, feature); extra columns are named by a plain string.
+
+    The table is written to csv or hdf5 in chunks of rows, so an export never needs
+    a second copy of the whole table.
+    """
+    EXPORT_CHUNK_ROWS = 100000
+
+    def __init__(self, rowCounts, columns, objects=None):
+        """
+        rowCounts: dict of t -> number of objects
+        columns: list of (name, nchannels, exportDtype) tuples
+        objects: optional dict of t -> ids of the objects in the table (default: all objects)
+        """
+        self._rowSlices = collections.OrderedDict()
+        times = []
+        objectIds = []
+        start = 0
+        for t in sorted(rowCounts.keys()):
+            if objects is not None:
+                ids = numpy.asarray(objects[t], dtype=numpy.uint32)
+            else:
+                ids = numpy.arange(rowCounts[t], dtype=numpy.uint32)
+            self._rowSlices[t] = slice(start, start + len(ids))
+            start += len(ids)
+            times.append(numpy.repeat(numpy.uint32(t), len(ids)))
+            objectIds.append(ids)
+        self.times = numpy.concatenate(times) if times else numpy.zeros((0,), dtype=numpy.uint32)
+        self.objectIds = numpy.concatenate(objectIds) if objectIds else numpy.zeros((0,), dtype=numpy.uint32)
+
+        self._columns = collections.OrderedDict()
+        self._numFeatureChannels = 0
+        nchannels_total = 0
+        for name, nchannels, dtype in columns:
+            self._columns[name] = (slice(nchannels_total, nchannels_total + nchannels), numpy.dtype(dtype))
+            nchannels_total += nchannels
+            if isinstance(name, tuple):
+                self._numFeatureChannels = nchannels_total
+        self.matrix = numpy.zeros((start, nchannels_total), dtype=numpy.float32)
+
+    @classmethod
+    def fromFeatures(cls, features, selected=None, objects=None, extraColumns=()):
+        """
+        Create a table from features as produced by the RegionFeatures slot,
+        i.e. a dict of t -> {plugin: {feature: array}}.
+
+        selected: optional dict of plugin -> feature names to include (default: all features)
+        objects: optional dict of t -> ids of the objects to include (default: all objects)
+        extraColumns: (name, nchannels, exportDtype) tuples of columns to append, initialized to zero
+
+        Feature columns are sorted by plugin and feature name.
+        """
+        columns = None
+        rowCounts = {}
+        for t in sorted(features.keys()):
+            timestep_columns = []
+            nobjects = 0
+            for plugin, featname, value in cls._selectedFeatures(features[t], selected):
+                value = numpy.asarray(value)
+                nchannels = value.reshape(len(value), -1).shape[1] if len(value) > 0 else value.shape[-1]
+                timestep_columns.append(((plugin, featname), nchannels, value.dtype))
+                nobjects = max(nobjects, len(value))
+            if columns is None:
+                columns = timestep_columns
+            elif [c[:2] for c in columns] != [c[:2] for c in timestep_columns]:
+                raise Exception('different time slices did not have same features.')
+            rowCounts[t] = nobjects
+
+        table = cls(rowCounts, list(columns or []) + list(extraColumns), objects)
+        for t in rowCounts.keys():
+            rows = table._rowSlices[t]
+            for plugin, featname, value in cls._selectedFeatures(features[t], selected):
+                value = numpy.asarray(value)
+                value = value.reshape(len(value), -1)
+                if objects is not None:
+                    value = value[numpy.asarray(objects[t], dtype=numpy.intp)]
+                table.column((plugin, featname))[rows] = value
+        return table
+
+    @staticmethod
+    def _selectedFeatures(timestep_features, selected):
+        for plugin in sorted(timestep_features.keys()):
+            if selected is not None and plugin not in selected:
+                continue
+            for featname in sorted(timestep_features[plugin].keys()):
+                if selected is not None and featname not in selected[plugin]:
+                    continue
+                yield plugin, featname, timestep_features[plugin][featname]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def features(self):
+        """
+        The feature channels of the matrix, without the extra columns.
+        This is the matrix itself (not a strided view) if there are no extra columns.
+        """
+        if self._numFeatureChannels == self.matrix.shape[1]:
+            return self.matrix
+        return self.matrix[:, :self._numFeatureChannels]
+
+    @property
+    def featureNames(self):
+        """
+        The (plugin, feature) name of each channel of self.features.
+        """
+        names = []
+        for name, (channels, _) in self._columns.iteritems():
+            if isinstance(name, tuple):
+                names.extend([name] * (channels.stop - channels.start))
+        return names
+
+    def column(self, name):
+        """
+        Return a view of the given column, indexed as [row, channel].
+        """
+        return self.matrix[:, self._columns[name][0]]
+
+    def rows(self, t):
+        """
+        Return the slice of rows belonging to time step t.
+        """
+        return self._rowSlices[t]
+
+    def _exportFields(self):
+        """
+        Return (field name, dtype, column name, channel) for each field of the exported table.
+        """
+        fields = []
+        for name, (channels, dtype) in self._columns.iteritems():
+            nchannels = channels.stop - channels.start
+            if isinstance(name, tuple):
+                name = name[0] + ", " + name[1]
+            # Some versions of numpy can't handle unicode names.
+            name = str(name)
+            if nchannels == 1:
+                fields.append((name, dtype, channels.start))
+            else:
+                for ich in range(nchannels):
+                    fields.append((name + "_ch_%d" % ich, dtype, channels.start + ich))
+        return fields
+
+    def exportDtype(self):
+        """
+        The dtype of the record array returned by toRecordArray().
+        """
+        names = ["Object id", "Time"] + [f[0] for f in self._exportFields()]
+        formats = [numpy.uint32, numpy.uint32] + [f[1] for f in self._exportFields()]
+        return numpy.dtype({'names': names, 'formats': formats})
+
+    def toRecordArray(self, start=0, stop=None):
+        """
+        Return rows [start, stop) as a flat record array with the columns
+        (Object id, Time, feature 1, feature 2, ..., extra columns),
+        where features with several channels are split into one column per channel.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        table = numpy.zeros(max(stop - start, 0), dtype=self.exportDtype())
+        table["Object id"] = self.objectIds[start:stop]
+        table["Time"] = self.times[start:stop]
+        for name, _, channel in self._exportFields():
+            table[name] = self.matrix[start:stop, channel]
+        return table
+
+    def _chunks(self, chunkRows):
+        chunkRows = chunkRows or self.EXPORT_CHUNK_ROWS
+        for start in range(0, len(self), chunkRows):
+            yield start, min(start + chunkRows, len(self))
+
+    def writeCsv(self, filename, chunkRows=None):
+        """
+        Write the exported table (see toRecordArray()) to a csv file, chunk by chunk.
+        """
+        dtype = self.exportDtype()
+        formats = []
+        for name in dtype.names:
+            if dtype[name].kind in 'iub':
+                formats.append('%d')
+            else:
+                formats.append('%.9g')
+        with open(filename, 'w') as csv_file:
+            # Remove any commas in the header (this is csv, after all)
+            csv_file.write(','.join(name.replace(',', '/') for name in dtype.names) + '\n')
+            for start, stop in self._chunks(chunkRows):
+                numpy.savetxt(csv_file, self.toRecordArray(start, stop), fmt=formats, delimiter=',')
+
+    def writeHdf5(self, group, name, chunkRows=None, compression='gzip'):
+        """
+        Write the exported table (see toRecordArray()) as a compound dataset
+        of the given h5py group (or file), chunk by chunk.
+        Returns the dataset.
+        """
+        chunkRows = chunkRows or self.EXPORT_CHUNK_ROWS
+        chunks = (min(chunkRows, len(self)),) if len(self) > 0 else None
+        dataset = group.create_dataset(name, shape=(len(self),), dtype=self.exportDtype(),
+                                       chunks=chunks, compression=compression if chunks else None)
+        for start, stop in self._chunks(chunkRows):
+            dataset[start:stop] = self.toRecordArray(start, stop)
+        return dataset
@@ -21,7 +21,9 @@
 #Python
 from copy import copy, deepcopy
 import collections
+import itertools
 from collections import defaultdict
+from functools import partial
 
 #SciPy
 import numpy as np
@@ -33,6 +35,7 @@ from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
 from lazyflow.roi import roiToSlice, sliceToRoi
 from lazyflow.operators import OpLabelVolume, OpMultiArraySlicer2, OpMultiArrayStacker, OpArrayCache, OpCompressedCache
+from lazyflow.request import Request, RequestPool
 
 import logging
 logger = logging.getLogger(__name__)
@@ -44,6 +47,8 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.featureTable import FeatureTable
+from ilastik.config import cfg as ilastik_config
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -110,6 +115,110 @@ def make_bboxes(binary_bbox, margin):
     return passed, context
 
 
+class _RegionStatistics(object):
+    """Per-object statistics that are accumulated block by block.
+
+    The partial statistics of each block are merged exactly into the
+    running totals, so objects that cross block boundaries get the same
+    features as if the whole volume had been processed at once.  Only the
+    per-object totals are kept, not the blocks.
+
+    """
+    def __init__(self, nchannels, coord_axes):
+        self.coord_axes = coord_axes
+        ncoords = len(coord_axes)
+        self.count = np.zeros((0,))
+        self.sum = np.zeros((0, nchannels))
+        self.m2 = np.zeros((0, nchannels))
+        self.minimum = np.zeros((0, nchannels))
+        self.maximum = np.zeros((0, nchannels))
+        self.coord_sum = np.zeros((0, ncoords))
+        self.coord_min = np.zeros((0, ncoords), dtype=np.int64)
+        self.coord_max = np.zeros((0, ncoords), dtype=np.int64)
+
+    def _grow(self, nlabels):
+        """Make room for the labels 0..nlabels-1"""
+        n = nlabels - self.count.shape[0]
+        if n <= 0:
+            return
+        for name, fill in [("count", 0), ("sum", 0), ("m2", 0),
+                           ("minimum", np.inf), ("maximum", -np.inf),
+                           ("coord_sum", 0),
+                           ("coord_min", np.iinfo(np.int64).max),
+                           ("coord_max", np.iinfo(np.int64).min)]:
+            a = getattr(self, name)
+            pad = np.empty((n,) + a.shape[1:], dtype=a.dtype)
+            pad[...] = fill
+            setattr(self, name, np.concatenate((a, pad)))
+
+    def add_block(self, raw, labels, offset):
+        """Add the statistics of one block.
+
+        raw has the shape labels.shape + (nchannels,); offset is the global
+        coordinate of the first pixel of the block.
+
+        """
+        foreground = np.nonzero(labels)
+        if len(foreground[0]) == 0:
+            return
+        lab = labels[foreground].astype(np.intp)
+        values = raw[foreground].astype(np.float64)
+        coords = np.column_stack([foreground[i] + offset[i] for i in self.coord_axes])
+
+        nlabels = lab.max() + 1
+        self._grow(nlabels)
+
+        def bincount(weights):
+            return np.column_stack([np.bincount(lab, weights[:, i], minlength=nlabels)
+                                    for i in range(weights.shape[1])])
+
+        n_b = np.bincount(lab, minlength=nlabels).astype(np.float64)
+        sum_b = bincount(values)
+        mean_b = sum_b / np.maximum(n_b, 1)[:, None]
+        m2_b = bincount((values - mean_b[lab])**2)
+
+        # Merge the variances (Chan et al., "Updating Formulae and a Pairwise
+        # Algorithm for Computing Sample Variances")
+        n_a = self.count[:nlabels]
+        n = n_a + n_b
+        delta = mean_b - self.sum[:nlabels] / np.maximum(n_a, 1)[:, None]
+        self.m2[:nlabels] += m2_b + delta**2 * (n_a * n_b / np.maximum(n, 1))[:, None]
+        self.count[:nlabels] = n
+        self.sum[:nlabels] += sum_b
+        self.coord_sum[:nlabels] += bincount(coords)
+
+        # Minima and maxima of all objects present in the block
+        order = np.argsort(lab, kind='mergesort')
+        sorted_lab = lab[order]
+        first = np.flatnonzero(np.r_[True, sorted_lab[1:] != sorted_lab[:-1]])
+        ids = sorted_lab[first]
+        for target, ufunc, data in [(self.minimum, np.minimum, values),
+                                    (self.maximum, np.maximum, values),
+                                    (self.coord_min, np.minimum, coords),
+                                    (self.coord_max, np.maximum, coords)]:
+            target[ids] = ufunc(target[ids], ufunc.reduceat(data[order], first, axis=0))
+
+    def features(self):
+        """The merged features of all objects, without the background object."""
+        count = self.count[1:, None]
+        present = count[:, 0] > 0
+        def valid(a):
+            # objects that were never seen have no minimum or maximum
+            a = a[1:].astype(np.float64)
+            a[~present] = 0
+            return a
+        nonzero = np.maximum(count, 1)
+        return { "Count" : count,
+                 "Sum" : self.sum[1:],
+                 "Mean" : self.sum[1:] / nonzero,
+                 "Variance" : self.m2[1:] / nonzero,
+                 "Minimum" : valid(self.minimum),
+                 "Maximum" : valid(self.maximum),
+                 "RegionCenter" : self.coord_sum[1:] / nonzero,
+                 "Coord<Minimum>" : valid(self.coord_min),
+                 "Coord<Maximum>" : valid(self.coord_max) }
+
+
 class OpRegionFeatures3d(Operator):
     """Produces region features for a 3d image.
 
@@ -125,6 +234,12 @@ class OpRegionFeatures3d(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * BlockShape : optional (x, y, z) block shape.  If given, the features
+      are computed block by block and only one block is held in memory at a
+      time.  This is only possible if all requested features can be merged
+      exactly across blocks (see BLOCKWISE_FEATURES), otherwise the whole
+      volume is loaded as usual.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -134,9 +249,17 @@ class OpRegionFeatures3d(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True)
 
     Output = OutputSlot()
 
+    # Local (per-object) features are computed in parallel for batches of this many objects.
+    LOCAL_FEATURES_BATCH_SIZE = 500
+
+    # The features that can be computed block by block (see BlockShape)
+    BLOCKWISE_FEATURES = set(["Count", "Sum", "Mean", "Variance", "Minimum", "Maximum",
+                              "RegionCenter", "Coord<Minimum>", "Coord<Maximum>"])
+
     def setupOutputs(self):
         if self.LabelVolume.meta.axistags != self.RawVolume.meta.axistags:
             raise Exception('raw and label axis tags do not match')
@@ -171,6 +294,18 @@ class OpRegionFeatures3d(Operator):
         assert slot == self.Output
         import time
         start = time.time()
+
+        if self.BlockShape.ready() and self.BlockShape.value is not None:
+            feature_names = self.Features([]).wait()
+            if self._can_extract_blockwise(feature_names):
+                acc = self._extract_blockwise(feature_names, self.BlockShape.value)
+                result[tuple(roi.start)] = acc
+                stop = time.time()
+                logger.debug("TIMING: computing features blockwise took {:.3f}s".format(stop-start))
+                return result
+            logger.warn("Some of the selected features can not be merged across blocks."
+                        " Computing the features on the whole volume instead.")
+
         # Process ENTIRE volume
         rawVolume = self.RawVolume[:].wait()
         labelVolume = self.LabelVolume[:].wait()
@@ -220,12 +355,51 @@ class OpRegionFeatures3d(Operator):
 
         return result
 
+    def compute_extents(self, image, mincoords, maxcoords, axes, margin):
+        """Vectorized version of compute_extent(): make the slicings 
+        for all objects at once.
+
+        Returns (starts, stops), with one row per object and 
+        one column per spatial axis of the image (in the image's axis order).
+
+        """
+        nobj = mincoords.shape[0]
+        ndim = len(image.shape)
+        starts = np.zeros((nobj, ndim), dtype=np.int64)
+        stops = np.ones((nobj, ndim), dtype=np.int64)
+        for ax in (axes.x, axes.y, axes.z):
+            if ax >= mincoords.shape[1]:
+                # No z coordinates (2D data).
+                continue
+            # Coord<Minimum> and Coord<Maximum> give us the [min,max]
+            # coords of the object, but we want the bounding box: [min,max), so add 1
+            starts[:, ax] = np.maximum(mincoords[:, ax] - margin[ax], 0)
+            stops[:, ax] = np.minimum(maxcoords[:, ax] + 1 + margin[ax], image.shape[ax])
+        return starts, stops
+
     def compute_rawbbox(self, image, extent, axes):
         """essentially returns image[extent], preserving all channels."""
         key = copy(extent)
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
+    def _compute_local_batch(self, image, labels, local_plugins, starts, stops, first, axes):
+        """Compute the local features for the objects first, first+1, ...,
+        whose (margin-extended) bounding boxes are given by starts and stops.
+
+        Returns a list with one entry per object: [(plugin_name, features), ...]
+
+        """
+        results = []
+        for i, (start, stop) in enumerate(zip(starts, stops)):
+            extent = [ slice(start[ax], stop[ax]) for ax in (0, 1, 2) ]
+            rawbbox = self.compute_rawbbox(image, extent, axes)
+            #it's i+1 here, because the background has label 0
+            binary_bbox = np.asarray(labels[tuple(extent)] == first+i+1)
+            results.append( [ (plugin_name, plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes))
+                              for plugin_name, plugin_object, feature_dict in local_plugins ] )
+        return results
+
     def _extract(self, image, labels):
         if not (image.ndim == labels.ndim == 4):
             raise Exception("both images must be 4D. raw image shape: {}"
@@ -311,19 +485,33 @@ class OpRegionFeatures3d(Operator):
             
                             
         if np.any(margin) > 0:
-            #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
-                for plugin_name, feature_dict in feature_names.iteritems():
-                    if not has_local_features[plugin_name]:
-                        continue
+            local_plugins = []
+            for plugin_name, feature_dict in feature_names.iteritems():
+                if has_local_features[plugin_name]:
                     plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+                    local_plugins.append( (plugin_name, plugin.plugin_object, feature_dict) )
+
+            # The bounding boxes of all objects are known from the global pass.
+            starts, stops = self.compute_extents(image, mincoords, maxcoords, axes, margin)
+
+            # Compute the objects in batches, in parallel.
+            batch_size = self.LOCAL_FEATURES_BATCH_SIZE
+            batch_results = [None] * ((nobj + batch_size - 1) // batch_size)
+            def compute_batch(batch_index):
+                first = batch_index * batch_size
+                batch_results[batch_index] = self._compute_local_batch(
+                    image, labels, local_plugins, starts[first:first+batch_size], stops[first:first+batch_size], first, axes)
+
+            pool = RequestPool()
+            for batch_index in range(len(batch_results)):
+                pool.add( Request( partial(compute_batch, batch_index) ) )
+            pool.wait()
+
+            # Assemble the results in object order
+            for batch in batch_results:
+                for object_feats in batch:
+                    for plugin_name, feats in object_feats:
+                        local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
@@ -346,7 +534,12 @@ class OpRegionFeatures3d(Operator):
             all_features[name] = dict(d1.items() + d2.items())
         all_features[default_features_key]=extrafeats
 
-        # reshape all features
+        self._add_background(all_features, nobj)
+        logger.debug("merged, returning")
+        return all_features
+
+    def _add_background(self, all_features, nobj):
+        """Reshape all features in place and prepend a row for the background object."""
         for pfeats in all_features.itervalues():
             for key, value in pfeats.iteritems():
                 if value.shape[0] != nobj:
@@ -363,12 +556,66 @@ class OpRegionFeatures3d(Operator):
                 assert value.ndim == 2
 
                 pfeats[key] = value
-        logger.debug("merged, returning")
+
+    def _can_extract_blockwise(self, feature_names):
+        for plugin_name, feature_dict in feature_names.iteritems():
+            if plugin_name != "Standard Object Features":
+                return False
+            if not set(feature_dict.keys()) <= self.BLOCKWISE_FEATURES:
+                return False
+        return True
+
+    def _extract_blockwise(self, feature_names, blockshape):
+        """Compute the features block by block and merge the per-object 
+        partial statistics of all blocks.
+
+        Returns the same nested dictionary as _extract().
+
+        """
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        axes = taggedShape.keys()
+        spatial = [k for k in axes if k in 'xyz']
+        # Coordinate features have one column per spatial axis (in array order),
+        # except for z in 2D images.
+        coord_axes = [i for i, k in enumerate(spatial) if not (k == 'z' and taggedShape['z'] == 1)]
+
+        blockshape = dict(zip('xyz', blockshape))
+        perm = [axes.index(k) for k in spatial] + [axes.index('c')]
+        if 't' in axes:
+            perm.append(axes.index('t'))
+
+        def read(slot, start, stop):
+            # Returns the block with the spatial axes first, followed by channels.
+            a = np.asarray(slot(start, stop).wait()).transpose(perm)
+            return a.reshape(a.shape[:len(spatial)+1])
+
+        stats = _RegionStatistics(taggedShape['c'], coord_axes)
+        blockstarts = itertools.product(*[range(0, taggedShape[k], blockshape[k]) for k in spatial])
+        for blockstart in blockstarts:
+            blockstart = dict(zip(spatial, blockstart))
+            start = [blockstart.get(k, 0) for k in axes]
+            stop = [min(blockstart[k] + blockshape[k], taggedShape[k]) if k in blockstart else taggedShape[k]
+                    for k in axes]
+            raw = read(self.RawVolume, start, stop)
+            labels = read(self.LabelVolume, start, stop)[..., 0]
+            stats.add_block(raw, labels, [blockstart[k] for k in spatial])
+
+        features = stats.features()
+        nobj = features["Count"].shape[0]
+
+        all_features = {}
+        for plugin_name, feature_dict in feature_names.iteritems():
+            all_features[plugin_name] = dict((k, features[k]) for k in feature_dict)
+        all_features[default_features_key] = dict((k, features[k]) for k in default_features)
+        self._add_background(all_features, nobj)
         return all_features
 
     def propagateDirty(self, slot, subindex, roi):
         if slot is self.Features:
             self.Output.setDirty(slice(None))
+        elif slot is self.BlockShape:
+            # The features do not depend on the block shape
+            pass
         else:
             axes = self.RawVolume.meta.getTaggedShape().keys()
             dirtyStart = collections.OrderedDict(zip(axes, roi.start))
@@ -392,6 +639,7 @@ class OpRegionFeatures(Operator):
     RawImage = InputSlot()
     LabelImage = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True) # see OpRegionFeatures3d
     Output = OutputSlot()
 
     # Schematic:
@@ -423,6 +671,7 @@ class OpRegionFeatures(Operator):
         self.opRegionFeatures3dBlocks.RawVolume.connect(self.opRawTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.LabelVolume.connect(self.opLabelTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.Features.connect(self.Features)
+        self.opRegionFeatures3dBlocks.BlockShape.connect(self.BlockShape)
         assert self.opRegionFeatures3dBlocks.Output.level == 1
 
         self.opTimeStacker = OpMultiArrayStacker(parent=self)
@@ -449,6 +698,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot(optional=True) # see OpRegionFeatures3d
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -469,6 +719,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawImage.connect(self.RawImage)
         self._opRegionFeatures.LabelImage.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.BlockShape.connect(self.BlockShape)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -628,6 +879,11 @@ class OpObjectExtraction(Operator):
     # for example {"Standard Object Features": {"Mean in neighborhood":{"margin": (5, 5, 2)}}}
     Features = InputSlot(rtype=List, stype=Opaque, value={})
 
+    # optional (x, y, z) block shape for computing the region features block by block,
+    # instead of loading the whole volume (see OpRegionFeatures3d).
+    # Defaults to cubes of the block_size given in the [object_extraction] config section.
+    RegionFeaturesBlockShape = InputSlot(optional=True)
+
     LabelImage = OutputSlot()
     ObjectCenterImage = OutputSlot()
 
@@ -679,6 +935,7 @@ class OpObjectExtraction(Operator):
         self._opRegFeats.RawImage.connect(self.RawImage)
         self._opRegFeats.LabelImage.connect(self._opLabelVolume.CachedOutput)
         self._opRegFeats.Features.connect(self.Features)
+        self._opRegFeats.BlockShape.connect(self.RegionFeaturesBlockShape)
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
@@ -692,6 +949,10 @@ class OpObjectExtraction(Operator):
         self._opCenterCache.name = "OpObjectExtraction._opCenterCache"
         self._opCenterCache.Input.connect(self._opObjectCenterImage.Output)
 
+        block_size = ilastik_config.getint('object_extraction', 'block_size')
+        if block_size > 0:
+            self.RegionFeaturesBlockShape.setValue((block_size,)*3)
+
         # connect outputs
         self.LabelImage.connect(self._opLabelVolume.CachedOutput)
         self.ObjectCenterImage.connect(self._opCenterCache.Output)
@@ -746,68 +1007,9 @@ class OpObjectExtraction(Operator):
         ''' This function takes the features as produced by the RegionFeatures slot
             and transforms them into a flat table, which is later used for exporting
             object-level data to csv and h5 files. The columns of the table are as follows:
-            (t, object index, feature 1, feature 2, ...). Row-wise object index increases
-            faster than time, so first all objects for time 0 are exported, then for time 1, etc  '''
-       
-        ntimes = len(features.keys())
-        nplugins = len(features[0].keys())
-        nchannels = 0
-        nobjects = []
-        dtype_names = []
-        dtype_types = []
-        for t, plugin_name in features.iteritems():
-            feat0 = plugin_name.values()[0]
-            feat0_name = feat0.keys()[0]
-            feat0_array = feat0.values()[0]
-            nobjects.append(feat0_array.shape[0])
-                
-                
-        for plugin_name, plugins in features[0].iteritems():
-            for feature_name, feature_array in plugins.iteritems():
-                feature_channels = feature_array.shape[-1]
-                nchannels += feature_channels
-                if feature_channels==1:
-                    dtype_names.append(plugin_name + ", "+feature_name)
-                    dtype_types.append(feature_array.dtype)
-                else:
-                    for ich in range(feature_channels):
-                        dtype_names.append(plugin_name + ", "+ feature_name+"_ch_%d"%ich)
-                        dtype_types.append(feature_array.dtype)
-                    
-        nchannels += 2 #true channels + time value + explicit object id
-        
-        dtype_names.insert(0, "Time")
-        dtype_names.insert(0, "Object id")
-        
-        # Some versions of numpy can't handle unicode names.
-        # Convert to str.
-        dtype_names = map(str, dtype_names)
-        
-        dtype_types.insert(0, np.dtype(np.uint32).str)
-        dtype_types.insert(0, np.dtype(np.uint32).str)
-        
-        nobjects_total = sum(nobjects)
-        
-        table = np.zeros(nobjects_total, dtype = {'names': dtype_names, 'formats': dtype_types})
-        
-        #table = np.zeros(4, dtype = {'names': ['Mean', 'Coord<Maximum>_ch_0'], \
-        #                           'formats': [np.dtype(np.uint32), np.dtype(np.uint8)]})
-        
-        
-        start = 0
-        finish = start
-        for itime in range(ntimes):
-            finish = start+nobjects[itime]
-            table["Object id"][start: finish] = np.arange(nobjects[itime])
-            table["Time"][start: finish] = itime
-            nfeat = 2
-            for plugin_name, plugins in features[itime].iteritems():
-                for feature_name, feature_array in plugins.iteritems():
-                    nchannels = feature_array.shape[-1]
-                    for ich in range(nchannels):
-                        table[dtype_names[nfeat]][start: finish] = feature_array[:, ich]
-                        nfeat += 1
-            start = finish
-        
-        return table
+            (object index, t, feature 1, feature 2, ...). Row-wise object index increases
+            faster than time, so first all objects for time 0 are exported, then for time 1, etc.
+            To export large tables without building the whole record array, use
+            FeatureTable.fromFeatures(features) and its writeCsv()/writeHdf5() methods. '''
+        return FeatureTable.fromFeatures(features).toRecordArray()
         
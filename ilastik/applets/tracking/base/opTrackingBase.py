@@ -18,13 +18,18 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+import collections
+import multiprocessing
+from collections import namedtuple
+from functools import partial
+
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 
 import numpy as np
 import pgmlink
-from ilastik.applets.tracking.base.trackingUtilities import relabel,\
+from ilastik.applets.tracking.base.trackingUtilities import relabel_lut, apply_lut,\
     get_dict_value
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction import config
@@ -33,10 +38,52 @@ from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.valueProviders import OpZeroDefault
 
 from lazyflow.roi import sliceToRoi
+from lazyflow.request import Request
 
 import logging
 logger = logging.getLogger(__name__)
 
+# The objects of one frame that passed the filter, ready to be added to the traxelstore
+_TraxelFrame = namedtuple('_TraxelFrame', ['num_objects', 'ids', 'filtered', 'com', 'com_corrected',
+                                           'count', 'lower', 'excerpts'])
+
+# One step of the track id computation (between two time steps, see OpTrackingBase._setLabel2Color()):
+#  the events it was computed from, the next track id before the step, and the (time step, labels) of
+#  the objects of earlier time steps that got a new track id in the step
+_TrackStep = namedtuple('_TrackStep', ['events', 'maxIdBefore', 'fillIns'])
+
+# The events that determine the track ids
+_TRACK_EVENTS = ('app', 'mov', 'div', 'multiMove')
+
+def _events_equal(events_at, track_events):
+    events_at = dict( (k, v) for k, v in events_at.items() if k in _TRACK_EVENTS )
+    if set(events_at.keys()) != set(track_events.keys()):
+        return False
+    return all( np.array_equal(np.asarray(v), track_events[k]) for k, v in events_at.items() )
+
+def _grow(ids, labels):
+    # make the track id array large enough for the given labels, new entries are -1 (no track)
+    size = int(np.max(labels)) + 1 if len(labels) else 0
+    if size <= len(ids):
+        return ids
+    grown = -np.ones((size,), dtype=np.int64)
+    grown[:len(ids)] = ids
+    return grown
+
+def _luts_equal(lut1, lut2):
+    # labels beyond the end of a table are mapped to its last entry (1), see apply_lut()
+    n = max(len(lut1), len(lut2))
+    padded1 = np.ones((n,), dtype=np.int64)
+    padded1[:len(lut1)] = lut1
+    padded2 = np.ones((n,), dtype=np.int64)
+    padded2[:len(lut2)] = lut2
+    return np.array_equal(padded1, padded2)
+
+def _set_feature_array(traxel, name, values):
+    traxel.add_feature_array(name, len(values))
+    for i, v in enumerate(values):
+        traxel.set_feature_value(name, i, float(v))
+
 class OpTrackingBase(Operator):
     name = "Tracking"
     category = "other"
@@ -53,14 +100,26 @@ class OpTrackingBase(Operator):
     CleanBlocks = OutputSlot()
     AllBlocks = OutputSlot() 
     OutputHdf5 = OutputSlot()
+
+    # The number of frames that are prepared ahead of the one that is added to the traxelstore
+    TRAXEL_FRAME_PREFETCH = max( 2, multiprocessing.cpu_count() )
     CachedOutput = OutputSlot() # For the GUI (blockwise-access)
         
     Output = OutputSlot()    
     
     def __init__(self, parent=None, graph=None):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)        
-        self.label2color = []  
         self.mergers = []
+        # The track id of each object, one array (indexed by label) per time step; -1: no track.
+        # The steps between time steps are computed incrementally from the events (see _setLabel2Color())
+        self._trackIds = []
+        self._trackSteps = []
+        self._trackKey = None
+        self._maxTrackId = 2
+        self._filteredLabels = {}
+        # Dense lookup tables for label2color and mergers (see relabel_lut())
+        self._label2colorLuts = []
+        self._mergerLuts = []
     
         self._opCache = OpCompressedCache( parent=self )        
         self._opCache.InputHdf5.connect( self.InputHdf5 )
@@ -129,14 +188,14 @@ class OpTrackingBase(Operator):
             t_start = roi.start[0]
             t_end = roi.stop[0]
             for t in range(t_start, t_end):
-                if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0]) and len(self.label2color) > t:                
-                    result[t-t_start, ..., 0] = relabel(result[t-t_start, ..., 0], self.label2color[t])
+                if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0]) and len(self._label2colorLuts) > t:                
+                    result[t-t_start, ..., 0] = apply_lut(result[t-t_start, ..., 0], self._label2colorLuts[t])
                 else:
                     result[t-t_start,...] = 0
             return result         
         elif slot == self.AllBlocks:            
             # if nothing was computed, return empty list
-            if len(self.label2color) == 0:
+            if len(self._label2colorLuts) == 0:
                 result[0] = []
                 return result 
             
@@ -161,7 +220,30 @@ class OpTrackingBase(Operator):
     def setInSlot(self, slot, subindex, roi, value):
         assert slot == self.InputHdf5, "Invalid slot for setInSlot(): {}".format( slot.name )
         
+    @property
+    def label2color(self):
+        """
+        The track id of each object, as a list (one per time step) of dicts label -> track id.
+        Filtered objects have track id 0.
+        """
+        label2color = []
+        for t in range(len(self._trackIds)):
+            colors = self._colorsAt(t)
+            labels = np.flatnonzero(colors >= 0)
+            labels = labels[labels > 0]
+            label2color.append( dict( zip( labels.tolist(), colors[labels].tolist() ) ) )
+        return label2color
+
     def _setLabel2Color(self, successive_ids=True):
+        """
+        Assign a track id to each object from the events.
+
+        The track ids are computed step by step (from one time step to the next).  The steps whose
+        events are unchanged since the last call are kept, only the steps from the first changed one
+        on are recomputed.  The outputs are only marked dirty for the time steps whose mapping changed.
+        The same holds if only the end of the time range changed, so a result that grows at the end
+        (as with sliding window tracking) is streamed incrementally.
+        """
         if not self.EventsVector.ready() or not self.Parameters.ready() \
             or not self.FilteredLabels.ready():            
             return
@@ -171,104 +253,183 @@ class OpTrackingBase(Operator):
         time_min, time_max = parameters['time_range']
         time_range = range(time_min, time_max)
 
-        filtered_labels = self.FilteredLabels.value
-                                                    
-        label2color = []
-        label2color.append({})
-        mergers = []
-        
-        maxId = 2 #  misdetections have id 1
-        
-        # handle start time offsets
-        for i in range(time_range[0]):            
-            label2color.append({})
-            mergers.append({})
-        
-        for i in time_range:
-            dis = get_dict_value(events[str(i-time_range[0]+1)], "dis", [])
-            app = get_dict_value(events[str(i-time_range[0]+1)], "app", [])
-            div = get_dict_value(events[str(i-time_range[0]+1)], "div", [])
-            mov = get_dict_value(events[str(i-time_range[0]+1)], "mov", [])
+        oldLuts = self._label2colorLuts
+        oldMergers = self.mergers
+        touched = set()
+
+        key = (time_min, successive_ids)
+        fullUpdate = key != self._trackKey
+        if fullUpdate:
+            # start from scratch
+            self._trackIds = [ np.zeros((0,), dtype=np.int64) for t in range(time_min + 1) ]
+            self._trackSteps = []
+            self._trackKey = key
+            self._maxTrackId = 2 #  misdetections have id 1
+
+        # find the first step whose events changed
+        first = 0
+        while first < min(len(time_range), len(self._trackSteps)) and \
+              _events_equal(events[str(first+1)], self._trackSteps[first].events):
+            first += 1
+
+        # undo the steps from there on
+        for step in reversed(self._trackSteps[first:]):
+            for t, labels in step.fillIns:
+                self._trackIds[t][labels] = -1
+                touched.add(t)
+            self._maxTrackId = step.maxIdBefore
+        touched.update(range(time_min + first + 1, len(self._trackIds)))
+        del self._trackSteps[first:]
+        del self._trackIds[time_min + first + 1:]
+
+        for i in time_range[first:]:
+            step = self._trackStep(i, events[str(i-time_range[0]+1)], successive_ids)
+            self._trackSteps.append(step)
+            touched.update(t for t, _ in step.fillIns)
+            touched.add(i+1)
+        logger.info( "recomputed the tracks of {} of {} time steps".format( len(time_range) - first, len(time_range) ) )
+
+        mergers = [ {} for i in range(time_range[0]) ]
+        for i in time_range + [time_range[-1] + 1]:
             merger = get_dict_value(events[str(i-time_range[0])], "merger", [])
-            multi = get_dict_value(events[str(i-time_range[0]+1)], "multiMove", [])
-            
-            logger.info( " {} dis at {}".format( len(dis), i ) )
-            logger.info( " {} app at {}".format( len(app), i ) )
-            logger.info( " {} div at {}".format( len(div), i ) )
-            logger.info( " {} mov at {}".format( len(mov), i ) )
-            logger.info( " {} merger at {}".format( len(merger), i ) )
-            logger.info( " {} multiMoves at {}\n".format( len(multi), i ) )
-            
-            label2color.append({})
-            mergers.append({})
-            moves_at = []
-                        
-            for e in app:
-                if successive_ids:
-                    label2color[-1][int(e[0])] = maxId
-                    maxId += 1
-                else:
-                    label2color[-1][int(e[0])] = np.random.randint(1, 255)
-
-            for e in mov:                
-                if not label2color[-2].has_key(int(e[0])):
-                    if successive_ids:
-                        label2color[-2][int(e[0])] = maxId
-                        maxId += 1
-                    else:
-                        label2color[-2][int(e[0])] = np.random.randint(1, 255)
-                label2color[-1][int(e[1])] = label2color[-2][int(e[0])]
-                moves_at.append(int(e[0]))
-
-            for e in div:
-                if not label2color[-2].has_key(int(e[0])):
-                    if successive_ids:
-                        label2color[-2][int(e[0])] = maxId
-                        maxId += 1
-                    else:
-                        label2color[-2][int(e[0])] = np.random.randint(1, 255)
-                ancestor_color = label2color[-2][int(e[0])]
-                label2color[-1][int(e[1])] = ancestor_color
-                label2color[-1][int(e[2])] = ancestor_color
-            
-            for e in merger:
-                mergers[-1][int(e[0])] = int(e[1])
-
-            for e in multi:
-                if int(e[2]) >= 0 and not label2color[time_range[0] + int(e[2])].has_key(int(e[0])):
-                    if successive_ids:
-                        label2color[time_range[0] + int(e[2])][int(e[0])] = maxId
-                        maxId += 1
-                    else:
-                        label2color[time_range[0] + int(e[2])][int(e[0])] = np.random.randint(1, 255)
-                label2color[-1][int(e[1])] = label2color[time_range[0] + int(e[2])][int(e[0])]
-
-        # last timestep
-        merger = get_dict_value(events[str(time_range[-1] - time_range[0] + 1)], "merger", [])
-        mergers.append({})
-        for e in merger:
-            mergers[-1][int(e[0])] = int(e[1])
-
-
-        # mark the filtered objects
-        for i in filtered_labels.keys():
-            if int(i)+time_range[0] >= len(label2color):
-                continue
-            fl_at = filtered_labels[i]
-            for l in fl_at:
-                assert l not in label2color[int(i)+time_range[0]]
-                label2color[int(i)+time_range[0]][l] = 0                
-
-        self.label2color = label2color
-        self.mergers = mergers        
-        
+            mergers.append( dict( (int(e[0]), int(e[1])) for e in merger ) )
+
+        # the filtered objects
+        filteredLabels = {}
+        for i in self.FilteredLabels.value.keys():
+            if int(i)+time_range[0] < len(self._trackIds):
+                filteredLabels[int(i)+time_range[0]] = np.asarray(self.FilteredLabels.value[i], dtype=np.int64)
+        for t in set(filteredLabels.keys()) | set(self._filteredLabels.keys()):
+            if t not in filteredLabels or t not in self._filteredLabels or \
+               not np.array_equal(filteredLabels[t], self._filteredLabels[t]):
+                touched.add(t)
+        self._filteredLabels = filteredLabels
+
+        self.mergers = mergers
+        self._updateLuts(None if fullUpdate else touched)
+
+        # with a different start of the time range, the output changes everywhere
+        changed = [ t for t in range(max(len(oldLuts), len(self._label2colorLuts)))
+                    if fullUpdate or t >= len(oldLuts) or t >= len(self._label2colorLuts) or
+                       (t in touched and not _luts_equal(oldLuts[t], self._label2colorLuts[t])) ]
         self.Output._value = None
-        self.Output.setDirty(slice(None))
+        self._setTimesDirty(self.Output, changed, fullUpdate)
 
         if 'MergerOutput' in self.outputs:
+            changed = [ t for t in range(max(len(oldMergers), len(mergers)))
+                        if fullUpdate or t >= len(oldMergers) or t >= len(mergers) or oldMergers[t] != mergers[t] ]
             self.MergerOutput._value = None
-            self.MergerOutput.setDirty(slice(None))            
-        
+            self._setTimesDirty(self.MergerOutput, changed, fullUpdate)
+
+    def _trackStep(self, i, events_at, successive_ids):
+        """
+        Assign the track ids of time step i+1 from the events between time steps i and i+1.
+        Objects of earlier time steps without a track id get a new one if they are continued.
+        """
+        dis = get_dict_value(events_at, "dis", [])
+        app = np.asarray(get_dict_value(events_at, "app", []), dtype=np.int64).reshape((-1, 2))
+        div = np.asarray(get_dict_value(events_at, "div", []), dtype=np.int64).reshape((-1, 4))
+        mov = np.asarray(get_dict_value(events_at, "mov", []), dtype=np.int64).reshape((-1, 3))
+        multi = np.asarray(get_dict_value(events_at, "multiMove", []), dtype=np.int64).reshape((-1, 4))
+
+        logger.debug( " {} dis at {}".format( len(dis), i ) )
+        logger.debug( " {} app at {}".format( len(app), i ) )
+        logger.debug( " {} div at {}".format( len(div), i ) )
+        logger.debug( " {} mov at {}".format( len(mov), i ) )
+        logger.debug( " {} multiMoves at {}\n".format( len(multi), i ) )
+
+        step = _TrackStep( events=dict( (k, np.asarray(v)) for k, v in events_at.items() if k in _TRACK_EVENTS ),
+                           maxIdBefore=self._maxTrackId,
+                           fillIns=[] )
+
+        def newIds(n):
+            if successive_ids:
+                ids = np.arange(self._maxTrackId, self._maxTrackId + n, dtype=np.int64)
+                self._maxTrackId += n
+            else:
+                ids = np.random.randint(1, 255, n).astype(np.int64)
+            return ids
+
+        def trackIdsOf(t, labels):
+            # the track ids of the given objects at t, assigning new ones to objects without a track
+            self._trackIds[t] = _grow(self._trackIds[t], labels)
+            ids = self._trackIds[t]
+            missing = labels[ids[labels] == -1]
+            # in the order of their first occurrence
+            missing = missing[np.sort(np.unique(missing, return_index=True)[1])]
+            ids[missing] = newIds(len(missing))
+            if len(missing):
+                step.fillIns.append( (t, missing) )
+            return ids[labels]
+
+        targets = np.concatenate( (app[:, 0], mov[:, 1], div[:, 1], div[:, 2], multi[:, 1]) )
+        current = _grow( np.zeros((0,), dtype=np.int64), targets )
+        self._trackIds.append(current)
+
+        current[app[:, 0]] = newIds(len(app))
+        current[mov[:, 1]] = trackIdsOf(i, mov[:, 0])
+        ancestors = trackIdsOf(i, div[:, 0])
+        current[div[:, 1]] = ancestors
+        current[div[:, 2]] = ancestors
+        time_min = self._trackKey[0]
+        for e in multi:
+            t = time_min + int(e[2])
+            if int(e[2]) >= 0:
+                current[e[1]] = trackIdsOf(t, e[0:1])[0]
+            else:
+                current[e[1]] = self._trackIds[t][e[0]]
+        return step
+
+    def _colorsAt(self, t):
+        """
+        The track id of each object at t (indexed by label), 0 for filtered objects and -1 for untracked objects.
+        """
+        colors = self._trackIds[t]
+        filtered = self._filteredLabels.get(t, None)
+        if filtered is not None and len(filtered):
+            colors = _grow(colors.copy(), filtered)
+            colors[filtered] = 0
+        return colors
+
+    def _updateLuts(self, times=None):
+        """
+        Build the lookup tables for label2color and mergers, so that each time step
+        of the output can be relabeled with a single gather.
+        Only the tables of the given time steps are rebuilt (default: all).
+        """
+        dtype = np.uint32
+        if self.LabelImage.ready():
+            dtype = self.LabelImage.meta.dtype
+        luts = self._label2colorLuts[:len(self._trackIds)]
+        for t in range(len(self._trackIds)):
+            if t >= len(luts) or times is None or t in times:
+                colors = self._colorsAt(t)
+                lut = np.ones((len(colors) + 1,), dtype=dtype)
+                lut[:len(colors)] = np.where(colors == -1, 1, colors)
+                lut[0] = 0
+                if t < len(luts):
+                    luts[t] = lut
+                else:
+                    luts.append(lut)
+        self._label2colorLuts = luts
+        self._mergerLuts = [ relabel_lut(mergers_at, dtype) for mergers_at in self.mergers ]
+
+    def _setTimesDirty(self, slot, times, everything=False):
+        """
+        Mark the given time steps of the (txyzc) slot dirty, one notification per run of consecutive time steps.
+        """
+        if everything or not slot.ready():
+            slot.setDirty(slice(None))
+            return
+        shape = slot.meta.shape
+        times = sorted(t for t in times if t < shape[0])
+        start = 0
+        while start < len(times):
+            stop = start + 1
+            while stop < len(times) and times[stop] == times[stop-1] + 1:
+                stop += 1
+            slot.setDirty( [times[start]] + [0] * (len(shape) - 1), [times[stop-1] + 1] + list(shape[1:]) )
+            start = stop
 
     def _generate_traxelstore(self,
                                time_range,
@@ -286,15 +447,22 @@ class OpTrackingBase(Operator):
                                with_opt_correction=False,
                                with_coordinate_list=False,
                                with_classifier_prior=False,
-                               coordinate_map = None):
-                
+                               coordinate_map = None,
+                               parameters=None,
+                               filtered_labels=None):
+        """
+        parameters: the dict to record the parameters in (default: the value of the Parameters slot)
+        filtered_labels: a dict to return the filtered objects in, instead of setting the FilteredLabels slot
+            (so that several time ranges can be prepared at the same time)
+        """
         if not self.Parameters.ready():
             raise Exception("Parameter slot is not ready")
 
         if coordinate_map is not None and not with_coordinate_list:
             coordinate_map.initialize()
         
-        parameters = self.Parameters.value
+        if parameters is None:
+            parameters = self.Parameters.value
         parameters['scales'] = [x_scale,y_scale,z_scale] 
         parameters['time_range'] = [min(time_range),max(time_range)]
         parameters['x_range'] = x_range
@@ -319,138 +487,76 @@ class OpTrackingBase(Operator):
                raise Exception, "Classifier not yet ready. Did you forget to train the Object Count Classifier?"
             detProbs = self.DetectionProbabilities(time_range).wait()
             
-        logger.info( "filling traxelstore" )
+        # The filtering and the label image reads (for the coordinate lists) are done in parallel
+        #  a few frames ahead, while the traxels are added to the traxelstore in order.
+        def prepare_frame(t):
+            return self._prepareTraxelFrame( t, feats[t], x_range, y_range, z_range, size_range,
+                                             with_opt_correction,
+                                             with_coordinate_list and coordinate_map is not None )
+
+        logger.info( "filtering objects and filling traxelstore" )
         ts = pgmlink.TraxelStore()
                 
         max_traxel_id_at = pgmlink.VectorOfInt()  
-        filtered_labels = {}        
+        set_filtered_labels = filtered_labels is None
+        if set_filtered_labels:
+            filtered_labels = {}
         obj_sizes = []
         total_count = 0
         empty_frame = False
-        for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
-                
-            if with_opt_correction:
-                try:
-                    rc_corr = feats[t][config.features_vigra_name]['RegionCenter_corr']
-                except:
-                    raise Exception, 'cannot consider optical correction since it has not been computed before'
-                if rc_corr.size:
-                    rc_corr = rc_corr[1:,...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
+        for t, frame in self._iterTraxelFrames( sorted(feats.keys()), prepare_frame ):
+            ids = frame.ids
+            count = len(ids)
+            logger.info( "at timestep {}, {} traxels found".format( t, frame.num_objects ) )
 
-            
-            logger.info( "at timestep {}, {} traxels found".format( t, rc.shape[0] ) )
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:                    
-                    x, y, z = rc[idx]
-                else:
-                    raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                    y < y_range[0] or y >= y_range[1] or
-                    z < z_range[0] or z >= z_range[1] or
-                    size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
+            if with_div:
+                # rc and ct start from 1, divProbs starts from 0
+                div_probs = np.asarray(divProbs[t])[ids, 1].tolist()
+            if with_classifier_prior:
+                det_probs = np.asarray(detProbs[t])[ids].tolist()
+
+            for i, idx in enumerate(ids.tolist()):
                 tr = pgmlink.Traxel()
                 tr.set_x_scale(x_scale)
                 tr.set_y_scale(y_scale)
                 tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
+                tr.Id = idx
                 tr.Timestep = t
 
                 # pgmlink expects always 3 coordinates, z=0 for 2d data
-                tr.add_feature_array("com", 3)
-                for i, v in enumerate([x,y,z]):
-                    tr.set_feature_value('com', i, float(v))            
+                _set_feature_array(tr, "com", frame.com[i])
                 
                 if with_opt_correction:
-                    tr.add_feature_array("com_corrected", 3)
-                    for i, v in enumerate(rc_corr[idx]):
-                        tr.set_feature_value("com_corrected", i, float(v))
-                    if len(rc_corr[idx]) == 2:
-                        tr.set_feature_value("com_corrected", 2, 0.)
+                    _set_feature_array(tr, "com_corrected", frame.com_corrected[i])
 
                 if with_div:
-                    tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx+1][1]))
+                    _set_feature_array(tr, "divProb", [div_probs[i]])
 
                 if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx+1]))
-                    for i, v in enumerate(detProbs[t][idx+1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(v))
-                        
+                    _set_feature_array(tr, "detProb", det_probs[i])
                 
                 # FIXME: check whether it is 2d or 3d data!
                 if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx+1]))  
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx+1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx+1]))            
-                    for i, v in enumerate(localCenters[t][idx+1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))                
-
-                tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
+                    centers = localCenters[t][idx]
+                    _set_feature_array(tr, "localCentersX", [float(v[0]) for v in centers])
+                    _set_feature_array(tr, "localCentersY", [float(v[1]) for v in centers])
+                    _set_feature_array(tr, "localCentersZ", [float(v[2]) for v in centers])
 
+                _set_feature_array(tr, "count", [frame.count[i]])
                     
                 ts.add(tr)
 
                 # add coordinate lists
+                if frame.excerpts is not None: # store coordinates in arma::mat
+                    pgmlink.extract_coordinates(coordinate_map, frame.excerpts[i], frame.lower[i], tr)
 
-                if with_coordinate_list and coordinate_map is not None: # store coordinates in arma::mat
-                    # generate roi: assume the following order: txyzc
-                    n_dim = len(rc[idx])
-                    roi = [0]*5
-                    roi[0] = slice(int(t), int(t+1))
-                    roi[1] = slice(int(lower[idx][0]), int(upper[idx][0] + 1))
-                    roi[2] = slice(int(lower[idx][1]), int(upper[idx][1] + 1))
-                    if n_dim == 3:
-                        roi[3] = slice(int(lower[idx][2]), int(upper[idx][2] + 1))
-                    else:
-                        assert n_dim == 2
-                    image_excerpt = self.LabelImage[roi].wait()
-                    if n_dim == 2:
-                        image_excerpt = image_excerpt[0, ..., 0, 0]
-                    elif n_dim ==3:
-                        image_excerpt = image_excerpt[0, ..., 0]
-                    else:
-                        raise Exception, "n_dim = %s instead of 2 or 3"
-
-                    pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx].astype(np.int64), tr)
-                    
+            if median_object_size is not None:
+                obj_sizes.extend(frame.count)
             
-            if len(filtered_labels_at) > 0:
-                filtered_labels[str(int(t)-time_range[0])] = filtered_labels_at
+            if len(frame.filtered) > 0:
+                filtered_labels[str(int(t)-time_range[0])] = frame.filtered
             logger.info( "at timestep {}, {} traxels passed filter".format(t, count) )
-            max_traxel_id_at.append(int(rc.shape[0]))
+            max_traxel_id_at.append(int(frame.num_objects))
             if count == 0:
                 empty_frame = True
                 
@@ -460,8 +566,116 @@ class OpTrackingBase(Operator):
             median_object_size[0] = np.median(np.array(obj_sizes),overwrite_input=True)
             logger.info( 'median object size = ' + str(median_object_size[0]) )
         
-        self.FilteredLabels.setValue(filtered_labels, check_changed=False)
+        if set_filtered_labels:
+            self.FilteredLabels.setValue(filtered_labels, check_changed=False)
         
         return ts, empty_frame
 
+    def _iterTraxelFrames(self, times, prepare_frame):
+        """
+        Yield (t, prepare_frame(t)) for the given time steps, in order.
+        At most TRAXEL_FRAME_PREFETCH frames are prepared (by parallel requests) ahead of the consumer,
+        so the excerpts of only a few frames are held in memory at the same time.
+        """
+        pending = collections.deque()
+        try:
+            for t in times:
+                req = Request( partial(prepare_frame, t) )
+                req.submit()
+                pending.append( (t, req) )
+                if len(pending) >= self.TRAXEL_FRAME_PREFETCH:
+                    t_next, req_next = pending.popleft()
+                    yield t_next, req_next.wait()
+            while pending:
+                t_next, req_next = pending.popleft()
+                yield t_next, req_next.wait()
+        finally:
+            # the consumer stopped early (e.g. adding a traxel failed)
+            for _, req in pending:
+                req.cancel()
+
+    def _prepareTraxelFrame(self, t, feats_at, x_range, y_range, z_range, size_range,
+                            with_opt_correction=False, with_coordinate_list=False):
+        """
+        Filter the objects of frame t by position and size (vectorized over all objects),
+        and collect everything needed to create their traxels.
+        With with_coordinate_list, the label image is read once for the bounding box of all
+        objects that passed the filter, and cut into the excerpts of each object.
+        """
+        rc = feats_at[default_features_key]['RegionCenter']
+        lower = feats_at[default_features_key]['Coord<Minimum>']
+        upper = feats_at[default_features_key]['Coord<Maximum>']
+        ct = feats_at[default_features_key]['Count']
+        if rc.size:
+            rc = rc[1:, ...]
+            lower = lower[1:, ...]
+            upper = upper[1:, ...]
+            ct = ct[1:, ...]
+        num_objects = rc.shape[0] if rc.size else 0
+        if num_objects == 0:
+            rc = np.zeros((0, 3))
+        else:
+            rc = np.asarray(rc, dtype=np.float64).reshape((num_objects, -1))
+        n_dim = rc.shape[1]
+        if n_dim not in (2, 3):
+            raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
+
+        # for 2d data, set z-coordinate to 0:
+        com = np.zeros((num_objects, 3))
+        com[:, :n_dim] = rc
+        size = np.asarray(ct, dtype=np.float64).reshape(num_objects)
+
+        passed = np.ones((num_objects,), dtype=bool)
+        for axis, axis_range in enumerate([x_range, y_range, z_range]):
+            passed &= (com[:, axis] >= axis_range[0]) & (com[:, axis] < axis_range[1])
+        passed &= (size >= size_range[0]) & (size < size_range[1])
+
+        # Object ids start from 1
+        ids = np.flatnonzero(passed) + 1
+        filtered = (np.flatnonzero(~passed) + 1).tolist()
+
+        com_corrected = None
+        if with_opt_correction:
+            try:
+                rc_corr = feats_at[config.features_vigra_name]['RegionCenter_corr']
+            except:
+                raise Exception, 'cannot consider optical correction since it has not been computed before'
+            if rc_corr.size:
+                rc_corr = rc_corr[1:,...]
+            com_corrected = np.zeros((num_objects, 3))
+            if num_objects > 0:
+                rc_corr = np.asarray(rc_corr, dtype=np.float64).reshape((num_objects, -1))
+                com_corrected[:, :rc_corr.shape[1]] = rc_corr
+            com_corrected = com_corrected[passed].tolist()
+
+        excerpts = None
+        lower_passed = None
+        if with_coordinate_list:
+            lower_passed = np.asarray(lower[passed], dtype=np.int64).reshape((len(ids), n_dim))
+            upper_passed = np.asarray(upper[passed], dtype=np.int64).reshape((len(ids), n_dim))
+            excerpts = []
+            if len(ids) > 0:
+                # A single read for all objects of the frame (assumes txyzc)
+                start = [t] + list(lower_passed.min(axis=0))
+                stop = [t+1] + list(upper_passed.max(axis=0) + 1)
+                if n_dim == 2:
+                    start.append(0)
+                    stop.append(1)
+                image = self.LabelImage(start + [0], stop + [1]).wait()[0, ..., 0]
+                for object_lower, object_upper in zip(lower_passed - start[1:n_dim+1], upper_passed - start[1:n_dim+1] + 1):
+                    excerpt = image[tuple(slice(l, u) for l, u in zip(object_lower, object_upper))]
+                    if n_dim == 2:
+                        excerpt = excerpt[..., 0]
+                    excerpts.append(np.ascontiguousarray(excerpt))
+            lower_passed = list(lower_passed)
+
+        return _TraxelFrame( num_objects=num_objects,
+                             ids=ids,
+                             filtered=filtered,
+                             com=com[passed].tolist(),
+                             com_corrected=com_corrected,
+                             count=size[passed].tolist(),
+                             lower=lower_passed,
+                             excerpts=excerpts )
+
     
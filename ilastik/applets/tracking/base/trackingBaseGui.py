@@ -23,16 +23,13 @@ from PyQt4.QtGui import QColor, QFileDialog, QMessageBox
 from volumina.api import LazyflowSource, ColortableLayer
 import volumina.colortables as colortables
 
-from lazyflow.operators.generic import axisTagsToString
-from lazyflow.rtype import SubRegion
-
 import logging
 import os
 import numpy as np
 import vigra
 import h5py
 from ilastik.applets.labeling.labelingGui import LabelingGui
-from ilastik.applets.tracking.base.trackingUtilities import relabel,write_events
+from ilastik.applets.tracking.base.trackingResultExporter import TrackingResultExporter
 from volumina.layer import GrayscaleLayer
 from volumina.utility import encode_from_qstring
 from ilastik.applets.layerViewer.layerViewerGui import LayerViewerGui
@@ -278,6 +275,11 @@ class TrackingBaseGui( LayerViewerGui ):
         def _handle_progress(x):       
             self.applet.progressSignal.emit(x)
         
+        singleFile = QMessageBox.question(self, "Export Tracking Results",
+                                          "Write all time steps into a single file (tracking.h5)?\n"
+                                          "Otherwise, one file is written per time step.",
+                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.No) == QMessageBox.Yes
+
         def _export():
             self.applet.busy = True
             self.applet.appletStateUpdateRequested.emit()
@@ -296,43 +298,18 @@ class TrackingBaseGui( LayerViewerGui ):
             
             t_from = int(t_from)
 
-            logger.info( "Saving first label image..." )
-            key = []
-            for idx, flag in enumerate(axisTagsToString(self.mainOperator.LabelImage.meta.axistags)):
-                if flag is 't':
-                    key.append(slice(t_from,t_from+1))
-                elif flag is 'c':
-                    key.append(slice(0,1))                
-                else:
-                    key.append(slice(0,self.mainOperator.LabelImage.meta.shape[idx]))                        
-            
-        
-            roi = SubRegion(self.mainOperator.LabelImage, key)
-            labelImage = self.mainOperator.LabelImage.get(roi).wait()
-            labelImage = labelImage[0,...,0]
-            
-            try:
-                # write_events([], str(directory), t_from, labelImage)
-                
-                events = self.mainOperator.EventsVector.value
-                logger.info( "Saving events..." )
-                logger.info( "Length of events " + str(len(events)) )
-                
-                num_files = float(len(events))
+            events = self.mainOperator.EventsVector.value
+            logger.info( "Saving events..." )
+            logger.info( "Length of events " + str(len(events)) )
+            events = dict( (t_from + int(i), events_at) for i, events_at in events.items() )
 
-                for i in sorted(events.keys()):
-                    events_at = events[i]
-                    i = int(i)
-                    t = t_from + i            
-                    key[0] = slice(t,t+1)
-                    roi = SubRegion(self.mainOperator.LabelImage, key)
-                    labelImage = self.mainOperator.LabelImage.get(roi).wait()
-                    labelImage = labelImage[0,...,0]
-                    if self.withMergers:                
-                        write_events(events_at, str(directory), t, labelImage, self.mainOperator.mergers)
-                    else:
-                        write_events(events_at, str(directory), t, labelImage)
-                    _handle_progress(i/num_files * 100)
+            mergers = self.mainOperator.mergers if self.withMergers else None
+            exporter = TrackingResultExporter(self.mainOperator.LabelImage, events, mergers=mergers)
+            try:
+                if singleFile:
+                    exporter.exportSingleFile(os.path.join(str(directory), "tracking.h5"), _handle_progress)
+                else:
+                    exporter.exportLineageH5(str(directory), _handle_progress)
             except IOError as e:                    
                 self._criticalMessage("Cannot export the tracking results. Maybe these files already exist. "\
                                       "Please delete them or choose a different directory.")
@@ -374,21 +351,18 @@ class TrackingBaseGui( LayerViewerGui ):
         logger.info( 'Saving results as tiffs...' )
         
         label2color = self.mainOperator.label2color
-        lshape = list(self.mainOperator.LabelImage.meta.shape)
     
         def _handle_progress(x):       
             self.applet.progressSignal.emit(x)
         
         def _export():
             num_files = float(len(label2color))
-            for t, label2color_at in enumerate(label2color):
-                if len(label2color_at) == 0:                
-                    continue
+            times = [t for t, label2color_at in enumerate(label2color) if len(label2color_at) > 0]
+            # the label images are fetched and relabeled in parallel, ahead of writing
+            exporter = TrackingResultExporter(self.mainOperator.LabelImage, label2color=label2color)
+            for t, relabeled in exporter.iterFrames(times):
                 logger.info( 'exporting tiffs for t = ' + str(t) )            
                 
-                roi = SubRegion(self.mainOperator.LabelImage, start=[t,] + 4*[0,], stop=[t+1,] + list(lshape[1:]))
-                labelImage = self.mainOperator.LabelImage.get(roi).wait()
-                relabeled = relabel(labelImage[0,...,0],label2color_at)
                 for i in range(relabeled.shape[2]):
                     out_im = relabeled[:,:,i]
                     out_fn = str(directory) + '/vis_t' + str(t).zfill(4) + '_z' + str(i).zfill(4) + '.tif'
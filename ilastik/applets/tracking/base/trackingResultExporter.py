@@ -0,0 +1,177 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+import multiprocessing
+from functools import partial
+
+import numpy as np
+import h5py
+
+from lazyflow.request import Request
+from lazyflow.rtype import SubRegion
+from lazyflow.utility.timer import Timer
+
+from ilastik.applets.tracking.base.trackingUtilities import write_events, relabel_lut, apply_lut, \
+                                                            get_dict_value, EVENT_TABLES, ENERGY_FORMAT
+
+import logging
+logger = logging.getLogger(__name__)
+
+class TrackingResultExporter(object):
+    """
+    Exports the tracking result (label images and events) of many time steps,
+    either as one LineageH5 file per time step (as write_events() does) or as a single,
+    chunked hdf5 file.  It only needs the label image slot and the events,
+    so it can be used without the GUI, e.g. from a headless workflow.
+
+    The label images are fetched (and, with label2color, relabeled) by parallel requests,
+    at most `prefetch` time steps ahead, while the calling thread writes them in order.
+    The progress is reported to a callback, the throughput is logged.
+    """
+    # The number of time steps that are fetched ahead of the writer
+    DEFAULT_PREFETCH = max( 2, multiprocessing.cpu_count() )
+
+    # Chunks of the label images in the single file layout hold (at most) this many voxels of one time step
+    LABEL_CHUNK_VOXELS = 2**18
+
+    # Chunk size (in rows) of the event tables in the single file layout
+    EVENT_CHUNK_ROWS = 4096
+
+    def __init__(self, labelImageSlot, events=None, label2color=None, mergers=None, prefetch=None, compression=1):
+        """
+        labelImageSlot: the txyzc label image slot (e.g. OpTrackingBase.LabelImage)
+        events: dict of t -> events at t (as returned by get_events_at()), the time steps to export;
+            may be omitted if only iterFrames() is used
+        label2color: optional list of dicts (one per time step) to relabel the label images with
+        mergers: passed on to write_events()
+        """
+        self.labelImageSlot = labelImageSlot
+        self.events = events or {}
+        self.label2color = label2color
+        self.mergers = mergers
+        self.prefetch = prefetch or self.DEFAULT_PREFETCH
+        self.compression = compression
+
+    @property
+    def times(self):
+        return sorted(self.events.keys())
+
+    def _fetchFrame(self, t):
+        shape = self.labelImageSlot.meta.shape
+        roi = SubRegion(self.labelImageSlot, start=[t,] + [0,]*(len(shape)-1), stop=[t+1,] + list(shape[1:-1]) + [1,])
+        labelImage = self.labelImageSlot.get(roi).wait()[0,...,0]
+        if self.label2color is not None:
+            labelImage = apply_lut(labelImage, relabel_lut(self.label2color[t], labelImage.dtype))
+        return labelImage
+
+    def iterFrames(self, times=None):
+        """
+        Yield (t, label image) for the given time steps (default: all time steps with events), in order.
+        """
+        times = self.times if times is None else list(times)
+        pending = collections.deque()
+        try:
+            for t in times:
+                req = Request( partial(self._fetchFrame, t) )
+                req.submit()
+                pending.append( (t, req) )
+                if len(pending) >= self.prefetch:
+                    t_next, req_next = pending.popleft()
+                    yield t_next, req_next.wait()
+            while pending:
+                t_next, req_next = pending.popleft()
+                yield t_next, req_next.wait()
+        finally:
+            # the consumer stopped early (e.g. a write failed)
+            for _, req in pending:
+                req.cancel()
+
+    def exportLineageH5(self, directory, progressCallback=None):
+        """
+        Write one LineageH5 file per time step into the given directory.
+        """
+        def write(t, labelImage):
+            write_events(self.events[t], directory, t, labelImage, self.mergers, compression=self.compression)
+        self._export(write, progressCallback)
+
+    def exportSingleFile(self, filename, progressCallback=None):
+        """
+        Write all time steps into a single hdf5 file:
+          /segmentation/labels: the label images, shape (time steps,) + spatial shape,
+            chunked per time step
+          /segmentation/timesteps: the time step of each label image
+          /tracking/<event type>: the event tables of all time steps,
+            with the time step as additional first column
+          /tracking/<event type>-Energy: the energies of the events
+        """
+        times = self.times
+        spatialShape = tuple(self.labelImageSlot.meta.shape[1:-1])
+        with h5py.File(filename, 'w-') as f:
+            seg = f.create_group("segmentation")
+            labels = seg.create_dataset("labels", shape=(len(times),) + spatialShape, maxshape=(None,) + spatialShape, dtype=np.uint32,
+                                        chunks=(1,) + self._labelChunkShape(spatialShape), compression=self.compression)
+            seg.create_dataset("timesteps", data=np.asarray(times, dtype=np.uint32))
+            index = dict( (t, i) for i, t in enumerate(times) )
+            tg = f.create_group("tracking")
+
+            def write(t, labelImage):
+                labels[index[t]] = labelImage
+                for key, name, dtype, format in EVENT_TABLES:
+                    events = np.asarray(get_dict_value(self.events[t], key, []))
+                    if len(events):
+                        rows = np.column_stack( (np.repeat(t, len(events)), events[:, :-1]) )
+                        self._appendRows(tg, name, rows, dtype, "timestep, " + format)
+                        self._appendRows(tg, name + "-Energy", events[:, -1], np.double, ENERGY_FORMAT)
+            self._export(write, progressCallback)
+
+    def _labelChunkShape(self, spatialShape):
+        chunkShape = list(spatialShape)
+        while np.prod(chunkShape) > self.LABEL_CHUNK_VOXELS:
+            axis = int(np.argmax(chunkShape))
+            chunkShape[axis] = (chunkShape[axis] + 1) // 2
+        return tuple(chunkShape)
+
+    def _appendRows(self, group, name, rows, dtype, format):
+        if name not in group:
+            ds = group.create_dataset(name, shape=(0,) + rows.shape[1:], maxshape=(None,) + rows.shape[1:], dtype=dtype,
+                                      chunks=(self.EVENT_CHUNK_ROWS,) + rows.shape[1:], compression=self.compression)
+            ds.attrs["Format"] = format
+        ds = group[name]
+        start = ds.shape[0]
+        ds.resize(start + len(rows), axis=0)
+        ds[start:] = rows
+
+    def _export(self, write, progressCallback):
+        times = self.times
+        nbytes = 0
+        frames = self.iterFrames(times)
+        with Timer() as timer:
+            try:
+                for i, (t, labelImage) in enumerate(frames):
+                    write(t, labelImage)
+                    nbytes += labelImage.nbytes
+                    if progressCallback is not None:
+                        progressCallback( 100.0 * (i+1) / len(times) )
+            finally:
+                frames.close()
+        seconds = max( timer.seconds(), 1e-6 )
+        logger.info( "Exported {} time steps in {:.1f} seconds ({:.1f} time steps/s, {:.1f} MB/s of label images)"
+                     .format( len(times), seconds, len(times) / seconds, nbytes / float(1024**2) / seconds ) )
@@ -26,32 +26,39 @@ import pgmlink
 import logging
 logger = logging.getLogger(__name__)
 
+def relabel_lut(replace, dtype=np.uint32):
+    """
+    Dense lookup table for relabel(): maps each label to replace[label],
+    labels that are not in replace to 1, and the background (0) to 0.
+    The last entry is 1 as well, so labels beyond the table can be clipped to it
+    (see apply_lut()), i.e. the table doesn't depend on the labels of the volume.
+    """
+    keys = np.array(list(replace.keys()), dtype=np.int64)
+    values = np.array([replace[k] for k in keys], dtype=np.int64)
+    size = keys.max() + 1 if len(keys) else 1
+    lut = np.ones((size + 1,), dtype=dtype)
+    lut[keys] = values
+    lut[0] = 0
+    return lut
+
+def apply_lut(volume, lut):
+    """
+    Map all labels of the volume with a table made by relabel_lut().
+    """
+    return np.take(lut, volume, mode='clip')
+
 def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
-    
+    """
+    Replace the labels of the volume according to the replace dict.
+    Labels that are not in replace are set to 1, the background stays 0.
+    """
+    return apply_lut(volume, relabel_lut(replace, volume.dtype))
     
 def relabelMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)    
-    mp[:] = 0
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 1
-    return mp[volume]
+    """
+    Replace merger labels by their number of objects, all other labels by 1.
+    """
+    return relabel(volume, merger)
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
@@ -106,24 +113,82 @@ def get_events_at(eventsVector, t):
     return events_at
 
 
-def write_events(events_at, directory, t, labelImage, mergers=None):
+def sliding_windows(time_range, window_size, overlap):
+    """
+    Split the (consecutive) time steps of time_range into windows of window_size time steps,
+    each of which overlaps the previous one by overlap time steps.  The last window may be shorter.
+    """
+    assert overlap >= 1 and window_size > overlap, "the windows must overlap by at least one time step"
+    t_stop = time_range[-1] + 1
+    windows = []
+    start = time_range[0]
+    while True:
+        stop = min(start + window_size, t_stop)
+        windows.append(range(start, stop))
+        if stop == t_stop:
+            return windows
+        start = stop - overlap
+
+def _event_set(events_at):
+    result = set()
+    for key in ("app", "dis", "mov", "div", "merger"):
+        for e in get_dict_value(events_at, key, []):
+            result.add( (key,) + tuple(int(x) for x in e[:-1]) )
+    return result
+
+def events_agreement(events_at1, events_at2):
+    """
+    The similarity (Jaccard index, ignoring the energies) of two sets of events of the same time step,
+    as returned by get_events_at().  Two empty sets agree completely.
+    """
+    events1 = _event_set(events_at1)
+    events2 = _event_set(events_at2)
+    if len(events1) == 0 and len(events2) == 0:
+        return 1.0
+    return len(events1 & events2) / float(len(events1 | events2))
+
+def find_seam(events1, window1, events2, window2):
+    """
+    Given the events (as returned by get_events()) of two overlapping tracking windows,
+    return the time step from which on the events of the second window should be used:
+    the time step in the overlap at which both windows agree most, preferring the middle of the overlap.
+    """
+    candidates = range(window2[0] + 1, window1[-1] + 1)
+    if len(candidates) == 0:
+        return window1[-1] + 1
+    middle = (window2[0] + window1[-1]) / 2.0
+    def score(t):
+        agreement = events_agreement(events1[str(t - window1[0])], events2[str(t - window2[0])])
+        return (agreement, -abs(t - middle))
+    return max(candidates, key=score)
+
+def shift_events_at(events_at, offset):
+    """
+    Make the events of a tracking window relative to a time range that starts offset time steps earlier
+    (the multi frame moves refer to a time step).
+    """
+    if len(get_dict_value(events_at, "multiMove", [])) == 0:
+        return events_at
+    events_at = dict(events_at)
+    multiMove = np.array(events_at["multiMove"], copy=True)
+    multiMove[multiMove[:, 2] >= 0, 2] += offset
+    events_at["multiMove"] = multiMove
+    return events_at
+
+# The event tables written by write_events(): (key in events_at, dataset name, dtype, format description).
+# The last column of each event array is the energy, which is written to a separate "<name>-Energy" dataset.
+EVENT_TABLES = [ ("app", "Appearances", np.uint32, "cell label appeared in current file"),
+                 ("dis", "Disappearances", np.uint32, "cell label disappeared in current file"),
+                 ("mov", "Moves", np.uint32, "from (previous file), to (current file)"),
+                 ("div", "Splits", np.uint32, "ancestor (previous file), descendant (current file), descendant (current file)"),
+                 ("merger", "Mergers", np.uint32, "descendant (current file), number of objects"),
+                 ("multiMove", "MultiFrameMoves", np.int32, "from (given by timestep), to (current file), timestep") ]
+ENERGY_FORMAT = "lower energy -> higher confidence"
+
+def write_events(events_at, directory, t, labelImage, mergers=None, compression=1):
         fn =  directory + "/" + str(t).zfill(5)  + ".h5"
         
         logger.info( "-- Writing results to " + path.basename(fn) ) 
-        if len(events_at) == 0:
-            dis = []
-            app = []
-            mov = []
-            div = []
-            merger = []
-            mult_movs = []
-        else:        
-            dis = get_dict_value(events_at, "dis", [])
-            app = get_dict_value(events_at, "app", [])
-            mov = get_dict_value(events_at, "mov", [])
-            div = get_dict_value(events_at, "div", [])
-            merger = get_dict_value(events_at, "merger", [])
-            mult_movs = get_dict_value(events_at, "multiMove", [])
         try:
             with LineageH5(fn, 'w-') as f_curr:
                 # delete old label image
@@ -132,7 +197,7 @@ def write_events(events_at, directory, t, labelImage, mergers=None):
                 
                 seg = f_curr.create_group("segmentation")            
                 # write label image
-                seg.create_dataset("labels", data = labelImage, dtype=np.uint32, compression=1)
+                seg.create_dataset("labels", data = labelImage, dtype=np.uint32, compression=compression)
                 
                 # delete old tracking
                 if "tracking" in f_curr.keys():
@@ -141,36 +206,13 @@ def write_events(events_at, directory, t, labelImage, mergers=None):
                 tg = f_curr.create_group("tracking")            
                 
                 # write associations
-                if len(app):
-                    ds = tg.create_dataset("Appearances", data=app[:, :-1], dtype=np.uint32, compression=1)
-                    ds.attrs["Format"] = "cell label appeared in current file"    
-                    ds = tg.create_dataset("Appearances-Energy", data=app[:, -1], dtype=np.double, compression=1)
-                    ds.attrs["Format"] = "lower energy -> higher confidence"    
-                if len(dis):
-                    ds = tg.create_dataset("Disappearances", data=dis[:, :-1], dtype=np.uint32, compression=1)
-                    ds.attrs["Format"] = "cell label disappeared in current file"
-                    ds = tg.create_dataset("Disappearances-Energy", data=dis[:, -1], dtype=np.double, compression=1)
-                    ds.attrs["Format"] = "lower energy -> higher confidence"    
-                if len(mov):
-                    ds = tg.create_dataset("Moves", data=mov[:, :-1], dtype=np.uint32, compression=1)
-                    ds.attrs["Format"] = "from (previous file), to (current file)"    
-                    ds = tg.create_dataset("Moves-Energy", data=mov[:, -1], dtype=np.double, compression=1)
-                    ds.attrs["Format"] = "lower energy -> higher confidence"                
-                if len(div):
-                    ds = tg.create_dataset("Splits", data=div[:, :-1], dtype=np.uint32, compression=1)
-                    ds.attrs["Format"] = "ancestor (previous file), descendant (current file), descendant (current file)"    
-                    ds = tg.create_dataset("Splits-Energy", data=div[:, -1], dtype=np.double, compression=1)
-                    ds.attrs["Format"] = "lower energy -> higher confidence"
-                if len(merger):
-                    ds = tg.create_dataset("Mergers", data=merger[:, :-1], dtype=np.uint32, compression=1)
-                    ds.attrs["Format"] = "descendant (current file), number of objects"    
-                    ds = tg.create_dataset("Mergers-Energy", data=merger[:, -1], dtype=np.double, compression=1)
-                    ds.attrs["Format"] = "lower energy -> higher confidence"
-                if len(mult_movs):
-                    ds = tg.create_dataset("MultiFrameMoves", data=mult_movs[:, :-1], dtype=np.int32, compression=1)
-                    ds.attrs["Format"] = "from (given by timestep), to (current file), timestep"
-                    ds = tg.create_dataset("MultiFrameMoves-Energy", data=mult_movs[:, -1], dtype=np.double)
-                    ds.attrs["Format"] = "lower energy -> higher confidence"
+                for key, name, dtype, format in EVENT_TABLES:
+                    events = get_dict_value(events_at, key, [])
+                    if len(events):
+                        ds = tg.create_dataset(name, data=events[:, :-1], dtype=dtype, compression=compression)
+                        ds.attrs["Format"] = format
+                        ds = tg.create_dataset(name + "-Energy", data=events[:, -1], dtype=np.double, compression=compression)
+                        ds.attrs["Format"] = ENERGY_FORMAT
         except IOError:                    
             raise IOError("File " + str(fn) + " exists already. Please choose a different folder or delete the file(s).")
                 
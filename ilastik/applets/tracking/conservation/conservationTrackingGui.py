@@ -63,6 +63,12 @@ class ConservationTrackingGui( TrackingBaseGui ):
             self._drawer.appearanceBox.setValue(parameters['appearanceCost'])
         if 'disappearanceCost' in parameters.keys():
             self._drawer.disappearanceBox.setValue(parameters['disappearanceCost'])
+        if 'windowSize' in parameters.keys():
+            self._drawer.windowSizeBox.setValue(parameters['windowSize'])
+        if 'windowOverlap' in parameters.keys():
+            self._drawer.windowOverlapBox.setValue(parameters['windowOverlap'])
+        if 'maxParallelWindows' in parameters.keys():
+            self._drawer.parallelWindowsBox.setValue(parameters['maxParallelWindows'])
         
         return self._drawer
 
@@ -166,6 +172,9 @@ class ConservationTrackingGui( TrackingBaseGui ):
             withArmaCoordinates = True
             appearanceCost = self._drawer.appearanceBox.value()
             disappearanceCost = self._drawer.disappearanceBox.value()
+            windowSize = self._drawer.windowSizeBox.value() or None # 0: track the whole time range at once
+            windowOverlap = self._drawer.windowOverlapBox.value()
+            maxParallelWindows = self._drawer.parallelWindowsBox.value()
     
             ndim=3
             if (to_z - from_z == 0):
@@ -198,7 +207,10 @@ class ConservationTrackingGui( TrackingBaseGui ):
                     withArmaCoordinates = withArmaCoordinates,
                     cplex_timeout = cplex_timeout,
                     appearance_cost = appearanceCost,
-                    disappearance_cost = disappearanceCost
+                    disappearance_cost = disappearanceCost,
+                    windowSize = windowSize,
+                    windowOverlap = windowOverlap,
+                    maxParallelWindows = maxParallelWindows
                     )
             except Exception:           
                 ex_type, ex, tb = sys.exc_info()
@@ -1,11 +1,16 @@
+import collections
+from functools import partial
+
 from lazyflow.graph import InputSlot, OutputSlot
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 import pgmlink
 from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
-from ilastik.applets.tracking.base.trackingUtilities import relabelMergers
+from ilastik.applets.tracking.base.trackingUtilities import apply_lut
 from ilastik.applets.tracking.base.trackingUtilities import get_events
+from ilastik.applets.tracking.base.trackingUtilities import sliding_windows, find_seam, shift_events_at
 from lazyflow.operators.opCompressedCache import OpCompressedCache
+from lazyflow.request import Request
 from lazyflow.roi import sliceToRoi
 
 import logging
@@ -50,7 +55,7 @@ class OpConservationTracking(OpTrackingBase):
             trange = range(roi.start[0], roi.stop[0])
             for t in trange:
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0] and len(self.mergers) > t and len(self.mergers[t])):
-                    result[t-roi.start[0],...,0] = relabelMergers(result[t-roi.start[0],...,0], self.mergers[t])
+                    result[t-roi.start[0],...,0] = apply_lut(result[t-roi.start[0],...,0], self._mergerLuts[t])
                 else:
                     result[t-roi.start[0],...][:] = 0
             
@@ -85,9 +90,19 @@ class OpConservationTracking(OpTrackingBase):
             borderAwareWidth = 0.0,
             withArmaCoordinates = True,
             appearance_cost = 500,
-            disappearance_cost = 500
+            disappearance_cost = 500,
+            windowSize=None,
+            windowOverlap=10,
+            maxParallelWindows=1
             ):
-        
+        """
+        Track the objects of the given time range.
+
+        windowSize: if given and shorter than the time range, the time range is tracked in overlapping
+            windows of this many time steps (see _trackWindowed()), which needs much less memory and time
+            for long movies.  The windows overlap by windowOverlap time steps, and up to maxParallelWindows
+            windows are solved at the same time.
+        """
         if not self.Parameters.ready():
             raise Exception("Parameter slot is not ready")
         
@@ -108,6 +123,9 @@ class OpConservationTracking(OpTrackingBase):
         parameters['withArmaCoordinates'] = withArmaCoordinates
         parameters['appearanceCost'] = appearance_cost
         parameters['disappearanceCost'] = disappearance_cost
+        parameters['windowSize'] = windowSize or 0
+        parameters['windowOverlap'] = windowOverlap
+        parameters['maxParallelWindows'] = maxParallelWindows
                 
         if cplex_timeout:
             parameters['cplex_timeout'] = cplex_timeout
@@ -127,6 +145,74 @@ class OpConservationTracking(OpTrackingBase):
                     'Check whether you have (i) the correct number of label names specified in Object Count Classification, and (ii) provided at least' \
                     'one training example for each class.'            
         
+        solve = partial(self._solveWindow,
+                        x_range=x_range,
+                        y_range=y_range,
+                        z_range=z_range,
+                        size_range=size_range,
+                        x_scale=x_scale,
+                        y_scale=y_scale,
+                        z_scale=z_scale,
+                        maxDist=maxDist,
+                        maxObj=maxObj,
+                        divThreshold=divThreshold,
+                        avgSize=avgSize,
+                        withTracklets=withTracklets,
+                        sizeDependent=sizeDependent,
+                        divWeight=divWeight,
+                        transWeight=transWeight,
+                        withDivisions=withDivisions,
+                        withOpticalCorrection=withOpticalCorrection,
+                        withClassifierPrior=withClassifierPrior,
+                        ndim=ndim,
+                        cplex_timeout=cplex_timeout,
+                        withMergerResolution=withMergerResolution,
+                        borderAwareWidth=borderAwareWidth,
+                        withArmaCoordinates=withArmaCoordinates,
+                        appearance_cost=appearance_cost,
+                        disappearance_cost=disappearance_cost)
+
+        if windowSize is None or len(time_range) <= windowSize:
+            events = solve(time_range, parameters=parameters)
+            self.Parameters.setValue(parameters, check_changed=False)
+            self.EventsVector.setValue(events, check_changed=False)
+        else:
+            self._trackWindowed(solve, time_range, parameters, windowSize, windowOverlap, maxParallelWindows)
+
+    def _solveWindow(self,
+            time_range,
+            x_range,
+            y_range,
+            z_range,
+            size_range,
+            x_scale,
+            y_scale,
+            z_scale,
+            maxDist,
+            maxObj,
+            divThreshold,
+            avgSize,
+            withTracklets,
+            sizeDependent,
+            divWeight,
+            transWeight,
+            withDivisions,
+            withOpticalCorrection,
+            withClassifierPrior,
+            ndim,
+            cplex_timeout,
+            withMergerResolution,
+            borderAwareWidth,
+            withArmaCoordinates,
+            appearance_cost,
+            disappearance_cost,
+            parameters=None,
+            filtered_labels=None):
+        """
+        Build the traxelstore of the given time range and solve the tracking problem on it.
+        Returns the events (as returned by get_events()), relative to the start of the time range.
+        parameters and filtered_labels are passed on to _generate_traxelstore().
+        """
         median_obj_size = [0]
 
         coordinate_map = pgmlink.TimestepIdCoordinateMap()
@@ -139,7 +225,9 @@ class OpConservationTracking(OpTrackingBase):
                                                                       with_opt_correction=withOpticalCorrection,
                                                                       with_coordinate_list=withMergerResolution , # no vigra coordinate list, that is done by arma
                                                                       with_classifier_prior=withClassifierPrior,
-                                                                      coordinate_map=coordinate_map)
+                                                                      coordinate_map=coordinate_map,
+                                                                      parameters=parameters,
+                                                                      filtered_labels=filtered_labels)
         
         if empty_frame:
             raise Exception, 'cannot track frames with 0 objects, abort.'
@@ -207,10 +295,72 @@ class OpConservationTracking(OpTrackingBase):
         if len(eventsVector) == 0:
             raise Exception, 'Tracking terminated unsuccessfully: Events vector has zero length.'
         
-        events = get_events(eventsVector)
-        self.Parameters.setValue(parameters, check_changed=False)
-        self.EventsVector.setValue(events, check_changed=False)
-        
+        return get_events(eventsVector)
+
+    def _trackWindowed(self, solve, time_range, parameters, windowSize, windowOverlap, maxParallelWindows):
+        """
+        Track the time range in overlapping windows, which are solved independently and stitched in order:
+        the events of a window are used up to the time step of the overlap at which it agrees best with
+        the next window (see find_seam()).  The stitched result is published whenever it grows, so the
+        first time steps can be inspected while the later windows are still being solved.
+        """
+        if windowOverlap < 1 or windowSize <= windowOverlap + 1:
+            raise Exception, 'The tracking windows must overlap by at least one time step, '\
+                'and be longer than the overlap plus one time step.'
+        windows = sliding_windows(time_range, windowSize, windowOverlap)
+        t0 = time_range[0]
+        logger.info( "tracking {} time steps in {} windows of {} time steps".format( len(time_range), len(windows), windowSize ) )
+
+        def solveWindow(window):
+            windowParameters = dict(parameters)
+            filtered = {}
+            events = solve(window, parameters=windowParameters, filtered_labels=filtered)
+            return events, windowParameters, filtered
+
+        def solved():
+            # solve up to maxParallelWindows windows at the same time, yield the results in order
+            pending = collections.deque()
+            try:
+                for window in windows:
+                    req = Request( partial(solveWindow, window) )
+                    req.submit()
+                    pending.append( (window, req) )
+                    if len(pending) >= max(1, maxParallelWindows):
+                        window_next, req_next = pending.popleft()
+                        yield (window_next,) + req_next.wait()
+                while pending:
+                    window_next, req_next = pending.popleft()
+                    yield (window_next,) + req_next.wait()
+            finally:
+                for _, req in pending:
+                    req.cancel()
+
+        events = {}
+        filteredLabels = {}
+
+        def commit(window, windowEvents, stop):
+            # use the events of the window for the time steps up to stop
+            for t in range(t0 + len(events), stop):
+                events[str(t - t0)] = shift_events_at(windowEvents[str(t - window[0])], window[0] - t0)
+            if len(events) > 1:
+                parameters['time_range'] = [t0, t0 + len(events) - 1]
+                self.Parameters.setValue(parameters, check_changed=False)
+                self.FilteredLabels.setValue(dict(filteredLabels), check_changed=False)
+                self.EventsVector.setValue(dict(events), check_changed=False)
+
+        previous = None
+        for window, windowEvents, windowParameters, filtered in solved():
+            if previous is None:
+                parameters.update(windowParameters)
+            for i, labels in filtered.items():
+                filteredLabels[str(int(i) + window[0] - t0)] = labels
+            if previous is not None:
+                seam = find_seam(previous[1], previous[0], windowEvents, window)
+                logger.info( "stitching the windows starting at {} and {} at time step {}".format( previous[0][0], window[0], seam ) )
+                commit(previous[0], previous[1], seam)
+            previous = (window, windowEvents)
+        commit(previous[0], previous[1], time_range[-1] + 1)
+
 
     def propagateDirty(self, inputSlot, subindex, roi):
         super(OpConservationTracking, self).propagateDirty(inputSlot, subindex, roi)
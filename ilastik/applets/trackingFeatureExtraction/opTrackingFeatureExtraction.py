@@ -59,23 +59,17 @@ class OpDivisionFeatures(Operator):
         import time
         start = time.time()
         
-        vroi_start = len(self.LabelVolume.meta.shape) * [0,]
-        vroi_stop = list(self.LabelVolume.meta.shape)
-        
         assert len(roi.start) == 1
         froi_start = roi.start[0]
         froi_stop = roi.stop[0]
-        vroi_stop[timeIndex] = roi.stop[0]
         
         assert timeIndex == 0
-        vroi_start[timeIndex] = roi.start[0]
         if roi.stop[0] + 1 < self.LabelVolume.meta.shape[timeIndex]:
-            vroi_stop[timeIndex] = roi.stop[0]+1
             froi_stop = roi.stop[0]+1
-        vroi = [slice(vroi_start[i],vroi_stop[i]) for i in range(len(vroi_start))]
+        # the successor search only needs the region centers and the extent of the label volume
+        shape_next = self.LabelVolume.meta.shape[timeIndex+1:]
         
         feats = self.RegionFeaturesVigra[slice(froi_start, froi_stop)].wait()
-        labelVolume = self.LabelVolume[vroi].wait()
         divisionFeatNames = self.DivisionFeatureNames[()].wait()[config.features_division_name] 
         
         for t in range(roi.stop[0]-roi.start[0]):
@@ -83,12 +77,9 @@ class OpDivisionFeatures(Operator):
             feats_cur = feats[t][config.features_vigra_name]
             if t+1 < froi_stop-froi_start:                
                 feats_next = feats[t+1][config.features_vigra_name]
-                                
-                img_next = labelVolume[t+1,...]
             else:
                 feats_next = None
-                img_next = None
-            res = self.featureManager.computeFeatures_at(feats_cur, feats_next, img_next, divisionFeatNames)
+            res = self.featureManager.computeFeatures_at(feats_cur, feats_next, None, divisionFeatNames, shape_next=shape_next)
             result[t][config.features_division_name] = res 
         
         stop = time.time()
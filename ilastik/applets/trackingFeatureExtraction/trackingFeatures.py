@@ -1,5 +1,6 @@
 import numpy as np
 import math
+import itertools
 
 def dotproduct(v1, v2):
     return sum((a*b) for a, b in zip(v1, v2))
@@ -21,6 +22,12 @@ def angle(v1, v2):
     return (radians*180)/math.pi
 
 
+def round_half_up(x):
+    ''' round like python's round() (half away from zero), unlike np.round '''
+    x = np.asarray(x, dtype=np.float64)
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+
 
 ##### Feature base class #######
 
@@ -42,6 +49,15 @@ class Feature( object ):
     def compute(self, feats_cur, feats_next, **kwargs):
         raise NotImplementedError('Feature not fully implemented yet.')
 
+    def computeBatch(self, feats_cur, feats_next, n_next):
+        '''
+        compute the feature for many objects at once:
+        feats_cur has shape (N, d), feats_next has shape (N, n_best, d) and
+        n_next holds the number of valid successors (the first rows of feats_next) of each object.
+        The default implementation calls compute() for every object.
+        '''
+        return np.array([self.compute(f_cur, f_next[:n]) for f_cur, f_next, n in zip(feats_cur, feats_next, n_next)])
+
     def getName(self):
         return self.name
 
@@ -65,6 +81,18 @@ class ParentChildrenRatio( Feature ):
                 result[i] = self.default_value
         return result
 
+    def computeBatch(self, feats_cur, feats_next, n_next):
+        result = np.empty(feats_cur.shape)
+        result[:] = self.default_value
+        if feats_next.shape[1] < 2:
+            return result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = feats_cur / (feats_next[:, 0] + feats_next[:, 1])
+        ratio[np.isnan(ratio)] = self.default_value
+        valid = n_next >= 2
+        result[valid] = ratio[valid]
+        return result
+
     def dim(self):
         return self.dimensionality * self.feat_dim
 
@@ -83,6 +111,19 @@ class ChildrenRatio( Feature ):
                 ratio[i] = 1./ratio[i]
         return ratio
 
+    def computeBatch(self, feats_cur, feats_next, n_next):
+        result = np.empty(feats_cur.shape)
+        result[:] = self.default_value
+        if feats_next.shape[1] < 2:
+            return result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = feats_next[:, 0] / feats_next[:, 1]
+            ratio[np.isnan(ratio)] = self.default_value
+            ratio = np.where(ratio > 1, 1. / ratio, ratio)
+        valid = n_next >= 2
+        result[valid] = ratio[valid]
+        return result
+
     def dim(self):
         return self.dimensionality * self.feat_dim
 
@@ -92,6 +133,9 @@ class SquaredDistances( Feature ):
     def compute(self, feats_cur, feats_next, **kwargs):
         return feats_cur
 
+    def computeBatch(self, feats_cur, feats_next, n_next):
+        return feats_cur
+
     def dim(self):
         return self.ndim
 
@@ -117,6 +161,24 @@ class ParentChildrenAngle( Feature ):
 
         return max(angles)
 
+    def computeBatch(self, feats_cur, feats_next, n_next):
+        result = np.empty((feats_cur.shape[0],))
+        result[:] = -np.inf
+        scales = np.asarray(self.scales[0:feats_cur.shape[1]], dtype=np.float64)
+        vectors = (feats_next - feats_cur[:, np.newaxis, :]) * scales
+        lengths = np.sqrt((vectors ** 2).sum(axis=-1))
+        for idx1, idx2 in itertools.combinations(range(feats_next.shape[1]), 2):
+            valid = n_next > idx2
+            norm = lengths[:, idx1] * lengths[:, idx2]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cos = (vectors[:, idx1] * vectors[:, idx2]).sum(axis=-1) / norm
+                # degenerate vectors and rounding errors beyond [-1, 1] count as zero degrees, as in angle()
+                degenerate = (norm == 0) | (np.abs(cos) > 1)
+            ang = np.degrees(np.arccos(np.where(degenerate, 1., cos)))
+            result[valid] = np.maximum(result[valid], ang[valid])
+        result[n_next < 2] = self.default_value
+        return result
+
 
 
 
@@ -127,6 +189,89 @@ class ParentIdentity( Feature ):
         return feats_cur
 
 
+class SuccessorIndex( object ):
+    '''
+    a uniform grid over the (rounded) region centers of the objects in frame t+1,
+    used to find the successor candidates of all objects in frame t at once
+    '''
+
+    def __init__(self, coms, labels, cell_size):
+        '''
+        coms: region centers of all objects in frame t+1, indexed by label
+        labels: the labels of the objects to put into the index
+        cell_size: edge length of the grid cells (in pixels)
+        '''
+        coms = np.asarray(coms, dtype=np.float64)
+        coms = coms.reshape((coms.shape[0], -1))
+        self.cell_size = max(int(cell_size), 1)
+        self.ndim = coms.shape[1]
+
+        labels = np.asarray(labels, dtype=np.intp)
+        positions = round_half_up(coms[labels])
+        cells = np.floor_divide(positions, self.cell_size).astype(np.int64)
+        if len(labels) > 0:
+            self._origin = cells.min(axis=0)
+            self._gridShape = cells.max(axis=0) - self._origin + 1
+        else:
+            self._origin = np.zeros((self.ndim,), dtype=np.int64)
+            self._gridShape = np.ones((self.ndim,), dtype=np.int64)
+        cell_ids = self._cellIds(cells - self._origin)
+
+        order = np.argsort(cell_ids, kind='mergesort')
+        self.labels = labels[order]
+        self.positions = positions[order]
+        # objects of the cell self._cells[i] are self.labels[self._cellStart[i]:self._cellStart[i+1]]
+        self._cells, self._cellStart = np.unique(cell_ids[order], return_index=True)
+        self._cellStart = np.append(self._cellStart, len(order))
+
+    def _cellIds(self, cells):
+        ids = np.zeros(cells.shape[:1], dtype=np.int64)
+        for axis in range(self.ndim):
+            ids = ids * self._gridShape[axis] + cells[:, axis]
+        return ids
+
+    def query(self, start, stop):
+        '''
+        find the objects with their rounded center in the windows [start, stop), given as (N, ndim) arrays
+        returns the pairs (window index, label)
+        '''
+        start = np.asarray(start, dtype=np.int64)
+        stop = np.asarray(stop, dtype=np.int64)
+        empty = np.zeros((0,), dtype=np.intp)
+        if len(start) == 0 or len(self._cells) == 0:
+            return empty, empty
+        first = np.maximum(np.floor_divide(start, self.cell_size) - self._origin, 0)
+        last = np.minimum(np.floor_divide(stop - 1, self.cell_size) - self._origin, self._gridShape - 1)
+        span = max((last - first).max() + 1, 0)
+
+        windows = []
+        entries = []
+        for offset in itertools.product(range(span), repeat=self.ndim):
+            cells = first + np.array(offset, dtype=np.int64)
+            inside = np.all(cells <= last, axis=1)
+            cell_ids = self._cellIds(np.where(inside[:, np.newaxis], cells, 0))
+            idx = np.minimum(np.searchsorted(self._cells, cell_ids), len(self._cells) - 1)
+            found = inside & (self._cells[idx] == cell_ids)
+            begin = self._cellStart[idx]
+            counts = np.where(found, self._cellStart[idx + 1] - begin, 0)
+            total = counts.sum()
+            if total == 0:
+                continue
+            window = np.repeat(np.arange(len(start)), counts)
+            # enumerate the objects of each hit cell
+            entry = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(begin, counts)
+            windows.append(window)
+            entries.append(entry)
+
+        if len(windows) == 0:
+            return empty, empty
+        window = np.concatenate(windows)
+        entry = np.concatenate(entries)
+        positions = self.positions[entry]
+        hit = np.all((positions >= start[window]) & (positions < stop[window]), axis=1)
+        return window[hit], self.labels[entry[hit]]
+
+
 class FeatureManager( object ):
     
     feature_mappings = {'ParentIdentity': ParentIdentity,
@@ -150,34 +295,52 @@ class FeatureManager( object ):
         self.size_filter = size_filter
         self.squared_distance_default = squared_distance_default
 
-    def _getBestSquaredDistances(self, com_cur, coms_next, size_filter = None, sizes_next = [], default_value = 9999):
-        ''' returns the squared distances to the objects in the neighborhood of com_curr, optionally with size filter '''
-        squaredDistances = []
-
-        for label_next in coms_next.keys():
-            assert label_next in sizes_next.keys()
-            if size_filter != None and sizes_next[label_next] >= size_filter:
-                dist = np.linalg.norm(coms_next[label_next] - com_cur * self.scales)                
-                squaredDistances.append([label_next,dist])
-
-        squaredDistances = np.array(squaredDistances)
-        # sort the array in the second column in ascending order
-        squaredDistances = np.array(sorted(squaredDistances, key=lambda a_entry: a_entry[1]))        
-        
-        # initialize with label -1 and default value
-        result = np.array([ [-1, default_value] for x in range(self.n_best) ], dtype=np.float32)
-        if squaredDistances.shape[0] != 0:
-            result[0:min(squaredDistances.shape[0],result.shape[0]),:] = squaredDistances[0:min(squaredDistances.shape[0],result.shape[0]),:]
-
-        return result
- 
-
-    def computeFeatures_at(self, feats_cur, feats_next, img_next, feat_names): 
-
-#         n_labels = feats_cur.values()[0].shape[0]
+    def _getBestSquaredDistances(self, coms_cur, feats_next, shape_next):
+        '''
+        returns the labels (-1 if there is none) and distances (default if there is none) of the n_best
+        nearest objects in frame t+1 in the neighborhood of each object in frame t, optionally with size filter
+        '''
+        n_objects = coms_cur.shape[0]
+        labels = -np.ones((n_objects, self.n_best), dtype=np.intp)
+        distances = np.ones((n_objects, self.n_best), dtype=np.float32) * self.squared_distance_default
+        if feats_next is None or shape_next is None or n_objects == 0:
+            return labels, distances
+
+        coms_next = np.asarray(feats_next[self.com_name_next], dtype=np.float64)
+        coms_next = coms_next.reshape((coms_next.shape[0], -1))
+        candidates = np.arange(1, coms_next.shape[0])
+        if self.size_filter is not None:
+            sizes_next = np.asarray(feats_next[self.size_name]).reshape((coms_next.shape[0], -1))[:, 0]
+            candidates = candidates[sizes_next[candidates] >= self.size_filter]
+        index = SuccessorIndex(coms_next, candidates, self.template_size)
+
+        # search windows [round(com) - template_size/2, round(com) + template_size/2), clipped to the image
+        centers = round_half_up(coms_cur)
+        half = self.template_size // 2
+        start = np.maximum(centers - half, 0).astype(np.int64)
+        stop = np.minimum(centers + half, np.array(shape_next[:centers.shape[1]])).astype(np.int64)
+        objects, successors = index.query(start, stop)
+
+        dists = np.sqrt((((coms_next[successors] - coms_cur[objects] * self.scales)) ** 2).sum(axis=1))
+        # the n_best nearest successors of each object, ties broken by label
+        order = np.lexsort((successors, dists, objects))
+        objects, successors, dists = objects[order], successors[order], dists[order]
+        group_start = np.searchsorted(objects, objects)
+        rank = np.arange(len(objects)) - group_start
+        best = rank < self.n_best
+        labels[objects[best], rank[best]] = successors[best]
+        distances[objects[best], rank[best]] = dists[best]
+        return labels, distances
+
+    def computeFeatures_at(self, feats_cur, feats_next, img_next, feat_names, shape_next=None):
+        '''
+        compute the division features of all objects in frame t
+        img_next: label image of frame t+1 (or None for the last frame); only its shape is used,
+            so the shape can be given as shape_next instead
+        '''
+        if img_next is not None:
+            shape_next = img_next.shape
         result = {}
-        
-        vigra_feat_names = set([self.com_name_cur, self.com_name_next, self.size_name])
 
         feat_classes = {}
 
@@ -194,65 +357,36 @@ class FeatureManager( object ):
             shape = (feats_cur.values()[0].shape[0],feat_classes[name].dim())
             result[name] = np.ones(shape) * feat_classes[name].default_value
 
-            vigra_feat_names.add(name_split[1])
-        
-
         for idx in range(self.n_best):
             name = 'SquaredDistances_' + str(idx)
             result[name] = np.ones((feats_cur.values()[0].shape[0], 1)) * self.squared_distance_default
 
-        for label_cur, com_cur in enumerate(feats_cur[self.com_name_cur]):
-            if label_cur == 0:
-                continue
-
-            feats_next_subset = {}
-            for k in vigra_feat_names:
-                feats_next_subset[k] = {}
-
-            if feats_next is not None and img_next is not None:
-                idx_cur = [round(x) for x in com_cur]
-
-                roi = []
-                for idx,coord in enumerate(idx_cur):
-                    start = max(coord - self.template_size/2, 0)
-                    stop = min(coord + self.template_size/2, img_next.shape[idx])
-                    roi.append(slice(int(start),int(stop)))
-
-
-                # find all coms in the neighborhood of com_cur
-                subimg_next = img_next[roi]
-                labels_next = np.unique(subimg_next).tolist()
-
-                for l in labels_next:
-                    if l != 0:
-                        for n in vigra_feat_names:
-                            feats_next_subset[n][l] = np.array([feats_next[n][l]]).flatten()                            
-
-            sq_dist_label = self._getBestSquaredDistances(com_cur, feats_next_subset[self.com_name_next], 
-                                self.size_filter, feats_next_subset[self.size_name], default_value=self.squared_distance_default)
-
-            feats_next_subset_best = {}
-            for n in vigra_feat_names:
-                feats_next_subset_best[n] = []
-                for idx, row in enumerate(sq_dist_label):
-                    l = row[0]
-                    if l != -1:
-                        feats_next_subset_best[n].append(feats_next_subset[n][l])
-
-            # first add squared distances
-            for idx in range(self.n_best):
-                name = 'SquaredDistances_' + str(idx)                
-                result[name][label_cur] = sq_dist_label[idx][1]
-
-            # add all other features
-            for name, feat_class in feat_classes.items():
-                if feat_class.feats_name == 'SquaredDistances':
-                    f_next = sq_dist_label[0:2,1]
-                    f_cur = None
-                else:   
-                    f_cur = np.array([feats_cur[feat_class.feats_name][label_cur]]).flatten()
-                    f_next = np.array([feats_next_subset_best[feat_class.feats_name]]).reshape((-1,f_cur.shape[0]))
-                result[name][label_cur] = feat_class.compute(f_cur, f_next)
+        # label 0 is the background and keeps the default values
+        coms_cur = np.asarray(feats_cur[self.com_name_cur], dtype=np.float64)[1:]
+        if coms_cur.shape[0] == 0:
+            return result
+        coms_cur = coms_cur.reshape((coms_cur.shape[0], -1))
+        if feats_next is None:
+            shape_next = None
+        labels, distances = self._getBestSquaredDistances(coms_cur, feats_next, shape_next)
+        n_next = (labels != -1).sum(axis=1)
+
+        # first add squared distances
+        for idx in range(self.n_best):
+            name = 'SquaredDistances_' + str(idx)
+            result[name][1:, 0] = distances[:, idx]
+
+        # add all other features
+        for name, feat_class in feat_classes.items():
+            f_cur = np.asarray(feats_cur[feat_class.feats_name])[1:]
+            f_cur = f_cur.reshape((f_cur.shape[0], -1))
+            if feats_next is not None:
+                f_next = np.asarray(feats_next[feat_class.feats_name])
+                f_next = f_next.reshape((f_next.shape[0], -1))[np.maximum(labels, 0)]
+            else:
+                f_next = np.zeros(labels.shape + f_cur.shape[1:], dtype=f_cur.dtype)
+            values = feat_class.computeBatch(f_cur, f_next, n_next)
+            result[name][1:] = np.asarray(values).reshape((f_cur.shape[0], -1))
 
         return result
 
@@ -43,6 +43,11 @@ ClusterConfigFields = \
     "output_log_directory" : str,
     "server_working_directory" : str,
     "command_format" : FormattedField( requiredFields=["task_args"], optionalFields=["task_name"] ),
+    "blocks_per_task" : AutoEval(float),
+    "monitor_tasks" : bool,
+    "max_concurrent_tasks" : AutoEval(int),
+    "task_poll_interval_secs" : AutoEval(float),
+    "task_max_retries" : AutoEval(int),
     "debug_option_use_previous_node_files" : bool
 }
 
@@ -20,10 +20,13 @@
 ###############################################################################
 import os
 import copy
+import time
+import signal
 import subprocess
 import collections
 import hashlib
 import functools
+import threading
 
 import numpy
 
@@ -40,6 +43,15 @@ from ilastik.workflow import Workflow
 import logging
 logger = logging.getLogger(__name__)
 
+#: Separates the block rois of a multi-block task on the node command line.
+ROI_LIST_SEPARATOR = ';'
+
+def dumpRoiList(rois):
+    return ROI_LIST_SEPARATOR.join( map( Roi.dumps, rois ) )
+
+def loadRoiList(roiListString):
+    return map( Roi.loads, roiListString.split( ROI_LIST_SEPARATOR ) )
+
 class OpTaskWorker(Operator):
     Input = InputSlot()
     RoiString = InputSlot(stype='string')
@@ -83,33 +95,45 @@ class OpTaskWorker(Operator):
             "Output dataset has the wrong set of axes.  Input axes: {}, Output axes: {}".format( "".join(inputAxes), "".join(outputAxes) )
         
         roiString = self.RoiString.value
-        roi = Roi.loads(roiString)
-        if len( roi.start ) != len( self.Input.meta.shape ):
-            assert False, "Task roi: {} is not valid for this input.  Did the master launch this task correctly?".format( roiString )
-
-        logger.info( "Executing for roi: {}".format(roi) )
+        rois = loadRoiList(roiString)
+        for roi in rois:
+            if len( roi.start ) != len( self.Input.meta.shape ):
+                assert False, "Task roi: {} is not valid for this input.  Did the master launch this task correctly?".format( roiString )
+            assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), \
+                "Each task roi must be exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
 
         if config.use_node_local_scratch:
             assert False, "FIXME."
 
-        assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task must execute exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
         assert self.Input.ready()
 
-        with Timer() as computeTimer:
-            # Stream the data out to disk.
-            request_blockshape = self._primaryBlockwiseFileset.description.sub_block_shape # Could be None.  That's okay.
-            streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape )
-            streamer.progressSignal.subscribe( self.progressSignal )
-            streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
-            streamer.execute()
+        # Blocks may already be finished if this task was re-dispatched.
+        rois = filter( lambda roi: blockwiseFileset.getBlockStatus( roi.start ) != BlockwiseFileset.BLOCK_AVAILABLE, rois )
 
-            # Now the block is ready.  Update the status.
-            blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+        with Timer() as computeTimer:
+            # All blocks are computed with the same (already loaded) workflow,
+            #  so only the first block pays for loading the project and warming up the caches.
+            for blockIndex, roi in enumerate(rois):
+                logger.info( "Executing for roi: {} (block {} of {})".format(roi, blockIndex+1, len(rois)) )
+                with Timer() as blockTimer:
+                    # Stream the data out to disk.
+                    request_blockshape = self._primaryBlockwiseFileset.description.sub_block_shape # Could be None.  That's okay.
+                    streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape )
+                    streamer.progressSignal.subscribe( functools.partial( self._reportBlockProgress, blockIndex, len(rois) ) )
+                    streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
+                    streamer.execute()
+    
+                    # Now the block is ready.  Update the status.
+                    blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+                logger.info( "Finished block in {} seconds".format( blockTimer.seconds() ) )
 
-        logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
+        logger.info( "Finished task ({} blocks) in {} seconds".format( len(rois), computeTimer.seconds() ) )
         result[0] = True
         return result
 
+    def _reportBlockProgress(self, blockIndex, numBlocks, blockProgress):
+        self.progressSignal( (100.0*blockIndex + blockProgress) / numBlocks )
+
     def propagateDirty(self, slot, subindex, roi):
         self.ReturnCode.setDirty( slice(None) )
         
@@ -126,6 +150,202 @@ class OpTaskWorker(Operator):
             op = op.parent
         return op
 
+class LocalTaskProcess(object):
+    """
+    Launches a node task command as a local subprocess.
+    Used in place of a cluster scheduler when the task launch server is 'localhost'
+    and the master supervises its tasks, so a whole clusterized run can be executed
+    (and tested) on a single machine.
+    """
+    def __init__(self, command, workingDirectory):
+        # Start the task in its own process group, so kill() also stops
+        #  the children of the intermediate shell.
+        self._process = subprocess.Popen( command, shell=True, cwd=workingDirectory, preexec_fn=os.setsid )
+
+    def poll(self):
+        """
+        Return None if the task is still running, otherwise its exit code.
+        """
+        return self._process.poll()
+
+    def kill(self):
+        if self._process.poll() is None:
+            try:
+                os.killpg( self._process.pid, signal.SIGKILL )
+            except OSError:
+                # Already gone.
+                pass
+            self._process.wait()
+
+class BackgroundTask(object):
+    """
+    Runs a blocking launch function (e.g. a remote command executed via fabric) in a background thread,
+    so the supervisor can keep launching and polling other tasks in the meantime.
+    The task counts as failed if the launch function raises (fabric aborts with SystemExit if the remote command fails).
+    """
+    def __init__(self, func, *args):
+        self._exitCode = None
+        self._thread = threading.Thread( target=self._run, args=(func,) + args, name="BackgroundTask" )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, *args):
+        try:
+            func(*args)
+        except BaseException as ex:
+            logger.error( "Background task failed: {}".format( ex ) )
+            self._exitCode = 1
+        else:
+            self._exitCode = 0
+
+    def poll(self):
+        """
+        Return None if the task is still running, otherwise its exit code.
+        """
+        if self._thread.is_alive():
+            return None
+        return self._exitCode
+
+    def kill(self):
+        # A thread can't be stopped from the outside, and the remote process is out of our reach.
+        # The supervisor simply stops waiting for it (the re-dispatched task skips blocks that were finished meanwhile).
+        if self._thread.is_alive():
+            logger.warn( "Can't kill a background task, abandoning it." )
+
+class TaskSupervisor(object):
+    """
+    Launches node tasks and watches them until all of their blocks are available in the output fileset.
+
+    - At most maxConcurrentTasks tasks are in flight at once (None means no limit).
+    - Progress is determined by polling the BlockwiseFileset block status (and lock files, 
+      which indicate that a worker is currently writing the block).
+    - A task is re-dispatched if its worker died without finishing all of its blocks,
+      or if it didn't finish within taskTimeoutSecs.  Each task is retried at most maxRetries times.
+    
+    The launch function is called with the task command and must return without waiting for the task.
+    It may return a handle with poll() and kill() methods (e.g. a LocalTaskProcess or a BackgroundTask),
+    in which case dead workers are detected as soon as they exit.  Any other return value is ignored
+    (e.g. for tasks submitted to a remote scheduler), and failed tasks are only detected via the timeout.
+    """
+    class TaskStatus(object):
+        def __init__(self, taskInfo):
+            self.taskInfo = taskInfo
+            self.attempts = 0
+            self.handle = None
+            self.startTime = None
+            self.wallTime = None
+
+    def __init__( self, blockwiseFileset, taskInfos, launchFunc, maxConcurrentTasks=None, taskTimeoutSecs=None, 
+                  pollIntervalSecs=10.0, maxRetries=2, bytesPerVoxel=1 ):
+        assert maxConcurrentTasks is None or maxConcurrentTasks > 0
+        self._blockwiseFileset = blockwiseFileset
+        self._launchFunc = launchFunc
+        self._maxConcurrentTasks = maxConcurrentTasks
+        self._taskTimeoutSecs = taskTimeoutSecs
+        self._pollIntervalSecs = pollIntervalSecs
+        self._maxRetries = maxRetries
+        self._bytesPerVoxel = bytesPerVoxel
+
+        self._statuses = collections.OrderedDict()
+        for taskKey, taskInfo in taskInfos.items():
+            self._statuses[taskKey] = TaskSupervisor.TaskStatus( taskInfo )
+
+        self.completedTasks = []
+        self.failedTasks = []
+
+    def run(self):
+        """
+        Execute all tasks and block until each one has either completed or exhausted its retries.
+        Returns True if all tasks completed.
+        """
+        pending = collections.deque( self._statuses.keys() )
+        inFlight = collections.OrderedDict()
+
+        with Timer() as totalTimer:
+            while pending or inFlight:
+                while pending and ( self._maxConcurrentTasks is None or len(inFlight) < self._maxConcurrentTasks ):
+                    taskKey = pending.popleft()
+                    self._launch( taskKey )
+                    inFlight[taskKey] = self._statuses[taskKey]
+
+                time.sleep( self._pollIntervalSecs )
+
+                for taskKey, status in inFlight.items():
+                    state = self._checkTask( status )
+                    if state == 'running':
+                        continue
+                    del inFlight[taskKey]
+                    if state == 'finished':
+                        self._recordCompletion( taskKey, status )
+                    elif status.attempts <= self._maxRetries:
+                        logger.warn( "Re-dispatching task {} ({})".format( status.taskInfo.taskName, state ) )
+                        pending.append( taskKey )
+                    else:
+                        logger.error( "Task {} failed after {} attempts ({})".format( status.taskInfo.taskName, status.attempts, state ) )
+                        self.failedTasks.append( taskKey )
+
+                logger.info( "Tasks: {} completed, {} in flight ({} writing), {} pending, {} failed"
+                             .format( len(self.completedTasks), len(inFlight), self._countLocked(inFlight.values()), len(pending), len(self.failedTasks) ) )
+
+        self._logSummary( totalTimer.seconds() )
+        return len(self.failedTasks) == 0
+
+    def _launch(self, taskKey):
+        status = self._statuses[taskKey]
+        if status.handle is not None:
+            status.handle.kill()
+        logger.info("Launching node task: " + status.taskInfo.command )
+        status.attempts += 1
+        status.startTime = time.time()
+        handle = self._launchFunc( status.taskInfo.command )
+        if hasattr( handle, 'poll' ) and hasattr( handle, 'kill' ):
+            status.handle = handle
+        else:
+            status.handle = None
+
+    def _checkTask(self, status):
+        """
+        Return one of 'finished', 'running', 'died', or 'timeout'.
+        """
+        exited = ( status.handle is not None and status.handle.poll() is not None )
+        # Check the block status *after* polling the worker, 
+        #  in case it finished its last block just before exiting.
+        if all( self._blockwiseFileset.getBlockStatus( roi.start ) == BlockwiseFileset.BLOCK_AVAILABLE
+                for roi in status.taskInfo.subregions ):
+            status.wallTime = time.time() - status.startTime
+            return 'finished'
+        if exited:
+            return 'died'
+        if self._taskTimeoutSecs is not None and time.time() - status.startTime > self._taskTimeoutSecs:
+            if status.handle is not None:
+                status.handle.kill()
+            return 'timeout'
+        return 'running'
+
+    def _countLocked(self, statuses):
+        return sum( 1 for status in statuses 
+                    if any( self._blockwiseFileset.isBlockLocked( roi.start ) for roi in status.taskInfo.subregions ) )
+
+    def _taskBytes(self, taskKey):
+        return sum( self._bytesPerVoxel * numpy.prod( numpy.subtract( roi.stop, roi.start ) )
+                    for roi in self._statuses[taskKey].taskInfo.subregions )
+
+    def _recordCompletion(self, taskKey, status):
+        self.completedTasks.append( taskKey )
+        throughput = self._taskBytes(taskKey) / (1000.0*1000.0) / max( status.wallTime, 1e-6 )
+        logger.info( "Task {} finished in {:.1f} seconds ({:.2f} MB/s)".format( status.taskInfo.taskName, status.wallTime, throughput ) )
+
+    def _logSummary(self, totalSeconds):
+        if not self.completedTasks:
+            logger.info( "No tasks completed." )
+            return
+        wallTimes = [ self._statuses[taskKey].wallTime for taskKey in self.completedTasks ]
+        totalMB = sum( self._taskBytes(taskKey) for taskKey in self.completedTasks ) / (1000.0*1000.0)
+        logger.info( "Completed {} tasks in {:.1f} seconds. Task wall time: mean {:.1f}, max {:.1f} seconds. "
+                     "Overall throughput: {:.2f} MB/s".format( len(self.completedTasks), totalSeconds,
+                                                              numpy.mean(wallTimes), max(wallTimes),
+                                                              totalMB / max(totalSeconds, 1e-6) ) )
+
 class OpClusterize(Operator):
     Input = InputSlot()
     OutputDatasetDescription = InputSlot()
@@ -137,7 +357,7 @@ class OpClusterize(Operator):
     class TaskInfo():
         taskName = None
         command = None
-        subregion = None
+        subregions = None # The block rois computed by this task
         
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
@@ -153,23 +373,26 @@ class OpClusterize(Operator):
         self._config = parseClusterConfigFile( configFilePath )
 
         # Create the destination file if necessary
-        blockwiseFileset, taskInfos = self._prepareDestination()
+        blockwiseFileset, blockRois = self._prepareDestination()
 
         try:
             # Figure out which work doesn't need to be recomputed (if any)
-            unneeded_rois = []
-            for roi in taskInfos.keys():
+            needed_rois = []
+            for roi in blockRois:
                 if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE \
                 or blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
-                    unneeded_rois.append( roi )
-    
-            # Remove any tasks that we don't need to compute (they were finished in a previous run)
-            for roi in unneeded_rois:
-                logger.info( "No need to run task: {} for roi: {}".format( taskInfos[roi].taskName, roi ) )
-                del taskInfos[roi]
+                    logger.info( "No need to compute block roi: {}".format( roi ) )
+                else:
+                    needed_rois.append( roi )
+
+            # Pack the remaining blocks into tasks
+            taskInfos = self._prepareTaskInfos( needed_rois )
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
-            if self._config.task_launch_server == "localhost":
+            if self._config.monitor_tasks and self._config.task_launch_server == "localhost":
+                # Use a local process pool in place of the cluster
+                launchFunc = functools.partial( LocalTaskProcess, workingDirectory=absWorkDir )
+            elif self._config.task_launch_server == "localhost":
                 def localCommand( cmd ):
                     cwd = os.getcwd()
                     os.chdir( absWorkDir )
@@ -185,7 +408,23 @@ class OpClusterize(Operator):
                     with fab.cd( absWorkDir ):
                         fab.run( cmd )
                 launchFunc = functools.partial( fab.execute, remoteCommand )
+                if self._config.monitor_tasks:
+                    # fab.execute() blocks until the remote command exits, so run it in the background.
+                    launchFunc = functools.partial( BackgroundTask, launchFunc )
     
+            if self._config.monitor_tasks:
+                # Launch the tasks and wait for them to finish, re-dispatching failed tasks as needed.
+                supervisor = TaskSupervisor( blockwiseFileset,
+                                             taskInfos,
+                                             launchFunc,
+                                             maxConcurrentTasks=self._config.max_concurrent_tasks,
+                                             taskTimeoutSecs=self._config.task_timeout_secs,
+                                             pollIntervalSecs=self._getConfigValue( 'task_poll_interval_secs', 10.0 ),
+                                             maxRetries=self._getConfigValue( 'task_max_retries', 2 ),
+                                             bytesPerVoxel=dtypeBytes )
+                result[0] = supervisor.run()
+                return result
+
             # Spawn each task
             for taskInfo in taskInfos.values():
                 logger.info("Launching node task: " + taskInfo.command )
@@ -197,22 +436,53 @@ class OpClusterize(Operator):
         finally:
             blockwiseFileset.close()
 
+    def _getConfigValue(self, name, default):
+        value = getattr( self._config, name )
+        if value is None:
+            return default
+        return value
+
+    @classmethod
+    def _packBlocks(cls, roiList, maxTaskCost):
+        """
+        Group the given block rois into tasks of (at most) maxTaskCost estimated cost, 
+        so each node job amortizes its startup cost (loading the project, classifier, etc.) over several blocks.
+        A block's cost is estimated from its volume, measured in units of the largest (i.e. full-size) block.
+        Neighboring blocks are kept together, since they are likely to share cached data.
+        """
+        if not roiList:
+            return []
+        voxels = [ numpy.prod( numpy.subtract( roi[1], roi[0] ) ) for roi in roiList ]
+        fullBlockVoxels = float( max( voxels ) )
+
+        packedRois = [ [] ]
+        taskCost = 0.0
+        for roi, blockVoxels in zip( roiList, voxels ):
+            blockCost = blockVoxels / fullBlockVoxels
+            if packedRois[-1] and taskCost + blockCost > maxTaskCost:
+                packedRois.append( [] )
+                taskCost = 0.0
+            packedRois[-1].append( roi )
+            taskCost += blockCost
+        return packedRois
+
     def _prepareTaskInfos(self, roiList):
         # Divide up the workload into large pieces
-        logger.info( "Dividing into {} node jobs.".format( len(roiList) ) )
+        maxTaskCost = self._getConfigValue( 'blocks_per_task', 1 )
+        packedRois = self._packBlocks( roiList, maxTaskCost )
+        logger.info( "Dividing {} blocks into {} node jobs.".format( len(roiList), len(packedRois) ) )
 
         taskInfos = collections.OrderedDict()
-        for roiIndex, roi in enumerate(roiList):
-            roi = ( tuple(roi[0]), tuple(roi[1]) )
+        for taskIndex, taskRois in enumerate(packedRois):
             taskInfo = OpClusterize.TaskInfo()
-            taskInfo.subregion = SubRegion( None, start=roi[0], stop=roi[1] )
+            taskInfo.subregions = [ SubRegion( None, start=tuple(roi[0]), stop=tuple(roi[1]) ) for roi in taskRois ]
             
-            taskName = "J{:02}".format(roiIndex)
+            taskName = "J{:02}".format(taskIndex)
 
             commandArgs = []
             commandArgs.append( "--option_config_file=" + self.ConfigFilePath.value )
             commandArgs.append( "--project=" + self.ProjectFilePath.value )
-            commandArgs.append( "--_node_work_=\"" + Roi.dumps( taskInfo.subregion ) + "\"" )
+            commandArgs.append( "--_node_work_=\"" + dumpRoiList( taskInfo.subregions ) + "\"" )
             commandArgs.append( "--process_name={}".format(taskName)  )
             commandArgs.append( "--output_description_file={}".format( self.OutputDatasetDescription.value )  )
 
@@ -230,15 +500,15 @@ class OpClusterize(Operator):
             allArgs = " " + " ".join(commandArgs) + " "
             taskInfo.taskName = taskName
             taskInfo.command = commandFormat.format( task_args=allArgs, task_name=taskName, task_output_file=taskOutputLogPath )
-            taskInfos[roi] = taskInfo
+            taskInfos[taskName] = taskInfo
 
         return taskInfos
 
     def _prepareDestination(self):
         """
         - If the result file doesn't exist yet, create it (and the dataset)
-        - If the result file already exists, return a list of the rois that 
-        are NOT needed (their data already exists in the final output)
+        - Return the fileset and the list of all its block rois.
+          (If the blocking scheme changed, all blocks are marked as not available.)
         """
         originalDescription = BlockwiseFileset.readDescription(self.OutputDatasetDescription.value)
         datasetDescription = copy.deepcopy(originalDescription)
@@ -288,22 +558,23 @@ class OpClusterize(Operator):
         # Now open the dataset
         blockwiseFileset = BlockwiseFileset( self.OutputDatasetDescription.value )
         
-        taskInfos = self._prepareTaskInfos( blockwiseFileset.getAllBlockRois() )
+        blockRois = [ ( tuple(roi[0]), tuple(roi[1]) ) for roi in blockwiseFileset.getAllBlockRois() ]
         
         if blockwiseFileset.description.hash_id != originalDescription.hash_id:
             # Something about our blocking scheme changed.
             # Make sure all blocks are marked as NOT available.
             # (Just in case some were left over from a previous run.)
-            for roi in taskInfos.keys():
+            for roi in blockRois:
                 blockwiseFileset.setBlockStatus( roi[0], BlockwiseFileset.BLOCK_NOT_AVAILABLE )
 
-        return blockwiseFileset, taskInfos
+        return blockwiseFileset, blockRois
 
     def _determineCompletedBlocks(self, blockwiseFileset, taskInfos):
         finished_rois = []
-        for roi in taskInfos.keys():
-            if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE:
-                finished_rois.append( roi )
+        for taskInfo in taskInfos.values():
+            for subregion in taskInfo.subregions:
+                if blockwiseFileset.getBlockStatus(subregion.start) == BlockwiseFileset.BLOCK_AVAILABLE:
+                    finished_rois.append( (subregion.start, subregion.stop) )
         return finished_rois
 
     def propagateDirty(self, slot, subindex, roi):
@@ -30,6 +30,22 @@ Example:
 debug: false
 plugin_directories: ~/.ilastik/plugins,
 logging_config: ~/custom_ilastik_logging_config.json
+
+[feature_cache]
+directory: ~/.ilastik/feature_cache
+max_size_mb: 20000
+
+[object_extraction]
+block_size: 512
+
+[object_classification]
+warm_start: true
+
+[blockwise_object_classification]
+ram_budget_mb: 8192
+spill_directory: /tmp
+
+(The blockwise RAM budget covers the cached block pipelines and the halo slab caches.)
 """
 
 default_config = """
@@ -40,6 +56,25 @@ plugin_directories: ~/.ilastik/plugins,
 [lazyflow]
 threads: -1
 total_ram_mb: 0
+
+[project_file]
+block_compression: gzip
+block_compression_level: 1
+
+[feature_cache]
+directory:
+max_size_mb: 10240
+block_size: 64
+
+[object_extraction]
+block_size: 0
+
+[object_classification]
+warm_start: false
+
+[blockwise_object_classification]
+ram_budget_mb: 4096
+spill_directory:
 """
 
 cfg = ConfigParser.SafeConfigParser()
@@ -81,6 +81,14 @@ class ObjectClassificationWorkflow(Workflow):
         parser.add_argument('--fillmissing', help="use 'fill missing' applet with chosen detection method", choices=['classic', 'svm', 'none'], default='none')
         parser.add_argument('--filter', help="pixel feature filter implementation.", choices=['Original', 'Refactored', 'Interpolated'], default='Original')
         parser.add_argument('--nobatch', help="do not append batch applets", action='store_true', default=False)
+        parser.add_argument('--region_features_block_size', help="compute the object features block by block, in cubes of this size "
+                            "(0: load the whole volume; default: see the [object_extraction] config section)", type=int, default=None)
+        parser.add_argument('--blockwise_ram_budget_mb', help="memory budget of the blockwise object classification "
+                            "(0: no limit; default: see the [blockwise_object_classification] config section)", type=float, default=None)
+        parser.add_argument('--blockwise_spill_directory', help="directory to keep the predictions of evicted blocks in "
+                            "(default: see the [blockwise_object_classification] config section)", default=None)
+        parser.add_argument('--object_classifier_warm_start', help="when labels were only added, retrain only some of the object classifier's forests "
+                            "(default: see the [object_classification] config section)", action='store_true', default=None)
         
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
 
@@ -95,6 +103,7 @@ class ObjectClassificationWorkflow(Workflow):
             logger.error( "Ignoring --filter cmdline arg.  Can't specify a different filter setting after the project has already been created." )
 
         self.batch = not parsed_args.nobatch
+        self.regionFeaturesBlockSize = parsed_args.region_features_block_size
 
         self._applets = []
 
@@ -118,6 +127,8 @@ class ObjectClassificationWorkflow(Workflow):
         # our main applets
         self.objectExtractionApplet = ObjectExtractionApplet(workflow=self, name = "Object Feature Selection")
         self.objectClassificationApplet = ObjectClassificationApplet(workflow=self)
+        if parsed_args.object_classifier_warm_start is not None:
+            self.objectClassificationApplet.topLevelOperator.WarmStart.setValue( parsed_args.object_classifier_warm_start )
         self.dataExportApplet = ObjectClassificationDataExportApplet(self, "Object Prediction Export")
         opDataExport = self.dataExportApplet.topLevelOperator
         opDataExport.WorkingDirectory.connect( self.dataSelectionApplet.topLevelOperator.WorkingDirectory )
@@ -150,6 +161,11 @@ class ObjectClassificationWorkflow(Workflow):
             self.blockwiseObjectClassificationApplet = BlockwiseObjectClassificationApplet(
                 self, "Blockwise Object Classification", "Blockwise Object Classification")
             self._applets.append(self.blockwiseObjectClassificationApplet)
+            opBlockwiseObjectClassification = self.blockwiseObjectClassificationApplet.topLevelOperator
+            if parsed_args.blockwise_ram_budget_mb is not None:
+                opBlockwiseObjectClassification.PipelineRamBudgetMb.setValue( parsed_args.blockwise_ram_budget_mb )
+            if parsed_args.blockwise_spill_directory is not None:
+                opBlockwiseObjectClassification.SpillDirectory.setValue( parsed_args.blockwise_spill_directory )
 
             self.batchExportApplet = ObjectClassificationDataExportApplet(
                 self, "Batch Object Prediction Export", isBatch=True)
@@ -204,6 +220,11 @@ class ObjectClassificationWorkflow(Workflow):
 
         opObjExtraction.RawImage.connect(rawslot)
         opObjExtraction.BinaryImage.connect(binaryslot)
+        if self.regionFeaturesBlockSize is not None:
+            if self.regionFeaturesBlockSize > 0:
+                opObjExtraction.RegionFeaturesBlockShape.setValue( (self.regionFeaturesBlockSize,)*3 )
+            else:
+                opObjExtraction.RegionFeaturesBlockShape.disconnect()
 
         opObjClassification.RawImages.connect(rawslot)
         opObjClassification.LabelsAllowedFlags.connect(opData.AllowLabels)
@@ -281,6 +302,8 @@ class ObjectClassificationWorkflow(Workflow):
         opBatchClassify.SelectedFeatures.connect(opObjectTrainingTopLevel.SelectedFeatures)
         opBatchClassify.BlockShape3dDict.connect(opBlockwiseObjectClassification.BlockShape3dDict)
         opBatchClassify.HaloPadding3dDict.connect(opBlockwiseObjectClassification.HaloPadding3dDict)
+        opBatchClassify.PipelineRamBudgetMb.connect(opBlockwiseObjectClassification.PipelineRamBudgetMb)
+        opBatchClassify.SpillDirectory.connect(opBlockwiseObjectClassification.SpillDirectory)
 
         #  but image pathway is from the batch pipeline
         op5Raw = OperatorWrapper(OpReorderAxes, parent=self)
@@ -369,31 +392,34 @@ class ObjectClassificationWorkflow(Workflow):
                 opBatchClassifyView.BlockShape3dDict.setValue( tagged_shape )
 
                 # For now, we force the entire result to be computed as one big block.
-                # Force the batch classify op to create an internal pipeline for our block.
-                opBatchClassifyView._ensurePipelineExists( (0,0,0,0,0) )
-                opSingleBlockClassify = opBatchClassifyView._blockPipelines[(0,0,0,0,0)]
+                # Force the batch classify op to create an internal pipeline for our block,
+                #  and keep it from being evicted (and rebuilt) until all exports of this lane are done.
+                block_start = (0,0,0,0,0)
+                opSingleBlockClassify = opBatchClassifyView._acquirePipelines( [block_start] )[block_start]
+                try:
+                    # Export the images (if any)
+                    if self.input_types == 'raw':
+                        # If pixel probabilities need export, do that first.
+                        # (They are needed by the other outputs, anyway)
+                        if self._export_args.export_pixel_probability_img:
+                            self._export_batch_image( lane_index, EXPORT_SELECTION_PIXEL_PROBABILITIES, 'pixel-probability-img' )
+                    if self._export_args.export_object_prediction_img:
+                        self._export_batch_image( lane_index, EXPORT_SELECTION_PREDICTIONS, 'object-prediction-img' )
+                    if self._export_args.export_object_probability_img:
+                        self._export_batch_image( lane_index, EXPORT_SELECTION_PROBABILITIES, 'object-probability-img' )
+
+                    # Export the CSV
+                    csv_filename = self._export_args.table_filename
+                    if csv_filename:
+                        feature_table = opSingleBlockClassify._opPredict.createFeatureTable([])
+                        if len(self.opBatchClassify) > 1:
+                            base, ext = os.path.splitext( csv_filename )
+                            csv_filename = base + '-' + str(lane_index) + ext
+                        print "Exporting object table for image #{}:\n{}".format( lane_index, csv_filename )
+                        feature_table.writeCsv(csv_filename)
+                finally:
+                    opBatchClassifyView._releasePipelines( [block_start] )
 
-                # Export the images (if any)
-                if self.input_types == 'raw':
-                    # If pixel probabilities need export, do that first.
-                    # (They are needed by the other outputs, anyway)
-                    if self._export_args.export_pixel_probability_img:
-                        self._export_batch_image( lane_index, EXPORT_SELECTION_PIXEL_PROBABILITIES, 'pixel-probability-img' )
-                if self._export_args.export_object_prediction_img:
-                    self._export_batch_image( lane_index, EXPORT_SELECTION_PREDICTIONS, 'object-prediction-img' )
-                if self._export_args.export_object_probability_img:
-                    self._export_batch_image( lane_index, EXPORT_SELECTION_PROBABILITIES, 'object-probability-img' )
-
-                # Export the CSV
-                csv_filename = self._export_args.table_filename
-                if csv_filename:
-                    feature_table = opSingleBlockClassify._opPredict.createExportTable([])
-                    if len(self.opBatchClassify) > 1:
-                        base, ext = os.path.splitext( csv_filename )
-                        csv_filename = base + '-' + str(lane_index) + ext
-                    print "Exporting object table for image #{}:\n{}".format( lane_index, csv_filename )
-                    self.record_array_to_csv(feature_table, csv_filename)
-                
                 print "FINISHED."
 
     def _export_batch_image(self, lane_index, selection_index, selection_name):
@@ -430,24 +456,6 @@ class ObjectClassificationWorkflow(Workflow):
         # Restore original format
         opBatchExport.OutputFilenameFormat.setValue( default_output_path )
 
-    def record_array_to_csv(self, record_array, filename):
-        """
-        Save the given record array to a CSV file.
-        """
-        # Sort by offset
-        with open(filename, 'w') as csv_file:
-            sorted_fields = sorted( record_array.dtype.fields.items(), key=lambda (k,v): v[1] )
-            field_names = map( lambda (k,v): k, sorted_fields )
-            for name in field_names:
-                # Remove any commas in the header (this is csv, after all)
-                name = name.replace(',', '/')
-                csv_file.write(name + ',')
-            csv_file.write('\n')
-            for row in record_array:
-                for name in field_names:
-                    csv_file.write(str(row[name]) + ',')
-                csv_file.write('\n')
-
     def getHeadlessOutputSlot(self, slotId):
         if slotId == "BatchPredictionImage":
             return self.opBatchClassify.PredictionImage
@@ -470,16 +478,21 @@ class ObjectClassificationWorkflow(Workflow):
         sub_block_stop = sub_block_start + 1
         sub_block_roi = (sub_block_start, sub_block_stop)
         
+        # Keep the block pipeline from being evicted (and rebuilt) while we use it.
+        block_start = tuple(roi[0])
+        opBlockPipeline = opBatchClassify._acquirePipelines( [block_start] )[block_start]
+        try:
+            region_features = opBatchClassify.BlockwiseRegionFeatures( *sub_block_roi ).wait()
+            objectwise_predictions = opBlockPipeline.ObjectwisePredictions([]).wait()[0]
+            # Compute the block offset within the image coordinates
+            halo_roi = opBlockPipeline._halo_roi
+        finally:
+            opBatchClassify._releasePipelines( [block_start] )
+
         # FIRST, remove all objects that lie outside the block (i.e. remove the ones in the halo)
-        region_features = opBatchClassify.BlockwiseRegionFeatures( *sub_block_roi ).wait()
         region_features_dict = region_features.flat[0]
         region_centers = region_features_dict['Default features']['RegionCenter']
 
-        opBlockPipeline = opBatchClassify._blockPipelines[ tuple(roi[0]) ]
-
-        # Compute the block offset within the image coordinates
-        halo_roi = opBlockPipeline._halo_roi
-
         translated_region_centers = region_centers + halo_roi[0][1:-1]
 
         # TODO: If this is too slow, vectorize this
@@ -494,7 +507,6 @@ class ObjectClassificationWorkflow(Workflow):
         # Remove all 'negative' predictions, emit only 'positive' predictions
         # FIXME: Don't hardcode this?
         POSITIVE_LABEL = 2
-        objectwise_predictions = opBlockPipeline.ObjectwisePredictions([]).wait()[0]
         assert objectwise_predictions.shape == mask.shape
         mask[objectwise_predictions != POSITIVE_LABEL] = False
 
@@ -789,6 +801,8 @@ class ObjectClassificationWorkflowPixel(ObjectClassificationWorkflow):
         opBatchObjectClassify.SelectedFeatures.connect(opObjectTrainingTopLevel.SelectedFeatures)
         opBatchObjectClassify.BlockShape3dDict.connect(opBlockwiseObjectClassification.BlockShape3dDict)
         opBatchObjectClassify.HaloPadding3dDict.connect(opBlockwiseObjectClassification.HaloPadding3dDict)        
+        opBatchObjectClassify.PipelineRamBudgetMb.connect(opBlockwiseObjectClassification.PipelineRamBudgetMb)
+        opBatchObjectClassify.SpillDirectory.connect(opBlockwiseObjectClassification.SpillDirectory)
         
         opBatchObjectClassify.RawImage.connect(op5Raw.Output)
         opBatchObjectClassify.BinaryImage.connect(op5Binary.Output)
@@ -37,6 +37,7 @@ from ilastik.applets.featureSelection import FeatureSelectionApplet
 
 from ilastik.applets.featureSelection.opFeatureSelection import OpFeatureSelectionNoCache
 from ilastik.applets.pixelClassification.opPixelClassification import OpPredictionPipelineNoCache
+from ilastik.applets.dataExport.streamingBatchExport import StreamingBatchExport
 
 from lazyflow.roi import TinyVector, fullSlicing
 from lazyflow.graph import Graph, OperatorWrapper
@@ -79,6 +80,10 @@ class PixelClassificationWorkflow(Workflow):
         parser.add_argument('--random-label-value', help="The label value to use injecting random labels", default=1, type=int)
         parser.add_argument('--random-label-count', help="The number of random labels to inject via --generate-random-labels", default=2000, type=int)
         parser.add_argument('--retrain', help="Re-train the classifier based on labels stored in project file, and re-save.", action="store_true")
+        parser.add_argument('--batch-concurrent-files', help="The number of batch results to export at the same time.", default=1, type=int)
+        parser.add_argument('--batch-ram-budget-mb', help="Only start another concurrent batch export if the estimated memory of all running exports stays below this (0: no limit).",
+                            default=ilastik_config.getint('lazyflow', 'total_ram_mb'), type=int)
+        parser.add_argument('--resume-batch', help="Skip batch results that were completely exported by an earlier run.", action="store_true")
 
         # Parse the creation args: These were saved to the project file when this project was first created.
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
@@ -92,6 +97,9 @@ class PixelClassificationWorkflow(Workflow):
         self.random_label_value = parsed_args.random_label_value
         self.random_label_count = parsed_args.random_label_count
         self.retrain = parsed_args.retrain
+        self.batch_concurrent_files = parsed_args.batch_concurrent_files
+        self.batch_ram_budget_mb = parsed_args.batch_ram_budget_mb
+        self.resume_batch = parsed_args.resume_batch
 
         if parsed_args.filter and parsed_args.filter != parsed_creation_args.filter:
             logger.error("Ignoring new --filter setting.  Filter implementation cannot be changed after initial project creation.")
@@ -395,22 +403,11 @@ class PixelClassificationWorkflow(Workflow):
         
             # Now run the batch export and report progress....
             opBatchDataExport = self.batchResultsApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opBatchDataExport):
-                logger.info( "Exporting result {} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result {}/{} Progress: ".format( i, len( opBatchDataExport ) ) )
-                sys.stdout.flush()
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-                    sys.stdout.flush()
-    
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
-                opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
+            batchExport = StreamingBatchExport( opBatchDataExport,
+                                                max_concurrent_files=self.batch_concurrent_files,
+                                                ram_budget_mb=self.batch_ram_budget_mb,
+                                                resume=self.resume_batch )
+            batchExport.run()
 
 
     def _print_labels_by_slice(self, search_value):
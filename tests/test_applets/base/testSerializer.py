@@ -25,12 +25,16 @@ import vigra
 import unittest
 import shutil
 import tempfile
+import logging
 from lazyflow.graph import Graph, Operator, InputSlot, Slot, OperatorWrapper
 from lazyflow.operators import OpCompressedUserLabelArray
+from lazyflow.utility.timer import Timer
 
 from ilastik.applets.base.appletSerializer import \
     SerialSlot, SerialListSlot, AppletSerializer, SerialDictSlot, SerialBlockSlot
 
+logger = logging.getLogger(__name__)
+
 class OpMock(Operator):
     """A simple operator for testing serializers."""
     name = "OpMock"
@@ -431,5 +435,149 @@ class TestSerialBlockSlot(unittest.TestCase):
         os.remove(h5_filepath)
         shutil.rmtree(tmp_dir)
 
+    def testCompression(self):
+        tmp_dir = tempfile.mkdtemp()
+        h5_filepath = os.path.join(tmp_dir , 'serial_blockslot_test.h5' )
+
+        for compression, compression_opts in [('gzip', 4), ('lzf', None), ('none', None)]:
+            opLabelArrays, _ = self._init_objects()
+            slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks,
+                                              compression=compression, compression_opts=compression_opts )
+            opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+            with h5py.File(h5_filepath, 'w') as f:
+                label_group = f.create_group('label_data')
+                slotSerializer.serialize( label_group )
+                for dataset in label_group['Output/0'].values():
+                    if compression == 'none':
+                        assert dataset.compression is None
+                    else:
+                        assert dataset.compression == compression
+                        assert dataset.compression_opts == compression_opts
+                        assert dataset.chunks == dataset.shape
+
+            opLabelArrays, slotSerializer = self._init_objects()
+            with h5py.File(h5_filepath, 'r') as f:
+                slotSerializer.deserialize( f['label_data'] )
+            assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+            assert ( opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 2 ).all()
+
+        shutil.rmtree(tmp_dir)
+
+class TestSerialBlockSlotIncremental(unittest.TestCase):
+    """
+    After the first save, SerialBlockSlot should only rewrite the blocks that changed.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.h5_filepath = os.path.join(self.tmp_dir , 'serial_blockslot_test.h5' )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _init_objects(self, shape=(100,100,100,1), blockshape=(10,10,10,1)):
+        raw_data = numpy.zeros(shape, dtype=numpy.uint32)
+        raw_data = vigra.taggedView(raw_data, 'zyxc')
+
+        opLabelArrays = OperatorWrapper( OpCompressedUserLabelArray, graph=Graph() )
+        opLabelArrays.Input.resize(1)
+        opLabelArrays.Input[0].setValue( raw_data )
+        opLabelArrays.shape.setValue( raw_data.shape )
+        opLabelArrays.eraser.setValue( 255 )
+        opLabelArrays.deleteLabel.setValue( -1 )
+        opLabelArrays.blockShape.setValue( blockshape )
+
+        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks )
+        return opLabelArrays, slotSerializer
+
+    def _markAllDatasets(self, label_group):
+        for dataset in label_group['0'].values():
+            dataset.attrs['marker'] = True
+
+    def _rewrittenBlocks(self, label_group):
+        return sorted( dataset.attrs['sourceBlockSlice'] for dataset in label_group['0'].values()
+                       if 'marker' not in dataset.attrs )
+
+    def testOnlyEditedBlockIsRewritten(self):
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 3*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(self.h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            self.assertFalse( slotSerializer.dirty )
+            self._markAllDatasets( label_group['Output'] )
+
+            # Edit one block, add a new block, and erase another block
+            opLabelArrays.Input[0][12:13, 10:20, 10:20, 0:1] = 4*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][70:71, 70:80, 70:80, 0:1] = 5*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 255*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            self.assertTrue( slotSerializer.dirty )
+
+            slotSerializer.serialize( label_group )
+            self.assertFalse( slotSerializer.dirty )
+            self.assertEqual( len(label_group['Output/0']), 3 )
+            self.assertEqual( self._rewrittenBlocks( label_group['Output'] ),
+                              ['[10:20,10:20,10:20,0:1]', '[70:80,70:80,70:80,0:1]'] )
+
+        # Read it back with fresh objects.
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(self.h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][12:13, 10:20, 10:20, 0:1].wait() == 4 ).all()
+        assert ( opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 0 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 3 ).all()
+        assert ( opLabelArrays.Output[0][70:71, 70:80, 70:80, 0:1].wait() == 5 ).all()
+
+    def testNothingRewrittenAfterLoad(self):
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        with h5py.File(self.h5_filepath, 'w') as f:
+            slotSerializer.serialize( f.create_group('label_data') )
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(self.h5_filepath, 'a') as f:
+            label_group = f['label_data']
+            slotSerializer.deserialize( label_group )
+            self.assertFalse( slotSerializer.dirty )
+            self._markAllDatasets( label_group['Output'] )
+
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 3*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            slotSerializer.serialize( label_group )
+            self.assertEqual( self._rewrittenBlocks( label_group['Output'] ), ['[50:60,50:60,50:60,0:1]'] )
+
+    def testBenchmarkSaveAfterSingleBlockEdit(self):
+        """
+        Compare the time for a full save of a large label volume 
+        with the time for saving it again after a 1-block edit.
+        """
+        shape = (256,256,256,1)
+        blockshape = (32,32,32,1)
+        opLabelArrays, slotSerializer = self._init_objects(shape, blockshape)
+
+        # Label every block
+        labels = numpy.random.randint(1, 3, size=shape).astype(numpy.uint8)
+        opLabelArrays.Input[0][:] = labels
+
+        with h5py.File(self.h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            with Timer() as fullTimer:
+                slotSerializer.serialize( label_group )
+            numBlocks = len(label_group['Output/0'])
+
+            opLabelArrays.Input[0][0:1, 0:10, 0:10, 0:1] = 3*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            with Timer() as incrementalTimer:
+                slotSerializer.serialize( label_group )
+
+        logger.info( "Saving {} label blocks took {:.3f} seconds, saving after a 1-block edit took {:.3f} seconds."
+                     .format( numBlocks, fullTimer.seconds(), incrementalTimer.seconds() ) )
+        self.assertLess( incrementalTimer.seconds(), fullTimer.seconds() )
+
 if __name__ == "__main__":
     unittest.main()
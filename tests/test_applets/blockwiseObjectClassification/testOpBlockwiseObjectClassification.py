@@ -20,6 +20,7 @@
 ###############################################################################
 import sys
 import warnings
+import shutil
 import tempfile
 
 import numpy
@@ -28,6 +29,7 @@ import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import Op5ifyer
 
+from ilastik.config import cfg as ilastik_config
 from ilastik.applets import objectExtraction
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
@@ -105,6 +107,83 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
  
+    def testPipelineRamBudget(self):
+        # A budget that is smaller than a single pipeline:
+        #  after each request, all pipelines but the most recently used one are evicted and their predictions spilled to disk.
+        spill_dir = tempfile.mkdtemp()
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.PipelineRamBudgetMb.setValue( 0.01 )
+        self.op.SpillDirectory.setValue( spill_dir )
+
+        for _ in range(2):
+            pred = self.op.PredictionImage[:].wait()
+            assert len(self.op._blockPipelines) == 1
+            if not (pred == self.prediction_volume).all():
+                self.logImage(pred, "ram_budget_failed_prediction_")
+                assert False, \
+                    "Blockwise prediction operator did not produce the same prediction image" \
+                    "as the non-blockwise prediction operator!"
+
+        # Requesting a sub-region of a spilled block
+        pred = self.op.PredictionImage[:, 5:35, 5:35, 5:35, :].wait()
+        assert (pred == self.prediction_volume[:, 5:35, 5:35, 5:35, :]).all()
+
+        # Blocks that are gone from the spill file (e.g. cleared by a concurrent dirty notification) are recomputed
+        self.op._spilledPredictions.clear()
+        pred = self.op.PredictionImage[:].wait()
+        assert (pred == self.prediction_volume).all()
+
+        # Without a spill directory, evicted pipelines are simply recreated
+        self.op.SpillDirectory.setValue( '' )
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        pred = self.op.PredictionImage[:].wait()
+        assert len(self.op._blockPipelines) == 1
+        assert (pred == self.prediction_volume).all()
+
+        self.op.cleanUp()
+        shutil.rmtree(spill_dir)
+
+    def testSingleBlockOverRamBudget(self):
+        # A single block that alone exceeds the budget (e.g. the whole image in headless mode) is kept
+        #  after the request, so it isn't rebuilt for each further request
+        self.op.PipelineRamBudgetMb.setValue( 0.01 )
+        block_start = (0,0,0,0,0)
+        opBlockPipeline = self.op._acquirePipelines( [block_start] )[block_start]
+        try:
+            pred = self.op.PredictionImage[:].wait()
+            assert self.op._blockPipelines[block_start] is opBlockPipeline
+        finally:
+            self.op._releasePipelines( [block_start] )
+        assert (pred == self.prediction_volume).all()
+
+        self.op.PredictionImage[:].wait()
+        assert self.op._blockPipelines.values() == [opBlockPipeline]
+
+    def testDefaultRamBudget(self):
+        # Without explicit settings, the pipelines are bounded by the budget from the config file
+        assert not self.op.PipelineRamBudgetMb.ready()
+        budget = ilastik_config.getfloat('blockwise_object_classification', 'ram_budget_mb')
+        assert budget > 0
+        assert self.op._getRamBudgetMb() == budget
+
+    def testSlabCachesCountAgainstRamBudget(self):
+        # The halo slab caches are shrunk to their share of the budget
+        self.op.HaloSlabCacheMb.setValue( 256 )
+        self.op.PipelineRamBudgetMb.setValue( 400 )
+        for opSlabCache in (self.op._opRawSlabCache, self.op._opBinarySlabCache):
+            assert opSlabCache.MaxCacheMb.value == 400 * self.op.SLAB_CACHE_BUDGET_FRACTION / 2
+
+        # ... but they are not enlarged beyond their own setting
+        self.op.PipelineRamBudgetMb.setValue( 1e6 )
+        for opSlabCache in (self.op._opRawSlabCache, self.op._opBinarySlabCache):
+            assert opSlabCache.MaxCacheMb.value == 256
+
+        # Without a budget, only their own setting counts
+        self.op.PipelineRamBudgetMb.setValue( 0 )
+        for opSlabCache in (self.op._opRawSlabCache, self.op._opBinarySlabCache):
+            assert opSlabCache.MaxCacheMb.value == 256
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
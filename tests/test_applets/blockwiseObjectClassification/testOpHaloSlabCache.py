@@ -0,0 +1,88 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators.opArrayPiper import OpArrayPiper
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+
+from ilastik.applets.blockwiseObjectClassification.opHaloSlabCache import OpHaloSlabCache
+
+class TestOpHaloSlabCache(object):
+    def setUp(self):
+        self.data = numpy.random.randint( 0, 255, (1,60,50,40,2) ).astype( numpy.uint8 )
+        self.data = vigra.taggedView( self.data, 'txyzc' )
+
+        graph = Graph()
+        self.opSource = OpArrayPiper( graph=graph )
+        self.opSource.Input.setValue( self.data )
+
+        self.blockShape = (1,20,20,20,1)
+        self.haloPadding = (1,10,10,5,1)
+        self.opCache = OpHaloSlabCache( graph=graph )
+        self.opCache.Input.connect( self.opSource.Output )
+        self.opCache.BlockShape.setValue( self.blockShape )
+        self.opCache.HaloPadding.setValue( self.haloPadding )
+
+    def _requestHaloRois(self):
+        shape = self.data.shape
+        for block_start in getIntersectingBlocks( self.blockShape, ( (0,)*5, shape ) ):
+            block_start, block_stop = getBlockBounds( shape, self.blockShape, block_start )
+            halo_start = numpy.maximum( numpy.subtract( block_start, self.haloPadding ), 0 )
+            halo_stop = numpy.minimum( numpy.add( block_stop, self.haloPadding ), shape )
+            halo_start[-1], halo_stop[-1] = 0, shape[-1]
+            result = self.opCache.Output( halo_start, halo_stop ).wait()
+            assert ( result == self.data[ roiToSlice( halo_start, halo_stop ) ] ).all()
+
+    def testSharedHalos(self):
+        self._requestHaloRois()
+        stats = self.opCache.readStatistics()
+        assert stats['touched'] == 60*50*40
+        assert stats['requested'] > 1.5 * stats['touched']
+        # The cache is large enough to hold all shared slabs, so each voxel is read exactly once.
+        assert stats['read'] == stats['touched']
+
+        # Everything is cached now.
+        self.opCache.resetReadStatistics()
+        self._requestHaloRois()
+        stats = self.opCache.readStatistics()
+        assert stats['read'] < stats['touched']
+
+    def testDirty(self):
+        self._requestHaloRois()
+        self.data = self.data.copy()
+        self.data[:, 10:30, 10:30] += 1
+        self.opSource.Input.setValue( self.data )
+        self._requestHaloRois()
+
+    def testNoCache(self):
+        self.opCache.MaxCacheMb.setValue( 0 )
+        self._requestHaloRois()
+        stats = self.opCache.readStatistics()
+        assert stats['read'] >= stats['requested']
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,172 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+import threading
+import logging
+import collections
+
+import numpy
+
+from ilastik.applets.dataExport.streamingBatchExport import StreamingBatchExport
+
+class MockValue(object):
+    def __init__(self, value):
+        self.value = value
+
+class MockMeta(object):
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+
+    def getTaggedShape(self):
+        return collections.OrderedDict( zip('xyzc', self.shape) )
+
+class MockSignal(object):
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, fn):
+        self.subscribers.append(fn)
+
+    def __call__(self, *args):
+        for fn in self.subscribers:
+            fn(*args)
+
+class MockExportLaneView(object):
+    """
+    Simulates the parts of an OpDataExport lane view that are used by StreamingBatchExport.
+    """
+    def __init__(self, exportPath, shape, tracker, fail=False):
+        self.ExportPath = MockValue( exportPath )
+        self.ImageToExport = MockValue( None )
+        self.ImageToExport.meta = MockMeta( shape, numpy.float32 )
+        self.progressSignal = MockSignal()
+        self.tracker = tracker
+        self.fail = fail
+
+    def run_export(self):
+        self.tracker.start()
+        try:
+            for progress in range(0, 101, 5):
+                self.progressSignal(progress)
+                time.sleep(0.0025)
+            if self.fail:
+                raise RuntimeError("Simulated failure")
+            with open(self.ExportPath.value, 'w') as f:
+                f.write('exported')
+        finally:
+            self.tracker.stop()
+
+class ConcurrencyTracker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.maxRunning = 0
+        self.started = 0
+
+    def start(self):
+        with self.lock:
+            self.running += 1
+            self.started += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+
+    def stop(self):
+        with self.lock:
+            self.running -= 1
+
+class TestStreamingBatchExport(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tracker = ConcurrencyTracker()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _laneViews(self, count, shape=(100,100,10,1), failing=()):
+        return [ MockExportLaneView( os.path.join(self.tmpdir, "result{}.h5".format(i)), shape, self.tracker, i in failing )
+                 for i in range(count) ]
+
+    def testConcurrencyLimit(self):
+        laneViews = self._laneViews(6)
+        exported = StreamingBatchExport( laneViews, max_concurrent_files=3 ).run()
+        assert exported == range(6)
+        assert self.tracker.started == 6
+        assert 1 < self.tracker.maxRunning <= 3
+        for laneView in laneViews:
+            assert os.path.exists( laneView.ExportPath.value )
+
+    def testRamBudget(self):
+        # Each file is ~0.4 MB, so a budget of 1 MB admits only two at a time.
+        laneViews = self._laneViews(5)
+        StreamingBatchExport( laneViews, max_concurrent_files=5, ram_budget_mb=1 ).run()
+        assert self.tracker.started == 5
+        assert self.tracker.maxRunning <= 2
+
+    def testProgressIsLogged(self):
+        messages = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                if record.levelno >= logging.INFO:
+                    messages.append(record.getMessage())
+        handler = Handler()
+        logger = logging.getLogger("ilastik.applets.dataExport.streamingBatchExport")
+        logger.addHandler(handler)
+        oldLevel = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            StreamingBatchExport( self._laneViews(2), max_concurrent_files=2 ).run()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(oldLevel)
+        for i in range(2):
+            assert any( m.startswith("Exporting result {}/2".format(i)) for m in messages )
+            # every 10 percent, not every update
+            progress = [ m for m in messages if m.startswith("Result {}/2 Progress".format(i)) ]
+            assert len(progress) == 11, progress
+
+    def testResume(self):
+        laneViews = self._laneViews(4, failing=(2,))
+        try:
+            StreamingBatchExport( laneViews, max_concurrent_files=2 ).run()
+        except RuntimeError:
+            pass
+        else:
+            assert False, "Expected the failed export to be reported."
+
+        # Only the failed result is exported again.
+        laneViews = self._laneViews(4)
+        exported = StreamingBatchExport( laneViews, max_concurrent_files=2, resume=True ).run()
+        assert exported == [2]
+
+        # A result with a different shape is not considered complete.
+        laneViews = self._laneViews(4, shape=(100,100,20,1))
+        exported = StreamingBatchExport( laneViews, resume=True ).run()
+        assert exported == range(4)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,96 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+
+import numpy
+import h5py
+import vigra
+
+from ilastik.applets.dataSelection.stackToH5Converter import StackToH5Converter
+
+class TestStackToH5Converter(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.globstring = os.path.join(self.tmpdir, 'slice*.png')
+        self.h5Path = StackToH5Converter.cache_path(self.globstring, self.tmpdir)
+        self.slices = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _writeSlice(self, z):
+        data = numpy.random.randint(0, 255, (30, 20)).astype(numpy.uint8)
+        vigra.impex.writeImage( vigra.taggedView(data, 'xy'), os.path.join(self.tmpdir, 'slice{:03}.png'.format(z)) )
+        if z < len(self.slices):
+            self.slices[z] = data
+        else:
+            self.slices.append(data)
+
+    def _checkVolume(self, volumePath):
+        assert volumePath == self.h5Path + "/volume/data"
+        with h5py.File(self.h5Path, 'r') as f:
+            volume = f['volume/data']
+            assert volume.shape == (len(self.slices), 20, 30, 1)
+            assert volume.chunks is not None
+            assert volume.compression is not None
+            for z, data in enumerate(self.slices):
+                assert (volume[z,...,0] == data.transpose()).all()
+
+    def testIncrementalConversion(self):
+        for z in range(5):
+            self._writeSlice(z)
+
+        progress = []
+        converter = StackToH5Converter(self.globstring, self.h5Path)
+        converter.SLAB_SIZE = 2
+        self._checkVolume( converter.run( progress=progress.append ) )
+        assert converter.converted_slices == 5
+        assert progress == [40, 80, 100]
+
+        # Nothing changed
+        converter = StackToH5Converter(self.globstring, self.h5Path)
+        self._checkVolume( converter.run() )
+        assert converter.converted_slices == 0
+
+        # Append slices
+        for z in range(5, 8):
+            self._writeSlice(z)
+        converter = StackToH5Converter(self.globstring, self.h5Path)
+        self._checkVolume( converter.run() )
+        assert converter.converted_slices == 3
+
+        # Modify a slice
+        self._writeSlice(1)
+        sliceFile = os.path.join(self.tmpdir, 'slice001.png')
+        os.utime(sliceFile, (time.time(), time.time() + 10))
+        converter = StackToH5Converter(self.globstring, self.h5Path)
+        self._checkVolume( converter.run() )
+        assert converter.converted_slices == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
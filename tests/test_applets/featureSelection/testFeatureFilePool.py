@@ -0,0 +1,84 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.applets.featureSelection.featureFilePool import FeatureFilePool
+
+class TestFeatureFilePool(object):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.data = []
+        self.filenames = []
+        for i in range(5):
+            data = numpy.random.random((20,30,10)).astype(numpy.float32)
+            filename = os.path.join(self.tmpDir, "feature{}.h5".format(i))
+            with h5py.File(filename, 'w') as f:
+                if i % 2:
+                    # chunked and compressed: must be read through hdf5
+                    f.create_dataset("data", data=data, chunks=(10,10,10), compression='gzip')
+                else:
+                    f.create_dataset("data", data=data)
+            self.data.append(data)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testRead(self):
+        pool = FeatureFilePool(self.filenames, maxOpenFiles=2)
+        key = numpy.s_[3:17, 5:25, 2:9]
+        for i in range(len(self.filenames)):
+            assert pool.shape(i) == (20,30,10)
+            assert pool.dtype(i) == numpy.float32
+            assert (pool.read(i, key) == self.data[i][key]).all()
+            assert pool.numOpenFiles <= 2
+
+        out = numpy.zeros((14,20,7,3), dtype=numpy.float32)
+        pool.readChannels([4,1,2], key, out)
+        for j, i in enumerate([4,1,2]):
+            assert (out[...,j] == self.data[i][key]).all()
+        assert pool.numOpenFiles <= 2
+
+        pool.close()
+        assert pool.numOpenFiles == 0
+        # The pool can still be used after closing
+        assert (pool.read(3, key) == self.data[3][key]).all()
+        pool.close()
+
+    def testMemoryMap(self):
+        pool = FeatureFilePool(self.filenames)
+        pool.read(0, numpy.s_[:])
+        pool.read(1, numpy.s_[:])
+        assert isinstance(pool._readers[0][1], numpy.memmap)
+        assert not isinstance(pool._readers[1][1], numpy.memmap)
+        pool.close()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
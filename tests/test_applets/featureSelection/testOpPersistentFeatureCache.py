@@ -0,0 +1,163 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from ilastik.applets.featureSelection.opPersistentFeatureCache import OpPersistentFeatureCache, PersistentBlockStore
+
+class OpCountingFeatures(Operator):
+    """
+    Fake feature operator: doubles its input and counts the requested pixels.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super( OpCountingFeatures, self ).__init__( *args, **kwargs )
+        self.computedPixels = 0
+        self._lock = threading.Lock()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+        self.Output.meta.dtype = numpy.float32
+
+    def execute(self, slot, subindex, roi, result):
+        result[:] = 2 * self.Input(roi.start, roi.stop).wait()
+        with self._lock:
+            self.computedPixels += numpy.prod( numpy.subtract(roi.stop, roi.start) )
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty( roi.start, roi.stop )
+
+class TestOpPersistentFeatureCache(object):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        data = numpy.random.random((1,50,40,30,2)).astype(numpy.float32)
+        self.data = vigra.taggedView(data, 'txyzc')
+
+    def tearDown(self):
+        PersistentBlockStore._stores.clear()
+        shutil.rmtree(self.cacheDir)
+
+    def _createOperators(self, data, cacheDir, parameters='params'):
+        graph = Graph()
+        opFeatures = OpCountingFeatures(graph=graph)
+        opFeatures.Input.setValue(data)
+        opCache = OpPersistentFeatureCache(graph=graph)
+        opCache.Input.connect(opFeatures.Output)
+        opCache.KeyImage.setValue(data)
+        opCache.KeyParameters.setValue(parameters)
+        opCache.CacheDirectory.setValue(cacheDir)
+        opCache.BlockSize.setValue(16)
+        return opFeatures, opCache
+
+    def testPassThrough(self):
+        opFeatures, opCache = self._createOperators(self.data, '')
+        result = opCache.Output[:, 5:30, 3:17, 4:9, 1:2].wait()
+        assert (result == 2*self.data[:, 5:30, 3:17, 4:9, 1:2]).all()
+        assert os.listdir(self.cacheDir) == []
+
+    def testReuseAcrossSessions(self):
+        opFeatures, opCache = self._createOperators(self.data, self.cacheDir)
+        result = opCache.Output[:, 5:30, 3:17, 4:9, 1:2].wait()
+        assert (result == 2*self.data[:, 5:30, 3:17, 4:9, 1:2]).all()
+        assert opFeatures.computedPixels > 0
+
+        # A new "session" on the same data and settings computes nothing.
+        PersistentBlockStore._stores.clear()
+        opFeatures, opCache = self._createOperators(self.data.copy(), self.cacheDir)
+        result = opCache.Output[:, 5:30, 3:17, 4:9, :].wait()
+        assert (result == 2*self.data[:, 5:30, 3:17, 4:9, :]).all()
+        assert opFeatures.computedPixels == 0
+
+    def testKeyDependsOnDataAndParameters(self):
+        opFeatures, opCache = self._createOperators(self.data, self.cacheDir)
+        opCache.Output[:].wait()
+
+        opFeatures, opCache = self._createOperators(self.data, self.cacheDir, parameters='other params')
+        opCache.Output[:].wait()
+        assert opFeatures.computedPixels == self.data.size
+
+        otherData = self.data.copy()
+        otherData[0,0,0,0,0] += 1
+        opFeatures, opCache = self._createOperators(otherData, self.cacheDir)
+        result = opCache.Output[:].wait()
+        assert opFeatures.computedPixels == self.data.size
+        assert (result == 2*otherData).all()
+
+    def testKeyImageHashedOnce(self):
+        opFeatures, opCache = self._createOperators(self.data, self.cacheDir)
+        hashes = []
+        hashKeyImage = opCache._hashKeyImage
+        def countingHash():
+            hashes.append(1)
+            return hashKeyImage()
+        opCache._hashKeyImage = countingHash
+        opCache.Output[:].wait()
+        assert len(hashes) == 1
+
+        # Other parameters change the key, but the KeyImage is not hashed again.
+        opCache.KeyParameters.setValue('other params')
+        opCache.Output[:].wait()
+        assert len(hashes) == 1
+        assert opFeatures.computedPixels == 2*self.data.size
+
+        # A change of the KeyImage is hashed again.
+        opCache.KeyImage.setDirty(slice(None))
+        opCache.Output[:].wait()
+        assert len(hashes) == 2
+
+    def testEviction(self):
+        store = PersistentBlockStore.get(self.cacheDir, 3000)
+        block = numpy.zeros((10,10), dtype=numpy.float64) # 800 bytes + header
+        paths = [ store.blockPath('key', (i, 0)) for i in range(5) ]
+        for path in paths[:3]:
+            store.store(path, block)
+
+        # Touch the first block, so the second one is the least recently used.
+        assert store.load(paths[0], (10,10), block.dtype) is not None
+        store.store(paths[3], block)
+        assert store.totalBytes <= 3000
+        assert os.path.exists(paths[0])
+        assert not os.path.exists(paths[1])
+        assert store.load(paths[1], (10,10), block.dtype) is None
+
+        # The order of use survives across sessions.
+        PersistentBlockStore._stores.clear()
+        store = PersistentBlockStore.get(self.cacheDir, 3000)
+        assert store.totalBytes <= 3000
+        store.store(paths[4], block)
+        assert os.path.exists(paths[4])
+        assert os.path.exists(paths[3])
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
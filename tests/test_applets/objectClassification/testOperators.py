@@ -24,9 +24,11 @@ ilastik.ilastik_logging.default_config.init()
 import unittest
 import numpy as np
 import vigra
-from lazyflow.graph import Graph
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.stype import Opaque
+from lazyflow.rtype import List
 from ilastik.applets.objectClassification.opObjectClassification import \
-    OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
+    OpRelabelSegmentation, OpMultiRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
     
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifier
@@ -63,6 +65,32 @@ def emptyImage():
     img.axistags = vigra.defaultAxistags('txyzc')    
     return img
 
+class OpObjectMapProvider(Operator):
+    """
+    Provides the ObjectMap of OpRelabelSegmentation for (t, objects) requests,
+    and records these requests.
+    """
+    Map = InputSlot()
+    Output = OutputSlot(stype=Opaque, rtype=List)
+
+    def __init__(self, *args, **kwargs):
+        super(OpObjectMapProvider, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def setupOutputs(self):
+        self.Output.meta.shape = (len(self.Map.value),)
+        self.Output.meta.dtype = object
+        self.Output.meta.mapping_dtype = np.uint8
+        self.Output.meta.object_requests = True
+
+    def execute(self, slot, subindex, roi, result):
+        self.requests += roi._l
+        map_ = self.Map.value
+        return dict((t, map_[t][objects]) for t, objects in roi._l)
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty([])
+
 class TestOpRelabelSegmentation(object):
     def setUp(self):
         g = Graph()
@@ -85,6 +113,83 @@ class TestOpRelabelSegmentation(object):
         assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
         assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
 
+    def testEmptyTimeStep(self):
+        segimg = segImage()
+        segimg[0] = 0
+        # No objects at t=0, and a map that is too short at t=1
+        map_ = {0 : np.array([0]),
+                1 : np.array([40, 50, 60])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features._setReady() # hack because we do not use features
+        img = self.op.Output.value
+
+        assert np.all(img[0] == 0)
+        assert img[1, 49, 49, 49, 0] == 40
+        assert (np.all(img[1,  0:10,  0:10,  0:10, 0] == 50))
+        assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
+        assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 0))
+
+    def testDirtyMap(self):
+        segimg = segImage()
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue({0 : np.array([10, 20, 30]),
+                                    1 : np.array([40, 50, 60, 70])})
+        self.op.Features._setReady() # hack because we do not use features
+        img = self.op.Output.value
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 30))
+
+        self.op.ObjectMap.setValue({0 : np.array([10, 20, 35]),
+                                    1 : np.array([40, 50, 60, 75])})
+        img = self.op.Output.value
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 35))
+        assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 75))
+
+    def testObjectRequests(self):
+        # Only the objects that are visible in the roi are requested
+        segimg = segImage()
+        opMap = OpObjectMapProvider(graph=self.op.graph)
+        opMap.Map.setValue({0 : np.array([10, 20, 30]),
+                            1 : np.array([40, 50, 60, 70])})
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.connect(opMap.Output)
+        self.op.Features._setReady() # hack because we do not use features
+
+        img = self.op.Output[1:2, 5:15, 5:15, 5:15, :].wait()
+        assert len(opMap.requests) == 1
+        t, objects = opMap.requests[0]
+        assert t == 1
+        assert list(objects) == [0, 1, 2]
+        assert np.all(img[0, 0:5, 0:5, 0:5, 0] == 50)
+        assert np.all(img[0, 5:10, 5:10, 5:10, 0] == 60)
+        assert img[0, 0, 9, 0, 0] == 40
+
+        img = self.op.Output[0:1, 20:30, 20:30, 20:30, :].wait()
+        assert [list(objects) for _, objects in opMap.requests[1:]] == [[0, 2]]
+        assert np.all(img[0, 0:5, 0:5, 0:5, 0] == 30)
+        assert img[0, 9, 9, 9, 0] == 10
+
+class TestOpMultiRelabelSegmentation(object):
+    def test(self):
+        g = Graph()
+        op = OpMultiRelabelSegmentation(graph=g)
+        segimg = segImage()
+        maps = [{0 : np.array([0.0, 0.1, 0.2]), 1 : np.array([0.0, 0.4, 0.5, 0.6])},
+                {0 : np.array([0.0, 0.9, 0.8]), 1 : np.array([0.0, 0.6, 0.5, 0.4])}]
+        op.Image.setValue(segimg)
+        op.ObjectMaps.resize(2)
+        for islot, map_ in zip(op.ObjectMaps, maps):
+            islot.setValue(map_)
+        op.Features._setReady() # hack because we do not use features
+
+        stacked = op.StackedOutput[:].wait()
+        assert stacked.shape == segimg.shape[:-1] + (2,)
+        for c in range(2):
+            assert np.all(stacked[..., c:c+1] == op.Output[c][:].wait())
+
+        # A single channel of a sub-region
+        assert np.all(op.StackedOutput[1:2, 5:25, 5:25, 5:25, 1:2].wait() == stacked[1:2, 5:25, 5:25, 5:25, 1:2])
+
 class TestOpObjectTrain(unittest.TestCase):
     
     nRandomForests = 1
@@ -161,8 +266,74 @@ class TestOpObjectTrain(unittest.TestCase):
         except RuntimeError:
             print "Tried to compute features for time step w/o labels!"
             raise
-        
-        
+
+    def test_incremental_training(self):
+        self.op.LabelsCount.setValue(2)
+        self.op.Labels.resize(1)
+        self.op.Labels.setValue({0 : np.array([0, 1, 0]),
+                                 1 : np.array([0, 0, 0, 2])})
+        classifier = self.op.Classifier.value
+        self.assertIsInstance(classifier, ParallelVigraRfLazyflowClassifier)
+        self.assertEqual(sorted(self.op._rowStore.keys()), [(0, 0), (0, 1)])
+        rows_t0 = self.op._rowStore[(0, 0)]
+        self.assertTrue(all(key in self.op.timings for key in ('fetch', 'assemble', 'train')))
+
+        # Label another object in time step 1: the rows of time step 0 are reused
+        self.op.Labels.setValue({0 : np.array([0, 1, 0]),
+                                 1 : np.array([0, 1, 0, 2])})
+        classifier = self.op.Classifier.value
+        self.assertIsInstance(classifier, ParallelVigraRfLazyflowClassifier)
+        self.assertIs(self.op._rowStore[(0, 0)], rows_t0)
+        self.assertEqual(list(self.op._rowStore[(0, 1)].objects), [1, 3])
+
+        # Dirty features invalidate the stored rows
+        self.featsop.RawImage.setValue(self.featsop.RawImage.value + 1)
+        self.assertEqual(self.op._rowStore, {})
+        self.assertIsInstance(self.op.Classifier.value, ParallelVigraRfLazyflowClassifier)
+
+    def test_warm_start(self):
+        self.op.WarmStart.setValue(True)
+        self.op.LabelsCount.setValue(2)
+        self.op.Labels.resize(1)
+        self.op.Labels.setValue({0 : np.array([0, 1, 2]),
+                                 1 : np.array([0, 1, 0, 2])})
+        first = self.op.Classifier.value
+        self.assertEqual(len(first._forests), OpObjectTrain.WARM_START_MIN_FORESTS)
+
+        # Only added labels: some of the forests are kept
+        self.op.Labels.setValue({0 : np.array([0, 1, 2]),
+                                 1 : np.array([0, 1, 1, 2])})
+        second = self.op.Classifier.value
+        self.assertEqual(len(second._forests), OpObjectTrain.WARM_START_MIN_FORESTS)
+        self.assertIs(second._forests[0], first._forests[1])
+
+        # A changed label: all forests are retrained
+        self.op.Labels.setValue({0 : np.array([0, 2, 2]),
+                                 1 : np.array([0, 1, 1, 2])})
+        third = self.op.Classifier.value
+        self.assertFalse(set(map(id, third._forests)) & set(map(id, second._forests)))
+
+    def test_forest_count(self):
+        # Without a WarmStart value, the config decides (no warm start by default)
+        self.assertFalse(self.op._useWarmStart())
+        self.assertEqual(self.op._getForestCount(), self.nRandomForests)
+
+        # The classifier is dirty for all forests that are trained with warm start
+        self.op.WarmStart.setValue(True)
+        self.assertEqual(self.op._getForestCount(), OpObjectTrain.WARM_START_MIN_FORESTS)
+        self.op.ForestCount.setValue(OpObjectTrain.WARM_START_MIN_FORESTS + 2)
+        self.assertEqual(self.op._getForestCount(), OpObjectTrain.WARM_START_MIN_FORESTS + 2)
+
+    def test_compare_labels(self):
+        old = {(0, 0) : (np.array([1, 2]), np.array([1, 2]))}
+        new = {(0, 0) : (np.array([1, 2, 3]), np.array([1, 2, 1])),
+               (0, 1) : (np.array([4]), np.array([2]))}
+        self.assertEqual(OpObjectTrain._compareLabels(old, new), (2, 0))
+        self.assertEqual(OpObjectTrain._compareLabels(new, old), (0, 2))
+        changed = {(0, 0) : (np.array([1, 2]), np.array([2, 2]))}
+        self.assertEqual(OpObjectTrain._compareLabels(old, changed), (0, 1))
+
+
 
 
 class TestOpObjectPredict(unittest.TestCase):
@@ -236,7 +407,94 @@ class TestOpObjectPredict(unittest.TestCase):
         
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
-        
+
+    def test_concurrent_requests(self):
+        ###
+        # concurrent requests for the same and for different time slices get the same result
+        ###
+        reqs = [self.op.Probabilities([t]) for t in [0, 1, 0, 1, 0]]
+        for req in reqs:
+            req.submit()
+        results = [req.wait() for req in reqs]
+        for t, res in zip([0, 1, 0, 1, 0], results):
+            self.assertTrue( np.all(res[t] == results[t][t]) )
+        self.assertEqual( sorted(self.op.CachedProbabilities([]).wait().keys()), [0, 1] )
+
+    def test_bad_objects(self):
+        ###
+        # the bad objects don't depend on whether the prediction was cached
+        ###
+        bad = self.op.BadObjects([0, 1]).wait()
+        self.assertEqual( sorted(bad.keys()), [0, 1] )
+        self.assertEqual( len(bad[0]), 3 )
+        self.assertEqual( len(bad[1]), 4 )
+        self.assertTrue( not bad[0].any() and not bad[1].any() )
+
+        # The predictions are cached now
+        self.assertEqual( sorted(self.op.CachedProbabilities([]).wait().keys()), [0, 1] )
+        cached_bad = self.op.BadObjects([0, 1]).wait()
+        for t in [0, 1]:
+            self.assertTrue( np.all(cached_bad[t] == bad[t]) )
+
+        # Predictions that are not cached because the cache was invalidated meanwhile still report them
+        predictTimestep = self.op._predictTimestep
+        def predictAndInvalidate(*args):
+            result = predictTimestep(*args)
+            self.op.propagateDirty(self.op.SelectedFeatures, (), slice(None))
+            return result
+        self.op._predictTimestep = predictAndInvalidate
+        self.op.propagateDirty(self.op.SelectedFeatures, (), slice(None))
+
+        uncached_bad = self.op.BadObjects([0, 1]).wait()
+        self.assertEqual( len(self.op.CachedProbabilities([]).wait()), 0 )
+        for t in [0, 1]:
+            self.assertTrue( np.all(uncached_bad[t] == bad[t]) )
+
+    def test_predict_objects(self):
+        ###
+        # predicting only a few objects gives the same results as predicting the whole time slice
+        ###
+        objects = [2, 0, 3]
+        partial_probs = self.op.Probabilities([(1, objects)]).wait()
+        partial_preds = self.op.Predictions([(1, objects), (0, [1])]).wait()
+        partial_channel = self.op.ProbabilityChannels[1]([(1, objects)]).wait()
+        partial_bad = self.op.BadObjects([(1, objects)]).wait()
+        # Nothing is cached until all objects of a time slice are predicted
+        self.assertEqual( len(self.op.CachedProbabilities([]).wait()), 0 )
+
+        self.op.Probabilities([(0, [2]), (1, [1])]).wait()
+        self.assertEqual( sorted(self.op.CachedProbabilities([]).wait().keys()), [0, 1] )
+
+        probs = self.op.Probabilities([1]).wait()
+        preds = self.op.Predictions([0, 1]).wait()
+        self.assertTrue( np.all(partial_probs[1] == probs[1][objects]) )
+        self.assertTrue( np.all(partial_preds[1] == preds[1][objects]) )
+        self.assertEqual( partial_preds[1][1], 0 )
+        self.assertTrue( np.all(partial_preds[0] == preds[0][[1]]) )
+        self.assertTrue( np.all(partial_channel[1] == probs[1][objects, 1]) )
+        self.assertEqual( len(partial_bad[1]), 3 )
+
+        # Cached time slices are used for requests of some objects
+        self.assertTrue( np.all(self.op.Probabilities([(1, objects)]).wait()[1] == partial_probs[1]) )
+
+    def test_timestep_locks(self):
+        ###
+        # the locks of the time slices are only kept while they are predicted
+        ###
+        self.op.Probabilities([0, 1]).wait()
+        self.assertEqual( len(self.op._timestep_locks), 0 )
+
+        predictTimestep = self.op._predictTimestep
+        def predictAndInvalidate(*args):
+            self.assertEqual( len(self.op._timestep_locks), 1 )
+            self.op.propagateDirty(self.op.SelectedFeatures, (), slice(None))
+            self.assertEqual( len(self.op._timestep_locks), 0 )
+            return predictTimestep(*args)
+        self.op._predictTimestep = predictAndInvalidate
+        self.op.propagateDirty(self.op.SelectedFeatures, (), slice(None))
+        self.op.Probabilities([0]).wait()
+        self.assertEqual( len(self.op._timestep_locks), 0 )
+
 
  
 class TestFeatureSelection(unittest.TestCase):
@@ -420,6 +678,12 @@ class TestFullOperator(unittest.TestCase):
         self.assertTrue(self.classOp.Predictions.ready(), "Prediction slot of OpObjectClassification wasn't ready.")
         probs = self.classOp.PredictionImages[0][:].wait()
         
+    def testWarmStart(self):
+        self.assertFalse(self.classOp.opTrain._useWarmStart())
+        self.classOp.WarmStart.setValue(True)
+        self.assertTrue(self.classOp.opTrain._useWarmStart())
+        self.assertTrue(self.classOp.PredictionImages[0][:].wait().any())
+
     def testExport(self):
         table = self.classOp.createExportTable(0, [])
         print table["Object id"]
@@ -21,9 +21,24 @@
 import ilastik.ilastik_logging
 ilastik.ilastik_logging.default_config.init()
 
-from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
+from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification, _overlappingBoxPairs
 import numpy
 
+from lazyflow.utility.timer import Timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+def randomBoxes(nobj, ndim, size, max_extent, seed):
+    rand = numpy.random.RandomState(seed)
+    coords = dict()
+    coords["Coord<Minimum>"] = rand.randint(0, size, (nobj, ndim))
+    coords["Coord<Maximum>"] = coords["Coord<Minimum>"] + rand.randint(0, max_extent, (nobj, ndim))
+    # background
+    coords["Coord<Minimum>"][0] = 0
+    coords["Coord<Maximum>"][0] = size + max_extent
+    return coords
+
 class TestTransferLabelsFunction(object):
     def test(self):
         coords_old = dict()
@@ -52,8 +67,37 @@ class TestTransferLabelsFunction(object):
         newmin4 =  coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"]==(newmin4+(newmax4-newmin4)/2.))
-    
-    
+
+    def testOverlappingBoxPairs(self):
+        for ndim in (2, 3):
+            # A few boxes are large enough to be compared with all others
+            a = randomBoxes(300, ndim, 200, 40, seed=ndim)
+            b = randomBoxes(200, ndim, 200, 20, seed=ndim+10)
+            mins_a, maxs_a = a["Coord<Minimum>"], a["Coord<Maximum>"]
+            mins_b, maxs_b = b["Coord<Minimum>"], b["Coord<Maximum>"]
+
+            ia, ib = _overlappingBoxPairs(mins_a, maxs_a, mins_b, maxs_b)
+
+            dense = numpy.logical_and( mins_a[:, None] < maxs_b[None], mins_b[None] < maxs_a[:, None] ).all(axis=-1)
+            expected_ia, expected_ib = numpy.nonzero(dense)
+            assert (ia == expected_ia).all()
+            assert (ib == expected_ib).all()
+
+class TestTransferLabelsBenchmark(object):
+    def test(self):
+        nobj = 50000
+        coords_old = randomBoxes(nobj, 3, 2000, 20, seed=1)
+        coords_new = randomBoxes(nobj, 3, 2000, 20, seed=2)
+        labels = numpy.random.RandomState(3).randint(0, 3, nobj)
+        labels[0] = 0
+
+        with Timer() as timer:
+            newlabels, oldlost, newlost = OpObjectClassification.transferLabels(labels, coords_old, coords_new, None)
+        logger.info("Transferred labels of {} objects in {} seconds".format(nobj, timer.seconds()))
+        assert newlabels.shape == (nobj,)
+        assert len(oldlost["full"]) + len(oldlost["partial"]) + len(newlost["conflict"]) > 0
+
+
 if __name__ == "__main__":
     import sys
     import nose
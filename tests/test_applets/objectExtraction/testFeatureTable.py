@@ -0,0 +1,97 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.applets.objectExtraction.featureTable import FeatureTable
+
+class TestFeatureTable(object):
+    def setUp(self):
+        self.features = {
+            0 : { 'Plugin' : { 'Count' : numpy.array([[0.], [5.], [7.]]),
+                               'Center' : numpy.arange(6, dtype=numpy.float32).reshape(3, 2) },
+                  'Default features' : { 'Count' : numpy.ones((3, 1)) } },
+            1 : { 'Plugin' : { 'Count' : numpy.array([[0.], [2.]]),
+                               'Center' : numpy.arange(4, dtype=numpy.float32).reshape(2, 2) },
+                  'Default features' : { 'Count' : numpy.ones((2, 1)) } } }
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSelectedFeatures(self):
+        table = FeatureTable.fromFeatures(self.features, selected={'Plugin' : ['Count', 'Center']},
+                                          objects={0 : [1, 2], 1 : [1]})
+        assert table.features is table.matrix
+        assert table.matrix.dtype == numpy.float32
+        assert table.matrix.flags.c_contiguous
+        assert table.featureNames == [('Plugin', 'Center')]*2 + [('Plugin', 'Count')]
+        assert (table.features == [[2, 3, 5], [4, 5, 7], [2, 3, 2]]).all()
+        assert (table.column(('Plugin', 'Count'))[table.rows(0)] == [[5], [7]]).all()
+        assert list(table.objectIds) == [1, 2, 1]
+        assert list(table.times) == [0, 0, 1]
+
+    def testInconsistentFeatures(self):
+        del self.features[1]['Plugin']['Center']
+        try:
+            FeatureTable.fromFeatures(self.features)
+        except Exception:
+            pass
+        else:
+            assert False, "Expected an exception for time steps with different features"
+
+    def testExport(self):
+        table = FeatureTable.fromFeatures(self.features, extraColumns=[('Prediction', 1, numpy.uint8)])
+        table.column('Prediction')[table.rows(1)] = [[1], [2]]
+        assert table.features.shape == (5, 4)
+
+        records = table.toRecordArray()
+        assert records.dtype.names == ('Object id', 'Time', 'Default features, Count',
+                                       'Plugin, Center_ch_0', 'Plugin, Center_ch_1', 'Plugin, Count', 'Prediction')
+        assert records.dtype['Prediction'] == numpy.uint8
+        assert list(records['Object id']) == [0, 1, 2, 0, 1]
+        assert list(records['Time']) == [0, 0, 0, 1, 1]
+        assert list(records['Plugin, Center_ch_1']) == [1, 3, 5, 1, 3]
+        assert list(records['Prediction']) == [0, 0, 0, 1, 2]
+
+        h5_path = os.path.join(self.tmpdir, 'table.h5')
+        with h5py.File(h5_path, 'w') as f:
+            table.writeHdf5(f, 'table', chunkRows=2)
+        with h5py.File(h5_path, 'r') as f:
+            assert (f['table'][:] == records).all()
+
+        csv_path = os.path.join(self.tmpdir, 'table.csv')
+        table.writeCsv(csv_path, chunkRows=2)
+        lines = open(csv_path).read().splitlines()
+        assert len(lines) == 6
+        assert lines[0].split(',') == [name.replace(',', '/') for name in records.dtype.names]
+        assert lines[4].split(',') == ['0', '1', '1', '0', '1', '0', '1']
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
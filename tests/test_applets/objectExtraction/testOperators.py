@@ -19,11 +19,12 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import unittest
+from copy import deepcopy
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import OpLabelImage
-from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpObjectExtraction
+from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpRegionFeatures3d, OpObjectExtraction
 from ilastik.plugins import pluginManager
 
 import warnings
@@ -202,6 +203,105 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     center_good = mins[iobj][icoord] + (maxs[iobj][icoord]-mins[iobj][icoord])/2.
                     assert abs(coord-center_good)<0.01
 
+    def test_batches(self):
+        """
+        The local features must not depend on how the objects are split into parallel batches.
+        """
+        def compute():
+            self.op.Features.setValue(deepcopy(self.features))
+            opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+            opAdapt.Input.connect(self.op.Output)
+            return opAdapt.Output([0, 1]).wait()
+
+        original_batch_size = OpRegionFeatures3d.LOCAL_FEATURES_BATCH_SIZE
+        try:
+            OpRegionFeatures3d.LOCAL_FEATURES_BATCH_SIZE = 1
+            feats_single = compute()
+            OpRegionFeatures3d.LOCAL_FEATURES_BATCH_SIZE = 1000
+            feats_batched = compute()
+        finally:
+            OpRegionFeatures3d.LOCAL_FEATURES_BATCH_SIZE = original_batch_size
+
+        for t in feats_single:
+            for featname in ("Sum in neighborhood", "Mean in neighborhood", "Sum in object and neighborhood"):
+                assert np.all(feats_single[t][NAME][featname] == feats_batched[t][NAME][featname])
+
+class testOpRegionFeaturesBlockwise(object):
+    def setUp(self):
+        g = Graph()
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "RegionCenter" : {},
+                "Mean" : {},
+                "Variance" : {},
+                "Sum" : {},
+                "Minimum" : {},
+                "Maximum" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+            }
+        }
+
+        self.labelop = OpLabelImage(graph=g)
+        self.op = OpRegionFeatures(graph=g)
+        self.op.LabelImage.connect(self.labelop.Output)
+        self.op.RawImage.setValue(rawImage())
+        self.labelop.Input.setValue(binaryImage())
+
+    def compute(self, features, blockshape):
+        if blockshape is None:
+            self.op.BlockShape.disconnect()
+        else:
+            self.op.BlockShape.setValue(blockshape)
+        self.op.Features.setValue(deepcopy(features))
+        opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+        opAdapt.Input.connect(self.op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def test(self):
+        """
+        Objects crossing block boundaries must get the same features as without blocks.
+        """
+        feats_whole = self.compute(self.features, None)
+        feats_blockwise = self.compute(self.features, (17, 23, 5))
+        for t in feats_whole:
+            for plugin in (NAME, "Default features"):
+                assert set(feats_whole[t][plugin].keys()) == set(feats_blockwise[t][plugin].keys())
+                for featname, value in feats_whole[t][plugin].iteritems():
+                    blockwise = feats_blockwise[t][plugin][featname]
+                    assert blockwise.shape == value.shape, featname
+                    assert np.allclose(blockwise, value, rtol=1e-4, atol=1e-4), featname
+
+    def test_fallback(self):
+        """
+        Features that can not be merged across blocks are computed on the whole volume.
+        """
+        features = deepcopy(self.features)
+        features[NAME]["Mean in neighborhood"] = {"margin" : (30, 30, 1)}
+        feats = self.compute(features, (17, 23, 5))
+        assert "Mean in neighborhood" in feats[0][NAME]
+
+    def test_objectExtraction(self):
+        """
+        The block shape is set through OpObjectExtraction.RegionFeaturesBlockShape.
+        """
+        g = Graph()
+        feats = {}
+        for blockshape in (None, (17, 23, 5)):
+            op = OpObjectExtraction(graph=g)
+            op.RawImage.setValue(rawImage())
+            op.BinaryImage.setValue(binaryImage())
+            op.Features.setValue(deepcopy(self.features))
+            if blockshape is None:
+                op.RegionFeaturesBlockShape.disconnect()
+            else:
+                op.RegionFeaturesBlockShape.setValue(blockshape)
+            feats[blockshape] = op.RegionFeatures([0, 1]).wait()
+        assert op._opRegFeats._opRegionFeatures.opRegionFeatures3dBlocks[0].BlockShape.value == (17, 23, 5)
+        for t in feats[None]:
+            for featname, value in feats[None][t][NAME].iteritems():
+                assert np.allclose(feats[(17, 23, 5)][t][NAME][featname], value, rtol=1e-4, atol=1e-4), featname
 
 if __name__ == '__main__':
     import sys
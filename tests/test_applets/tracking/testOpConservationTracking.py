@@ -0,0 +1,98 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import threading
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators.opArrayPiper import OpArrayPiper
+from ilastik.applets.tracking.conservation.opConservationTracking import OpConservationTracking
+
+class TestWindowedTracking(object):
+    def setUp(self):
+        # 12 time steps with the objects 1 and 2 each
+        self.labels = numpy.zeros((12, 4, 2, 1, 1), dtype=numpy.uint32)
+        self.labels[:, :2] = 1
+        self.labels[:, 2:] = 2
+
+        graph = Graph()
+        self.opSource = OpArrayPiper( graph=graph )
+        self.opSource.Input.setValue( vigra.taggedView(self.labels, 'txyzc') )
+        self.op = OpConservationTracking( graph=graph )
+        self.op.LabelImage.connect( self.opSource.Output )
+        self.op.RawImage.connect( self.opSource.Output )
+
+        self.windows = []
+        self.lock = threading.Lock()
+
+    def solve(self, window, parameters, filtered_labels):
+        """
+        Stands in for _solveWindow(): both objects move straight on, except in the window starting at 4,
+        which swaps them at time step 5.  The energy of each event is the start of its window.
+        """
+        with self.lock:
+            self.windows.append( list(window) )
+        events = { "0" : {} }
+        for t in window[1:]:
+            if window[0] == 4 and t == 5:
+                mov = [[1, 2, window[0]], [2, 1, window[0]]]
+            else:
+                mov = [[1, 1, window[0]], [2, 2, window[0]]]
+            events[str(t - window[0])] = { "mov" : numpy.array(mov, dtype=float) }
+        if window[0] == 4:
+            filtered_labels["1"] = [3]
+        parameters['time_range'] = [window[0], window[-1]]
+        return events
+
+    def test(self):
+        self.op._trackWindowed( self.solve, range(12), {},
+                                windowSize=5, windowOverlap=3, maxParallelWindows=2 )
+        assert sorted(self.windows) == [range(0, 5), range(2, 7), range(4, 9), range(6, 11), range(8, 12)]
+
+        # The windows are stitched in the middle of each overlap, except between the windows
+        #  starting at 2 and 4, which disagree at time step 5
+        expected_window = [None, 0, 0, 2, 2, 2, 4, 6, 6, 8, 8, 8]
+        events = self.op.EventsVector.value
+        assert sorted(events.keys(), key=int) == [str(t) for t in range(12)]
+        assert events["0"] == {}
+        for t in range(1, 12):
+            mov = events[str(t)]["mov"]
+            assert (mov[:, :2] == [[1, 1], [2, 2]]).all(), t
+            assert (mov[:, 2] == expected_window[t]).all(), t
+
+        assert self.op.Parameters.value['time_range'] == [0, 11]
+        assert self.op.FilteredLabels.value == { "5" : [3] }
+
+    def testInvalidOverlap(self):
+        try:
+            self.op._trackWindowed( self.solve, range(12), {}, windowSize=3, windowOverlap=2, maxParallelWindows=1 )
+        except Exception:
+            pass
+        else:
+            assert False, "A window that is not longer than the overlap plus one time step must be rejected"
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
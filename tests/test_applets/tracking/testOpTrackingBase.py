@@ -0,0 +1,228 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators.opArrayPiper import OpArrayPiper
+from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.objectExtraction import config
+
+class TestLabel2Color(object):
+    def setUp(self):
+        # 6 time steps with the objects 1..4 each
+        self.labels = numpy.zeros((6, 8, 2, 1, 1), dtype=numpy.uint32)
+        for label in range(1, 5):
+            self.labels[:, 2*label-2:2*label] = label
+
+        graph = Graph()
+        self.opSource = OpArrayPiper( graph=graph )
+        self.opSource.Input.setValue( vigra.taggedView(self.labels, 'txyzc') )
+        self.op = OpTrackingBase( graph=graph )
+        self.op.LabelImage.connect( self.opSource.Output )
+        self.op.RawImage.connect( self.opSource.Output )
+        self.op.Parameters.setValue( {'time_range' : [0, 5]} )
+
+        # object 1 moves to 1, object 2 to 3, object 3 divides into 2 and 4 and object 4 disappears
+        step = { "mov" : numpy.array([[1, 1, 0.], [2, 3, 0.]]),
+                 "div" : numpy.array([[3, 2, 4, 0.]]),
+                 "dis" : numpy.array([[4, 0.]]) }
+        self.events = dict( (str(i), dict(step)) for i in range(1, 6) )
+        self.events["0"] = {}
+
+        self.dirty = []
+        self.op.Output.notifyDirty( lambda slot, roi: self.dirty.append( (roi.start[0], roi.stop[0]) ) )
+
+    def test(self):
+        self.op.EventsVector.setValue( self.events )
+        label2color = self.op.label2color
+        # The objects of the first time step get their track ids when they are continued
+        assert label2color[0] == {1 : 2, 2 : 3, 3 : 4}
+        assert label2color[1] == {1 : 2, 3 : 3, 2 : 4, 4 : 4}
+        assert label2color[2] == {1 : 2, 3 : 4, 2 : 3, 4 : 3}
+        assert len(label2color) == 6
+        output = self.op.Output[:].wait()
+        assert (output[2,...,0] == numpy.array([0, 2, 3, 4, 3])[self.labels[2,...,0]]).all()
+
+        # Change the events of a single step: only the following time steps are recomputed and dirty
+        self.dirty = []
+        events = dict( self.events )
+        events["4"] = { "mov" : numpy.array([[1, 1, 0.], [2, 2, 0.], [3, 3, 0.]]) }
+        self.op.EventsVector.setValue( events )
+        assert self.dirty == [(4, 6)]
+        assert self.op.label2color[:4] == label2color[:4]
+        assert self.op.label2color[4] == {1 : 2, 2 : 4, 3 : 3}
+
+        # Unchanged events: nothing is dirty
+        self.dirty = []
+        self.op.EventsVector.setValue( dict(events), check_changed=False )
+        assert self.dirty == []
+
+    def testGrowingTimeRange(self):
+        # A result that grows at the end (sliding window tracking) only dirties the new time steps
+        self.op.Parameters.setValue( {'time_range' : [0, 3]} )
+        self.op.EventsVector.setValue( dict( (str(i), self.events[str(i)]) for i in range(4) ) )
+        self.dirty = []
+        self.op.Parameters.setValue( {'time_range' : [0, 5]} )
+        self.op.EventsVector.setValue( self.events )
+        assert self.dirty == [(4, 6)]
+        assert self.op.label2color[2] == {1 : 2, 3 : 4, 2 : 3, 4 : 3}
+        assert len(self.op.label2color) == 6
+
+class TestTraxelFrames(object):
+    def setUp(self):
+        self.op = OpTrackingBase( graph=Graph() )
+        self.op.TRAXEL_FRAME_PREFETCH = 3
+
+    def test(self):
+        # The frames are yielded in order, and only a few of them are prepared ahead of the consumer
+        prepared = []
+        def prepare_frame(t):
+            prepared.append(t)
+            return t * 10
+
+        consumed = []
+        for t, frame in self.op._iterTraxelFrames( range(10), prepare_frame ):
+            assert frame == t * 10
+            assert max(prepared) < t + self.op.TRAXEL_FRAME_PREFETCH
+            consumed.append(t)
+        assert consumed == range(10)
+        assert sorted(prepared) == range(10)
+
+    def testStopEarly(self):
+        prepared = []
+        def prepare_frame(t):
+            prepared.append(t)
+            return t
+        for t, frame in self.op._iterTraxelFrames( range(100), prepare_frame ):
+            if t == 4:
+                break
+        assert max(prepared) < 4 + self.op.TRAXEL_FRAME_PREFETCH
+
+def object_features(labels, n_dim):
+    """
+    The features of the objects in a (single time step, txyzc) label image that are used for the traxels,
+    including the background object 0.
+    """
+    image = labels[0, ..., 0] if n_dim == 3 else labels[0, ..., 0, 0]
+    num_objects = image.max() + 1
+    feats = dict( (name, numpy.zeros((num_objects, n_dim), dtype=numpy.float32))
+                  for name in ['RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>'] )
+    feats['Count'] = numpy.zeros((num_objects, 1), dtype=numpy.float32)
+    for label in range(num_objects):
+        coords = numpy.transpose(numpy.nonzero(image == label))
+        feats['RegionCenter'][label] = coords.mean(axis=0)
+        feats['Coord<Minimum>'][label] = coords.min(axis=0)
+        feats['Coord<Maximum>'][label] = coords.max(axis=0)
+        feats['Count'][label] = len(coords)
+    return { default_features_key : feats,
+             config.features_vigra_name : { 'RegionCenter_corr' : feats['RegionCenter'] + 0.25 } }
+
+def reference_frame(labels, t, feats_at, x_range, y_range, z_range, size_range):
+    """
+    Filter the objects of a frame and cut their excerpts out of the label image one by one
+    (like the traxelstore used to be filled).
+    """
+    rc = feats_at[default_features_key]['RegionCenter'][1:]
+    rc_corr = feats_at[config.features_vigra_name]['RegionCenter_corr'][1:]
+    lower = feats_at[default_features_key]['Coord<Minimum>'][1:]
+    upper = feats_at[default_features_key]['Coord<Maximum>'][1:]
+    ct = feats_at[default_features_key]['Count'][1:]
+    frame = dict( (name, []) for name in ['ids', 'filtered', 'com', 'com_corrected', 'count', 'lower', 'excerpts'] )
+    for idx in range(rc.shape[0]):
+        if len(rc[idx]) == 2:
+            x, y = rc[idx]
+            z = 0
+        else:
+            x, y, z = rc[idx]
+        size = ct[idx]
+        if (x < x_range[0] or x >= x_range[1] or
+            y < y_range[0] or y >= y_range[1] or
+            z < z_range[0] or z >= z_range[1] or
+            size < size_range[0] or size >= size_range[1]):
+            frame['filtered'].append(int(idx + 1))
+            continue
+        frame['ids'].append(idx + 1)
+        frame['com'].append([float(x), float(y), float(z)])
+        frame['com_corrected'].append([float(v) for v in rc_corr[idx]] + [0.0]*(3 - len(rc_corr[idx])))
+        frame['count'].append(float(size))
+
+        roi = [slice(t, t+1)] + [slice(int(l), int(u) + 1) for l, u in zip(lower[idx], upper[idx])]
+        if len(rc[idx]) == 2:
+            roi.append(slice(0, 1))
+        excerpt = labels[tuple(roi)][0, ..., 0]
+        if len(rc[idx]) == 2:
+            excerpt = excerpt[..., 0]
+        frame['excerpts'].append(excerpt)
+        frame['lower'].append(lower[idx].astype(numpy.int64))
+    return frame
+
+class TestPrepareTraxelFrame(object):
+    def _check(self, shape, x_range, y_range, z_range, size_range):
+        n_dim = 3 if shape[2] > 1 else 2
+        # Scattered objects, so their bounding boxes overlap
+        labels = numpy.random.RandomState(0).randint(0, 7, size=(2,) + shape + (1,)).astype(numpy.uint32)
+        labels[1] = 0 # No objects at t=1
+
+        graph = Graph()
+        opSource = OpArrayPiper( graph=graph )
+        opSource.Input.setValue( vigra.taggedView(labels, 'txyzc') )
+        op = OpTrackingBase( graph=graph )
+        op.LabelImage.connect( opSource.Output )
+
+        feats_at = object_features(labels[0:1], n_dim)
+        frame = op._prepareTraxelFrame( 0, feats_at, x_range, y_range, z_range, size_range,
+                                        with_opt_correction=True, with_coordinate_list=True )
+        expected = reference_frame( labels, 0, feats_at, x_range, y_range, z_range, size_range )
+        assert len(expected['ids']) > 0 and len(expected['filtered']) > 0
+
+        assert frame.num_objects == 6
+        assert list(frame.ids) == expected['ids']
+        assert frame.filtered == expected['filtered']
+        assert frame.com == expected['com']
+        assert numpy.allclose(frame.com_corrected, expected['com_corrected'])
+        assert frame.count == expected['count']
+        assert len(frame.lower) == len(frame.excerpts) == len(expected['ids'])
+        for lower, expected_lower in zip(frame.lower, expected['lower']):
+            assert list(lower) == list(expected_lower)
+        for excerpt, expected_excerpt in zip(frame.excerpts, expected['excerpts']):
+            assert excerpt.shape == expected_excerpt.shape
+            assert (excerpt == expected_excerpt).all()
+
+        # A frame without objects
+        frame = op._prepareTraxelFrame( 1, object_features(labels[1:2], n_dim), x_range, y_range, z_range, size_range,
+                                        with_coordinate_list=True )
+        assert frame.num_objects == 0
+        assert len(frame.ids) == 0 and frame.filtered == [] and frame.excerpts == []
+
+    def test2D(self):
+        self._check( (12, 10, 1), [0, 5.6], [0, 10], [0, 1], [0, 20] )
+
+    def test3D(self):
+        self._check( (9, 8, 7), [0, 9], [0, 3.9], [0, 7], [66, 1000] )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
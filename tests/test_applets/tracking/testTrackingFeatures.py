@@ -0,0 +1,136 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from ilastik.applets.trackingFeatureExtraction.trackingFeatures import FeatureManager, SuccessorIndex, \
+                                                                       ParentChildrenRatio, ChildrenRatio, ParentChildrenAngle
+
+FEATURE_NAMES = ['ParentChildrenRatio_Count', 'ParentChildrenRatio_Mean', 'ChildrenRatio_Count', 'ChildrenRatio_Mean',
+                 'ParentChildrenAngle_RegionCenter']
+
+def singlePixelObjects(shape, nobjects, rng):
+    # Objects of one pixel each, so that an object is inside a search window iff its center is
+    coords = rng.permutation(numpy.prod(shape))[:nobjects]
+    centers = numpy.zeros((nobjects + 1, len(shape)), dtype=numpy.float32)
+    centers[1:] = numpy.array(numpy.unravel_index(coords, shape)).T
+    feats = { 'RegionCenter' : centers,
+              'Count' : numpy.ones((nobjects + 1, 1), dtype=numpy.float32),
+              'Mean' : rng.rand(nobjects + 1, 1).astype(numpy.float32) }
+    return feats
+
+def computeFeaturesReference(fm, feats_cur, feats_next, shape_next, feat_names):
+    # Per-object search for the nearest successors, as in the previous implementation of computeFeatures_at
+    classes = {}
+    result = {}
+    nobjects = len(feats_cur['RegionCenter'])
+    for name in feat_names:
+        op, feat = name.split('_')
+        classes[name] = fm.feature_mappings[op](feat, ndim=fm.ndim, feat_dim=len(feats_cur[feat][0]))
+        result[name] = numpy.ones((nobjects, classes[name].dim())) * classes[name].default_value
+    for idx in range(fm.n_best):
+        result['SquaredDistances_' + str(idx)] = numpy.ones((nobjects, 1)) * fm.squared_distance_default
+
+    for label_cur in range(1, nobjects):
+        com_cur = feats_cur['RegionCenter'][label_cur]
+        candidates = []
+        for label_next in range(1, len(feats_next['RegionCenter'])):
+            com_next = feats_next['RegionCenter'][label_next]
+            inside = True
+            for axis, coord in enumerate(com_cur):
+                start = max(round(coord) - fm.template_size/2, 0)
+                stop = min(round(coord) + fm.template_size/2, shape_next[axis])
+                inside = inside and start <= round(com_next[axis]) < stop
+            if inside and feats_next['Count'][label_next][0] >= fm.size_filter:
+                candidates.append((numpy.linalg.norm(com_next - com_cur * fm.scales), label_next))
+        best = sorted(candidates)[:fm.n_best]
+        for idx, (dist, _) in enumerate(best):
+            result['SquaredDistances_' + str(idx)][label_cur] = numpy.float32(dist)
+        for name, feat_class in classes.items():
+            f_cur = numpy.array(feats_cur[feat_class.feats_name][label_cur]).flatten()
+            f_next = numpy.array([feats_next[feat_class.feats_name][l] for _, l in best]).reshape((-1, f_cur.shape[0]))
+            result[name][label_cur] = feat_class.compute(f_cur, f_next)
+    return result
+
+class TestSuccessorIndex(object):
+    def test(self):
+        rng = numpy.random.RandomState(0)
+        coms = rng.rand(500, 3) * [200, 100, 50]
+        labels = numpy.arange(1, 500)
+        index = SuccessorIndex(coms, labels, 20)
+        start = rng.randint(-10, 200, (100, 3))
+        stop = start + rng.randint(0, 40, (100, 3))
+        windows, found = index.query(start, stop)
+
+        positions = numpy.floor(coms + 0.5)
+        for w in range(len(start)):
+            inside = numpy.all((positions[labels] >= start[w]) & (positions[labels] < stop[w]), axis=1)
+            assert sorted(found[windows == w]) == sorted(labels[inside])
+
+    def testEmpty(self):
+        index = SuccessorIndex(numpy.zeros((1, 2)), [], 50)
+        windows, found = index.query([[0, 0]], [[10, 10]])
+        assert len(windows) == len(found) == 0
+
+class TestFeatureManager(object):
+    def _check(self, shape, nobjects, seed):
+        rng = numpy.random.RandomState(seed)
+        feats_cur = singlePixelObjects(shape, nobjects, rng)
+        feats_next = singlePixelObjects(shape, nobjects, rng)
+        fm = FeatureManager(ndim=len(shape), size_filter=1)
+
+        result = fm.computeFeatures_at(feats_cur, feats_next, None, FEATURE_NAMES, shape_next=shape)
+        expected = computeFeaturesReference(fm, feats_cur, feats_next, shape, FEATURE_NAMES)
+        assert sorted(result.keys()) == sorted(expected.keys())
+        for name in expected:
+            assert result[name].shape == expected[name].shape, name
+            assert numpy.allclose(result[name], expected[name]), name
+
+        # Without a next frame, all features take their default values
+        result = fm.computeFeatures_at(feats_cur, None, None, FEATURE_NAMES)
+        assert (result['SquaredDistances_0'] == fm.squared_distance_default).all()
+        assert (result['ChildrenRatio_Count'] == 0).all()
+
+    def test2d(self):
+        self._check((300, 200), 500, 0)
+
+    def test3d(self):
+        self._check((60, 50, 40), 300, 1)
+
+class TestBatchFeatures(object):
+    def test(self):
+        rng = numpy.random.RandomState(2)
+        feats_cur = rng.rand(50, 2) * 10
+        feats_next = rng.rand(50, 3, 2) * 10
+        feats_next[0, :2] = feats_cur[0]
+        feats_next[1, 0] = 0
+        n_next = rng.randint(0, 4, 50)
+        for feature in [ParentChildrenRatio('Count', feat_dim=2), ChildrenRatio('Count', feat_dim=2),
+                        ParentChildrenAngle('RegionCenter')]:
+            result = numpy.asarray(feature.computeBatch(feats_cur, feats_next, n_next))
+            expected = numpy.array([feature.compute(f_cur, f_next[:n]) for f_cur, f_next, n in zip(feats_cur, feats_next, n_next)])
+            assert numpy.allclose(result, expected), feature.getName()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,92 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import vigra
+import h5py
+
+from lazyflow.graph import Graph
+from lazyflow.operators.opArrayPiper import OpArrayPiper
+from ilastik.applets.tracking.base.trackingResultExporter import TrackingResultExporter
+
+class TestTrackingResultExporter(object):
+    def setUp(self):
+        self.data = numpy.random.RandomState(0).randint(0, 20, (12, 30, 20, 5, 1)).astype(numpy.uint32)
+        self.opSource = OpArrayPiper( graph=Graph() )
+        self.opSource.Input.setValue( vigra.taggedView(self.data, 'txyzc') )
+        self.events = {}
+        for t in range(2, 12):
+            if t % 3:
+                self.events[t] = { "mov" : numpy.array([[1, 2, 0.5], [3, 4, 0.25]]), "app" : numpy.array([[5, 1.5]]) }
+            else:
+                self.events[t] = {}
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLineageH5(self):
+        progress = []
+        exporter = TrackingResultExporter(self.opSource.Output, self.events, prefetch=3)
+        exporter.exportLineageH5(self.directory, progress.append)
+        assert sorted(os.listdir(self.directory)) == [str(t).zfill(5) + ".h5" for t in range(2, 12)]
+        assert progress[-1] == 100
+
+        with h5py.File(os.path.join(self.directory, "00004.h5"), 'r') as f:
+            assert (f["segmentation/labels"][...] == self.data[4,...,0]).all()
+            assert f["tracking/Moves"][...].tolist() == [[1, 2], [3, 4]]
+            assert f["tracking/Moves-Energy"][...].tolist() == [0.5, 0.25]
+        with h5py.File(os.path.join(self.directory, "00003.h5"), 'r') as f:
+            assert len(f["tracking"].keys()) == 0
+
+    def testSingleFile(self):
+        filename = os.path.join(self.directory, "tracking.h5")
+        exporter = TrackingResultExporter(self.opSource.Output, self.events, prefetch=3)
+        exporter.exportSingleFile(filename)
+
+        with h5py.File(filename, 'r') as f:
+            assert (f["segmentation/labels"][...] == self.data[2:,...,0]).all()
+            assert f["segmentation/labels"].chunks[0] == 1
+            assert f["segmentation/timesteps"][...].tolist() == range(2, 12)
+            moves = f["tracking/Moves"][...]
+            assert moves.shape == (2 * 7, 3)
+            assert moves[:4].tolist() == [[2, 1, 2], [2, 3, 4], [4, 1, 2], [4, 3, 4]]
+            assert len(f["tracking/Appearances-Energy"]) == 7
+
+    def testRelabel(self):
+        label2color = [ dict( (label, label + 100) for label in range(1, 10) ) for t in range(12) ]
+        exporter = TrackingResultExporter(self.opSource.Output, label2color=label2color)
+        frames = list(exporter.iterFrames([0, 5, 7]))
+        assert [t for t, _ in frames] == [0, 5, 7]
+
+        expected = numpy.where(self.data[5,...,0] >= 10, 1, self.data[5,...,0] + 100)
+        expected[self.data[5,...,0] == 0] = 0
+        assert (frames[1][1] == expected).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,126 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import ilastik.ilastik_logging
+ilastik.ilastik_logging.default_config.init()
+
+import numpy
+
+from lazyflow.utility.timer import Timer
+from ilastik.applets.tracking.base.trackingUtilities import relabel, relabelMergers, relabel_lut, apply_lut, \
+                                                            sliding_windows, events_agreement, find_seam, shift_events_at
+
+import logging
+logger = logging.getLogger(__name__)
+
+def relabelReference(volume, replace):
+    # The previous (per-label) implementation of relabel()
+    mp = numpy.arange(0, numpy.amax(volume) + 1, dtype=volume.dtype)
+    mp[1:] = 1
+    for label in numpy.unique(volume):
+        if label > 0 and label in replace:
+            mp[label] = replace[label]
+    return mp[volume]
+
+class TestRelabel(object):
+    def test(self):
+        volume = numpy.random.RandomState(0).randint(0, 50, (20, 30, 10)).astype(numpy.uint32)
+        replace = {0 : 7, 3 : 12, 10 : 0, 49 : 5, 60 : 2}
+        expected = relabelReference(volume, replace)
+        assert (relabel(volume, replace) == expected).all()
+        assert (relabelMergers(volume, replace) == expected).all()
+        assert relabel(volume, replace).dtype == volume.dtype
+
+        # The lookup table does not depend on the labels of the volume
+        lut = relabel_lut(replace)
+        assert (apply_lut(volume, lut) == expected).all()
+        assert (apply_lut(volume + 100, lut)[volume > 0] == 1).all()
+
+    def testEmpty(self):
+        volume = numpy.arange(5, dtype=numpy.uint8)
+        assert list(relabel(volume, {})) == [0, 1, 1, 1, 1]
+
+class TestRelabelBenchmark(object):
+    def test(self):
+        # A long time series with many objects per time step
+        ntimes = 100
+        nobjects = 10000
+        rng = numpy.random.RandomState(1)
+        label2color = [ dict( zip( range(1, nobjects+1), rng.randint(1, 255, nobjects) ) ) for _ in range(ntimes) ]
+        volume = rng.randint(0, nobjects+1, (ntimes, 100, 100)).astype(numpy.uint32)
+
+        with Timer() as timer:
+            luts = [ relabel_lut(label2color_at) for label2color_at in label2color ]
+        logger.info("Built {} lookup tables in {} seconds".format(ntimes, timer.seconds()))
+
+        with Timer() as timer:
+            for t in range(ntimes):
+                apply_lut(volume[t], luts[t])
+        logger.info("Relabeled {} time steps with lookup tables in {} seconds".format(ntimes, timer.seconds()))
+
+        with Timer() as timer:
+            for t in range(ntimes):
+                relabelReference(volume[t], label2color[t])
+        logger.info("Relabeled {} time steps with the per-label loop in {} seconds".format(ntimes, timer.seconds()))
+
+        for t in [0, ntimes-1]:
+            assert (apply_lut(volume[t], luts[t]) == relabelReference(volume[t], label2color[t])).all()
+
+def movesAt(moves):
+    # events at one time step, consisting of moves (with an arbitrary energy)
+    return { "mov" : numpy.asarray([ (src, dst, 0.5) for src, dst in moves ]) }
+
+class TestSlidingWindows(object):
+    def testWindows(self):
+        windows = sliding_windows(range(3, 20), 8, 3)
+        assert [ (w[0], w[-1]) for w in windows ] == [ (3, 10), (8, 15), (13, 19) ]
+        assert [ (w[0], w[-1]) for w in sliding_windows(range(0, 5), 8, 3) ] == [ (0, 4) ]
+
+    def testAgreement(self):
+        assert events_agreement({}, {}) == 1.0
+        assert events_agreement(movesAt([(1, 2), (3, 4)]), movesAt([(1, 2), (3, 4)])) == 1.0
+        assert events_agreement(movesAt([(1, 2), (3, 4)]), movesAt([(1, 2), (3, 5)])) == 1.0 / 3
+
+    def testSeam(self):
+        # window 1: time steps 0..9, window 2: time steps 6..15
+        window1 = range(0, 10)
+        window2 = range(6, 16)
+        events1 = dict( (str(t), movesAt([(1, 1), (2, 2)])) for t in range(10) )
+        events2 = dict( (str(t - 6), movesAt([(1, 1), (2, 3)])) for t in range(6, 16) )
+        # complete agreement at 8 only
+        events2["2"] = movesAt([(1, 1), (2, 2)])
+        assert find_seam(events1, window1, events2, window2) == 8
+        # without any agreement, the middle of the overlap is taken
+        events2["2"] = movesAt([(1, 1), (2, 3)])
+        assert find_seam(events1, window1, events2, window2) in (7, 8)
+
+    def testShift(self):
+        events_at = { "multiMove" : numpy.asarray([ (1, 2, 3, 0.5), (4, 5, -1, 0.5) ]) }
+        shifted = shift_events_at(events_at, 10)
+        assert list(shifted["multiMove"][:, 2]) == [13, -1]
+        assert list(events_at["multiMove"][:, 2]) == [3, -1]
+        assert shift_events_at(movesAt([(1, 2)]), 10)["mov"].shape == (1, 3)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,165 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+import os
+import os
+import imp
+import time
+import shutil
+import tempfile
+
+import numpy
+
+# The scripts in bin/ aren't a package, so load the module from its file.
+downsample_pointcloud = imp.load_source( 'downsample_pointcloud',
+                                         os.path.join( os.path.split(__file__)[0], '../../bin/downsample_pointcloud.py' ) )
+POINTCLOUD_COLUMNS = downsample_pointcloud.POINTCLOUD_COLUMNS
+
+def reference_density( points, scale_xyz, offset_xyz, volume_shape_xyz, method ):
+    """
+    The density volume as computed by the original (in-memory) implementation, with numpy.add.at().
+    Points outside the volume are dropped first.
+    """
+    coords_xyz = ( numpy.array( [ points[:, POINTCLOUD_COLUMNS.index( axis + '_px' )] for axis in 'xyz' ] ).T
+                   - offset_xyz ) / scale_xyz
+    scaled_shape_xyz = ( numpy.array(volume_shape_xyz) + numpy.array(scale_xyz) - 1 ) / scale_xyz
+    inside = ( ( coords_xyz >= 0 ) & ( coords_xyz < scaled_shape_xyz ) ).all( axis=1 )
+    coords_zyx = tuple( coords_xyz[inside].T[::-1] )
+    if method == 'binary':
+        volume = numpy.zeros( tuple(scaled_shape_xyz[::-1]), dtype=numpy.uint8 )
+        volume[coords_zyx] = 1
+        return volume
+    volume = numpy.zeros( tuple(scaled_shape_xyz[::-1]), dtype=numpy.float32 )
+    weights = 1
+    if method == 'by_size':
+        weights = points[inside, POINTCLOUD_COLUMNS.index('size_px')]
+    numpy.add.at( volume, coords_zyx, weights )
+    return volume
+
+class TestDensityVolume(object):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        # 50 points (with duplicates) in a 20x10x5 volume starting at (100, 200, 10)
+        points = numpy.zeros( (50, len(POINTCLOUD_COLUMNS)), dtype=numpy.uint32 )
+        for axis, start, size in zip( 'xyz', (100, 200, 10), (20, 10, 5) ):
+            points[:, POINTCLOUD_COLUMNS.index( axis + '_px' )] = numpy.random.randint( start, start + size, size=50 )
+        points[:, POINTCLOUD_COLUMNS.index('size_px')] = numpy.random.randint( 1, 100, size=50 )
+        points[25:30] = points[0]
+        self.points = points
+        self.csvPath = self._writeCsv( 'points.csv', points )
+
+    def tearDown(self):
+        shutil.rmtree( self.tempDir )
+
+    def _writeCsv(self, filename, rows):
+        path = os.path.join( self.tempDir, filename )
+        with open( path, 'w' ) as f:
+            f.write( '\t'.join( POINTCLOUD_COLUMNS ) + '\n' )
+            for row in rows:
+                f.write( '\t'.join( map( str, row ) ) + '\n' )
+        # Make sure the cache (if any) is considered newer than the csv file.
+        past = time.time() - 100
+        os.utime( path, (past, past) )
+        return path
+
+    def testMethods(self):
+        # The bounding box of the points is used as the volume, read in chunks smaller than the file
+        for method in ('binary', 'by_count', 'by_size'):
+            for scale_xyz in ( None, (3, 2, 2) ):
+                expected = reference_density( self.points, scale_xyz or (1,1,1), (100, 200, 10),
+                                              tuple( self.points[:, :3].max(0) - (100, 200, 10) + 1 ), method )
+                for chunk_rows in (7, 1000):
+                    density = downsample_pointcloud.density_volume_from_pointcloud( self.csvPath, scale_xyz, method=method,
+                                                                                    use_cache=False, chunk_rows=chunk_rows )
+                    assert density.dtype == expected.dtype
+                    assert density.shape == expected.shape, "{} != {}".format( density.shape, expected.shape )
+                    assert ( density == expected ).all(), "Wrong density for method {}, scale {}, chunk_rows {}".format( method, scale_xyz, chunk_rows )
+
+    def testPointsOutsideVolume(self):
+        # Only part of the bounding box is rendered; the other points are ignored
+        offset_xyz = (105, 202, 11)
+        volume_shape_xyz = (10, 6, 3)
+        for method in ('binary', 'by_count', 'by_size'):
+            expected = reference_density( self.points, (2, 2, 1), offset_xyz, volume_shape_xyz, method )
+            density = downsample_pointcloud.density_volume_from_pointcloud( self.csvPath, (2, 2, 1), offset_xyz, volume_shape_xyz,
+                                                                            method, use_cache=False, chunk_rows=8 )
+            assert ( density == expected ).all()
+            assert 0 < density.sum() < expected.size * 50
+
+    def testCache(self):
+        cachePath = os.path.join( self.tempDir, 'points.cache' )
+        expected = downsample_pointcloud.density_volume_from_pointcloud( self.csvPath, method='by_size', use_cache=False )
+        # The first pass writes the cache, the second one reads it
+        for _ in range(2):
+            density = downsample_pointcloud.density_volume_from_pointcloud( self.csvPath, method='by_size',
+                                                                            use_cache=cachePath, chunk_rows=9 )
+            assert ( density == expected ).all()
+            assert downsample_pointcloud.ColumnarCache( cachePath ).load( os.path.getmtime( self.csvPath ) ) is not None
+
+        # Round trip
+        columns = downsample_pointcloud.ColumnarCache( cachePath ).load( os.path.getmtime( self.csvPath ) )
+        assert sorted( columns.keys() ) == sorted( POINTCLOUD_COLUMNS )
+        for i, name in enumerate( POINTCLOUD_COLUMNS ):
+            assert columns[name].dtype == numpy.uint32
+            assert ( columns[name] == self.points[:, i] ).all()
+
+        # A cache that is older than the csv file is ignored
+        os.utime( self.csvPath, None )
+        os.utime( os.path.join( cachePath, downsample_pointcloud.ColumnarCache.HEADER_FILENAME ), (0, 0) )
+        assert downsample_pointcloud.ColumnarCache( cachePath ).load( os.path.getmtime( self.csvPath ) ) is None
+
+    def testCacheAbortedWhenStoppedEarly(self):
+        cachePath = os.path.join( self.tempDir, 'points.cache' )
+        chunks = downsample_pointcloud.iter_pointcloud_chunks( self.csvPath, column_dtypes=numpy.uint32,
+                                                               use_cache=cachePath, chunk_rows=10 )
+        chunk = chunks.next()
+        assert len( chunk['x_px'] ) == 10
+        chunks.close()
+        assert downsample_pointcloud.ColumnarCache( cachePath ).load( 0 ) is None
+        assert os.listdir( cachePath ) == []
+
+        # So the next pass reads the csv file again (and completes the cache)
+        chunks = list( downsample_pointcloud.iter_pointcloud_chunks( self.csvPath, column_dtypes=numpy.uint32,
+                                                                     use_cache=cachePath, chunk_rows=10 ) )
+        assert sum( len( chunk['x_px'] ) for chunk in chunks ) == 50
+        assert downsample_pointcloud.ColumnarCache( cachePath ).load( 0 ) is not None
+
+    def testRejectInvalidIntegers(self):
+        for bad_value in ('-3', '1.5', str(2**33)):
+            rows = [ map( str, row ) for row in self.points[:3] ]
+            rows[1][0] = bad_value
+            path = self._writeCsv( 'bad.csv', rows )
+            try:
+                list( downsample_pointcloud.iter_pointcloud_chunks( path, column_dtypes=numpy.uint32, use_cache=False ) )
+            except ValueError:
+                pass
+            else:
+                assert False, "Value {} should have been rejected".format( bad_value )
+
+        # Float columns accept fractional values
+        chunks = list( downsample_pointcloud.iter_pointcloud_chunks( path, column_dtypes={'x_px' : numpy.float32}, use_cache=False ) )
+        assert chunks[0]['x_px'][1] == 2**33
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
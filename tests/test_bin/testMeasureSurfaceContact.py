@@ -0,0 +1,112 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+import os
+import os
+import imp
+import shutil
+import tempfile
+import itertools
+import collections
+
+import numpy
+import h5py
+
+# The scripts in bin/ aren't a package, so load the module from its file.
+measure_surface_contact = imp.load_source( 'measure_surface_contact',
+                                           os.path.join( os.path.split(__file__)[0], '../../bin/measure_surface_contact.py' ) )
+
+def brute_force_contacts( volume, offsets, background_label=0 ):
+    """
+    Count the neighboring voxel pairs and the touching voxels of each pair of labels, one voxel at a time.
+    Returns {(label_a, label_b) : (adjacency, voxels_a, voxels_b)} for label_a < label_b.
+    """
+    adjacency = collections.defaultdict(int)
+    touching = collections.defaultdict(set) # (own label, neighbor label) -> voxels of own label
+    for coord in itertools.product( *map( range, volume.shape ) ):
+        own = volume[coord]
+        for offset in offsets:
+            neighbor_coord = tuple( numpy.add( coord, offset ) )
+            if min(neighbor_coord) < 0 or any( numpy.array(neighbor_coord) >= volume.shape ):
+                continue
+            neighbor = volume[neighbor_coord]
+            if own == neighbor or background_label in (own, neighbor):
+                continue
+            if own < neighbor:
+                adjacency[(own, neighbor)] += 1
+            touching[(own, neighbor)].add( coord )
+    return dict( ( pair, (count, len(touching[pair]), len(touching[pair[::-1]])) ) for pair, count in adjacency.items() )
+
+class TestMeasureAllContacts(object):
+    def setUp(self):
+        # Blocky objects (with labels up to 9) that touch in all directions
+        numpy.random.seed(0)
+        coarse = numpy.random.randint( 0, 10, size=(4, 4, 4) ).astype( numpy.uint32 )
+        self.volume = coarse.repeat( 3, 0 ).repeat( 2, 1 ).repeat( 3, 2 )[:11, :, :10]
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.tempDir )
+
+    def _check(self, table, expected):
+        measured = dict( ( (row['label_a'], row['label_b']), (row['adjacency'], row['voxels_a'], row['voxels_b']) ) for row in table )
+        assert measured == expected, "Contact table doesn't match: {} != {}".format( measured, expected )
+        pairs = zip( table['label_a'], table['label_b'] )
+        assert pairs == sorted( pairs )
+
+    def testFaceConnectivity(self):
+        expected = brute_force_contacts( self.volume, measure_surface_contact.NEIGHBOR_OFFSETS['face'] )
+        for block_depth in (1, 2, 4, 64):
+            table = measure_surface_contact.measure_all_contacts( self.volume, 'face', block_depth )
+            self._check( table, expected )
+
+    def testEdgeConnectivity(self):
+        # voxels_a and voxels_b are what the pairwise measure_surface_contact_A() measures
+        expected = brute_force_contacts( self.volume, measure_surface_contact.NEIGHBOR_OFFSETS['edge'] )
+        for block_depth in (1, 3, 64):
+            table = measure_surface_contact.measure_all_contacts( self.volume, 'edge', block_depth )
+            self._check( table, expected )
+        for row in table:
+            assert row['voxels_b'] == measure_surface_contact.measure_surface_contact_A( self.volume, row['label_a'], row['label_b'] )
+            assert row['voxels_a'] == measure_surface_contact.measure_surface_contact_A( self.volume, row['label_b'], row['label_a'] )
+        assert measure_surface_contact.validate_contact_table( self.volume, table, num_pairs=len(table) ) == []
+
+    def testH5Dataset(self):
+        # A tzyxc dataset with singleton axes is read slab by slab
+        expected = measure_surface_contact.measure_all_contacts( self.volume, 'face' )
+        with h5py.File( os.path.join( self.tempDir, 'labels.h5' ), 'w' ) as f:
+            dataset = f.create_dataset( 'labels', data=self.volume[None, ..., None] )
+            for block_depth in (2, 64):
+                table = measure_surface_contact.measure_all_contacts( dataset, 'face', block_depth )
+                assert ( table == expected ).all()
+
+    def testUniqueCounts(self):
+        keys = numpy.array( [5, 3, 5, 1, 3, 5], dtype=numpy.int64 )
+        unique, counts = measure_surface_contact._unique_counts( keys )
+        assert list(unique) == [1, 3, 5]
+        assert list(counts) == [1, 2, 3]
+        unique, counts = measure_surface_contact._unique_counts( keys[:0] )
+        assert len(unique) == 0 and len(counts) == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
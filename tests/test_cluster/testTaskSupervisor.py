@@ -0,0 +1,244 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+import os
+import sys
+import shutil
+import time
+import tempfile
+import threading
+import collections
+
+import ilastik.ilastik_logging
+ilastik.ilastik_logging.default_config.init()
+
+from lazyflow.rtype import SubRegion
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+from ilastik.clusterOps import OpClusterize, TaskSupervisor, LocalTaskProcess, BackgroundTask
+
+class FakeBlockwiseFileset(object):
+    """
+    Stands in for a BlockwiseFileset.  Blocks become available when the (fake) workers say so.
+    """
+    def __init__(self):
+        self.available = set()
+        self.locked = set()
+
+    def getBlockStatus(self, blockstart):
+        if tuple(blockstart) in self.available:
+            return BlockwiseFileset.BLOCK_AVAILABLE
+        return BlockwiseFileset.BLOCK_NOT_AVAILABLE
+
+    def isBlockLocked(self, blockstart):
+        return tuple(blockstart) in self.locked
+
+class FakeTask(object):
+    """
+    A worker that finishes its block after a few polls, or dies (or hangs) instead.
+    """
+    def __init__(self, fileset, blockstart, behavior, polls=2):
+        self.fileset = fileset
+        self.blockstart = blockstart
+        self.behavior = behavior
+        self.remainingPolls = polls
+        self.killed = False
+
+    def poll(self):
+        if self.killed:
+            return -9
+        self.remainingPolls -= 1
+        if self.remainingPolls > 0 or self.behavior == 'hang':
+            self.fileset.locked.add( self.blockstart )
+            return None
+        self.fileset.locked.discard( self.blockstart )
+        if self.behavior == 'die':
+            return 1
+        self.fileset.available.add( self.blockstart )
+        return 0
+
+    def kill(self):
+        self.killed = True
+
+def makeTaskInfos(numTasks):
+    taskInfos = collections.OrderedDict()
+    for i in range(numTasks):
+        taskInfo = OpClusterize.TaskInfo()
+        taskInfo.taskName = "J{:02}".format(i)
+        taskInfo.command = taskInfo.taskName
+        taskInfo.subregions = [ SubRegion( None, start=(i*10, 0), stop=((i+1)*10, 10) ) ]
+        taskInfos[taskInfo.taskName] = taskInfo
+    return taskInfos
+
+class TestTaskSupervisor(object):
+
+    def setUp(self):
+        self.fileset = FakeBlockwiseFileset()
+        self.taskInfos = makeTaskInfos(6)
+        self.blockstarts = dict( (taskInfo.command, tuple(taskInfo.subregions[0].start)) for taskInfo in self.taskInfos.values() )
+        self.launches = collections.defaultdict(int)
+        self.tasks = []
+
+    def _launcher(self, behaviors={}):
+        def launch(command):
+            self.launches[command] += 1
+            behavior = behaviors.get( (command, self.launches[command]), 'finish' )
+            task = FakeTask( self.fileset, self.blockstarts[command], behavior )
+            self.tasks.append( task )
+            return task
+        return launch
+
+    def testConcurrencyLimit(self):
+        maxInFlight = [0]
+        launch = self._launcher()
+        def countingLaunch(command):
+            running = sum( 1 for t in self.tasks if not t.killed and t.blockstart not in self.fileset.available )
+            maxInFlight[0] = max( maxInFlight[0], running+1 )
+            return launch(command)
+
+        supervisor = TaskSupervisor( self.fileset, self.taskInfos, countingLaunch, maxConcurrentTasks=2, pollIntervalSecs=0.0 )
+        assert supervisor.run()
+        assert maxInFlight[0] == 2
+        assert len(supervisor.completedTasks) == 6
+        assert all( count == 1 for count in self.launches.values() )
+
+    def testRedispatchDeadWorker(self):
+        launch = self._launcher( { ('J01', 1) : 'die', ('J03', 1) : 'die', ('J03', 2) : 'die' } )
+        supervisor = TaskSupervisor( self.fileset, self.taskInfos, launch, pollIntervalSecs=0.0 )
+        assert supervisor.run()
+        assert self.launches['J00'] == 1
+        assert self.launches['J01'] == 2
+        assert self.launches['J03'] == 3
+        assert len(self.fileset.available) == 6
+
+    def testRedispatchStalledWorker(self):
+        launch = self._launcher( { ('J02', 1) : 'hang' } )
+        supervisor = TaskSupervisor( self.fileset, self.taskInfos, launch, taskTimeoutSecs=0.05, pollIntervalSecs=0.01 )
+        assert supervisor.run()
+        assert self.launches['J02'] == 2
+        stalled = [ t for t in self.tasks if t.behavior == 'hang' ]
+        assert len(stalled) == 1 and stalled[0].killed
+
+    def testGiveUpAfterRetries(self):
+        launch = self._launcher( { ('J04', 1) : 'die', ('J04', 2) : 'die' } )
+        supervisor = TaskSupervisor( self.fileset, self.taskInfos, launch, pollIntervalSecs=0.0, maxRetries=1 )
+        assert not supervisor.run()
+        assert self.launches['J04'] == 2
+        assert supervisor.failedTasks == [ 'J04' ]
+        assert len(supervisor.completedTasks) == 5
+
+    def testNonHandleLauncher(self):
+        # Like fabric.api.execute(), this launcher returns a {host: result} dict instead of a handle,
+        #  so lost tasks can only be detected via the timeout.
+        def launch(command):
+            self.launches[command] += 1
+            if (command, self.launches[command]) != ('J05', 1):
+                self.fileset.available.add( self.blockstarts[command] )
+            return { 'node' : None }
+        supervisor = TaskSupervisor( self.fileset, self.taskInfos, launch, taskTimeoutSecs=0.05, pollIntervalSecs=0.01 )
+        assert supervisor.run()
+        assert self.launches['J05'] == 2
+        assert all( self.launches[command] == 1 for command in self.launches if command != 'J05' )
+        assert len(supervisor.completedTasks) == 6
+
+    def testBackgroundTask(self):
+        # A blocking launch function (like fabric.api.execute()) runs in the background,
+        #  so the concurrency limit still applies and failures are detected when the function raises.
+        lock = threading.Lock()
+        running = [0]
+        maxRunning = [0]
+        def blockingLaunch(command):
+            with lock:
+                self.launches[command] += 1
+                attempt = self.launches[command]
+                running[0] += 1
+                maxRunning[0] = max( maxRunning[0], running[0] )
+            try:
+                time.sleep( 0.05 )
+                if (command, attempt) == ('J02', 1):
+                    raise SystemExit("remote command failed")
+                self.fileset.available.add( self.blockstarts[command] )
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        launch = lambda command: BackgroundTask( blockingLaunch, command )
+        supervisor = TaskSupervisor( self.fileset, self.taskInfos, launch, maxConcurrentTasks=3, pollIntervalSecs=0.01 )
+        assert supervisor.run()
+        assert maxRunning[0] == 3
+        assert self.launches['J02'] == 2
+        assert len(supervisor.completedTasks) == 6
+
+class TestLocalTaskProcess(object):
+    """
+    Run the supervisor with real local processes standing in for cluster nodes.
+    Each 'node' marks its block as finished by creating a file.
+    """
+    def setUp(self):
+        self.workingDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.workingDir )
+
+    def test(self):
+        workingDir = self.workingDir
+        class FileMarkerFileset(FakeBlockwiseFileset):
+            def getBlockStatus(self, blockstart):
+                if os.path.exists( os.path.join( workingDir, "{}.done".format( blockstart[0] ) ) ):
+                    return BlockwiseFileset.BLOCK_AVAILABLE
+                return BlockwiseFileset.BLOCK_NOT_AVAILABLE
+
+        taskInfos = makeTaskInfos(4)
+        for taskInfo in taskInfos.values():
+            blockstart = taskInfo.subregions[0].start
+            # The first task crashes on its first attempt.
+            crashFirst = "import os,sys; os.path.exists('J00.tried') or (open('J00.tried', 'w') and sys.exit(1)); " if blockstart[0] == 0 else ""
+            script = crashFirst + "open('{}.done', 'w')".format( blockstart[0] )
+            taskInfo.command = '{} -c "{}"'.format( sys.executable, script )
+
+        launch = lambda command: LocalTaskProcess( command, workingDir )
+        supervisor = TaskSupervisor( FileMarkerFileset(), taskInfos, launch, maxConcurrentTasks=2, pollIntervalSecs=0.1 )
+        assert supervisor.run()
+        assert os.path.exists( os.path.join( workingDir, 'J00.tried' ) )
+        assert len(supervisor.completedTasks) == 4
+
+class TestPackBlocks(object):
+    def test(self):
+        # Five full blocks and two half-size blocks at the edge of the volume
+        rois = [ ((i*10, 0), ((i+1)*10, 10)) for i in range(5) ]
+        rois += [ ((50, 0), (55, 10)), ((55, 0), (60, 10)) ]
+
+        packed = OpClusterize._packBlocks( rois, 1 )
+        assert len(packed) == 6, "Only the two half-size blocks should share a task"
+        assert packed[-1] == rois[-2:]
+
+        packed = OpClusterize._packBlocks( rois, 2 )
+        assert map( len, packed ) == [2, 2, 3]
+        assert sum( packed, [] ) == rois, "Blocks should keep their order"
+
+        packed = OpClusterize._packBlocks( rois, 100 )
+        assert packed == [ rois ]
+
+        assert OpClusterize._packBlocks( [], 2 ) == []
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)